@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# --- BEGIN_HEADER ---
+#
+# benchauthstate - benchmark of io daemon rate limit and session tracking
+# Copyright (C) 2003-2020  The MiG Project lead by Brian Vinter
+#
+# This file is part of MiG.
+#
+# MiG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# MiG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# -- END_HEADER ---
+#
+
+"""Measure the auth attempts per second the io daemons can sustain for the
+rate limit and session tracking part of a login storm. Each attempt checks
+and updates the rate limit and opens, counts and closes a session like
+grid_sftp does. A snapshot interval of 0 saves the pickle files on every
+update like the file based tracking did before the state store.
+"""
+
+import getopt
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import shared.griddaemons.statestore as statestore
+from shared.griddaemons.ratelimits import hit_rate_limit, \
+    update_rate_limit, expire_rate_limit
+from shared.griddaemons.sessions import track_open_session, \
+    track_close_session, active_sessions, clear_sessions
+
+
+class BenchConfiguration(object):
+    """Minimal configuration with just the values used by the state store"""
+
+    def __init__(self, run_dir, snapshot, address):
+        self.mig_system_run = run_dir
+        self.user_state_snapshot = snapshot
+        self.user_state_store = address
+        self.logger = logging.getLogger('benchauthstate')
+        self.logger.addHandler(logging.NullHandler())
+
+
+def usage(name='benchauthstate.py'):
+    """Usage help"""
+
+    print """Benchmark io daemon rate limit and session tracking.
+Usage:
+%(name)s [OPTIONS]
+Where OPTIONS may be one or more of:
+   -a ADDRESS          Use shared state store on unix socket ADDRESS
+   -h                  Show this help
+   -k KEYFILE          Use shared state store key in KEYFILE with -a
+   -n ATTEMPTS         Auth attempts per thread (default 1000)
+   -s INTERVALS        Comma separated snapshot intervals (default 0,60)
+   -t THREADS          Concurrent auth threads (default 8)
+""" % {'name': name}
+
+
+def auth_attempts(configuration, thread_no, attempts):
+    """Emulate attempts logins with every fourth one failing"""
+
+    proto = 'bench'
+    for i in xrange(attempts):
+        address = '10.0.%d.%d' % (thread_no, i % 250)
+        username = 'user-%d-%d@bench.org' % (thread_no, i % 50)
+        hit_rate_limit(configuration, proto, address, username)
+        success = i % 4 != 0
+        update_rate_limit(configuration, proto, address, username, success,
+                          secret='secret-%d' % i)
+        if not success:
+            continue
+        track_open_session(configuration, proto, username, address, i)
+        active_sessions(configuration, proto, username)
+        track_close_session(configuration, proto, username, address, i)
+
+
+def bench_store(configuration, threads, attempts):
+    """Run auth threads against the state store and return attempts/s"""
+
+    clear_sessions(configuration, 'bench')
+    expire_rate_limit(configuration, 'bench', fail_cache=0, expire_delay=0)
+    workers = [threading.Thread(target=auth_attempts,
+                                args=(configuration, i, attempts)) for i
+               in xrange(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * attempts / (time.time() - start)
+
+
+if '__main__' == __name__:
+    address = ''
+    key_path = ''
+    attempts = 1000
+    intervals = [0, 60]
+    threads = 8
+    opt_args = 'a:hk:n:s:t:'
+    try:
+        (opts, args) = getopt.getopt(sys.argv[1:], opt_args)
+    except getopt.GetoptError, err:
+        print 'Error: ', err.msg
+        usage()
+        sys.exit(1)
+
+    for (opt, val) in opts:
+        if opt == '-a':
+            address = val
+        elif opt == '-h':
+            usage()
+            sys.exit(0)
+        elif opt == '-k':
+            key_path = val
+        elif opt == '-n':
+            attempts = int(val)
+        elif opt == '-s':
+            intervals = [int(i) for i in val.split(',')]
+        elif opt == '-t':
+            threads = int(val)
+        else:
+            print 'Error: %s not supported!' % opt
+            usage()
+            sys.exit(1)
+
+    run_dir = tempfile.mkdtemp(prefix='benchauthstate-')
+    if key_path:
+        shutil.copy(key_path, os.path.join(run_dir,
+                                           statestore._state_store_key_name))
+    print 'Running %d threads with %d auth attempts each in %s' % \
+        (threads, attempts, run_dir)
+    print '  %-20s %14s' % ('snapshot interval', 'attempts/s')
+    for snapshot in intervals:
+        configuration = BenchConfiguration(run_dir, snapshot, address)
+        # Force fresh state store and snapshot timing for each run
+        statestore._store = None
+        statestore._last_snapshot.clear()
+        rate = bench_store(configuration, threads, attempts)
+        print '  %-20s %14.1f' % ('%ds' % snapshot, rate)
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# --- BEGIN_HEADER ---
+#
+# benchjobqueue - micro-benchmark of the grid_script job queue variants
+# Copyright (C) 2003-2020  The MiG Project lead by Brian Vinter
+#
+# This file is part of MiG.
+#
+# MiG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# MiG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# -- END_HEADER ---
+#
+
+"""Compare the plain list JobQueue with the IndexedJobQueue for a range of
+queue lengths. The list queue is prefilled directly since filling it through
+enqueue_job is quadratic and would take forever for the big sizes.
+"""
+
+import getopt
+import logging
+import random
+import sys
+import time
+
+from jobqueue import JobQueue, IndexedJobQueue, indexed_queue
+
+
+def usage(name='benchjobqueue.py'):
+    """Usage help"""
+
+    print """Benchmark job queue operations.
+Usage:
+%(name)s [OPTIONS]
+Where OPTIONS may be one or more of:
+   -h                  Show this help
+   -o OPS              Time OPS operations of each kind (default 100)
+   -s SIZES            Comma separated queue lengths (default 10000,100000,1000000)
+""" % {'name': name}
+
+
+def make_job(index):
+    """Build a minimal job dictionary"""
+
+    return {'JOB_ID': 'bench_job_%d' % index, 'STATUS': 'QUEUED'}
+
+
+def time_ops(func, args_list):
+    """Call func with each args tuple and return average usecs per call"""
+
+    start = time.time()
+    for args in args_list:
+        func(*args)
+    return (time.time() - start) * 1000000.0 / max(len(args_list), 1)
+
+
+def bench_queue(queue, size, ops):
+    """Run the operation mix on queue holding size jobs"""
+
+    results = []
+    new_jobs = [(make_job(size + i), queue.queue_length() + i) for i in
+                range(ops)]
+    results.append(('enqueue_job (append)',
+                    time_ops(queue.enqueue_job, new_jobs)))
+    indices = [(random.randint(0, size - 1), ) for _ in range(ops)]
+    results.append(('get_job', time_ops(queue.get_job, indices)))
+    ids = [('bench_job_%d' % random.randint(0, size - 1), ) for _ in
+           range(ops)]
+    results.append(('get_job_by_id', time_ops(queue.get_job_by_id, ids)))
+    victims = ['bench_job_%d' % i for i in random.sample(xrange(size), ops)]
+    results.append(('dequeue_job_by_id',
+                    time_ops(queue.dequeue_job_by_id,
+                             [(i, ) for i in victims])))
+    results.append(('dequeue_job (head)',
+                    time_ops(queue.dequeue_job, [(0, )] * ops)))
+    return results
+
+
+if '__main__' == __name__:
+    sizes = [10000, 100000, 1000000]
+    ops = 100
+    opt_args = 'ho:s:'
+    try:
+        (opts, args) = getopt.getopt(sys.argv[1:], opt_args)
+    except getopt.GetoptError, err:
+        print 'Error: ', err.msg
+        usage()
+        sys.exit(1)
+
+    for (opt, val) in opts:
+        if opt == '-h':
+            usage()
+            sys.exit(0)
+        elif opt == '-o':
+            ops = int(val)
+        elif opt == '-s':
+            sizes = [int(i) for i in val.split(',')]
+        else:
+            print 'Error: %s not supported!' % opt
+            usage()
+            sys.exit(1)
+
+    logger = logging.getLogger('benchjobqueue')
+    logger.addHandler(logging.NullHandler())
+    for size in sizes:
+        jobs = [make_job(i) for i in xrange(size)]
+        list_queue = JobQueue(logger)
+        list_queue.queue = jobs[:]
+        start = time.time()
+        index_queue = indexed_queue(list_queue, logger)
+        convert_time = time.time() - start
+        print 'Queue length %d (indexed fill took %.2fs):' % (size,
+                                                             convert_time)
+        list_results = bench_queue(list_queue, size, ops)
+        index_results = bench_queue(index_queue, size, ops)
+        print '  %-22s %14s %14s' % ('operation', 'list usec/op',
+                                      'indexed usec/op')
+        for ((name, list_usecs), (_, index_usecs)) in zip(list_results,
+                                                          index_results):
+            print '  %-22s %14.2f %14.2f' % (name, list_usecs, index_usecs)
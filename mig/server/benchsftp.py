@@ -0,0 +1,239 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# --- BEGIN_HEADER ---
+#
+# benchsftp - load test of concurrent sessions against the sftp daemon
+# Copyright (C) 2003-2020  The MiG Project lead by Brian Vinter
+#
+# This file is part of MiG.
+#
+# MiG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# MiG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# -- END_HEADER ---
+#
+
+"""Open a number of parallel SFTP sessions against a running grid_sftp
+daemon and report latency percentiles for login and a few simple
+operations in each session. Useful to measure how the daemon copes with
+many concurrent sync clients.
+With a transfer size each session instead uploads and downloads a file of
+that size and the upload and download throughput is reported. Useful to
+compare large file transfer speeds e.g. over loopback before and after
+daemon changes.
+"""
+
+import getopt
+import os
+import sys
+import threading
+import time
+
+try:
+    import paramiko
+except ImportError:
+    print "ERROR: the python paramiko module is required for this benchmark"
+    sys.exit(1)
+
+
+def usage(name='benchsftp.py'):
+    """Usage help"""
+
+    print """Load test grid_sftp with parallel sessions.
+Usage:
+%(name)s [OPTIONS] USERNAME
+Where OPTIONS may be one or more of:
+   -a ADDRESS          Daemon address (default localhost)
+   -f SIZE_MB          Transfer a SIZE_MB file up and down in each session
+   -h                  Show this help
+   -k KEY_PATH         Authenticate with private RSA key in KEY_PATH
+   -n SESSIONS         Number of parallel sessions (default 100)
+   -o OPERATIONS       Directory listings per session (default 10)
+   -p PORT             Daemon port (default 2222)
+   -P PASSWORD         Authenticate with PASSWORD
+""" % {'name': name}
+
+
+def percentile(values, percent):
+    """Returns the percent percentile of the sorted list values"""
+    if not values:
+        return 0.0
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def run_session(address, port, username, password, key, operations,
+                results):
+    """Open a single session and record login and operation latencies"""
+    start = time.time()
+    try:
+        transport = paramiko.Transport((address, port))
+        transport.connect(username=username, password=password, pkey=key)
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        results['login'].append(time.time() - start)
+        for _ in xrange(operations):
+            op_start = time.time()
+            sftp.listdir('.')
+            sftp.stat('.')
+            results['operation'].append(time.time() - op_start)
+        sftp.close()
+        transport.close()
+        results['session'].append(time.time() - start)
+    except Exception, exc:
+        results['errors'].append(str(exc))
+
+
+class ZeroFile(object):
+    """File-like object providing size bytes of zeros for uploads"""
+
+    def __init__(self, size):
+        self.remain = size
+        self.chunk = '\0' * 2**20
+
+    def read(self, size=-1):
+        if size < 0 or size > len(self.chunk):
+            size = len(self.chunk)
+        size = min(size, self.remain)
+        self.remain -= size
+        return self.chunk[:size]
+
+
+class NullFile(object):
+    """File-like object discarding downloaded data"""
+
+    def write(self, data):
+        pass
+
+
+def run_transfer(address, port, username, password, key, size, results):
+    """Open a single session and record upload and download throughput"""
+    remote_path = 'benchsftp-%d-%d.bin' % (os.getpid(),
+                                           threading.current_thread().ident)
+    try:
+        transport = paramiko.Transport((address, port))
+        transport.connect(username=username, password=password, pkey=key)
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        start = time.time()
+        sftp.putfo(ZeroFile(size), remote_path, file_size=size)
+        results['upload'].append(size / (time.time() - start) / 2**20)
+        start = time.time()
+        sftp.getfo(remote_path, NullFile())
+        results['download'].append(size / (time.time() - start) / 2**20)
+        sftp.remove(remote_path)
+        sftp.close()
+        transport.close()
+    except Exception, exc:
+        results['errors'].append(str(exc))
+
+
+def show_transfers(results, elapsed):
+    """Print throughput percentiles for the collected transfer results"""
+    print '  %-10s %8s %10s %10s %10s %10s' % ('MB/s', 'count', 'min',
+                                              'p50', 'p90', 'max')
+    for name in ('upload', 'download'):
+        values = sorted(results[name])
+        print '  %-10s %8d %10.1f %10.1f %10.1f %10.1f' % \
+            (name, len(values), percentile(values, 0),
+             percentile(values, 50), percentile(values, 90),
+             percentile(values, 100))
+    print '  %d sessions failed in %.1fs' % (len(results['errors']), elapsed)
+    for err in sorted(set(results['errors'])):
+        print '    %s' % err
+
+
+def show_results(results, elapsed):
+    """Print latency percentiles for the collected results"""
+    print '  %-10s %8s %10s %10s %10s %10s' % ('latency', 'count', 'p50 ms',
+                                              'p90 ms', 'p99 ms', 'max ms')
+    for name in ('login', 'operation', 'session'):
+        values = sorted(results[name])
+        print '  %-10s %8d %10.1f %10.1f %10.1f %10.1f' % \
+            (name, len(values), 1000 * percentile(values, 50),
+             1000 * percentile(values, 90), 1000 * percentile(values, 99),
+             1000 * percentile(values, 100))
+    print '  %d sessions failed in %.1fs' % (len(results['errors']), elapsed)
+    for err in sorted(set(results['errors'])):
+        print '    %s' % err
+
+
+if '__main__' == __name__:
+    address = 'localhost'
+    port = 2222
+    sessions = 100
+    operations = 10
+    transfer_size = 0
+    password = None
+    key = None
+    opt_args = 'a:f:hk:n:o:p:P:'
+    try:
+        (opts, args) = getopt.getopt(sys.argv[1:], opt_args)
+    except getopt.GetoptError, err:
+        print 'Error: ', err.msg
+        usage()
+        sys.exit(1)
+
+    for (opt, val) in opts:
+        if opt == '-a':
+            address = val
+        elif opt == '-f':
+            transfer_size = int(val) * 2**20
+        elif opt == '-h':
+            usage()
+            sys.exit(0)
+        elif opt == '-k':
+            key = paramiko.RSAKey.from_private_key_file(val)
+        elif opt == '-n':
+            sessions = int(val)
+        elif opt == '-o':
+            operations = int(val)
+        elif opt == '-p':
+            port = int(val)
+        elif opt == '-P':
+            password = val
+        else:
+            print 'Error: %s not supported!' % opt
+            usage()
+            sys.exit(1)
+
+    if len(args) != 1 or (password is None and key is None):
+        usage()
+        sys.exit(1)
+    username = args[0]
+
+    results = {'login': [], 'operation': [], 'session': [], 'upload': [],
+               'download': [], 'errors': []}
+    if transfer_size:
+        workers = [threading.Thread(target=run_transfer,
+                                    args=(address, port, username, password,
+                                          key, transfer_size, results)) for _
+                   in xrange(sessions)]
+        print 'Running %d parallel sessions with %dMB transfers on %s:%d' % \
+            (sessions, transfer_size / 2**20, address, port)
+    else:
+        workers = [threading.Thread(target=run_session,
+                                    args=(address, port, username, password,
+                                          key, operations, results)) for _
+                   in xrange(sessions)]
+        print 'Running %d parallel sessions with %d operations each on %s:%d' \
+            % (sessions, operations, address, port)
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if transfer_size:
+        show_transfers(results, time.time() - start)
+    else:
+        show_results(results, time.time() - start)
@@ -32,8 +32,11 @@ and trigger any associated actions based on rule database.
 Requires watchdog module (https://pypi.python.org/pypi/watchdog).
 """
 
+import errno
 import fnmatch
 import glob
+import heapq
+import mmap
 import logging
 import logging.handlers
 import os
@@ -44,12 +47,19 @@ import tempfile
 import time
 import threading
 import multiprocessing
+from array import array
+from collections import deque
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 
 try:
     from watchdog.observers import Observer
     from watchdog.events import PatternMatchingEventHandler, \
         FileModifiedEvent, FileCreatedEvent, FileDeletedEvent, \
-        DirModifiedEvent, DirCreatedEvent, DirDeletedEvent
+        FileMovedEvent, DirModifiedEvent, DirCreatedEvent, DirDeletedEvent, \
+        DirMovedEvent
+    from watchdog.utils.dirsnapshot import DirectorySnapshot, \
+        DirectorySnapshotDiff
 except ImportError:
     print 'ERROR: the python watchdog module is required for this daemon'
     sys.exit(1)
@@ -80,6 +90,7 @@ from shared.fileio import makedirs_rec, pickle, unpickle
 from shared.handlers import get_csrf_limit, make_csrf_token
 from shared.job import fill_mrsl_template, new_job
 from shared.logger import daemon_logger, register_hangup_handler
+from shared.metrics import counter, gauge, histogram, serve_metrics
 from shared.serial import load
 from shared.vgrid import vgrid_valid_entities, vgrid_add_workflow_jobs, \
     JOB_ID, JOB_CLIENT
@@ -104,6 +115,10 @@ shared_state['file_inotify'] = None
 shared_state['file_handler'] = None
 shared_state['rule_handler'] = None
 shared_state['rule_inotify'] = None
+shared_state['rule_index'] = None
+shared_state['rule_generation'] = 0
+shared_state['cold_poller'] = None
+shared_state['warmup_events'] = None
 
 # Only cache rule misses for one minute at a time to catch rule updates.
 # Run complete expire cycle if miss cache exceeds expire size.
@@ -111,6 +126,29 @@ shared_state['rule_inotify'] = None
 _miss_cache_ttl = 60
 _cache_expire_size = 10000
 
+# Compact dir cache file format with a header line, an array of dir mtimes
+# and the matching NUL separated relative dir paths sorted component-wise.
+# Dir cache generation and reconciliation and watch registration runs in
+# this many threads per monitor process. Watches are registered in batches
+# of dirs and dirs left without watches if max_user_watches is exhausted are
+# polled for changes at an interval instead. Events arriving while watches
+# are registered are buffered up to a limit and handled afterwards.
+
+_dir_cache_magic = 'MiG-dir-cache-1'
+_dir_cache_workers = 8
+_watch_batch_size = 1000
+_watch_progress_interval = 30
+_cold_poll_interval = 60
+_warmup_buffer_size = 100000
+_warmup_lock = threading.Lock()
+
+# File events for the same path and change are merged until none arrived for
+# the configured coalesce window or the first one waited this many windows.
+# Beyond the pending limit further events are handled right away.
+
+_coalesce_max_windows = 10
+_coalesce_max_pending = 100000
+
 # Rate limit helpers
 
 (_rate_limit_field, _settle_time_field) = ('rate_limit', 'settle_time')
@@ -129,6 +167,25 @@ _trigger_event = '_trigger_event'
 stop_running = multiprocessing.Event()
 (configuration, logger) = (None, None)
 
+# Metrics are per monitor process
+
+_events_handled = counter('events_total', 'File events handled',
+                          ('change', ))
+_triggers_fired = counter('event_triggers_total', 'Trigger rules fired',
+                          ('action', ))
+_run_handler_seconds = histogram('event_match_seconds', 'Run time of rule '
+                                 'matching for file events')
+_trigger_wait_seconds = histogram('event_trigger_wait_seconds', 'Time fired '
+                                  'triggers wait for a worker')
+_trigger_seconds = histogram('event_trigger_seconds', 'Run time of trigger '
+                             'handling including any settle time',
+                             ('action', ))
+_triggers_coalesced = counter('event_triggers_coalesced_total', 'Fired '
+                              'triggers merged into an identical pending one')
+_events_coalesced = counter('events_coalesced_total', 'File events merged '
+                            'into a later one for the same path and change',
+                            ('change', ))
+
 
 def stop_handler(sig, frame):
     """A simple signal handler to quit on Ctrl+C (SIGINT) in main"""
@@ -475,6 +532,579 @@ def run_command(
     #                                               ret_msg, txt_out))
 
 
+class RuleIndex(object):
+
+    """Precompiled index of the trigger rules in all_rules for fast matching
+    of event paths. Target paths without wildcards are looked up directly.
+    The remaining target paths are stored in a trie on the literal dir
+    components before their first wildcard, so that only targets with a
+    matching dir prefix are considered for a path. Each trie node holds the
+    regexps of its targets and a single combined regexp used to dismiss all
+    of them in one go on the common miss. Regexps are compiled on first use
+    and kept until the target path is removed.
+    """
+
+    _wildcards = re.compile(r'[*?[]')
+
+    def __init__(self, rules, generation, previous=None):
+        """Build index for rules dictionary mapping target paths to rule
+        lists. Compiled regexps are reused from any previous index.
+        """
+
+        self.generation = generation
+        self.exact = {}
+        self.root = [{}, [], None]
+        self.compiled = {}
+        if previous is not None:
+            old_compiled = previous.compiled
+        else:
+            old_compiled = {}
+        for (target_path, rule_list) in rules.items():
+            if not rule_list:
+                continue
+            wildcard = self._wildcards.search(target_path)
+            if wildcard is None:
+                self.exact[target_path] = rule_list
+                continue
+            regexps = old_compiled.get(target_path, None)
+            if regexps is None:
+
+                # Do not use ordinary fnmatch as it lets '*' match anything
+                # including '/' which leads to greedy matching in subdirs
+
+                recursive_regexp = fnmatch.translate(target_path)
+                regexps = [recursive_regexp, None, None]
+            self.compiled[target_path] = regexps
+            literal = target_path[:wildcard.start()]
+            node = self.root
+            for part in literal.split('/')[:-1]:
+                node = node[0].setdefault(part, [{}, [], None])
+            node[1].append((target_path, rule_list, regexps))
+
+    def __match_node(self, node, src_path, matches):
+        """Add targets in node matching src_path to matches"""
+
+        entries = node[1]
+        if len(entries) > 1:
+            combined = node[2]
+            if combined is None:
+                combined = node[2] = re.compile('|'.join(
+                    ['(?:%s)' % i[2][0] for i in entries]))
+            if not combined.match(src_path):
+                return
+        for (target_path, rule_list, regexps) in entries:
+            if regexps[1] is None:
+                direct_regexp = regexps[0].replace('.*', '[^/]*')
+                regexps[2] = re.compile(direct_regexp)
+                regexps[1] = re.compile(regexps[0])
+            if not regexps[1].match(src_path):
+                continue
+            direct_hit = regexps[2].match(src_path) is not None
+            matches.append((target_path, rule_list, direct_hit))
+
+    def match(self, src_path):
+        """Returns list of (target_path, rule_list, direct_hit) tuples for all
+        targets matching src_path. The direct_hit flag tells if the match
+        does not rely on wildcards matching across dirs.
+        """
+
+        matches = []
+        rule_list = self.exact.get(src_path, None)
+        if rule_list:
+            matches.append((src_path, rule_list, True))
+        node = self.root
+        self.__match_node(node, src_path, matches)
+        for part in src_path.split('/')[:-1]:
+            node = node[0].get(part, None)
+            if node is None:
+                break
+            if node[1]:
+                self.__match_node(node, src_path, matches)
+        return matches
+
+
+def get_rule_index():
+    """Returns RuleIndex for current all_rules. Rebuilt here after any
+    changes by MiGRuleEventHandler.update_rules.
+    """
+
+    rule_index = shared_state['rule_index']
+    generation = shared_state['rule_generation']
+    if rule_index is None or rule_index.generation != generation:
+        rule_index = RuleIndex(all_rules, generation, rule_index)
+        shared_state['rule_index'] = rule_index
+    return rule_index
+
+
+class TriggerWorkerPool(object):
+
+    """Bounded pool of worker threads handling fired trigger rules.
+    Pending triggers are queued per vgrid and per rule owner, and workers
+    always take the oldest trigger of the owner with the fewest running
+    triggers in the vgrid with the fewest running triggers. That way an
+    event storm in one vgrid or from one user can't starve the others.
+    A new trigger for the same path, change and rule as a pending one just
+    replaces the event of the pending one. Submit blocks while max_queued
+    triggers are pending, except in the workers themselves where chained
+    trigger events would otherwise risk a deadlock. Workers are started on
+    demand up to max_workers and exit after idle_timeout seconds without
+    triggers.
+    Triggers that need to wait e.g. for settle time are deferred to a single
+    timer thread, which queues them again once due, so that waiting never
+    holds a worker.
+    """
+
+    def __init__(self, handler, max_workers, max_queued, stop_running,
+                 idle_timeout=300):
+        """Init pool calling handler(event, target_path, rule) for each
+        trigger.
+        """
+
+        self.handler = handler
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.stop_running = stop_running
+        self.idle_timeout = idle_timeout
+        self.__cond = threading.Condition()
+        self.__local = threading.local()
+        self.__pending = {}
+        self.__entries = {}
+        self.__running = {}
+        self.__delayed = []
+        self.__timer = None
+        self.__sequence = 0
+        self.__workers = 0
+        self.__idle = 0
+
+    def __take(self):
+        """Remove and return the next pending entry by fair share.
+        The caller must hold the pool lock.
+        """
+
+        best = None
+        for (vgrid_name, owners) in self.__pending.items():
+            vgrid_running = self.__running.get(vgrid_name, 0)
+            for (owner, queue) in owners.items():
+                rank = (vgrid_running,
+                        self.__running.get((vgrid_name, owner), 0),
+                        queue[0][0])
+                if best is None or rank < best[0]:
+                    best = (rank, vgrid_name, owner)
+        (_, vgrid_name, owner) = best
+        owners = self.__pending[vgrid_name]
+        (_, key) = owners[owner].popleft()
+        if not owners[owner]:
+            del owners[owner]
+            if not owners:
+                del self.__pending[vgrid_name]
+        for name in (vgrid_name, (vgrid_name, owner)):
+            self.__running[name] = self.__running.get(name, 0) + 1
+        return (vgrid_name, owner, self.__entries.pop(key))
+
+    def __done(self, vgrid_name, owner):
+        """Update running counts after a trigger.
+        The caller must hold the pool lock.
+        """
+
+        for name in (vgrid_name, (vgrid_name, owner)):
+            self.__running[name] -= 1
+            if not self.__running[name]:
+                del self.__running[name]
+
+    def __worker(self):
+        """Handle pending triggers until idle for too long or stopped"""
+
+        pid = multiprocessing.current_process().pid
+        self.__local.worker = True
+        idle_since = time.time()
+        self.__cond.acquire()
+        try:
+            while not self.stop_running.is_set():
+                if not self.__entries:
+                    if idle_since + self.idle_timeout < time.time():
+                        break
+                    self.__idle += 1
+                    self.__cond.wait(1)
+                    self.__idle -= 1
+                    continue
+                (vgrid_name, owner, entry) = self.__take()
+                (event, target_path, rule, queued, args) = entry
+
+                # Wake any submitters waiting for room in the queue
+
+                self.__cond.notify_all()
+                self.__cond.release()
+                try:
+                    _trigger_wait_seconds.observe(time.time() - queued)
+                    with _trigger_seconds.time(action=rule['action']):
+                        self.handler(event, target_path, rule, *args)
+                except Exception, exc:
+                    logger.error('(%s) trigger %s for %s failed: %s'
+                                 % (pid, rule['rule_id'], event.src_path,
+                                    exc))
+                self.__cond.acquire()
+                self.__done(vgrid_name, owner)
+                idle_since = time.time()
+        finally:
+            self.__workers -= 1
+            self.__cond.release()
+
+    def __enqueue(self, key, event, target_path, rule, args=()):
+        """Add pending trigger entry with key and start a worker for it if
+        needed. The caller must hold the pool lock.
+        """
+
+        pid = multiprocessing.current_process().pid
+        self.__sequence += 1
+        self.__entries[key] = [event, target_path, rule, time.time(), args]
+        owners = self.__pending.setdefault(rule['vgrid_name'], {})
+        owners.setdefault(rule['run_as'], deque()).append(
+            (self.__sequence, key))
+        if self.__idle >= len(self.__entries) or \
+                self.__workers >= self.max_workers:
+            self.__cond.notify()
+            return
+        try:
+            worker = threading.Thread(target=self.__worker)
+            worker.daemon = True
+            worker.start()
+            self.__workers += 1
+        except threading.ThreadError, exc:
+
+            # Leave the trigger to the running workers
+
+            logger.warning('(%s) could not start trigger worker: %s'
+                           % (pid, exc))
+            self.__cond.notify()
+
+    def __wake_delayed(self):
+        """Queue deferred triggers as they become due until stopped"""
+
+        self.__cond.acquire()
+        try:
+            while not self.stop_running.is_set():
+                if not self.__delayed:
+                    self.__cond.wait(1)
+                    continue
+                now = time.time()
+                due = self.__delayed[0][0]
+                if due > now:
+                    self.__cond.wait(min(due - now, 1))
+                    continue
+                (_, sequence, event, target_path, rule, args) = \
+                    heapq.heappop(self.__delayed)
+
+                # Unique key as deferred triggers must never be merged
+
+                key = (event.src_path, event.event_type, rule['vgrid_name'],
+                       rule['rule_id'], sequence)
+                self.__enqueue(key, event, target_path, rule, args)
+        finally:
+            self.__timer = None
+            self.__cond.release()
+
+    def defer(self, delay, event, target_path, rule, *args):
+        """Queue trigger of rule for event after delay seconds. The handler
+        is called with any extra args after the usual ones.
+        """
+
+        self.__cond.acquire()
+        try:
+            self.__sequence += 1
+            heapq.heappush(self.__delayed, (time.time() + delay,
+                                            self.__sequence, event,
+                                            target_path, rule, args))
+            if self.__timer is None:
+                self.__timer = threading.Thread(target=self.__wake_delayed)
+                self.__timer.daemon = True
+                self.__timer.start()
+            self.__cond.notify_all()
+        finally:
+            self.__cond.release()
+
+    def submit(self, event, target_path, rule):
+        """Queue trigger of rule for event. Returns False if it was merged
+        into an identical pending trigger and True otherwise.
+        """
+
+        key = (event.src_path, event.event_type, rule['vgrid_name'],
+               rule['rule_id'])
+        in_worker = getattr(self.__local, 'worker', False)
+        self.__cond.acquire()
+        try:
+            while True:
+                entry = self.__entries.get(key, None)
+                if entry is not None:
+                    entry[:3] = [event, target_path, rule]
+                    _triggers_coalesced.inc()
+                    return False
+                if in_worker or len(self.__entries) < self.max_queued or \
+                        self.stop_running.is_set():
+                    break
+                self.__cond.wait(1)
+            self.__enqueue(key, event, target_path, rule)
+            return True
+        finally:
+            self.__cond.release()
+
+    def pending(self):
+        """Returns the number of pending and deferred triggers"""
+
+        self.__cond.acquire()
+        try:
+            return len(self.__entries) + len(self.__delayed)
+        finally:
+            self.__cond.release()
+
+
+class EventCoalescer(object):
+
+    """Merge file events for the same path and change before rule matching.
+    Each file upload or write produces a storm of modified events and only
+    the last one in a burst needs to trigger anything. An event is passed on
+    to handler once no further events for the same path and change arrived
+    within window seconds. Events keep their own time stamp, so settle time
+    and rate limits still apply to the merged event.
+    """
+
+    def __init__(self, handler, window, stop_running):
+        """Init coalescer calling handler(event) for each merged event"""
+
+        self.handler = handler
+        self.window = window
+        self.max_delay = window * _coalesce_max_windows
+        self.stop_running = stop_running
+        self.__cond = threading.Condition()
+        self.__pending = {}
+        self.__deadlines = []
+        self.__flusher = None
+
+    def __deadline(self, entry):
+        """Returns the time when entry should be passed on"""
+
+        (_, first_seen, last_seen) = entry
+        return min(last_seen + self.window, first_seen + self.max_delay)
+
+    def __flush(self):
+        """Pass on pending events as their deadlines pass until stopped"""
+
+        pid = multiprocessing.current_process().pid
+        self.__cond.acquire()
+        try:
+            while not self.stop_running.is_set():
+                if not self.__deadlines:
+                    self.__cond.wait(1)
+                    continue
+                (deadline, key) = self.__deadlines[0]
+                now = time.time()
+                if deadline > now:
+                    self.__cond.wait(min(deadline - now, 1))
+                    continue
+                heapq.heappop(self.__deadlines)
+
+                # Later events moved the deadline of the entry
+
+                deadline = self.__deadline(self.__pending[key])
+                if deadline > now:
+                    heapq.heappush(self.__deadlines, (deadline, key))
+                    continue
+                (event, _, _) = self.__pending.pop(key)
+                self.__cond.notify_all()
+                self.__cond.release()
+                try:
+                    self.handler(event)
+                except Exception, exc:
+                    logger.error('(%s) handling %s event for %s failed: %s'
+                                 % (pid, event.event_type, event.src_path,
+                                    exc))
+                self.__cond.acquire()
+        finally:
+            self.__cond.release()
+
+    def add(self, event):
+        """Merge time stamped event into any pending one for the same path
+        and change. Moves are only merged with moves to the same target.
+        The event is passed on to handler right away if the pending limit is
+        reached.
+        """
+
+        key = (event.src_path, event.event_type,
+               getattr(event, 'dest_path', None))
+        self.__cond.acquire()
+        try:
+            entry = self.__pending.get(key, None)
+            if entry is not None:
+                entry[0] = event
+                entry[2] = event.time_stamp
+                _events_coalesced.inc(change=event.event_type)
+                return
+            full = len(self.__pending) >= _coalesce_max_pending
+            if not full:
+                entry = self.__pending[key] = [event, event.time_stamp,
+                                               event.time_stamp]
+                heapq.heappush(self.__deadlines, (self.__deadline(entry),
+                                                  key))
+                if self.__flusher is None:
+                    self.__flusher = threading.Thread(target=self.__flush)
+                    self.__flusher.daemon = True
+                    self.__flusher.start()
+                self.__cond.notify()
+        finally:
+            self.__cond.release()
+
+        # Handle directly in the calling thread to slow down event delivery
+
+        if full:
+            self.handler(event)
+
+    def pending(self):
+        """Returns the number of pending events"""
+
+        return len(self.__pending)
+
+
+class ColdDirPoller(threading.Thread):
+
+    """Poll dirs that could not get an inotify watch because the
+    max_user_watches limit was reached. Each dir is compared to a snapshot of
+    its entries every interval seconds and file events for the changes are
+    dispatched to the file handler as if they came from inotify.
+    """
+
+    def __init__(self, interval):
+        """Init poller thread"""
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.__lock = threading.Lock()
+        self.__snapshots = {}
+
+    def add(self, path):
+        """Start polling *path*"""
+
+        try:
+            snapshot = DirectorySnapshot(path, recursive=False)
+        except OSError:
+            return
+        self.__lock.acquire()
+        try:
+            self.__snapshots.setdefault(path, snapshot)
+        finally:
+            self.__lock.release()
+
+    def polled(self):
+        """Returns the number of polled dirs"""
+
+        return len(self.__snapshots)
+
+    def __poll(self, path, old_snapshot):
+        """Dispatch events for changes in path since old_snapshot and return
+        new snapshot or None if path is gone.
+        """
+
+        try:
+            snapshot = DirectorySnapshot(path, recursive=False)
+        except OSError:
+            return None
+        diff = DirectorySnapshotDiff(old_snapshot, snapshot)
+        events = []
+        for (paths, event_class) in [
+                (diff.dirs_deleted, DirDeletedEvent),
+                (diff.files_deleted, FileDeletedEvent),
+                (diff.dirs_created, DirCreatedEvent),
+                (diff.files_created, FileCreatedEvent),
+                (diff.dirs_modified, DirModifiedEvent),
+                (diff.files_modified, FileModifiedEvent)]:
+            events += [event_class(i) for i in paths]
+        for (src_path, dest_path) in diff.dirs_moved:
+            events.append(DirMovedEvent(src_path, dest_path))
+        for (src_path, dest_path) in diff.files_moved:
+            events.append(FileMovedEvent(src_path, dest_path))
+        for event in events:
+            shared_state['file_handler'].dispatch(event)
+        return snapshot
+
+    def run(self):
+        """Poll all dirs until stopped"""
+
+        pid = multiprocessing.current_process().pid
+        while not stop_running.is_set():
+            stop_running.wait(self.interval)
+            self.__lock.acquire()
+            snapshots = self.__snapshots.items()
+            self.__lock.release()
+            for (path, old_snapshot) in snapshots:
+                try:
+                    snapshot = self.__poll(path, old_snapshot)
+                except Exception, exc:
+                    logger.error('(%s) polling %s failed: %s' % (pid, path,
+                                                                exc))
+                    continue
+                self.__lock.acquire()
+                if snapshot is None:
+                    self.__snapshots.pop(path, None)
+                else:
+                    self.__snapshots[path] = snapshot
+                self.__lock.release()
+
+
+def poll_cold_dir(path):
+    """Poll *path* for changes instead of watching it with inotify"""
+
+    _warmup_lock.acquire()
+    try:
+        if shared_state['cold_poller'] is None:
+            shared_state['cold_poller'] = ColdDirPoller(_cold_poll_interval)
+            shared_state['cold_poller'].start()
+    finally:
+        _warmup_lock.release()
+    shared_state['cold_poller'].add(path)
+
+
+def start_warmup():
+    """Start buffering file events until stop_warmup is called"""
+
+    _warmup_lock.acquire()
+    shared_state['warmup_events'] = deque()
+    _warmup_lock.release()
+
+
+def buffer_warmup_event(event):
+    """Buffer *event* if file monitors are still warming up. Returns True if
+    the event was buffered and False if it should be handled right away.
+    """
+
+    _warmup_lock.acquire()
+    try:
+        buffered = shared_state['warmup_events']
+        if buffered is None or len(buffered) >= _warmup_buffer_size:
+            return False
+        buffered.append(event)
+        return True
+    finally:
+        _warmup_lock.release()
+
+
+def stop_warmup(handler):
+    """Handle all buffered file events in order with *handler* including any
+    arriving meanwhile and stop buffering. Returns the number of events.
+    """
+
+    handled = 0
+    while True:
+        _warmup_lock.acquire()
+        buffered = shared_state['warmup_events']
+        if not buffered:
+            shared_state['warmup_events'] = None
+            _warmup_lock.release()
+            return handled
+        event = buffered.popleft()
+        _warmup_lock.release()
+        handler.process_event(event)
+        handled += 1
+
+
 class MiGRuleEventHandler(PatternMatchingEventHandler):
 
     """Rule pattern-matching event handler to take care of VGrid rule changes
@@ -615,6 +1245,10 @@ class MiGRuleEventHandler(PatternMatchingEventHandler):
                 all_rules[abs_path] = all_rules.get(abs_path, []) \
                     + [entry]
 
+            # Make sure the rule index is rebuilt on next use
+
+            shared_state['rule_generation'] += 1
+
             # logger.debug('(%s) all rules:\n%s' % (pid, all_rules))
         # else:
         #    logger.debug('(%s) %s skipping _NON_ rule file: %s' % (pid,
@@ -655,6 +1289,15 @@ class MiGFileEventHandler(PatternMatchingEventHandler):
                                              ignore_patterns,
                                              ignore_directories,
                                              case_sensitive)
+        self.trigger_pool = TriggerWorkerPool(
+            self.__handle_trigger, configuration.workflows_trigger_workers,
+            configuration.workflows_trigger_queue_size, stop_running)
+        if configuration.workflows_event_coalesce_window > 0:
+            self.coalescer = EventCoalescer(
+                self.__match_event,
+                configuration.workflows_event_coalesce_window, stop_running)
+        else:
+            self.coalescer = None
 
     def __workflow_log(
         self,
@@ -769,24 +1412,17 @@ class MiGFileEventHandler(PatternMatchingEventHandler):
 
         return result
 
-    def __handle_trigger(
-        self,
-        event,
-        target_path,
-        rule,
-    ):
-        """Actually handle valid trigger for a specific event and the
-        corresponding target_path pattern and trigger rule.
+    def __trigger_allowed(self, event, rule):
+        """Check settle time and rate limit of rule for event and update the
+        rule hits. Returns True if the trigger should proceed and False if it
+        should be skipped.
         """
 
         pid = multiprocessing.current_process().pid
         state = event.event_type
         src_path = event.src_path
         time_stamp = event.time_stamp
-        _chain = getattr(event, '_chain', [(src_path, state)])
         rel_src = src_path[shared_state['base_dir_len']:].lstrip(os.sep)
-        vgrid_prefix = os.path.join(
-            shared_state['base_dir'], rule['vgrid_name'])
         logger.info('(%s) in handling of %s for %s %s' %
                     (pid, rule['action'], state, rel_src))
         above_limit = False
@@ -818,20 +1454,52 @@ class MiGFileEventHandler(PatternMatchingEventHandler):
             self.__workflow_info(configuration, rule['vgrid_name'],
                                  'skip %s modified access time only event'
                                  % rel_src)
-            return
+            return False
 
         # Always update here to get trigger hits even for limited events
 
         update_rule_hits(rule, src_path, state, '', time_stamp)
         if above_limit:
-            return
+            return False
         logger.info('(%s) proceed with handling of %s for %s %s'
                     % (pid, rule['action'], state, rel_src))
         self.__workflow_info(configuration, rule['vgrid_name'],
                              'handle %s for %s %s' % (rule['action'],
                                                       state, rel_src))
+        return True
+
+    def __handle_trigger(
+        self,
+        event,
+        target_path,
+        rule,
+        settle_stamp=None,
+    ):
+        """Actually handle valid trigger for a specific event and the
+        corresponding target_path pattern and trigger rule.
+        The settle_stamp is set when the trigger was deferred to wait for
+        events to settle and is the time to check settle time against.
+        """
+
+        pid = multiprocessing.current_process().pid
+        state = event.event_type
+        src_path = event.src_path
+        _chain = getattr(event, '_chain', [(src_path, state)])
+        rel_src = src_path[shared_state['base_dir_len']:].lstrip(os.sep)
+        vgrid_prefix = os.path.join(
+            shared_state['base_dir'], rule['vgrid_name'])
         settle_secs = extract_time_in_secs(rule, _settle_time_field)
-        if settle_secs > 0.0:
+        if settle_stamp is not None:
+
+            # Limits were already checked before trigger was deferred
+
+            time_stamp = settle_stamp
+            wait_secs = wait_settled(rule, src_path, state, settle_secs,
+                                     time_stamp)
+        elif not self.__trigger_allowed(event, rule):
+            return
+        elif settle_secs > 0.0:
+            time_stamp = event.time_stamp
             wait_secs = settle_secs
         else:
             wait_secs = 0.0
@@ -839,20 +1507,17 @@ class MiGFileEventHandler(PatternMatchingEventHandler):
             # logger.debug('(%s) no settle time for %s (%s)' % (pid,
             #             target_path, rule))
 
-        while wait_secs > 0.0:
+        # Check again later without holding a trigger worker meanwhile
+
+        if wait_secs > 0.0:
             logger.info('(%s) wait %.1fs for %s file events to settle down'
                         % (pid, wait_secs, src_path))
             self.__workflow_info(configuration, rule['vgrid_name'],
                                  'wait %.1fs for events on %s to settle'
                                  % (wait_secs, rel_src))
-            time.sleep(wait_secs)
-
-            # logger.debug('(%s) slept %.1fs for %s file events to settle down'
-            #              % (pid, wait_secs, src_path))
-
-            time_stamp += wait_secs
-            wait_secs = wait_settled(rule, src_path, state,
-                                     settle_secs, time_stamp)
+            self.trigger_pool.defer(wait_secs, event, target_path, rule,
+                                    time_stamp + wait_secs)
+            return
 
         # TODO: perhaps we should discriminate on files and dirs here?
         # TODO: logger does not actually work here, only __workflow_X logs
@@ -1024,12 +1689,12 @@ class MiGFileEventHandler(PatternMatchingEventHandler):
 
             if os.path.exists(src_path) and os.path.isdir(src_path):
                 try:
-                    vgrid_dir_cache[rel_path] = {}
+                    vgrid_dir_cache[rel_path] = 0
                     rel_path_ctime = os.path.getctime(src_path)
                     rel_path_mtime = os.path.getmtime(src_path)
                     add_vgrid_file_monitor_watch(configuration,
                                                  rel_path)
-                    vgrid_dir_cache[rel_path]['mtime'] = rel_path_mtime
+                    vgrid_dir_cache[rel_path] = rel_path_mtime
 
                     # Check if sub paths or files were changed
                     # For create this occurs by eg. mkdir -p 'path/subpath/subpath2'
@@ -1040,9 +1705,8 @@ class MiGFileEventHandler(PatternMatchingEventHandler):
                             vgrid_sub_path = ent.path[
                                 shared_state['base_dir_len']:]
 
-                            if not vgrid_sub_path in \
-                                    vgrid_dir_cache.keys() or \
-                                    vgrid_dir_cache[vgrid_sub_path]['mtime'] \
+                            if not vgrid_sub_path in vgrid_dir_cache or \
+                                    vgrid_dir_cache[vgrid_sub_path] \
                                     < rel_path_ctime:
 
                                 # logger.debug('(%s) %s -> Dispatch DirCreatedEvent for: %s'
@@ -1150,101 +1814,74 @@ class MiGFileEventHandler(PatternMatchingEventHandler):
 
         # Each target_path pattern has one or more rules associated
 
-        for (target_path, rule_list) in all_rules.items():
-
-            # Do not use ordinary fnmatch as it lets '*' match anything
-            # including '/' which leads to greedy matching in subdirs
-
-            recursive_regexp = fnmatch.translate(target_path)
-            direct_regexp = recursive_regexp.replace('.*', '[^/]*')
-            recursive_hit = re.match(recursive_regexp, src_path)
-            direct_hit = re.match(direct_regexp, src_path)
-
-            if direct_hit or recursive_hit:
+        matches = get_rule_index().match(src_path)
+        for (target_path, rule_list, direct_hit) in matches:
 
-                # logger.debug('(%s) matched %s for %s and/or %s' % (pid,
-                #             src_path, direct_regexp, recursive_regexp))
+            # logger.debug('(%s) matched %s for %s (direct: %s)' % (pid,
+            #             src_path, target_path, direct_hit))
 
-                for rule in rule_list:
+            for rule in rule_list:
 
-                    # Rules may listen for only file or dir events and with
-                    # recursive directory search
+                # Rules may listen for only file or dir events and with
+                # recursive directory search
 
-                    if is_directory and not rule.get('match_dirs',
-                                                     False):
+                if is_directory and not rule.get('match_dirs',
+                                                 False):
 
-                        # logger.debug('(%s) skip event %s handling for dir: %s'
-                        #              % (pid, rule['rule_id'], src_path))
+                    # logger.debug('(%s) skip event %s handling for dir: %s'
+                    #              % (pid, rule['rule_id'], src_path))
 
-                        continue
-                    if not is_directory and not rule.get('match_files',
-                                                         True):
-
-                        # logger.debug('(%s) skip %s event handling for file: %s'
-                        #             % (pid, rule['rule_id'], src_path))
-
-                        continue
-                    if not direct_hit and not rule.get('match_recursive',
-                                                       False):
+                    continue
+                if not is_directory and not rule.get('match_files',
+                                                     True):
 
-                        # logger.debug('(%s) skip %s recurse event handling for: %s'
-                        #              % (pid, rule['rule_id'], src_path))
+                    # logger.debug('(%s) skip %s event handling for file: %s'
+                    #             % (pid, rule['rule_id'], src_path))
 
-                        continue
-                    if not state in rule['changes']:
+                    continue
+                if not direct_hit and not rule.get('match_recursive',
+                                                   False):
 
-                        # logger.debug('(%s) skip %s %s event handling for: %s'
-                        #         % (pid, rule['rule_id'], state,
-                        #        src_path))
+                    # logger.debug('(%s) skip %s recurse event handling for: %s'
+                    #              % (pid, rule['rule_id'], src_path))
 
-                        continue
+                    continue
+                if not state in rule['changes']:
 
-                    # IMPORTANT: keep this vgrid access check last!
-                    # It is far more computationally expensive than the simple
-                    # checks above. We particularly want to filter the common
-                    # storm of events from the system_imagesettings_dir_deleted
-                    # trigger for '*' but only on dirs, before it gets here.
+                    # logger.debug('(%s) skip %s %s event handling for: %s'
+                    #         % (pid, rule['rule_id'], state,
+                    #        src_path))
 
-                    # User may have been removed from vgrid - log and ignore
+                    continue
 
-                    # logger.debug('(%s) check valid user %s in %s for %s' % \
-                    #              (pid, rule['run_as'], rule['vgrid_name'],
-                    #               rule['rule_id']))
+                # IMPORTANT: keep this vgrid access check last!
+                # It is far more computationally expensive than the simple
+                # checks above. We particularly want to filter the common
+                # storm of events from the system_imagesettings_dir_deleted
+                # trigger for '*' but only on dirs, before it gets here.
 
-                    if not check_vgrid_access(configuration, rule['run_as'],
-                                              rule['vgrid_name']):
-                        logger.warning('(%s) no such user in vgrid: %s'
-                                       % (pid, rule['run_as']))
-                        continue
+                # User may have been removed from vgrid - log and ignore
 
-                    logger.info('(%s) trigger %s for src_path: %s -> %s'
-                                % (pid, rule['action'], src_path,
-                                    rule))
+                # logger.debug('(%s) check valid user %s in %s for %s' % \
+                #              (pid, rule['run_as'], rule['vgrid_name'],
+                #               rule['rule_id']))
 
-                    rule_hit = True
+                if not check_vgrid_access(configuration, rule['run_as'],
+                                          rule['vgrid_name']):
+                    logger.warning('(%s) no such user in vgrid: %s'
+                                   % (pid, rule['run_as']))
+                    continue
 
-                    # TODO: Replace try/catch with an event queue or thread
-                    #       pool setup
+                logger.info('(%s) trigger %s for src_path: %s -> %s'
+                            % (pid, rule['action'], src_path,
+                                rule))
 
-                    waiting_for_thread_resources = True
-                    while waiting_for_thread_resources:
-                        try:
-                            worker = \
-                                threading.Thread(target=self.__handle_trigger,
-                                                 args=(event, target_path, rule))
-                            worker.daemon = True
-                            worker.start()
-                            waiting_for_thread_resources = False
-                        except threading.ThreadError, exc:
+                rule_hit = True
+                _triggers_fired.inc(action=rule['action'])
 
-                            # logger.debug('(%s) Waiting for thread resources to handle trigger: %s'
-                            #              % (pid, str(event)))
+                # Blocks here if the trigger workers are too far behind
 
-                            time.sleep(1)
-
-            # else:
-            #    logger.debug('(%s) skip %s with no matching rules'
-            #                 % (pid, target_path))
+                self.trigger_pool.submit(event, target_path, rule)
 
         # Finally update rule miss cache for this event
 
@@ -1258,17 +1895,34 @@ class MiGFileEventHandler(PatternMatchingEventHandler):
         values obtained deeply in handling calls.
         """
 
-        pid = multiprocessing.current_process().pid
-
         event.time_stamp = time.time()
 
+        # Events are buffered while the file monitors are warming up
+
+        if buffer_warmup_event(event):
+            return
+        self.process_event(event)
+
+    def process_event(self, event):
+        """Update file monitor and run handler for time stamped event"""
+
         # Update file_monitor and dir cache
 
         self.__update_file_monitor(event)
 
-        # Run event handler
+        # Run event handler once events for the path and change settle
 
-        self.run_handler(event)
+        _events_handled.inc(change=event.event_type)
+        if self.coalescer is not None:
+            self.coalescer.add(event)
+        else:
+            self.__match_event(event)
+
+    def __match_event(self, event):
+        """Run handler for event"""
+
+        with _run_handler_seconds.time():
+            self.run_handler(event)
 
     def on_modified(self, event):
         """Handle modified files"""
@@ -1299,15 +1953,29 @@ class MiGFileEventHandler(PatternMatchingEventHandler):
 
 
 def add_vgrid_file_monitor_watch(configuration, path):
-    """Adds file inotify watch for *path*"""
+    """Adds file inotify watch for *path*. Falls back to polling *path* if
+    the max_user_watches limit is reached. Returns True if *path* got a watch
+    and False otherwise.
+    """
 
     pid = multiprocessing.current_process().pid
 
-    vgrid_files_path = os.path.join(configuration.vgrid_files_home,
-                                    path)
+    vgrid_files_path = force_utf8(os.path.join(configuration.vgrid_files_home,
+                                               path))
+
+    if not shared_state['file_inotify']._wd_for_path.has_key(
+            vgrid_files_path):
+        try:
+            shared_state['file_inotify'].add_watch(vgrid_files_path)
+        except OSError, exc:
+            if exc.errno != errno.ENOSPC:
+                raise
 
-    if not shared_state['file_inotify']._wd_for_path.has_key(path):
-        shared_state['file_inotify'].add_watch(force_utf8(vgrid_files_path))
+            # logger.debug('(%s) Polling %s without watch' % (pid,
+            #             vgrid_files_path))
+
+            poll_cold_dir(vgrid_files_path)
+            return False
     else:
 
         # logger.debug('(%s) Adding watch for: %s' % (pid,
@@ -1338,13 +2006,12 @@ def add_vgrid_file_monitor(configuration, vgrid_name, path):
         vgrid_files_path_mtime = os.path.getmtime(vgrid_files_path)
 
         # NOTE: make sure cache entry always gets initialized before use
-        vgrid_dir_cache[path] = vgrid_dir_cache.get(path, {})
-        vgrid_dir_cache[path]['mtime'] = vgrid_dir_cache[path].get('mtime', 0)
+        vgrid_dir_cache[path] = vgrid_dir_cache.get(path, 0)
 
         try:
             add_vgrid_file_monitor_watch(configuration, path)
 
-            if vgrid_files_path_mtime != vgrid_dir_cache[path]['mtime']:
+            if vgrid_files_path_mtime != vgrid_dir_cache[path]:
 
                 # Traverse dirs for subdirs created since last run
 
@@ -1354,12 +2021,12 @@ def add_vgrid_file_monitor(configuration, vgrid_name, path):
                             shared_state['base_dir_len']:]
                         # Force utf8 everywhere to avoid encoding issues
                         vgrid_sub_path = force_utf8(vgrid_sub_path)
-                        if not vgrid_sub_path in vgrid_dir_cache.keys():
+                        if not vgrid_sub_path in vgrid_dir_cache:
                             retval &= add_vgrid_file_monitor(configuration,
                                                              vgrid_name,
                                                              vgrid_sub_path)
 
-                vgrid_dir_cache[path]['mtime'] = vgrid_files_path_mtime
+                vgrid_dir_cache[path] = vgrid_files_path_mtime
         except OSError, exc:
             # If we get an OSError, src_path was most likely deleted
             # after os.path.exists check or somehow not accessible
@@ -1374,34 +2041,147 @@ def add_vgrid_file_monitor(configuration, vgrid_name, path):
 
 def add_vgrid_file_monitors(configuration, vgrid_name):
     """Add file monitors for all dirs and subdirs for *vgrid_name*, using the
-    global dir_cache.
+    global dir_cache. The dirs are handled in batches by a pool of threads
+    with the most recently modified dirs first. So if max_user_watches is
+    exhausted it is the least active dirs that are left to polling.
     """
 
     pid = multiprocessing.current_process().pid
 
     vgrid_dir_cache = dir_cache[vgrid_name]
 
-    vgrid_dir_cache_keys = vgrid_dir_cache.keys()
-    for path in vgrid_dir_cache_keys:
-        # Make sure we only have utf8 everywhere to avoid encoding issues
-        path = force_utf8(path)
-        vgrid_files_path = os.path.join(configuration.vgrid_files_home,
-                                        path)
-        if os.path.exists(vgrid_files_path):
-            add_vgrid_file_monitor(configuration, vgrid_name, path)
-        else:
+    vgrid_dir_cache_keys = sorted(vgrid_dir_cache.keys(), key=lambda i:
+                                  vgrid_dir_cache.get(i, 0), reverse=True)
+    total = len(vgrid_dir_cache_keys)
+    batches = [vgrid_dir_cache_keys[i:i + _watch_batch_size] for i in
+               xrange(0, total, _watch_batch_size)]
+    progress = {'done': 0, 'reported': time.time()}
+    progress_lock = threading.Lock()
+
+    def add_batch(batch):
+        """Add file monitors for dirs in batch and report progress"""
+        for path in batch:
+            # Make sure we only have utf8 everywhere to avoid encoding issues
+            path = force_utf8(path)
+            vgrid_files_path = os.path.join(configuration.vgrid_files_home,
+                                            path)
+            if os.path.exists(vgrid_files_path):
+                add_vgrid_file_monitor(configuration, vgrid_name, path)
+            else:
 
-            # logger.debug('(%s) Removing deleted dir: %s from dir_cache'
-            #             % (pid, path))
-
-            del vgrid_dir_cache[path]
+                # logger.debug('(%s) Removing deleted dir: %s from dir_cache'
+                #             % (pid, path))
 
+                vgrid_dir_cache.pop(path, None)
+        progress_lock.acquire()
+        try:
+            progress['done'] += len(batch)
+            now = time.time()
+            if progress['reported'] + _watch_progress_interval < now:
+                progress['reported'] = now
+                logger.info('(%s) added file monitors for %d of %d dirs in %s'
+                            % (pid, progress['done'], total, vgrid_name))
+        finally:
+            progress_lock.release()
+
+    _parallel_map(add_batch, batches)
+    if shared_state['cold_poller'] is not None:
+        logger.warning('(%s) polling %d dirs without inotify watches after '
+                       'reaching max_user_watches' %
+                       (pid, shared_state['cold_poller'].polled()))
     return True
 
 
+def _parallel_map(func, items):
+    """Returns list of func applied to each of items using a pool of
+    _dir_cache_workers threads. The file system calls of func release the GIL
+    so threads are enough to overlap the I/O.
+    """
+
+    if len(items) < 2:
+        return map(func, items)
+    pool = ThreadPool(min(_dir_cache_workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _subtree_key(path):
+    """Returns the top-level subtree of the vgrid dir in *path* relative to
+    vgrid_files_home. That is, the vgrid root and its immediate subdirs.
+    """
+
+    return os.sep.join(path.split(os.sep, 2)[:2])
+
+
+def _scan_dir_tree(configuration, path):
+    """Returns dictionary mapping the dir in *path* relative to
+    vgrid_files_home and all dirs below it to their mtime.
+    """
+
+    base_dir_len = shared_state['base_dir_len']
+    abs_path = os.path.join(configuration.vgrid_files_home, path)
+    found = {}
+    try:
+        found[path] = os.path.getmtime(abs_path)
+    except OSError:
+        return found
+    for (root, dir_names, _) in walk(abs_path, followlinks=True):
+        for dir_name in dir_names:
+            dir_path = os.path.join(root, dir_name)
+            try:
+                found[force_utf8(dir_path[base_dir_len:])] = \
+                    os.path.getmtime(dir_path)
+            except OSError:
+
+                # Removed during the walk
+
+                continue
+    return found
+
+
+def _reconcile_dir_tree(configuration, vgrid_dir_cache, entries):
+    """Check cached dirs in *entries* list of (path, mtime) tuples against the
+    file system. Only dirs with changed mtime are scanned for new subdirs,
+    which are then added along with all dirs below them.
+    Returns a tuple with a dictionary of new or changed dirs and their mtime
+    and a list of removed dirs. Only reads vgrid_dir_cache so that subtrees
+    can be reconciled in parallel.
+    """
+
+    base_dir_len = shared_state['base_dir_len']
+    changed = {}
+    removed = []
+    for (path, mtime) in entries:
+        abs_path = os.path.join(configuration.vgrid_files_home, path)
+        try:
+            if not os.path.isdir(abs_path):
+                removed.append(path)
+                continue
+            cur_mtime = os.path.getmtime(abs_path)
+            if cur_mtime == mtime:
+                continue
+            changed[path] = cur_mtime
+            for ent in scandir(abs_path):
+                if not ent.is_dir(follow_symlinks=True):
+                    continue
+                sub_path = force_utf8(ent.path[base_dir_len:])
+                if not sub_path in vgrid_dir_cache and \
+                        not sub_path in changed:
+                    changed.update(_scan_dir_tree(configuration, sub_path))
+        except OSError:
+
+            # Removed after the isdir check
+
+            removed.append(path)
+    return (changed, removed)
+
+
 def generate_vgrid_dir_cache(configuration, vgrid_base_path):
     """Generate directory cache for *vgrid_base_path*, using the global
-    dir_cache.
+    dir_cache. The top-level subtrees are walked in parallel.
     """
 
     pid = multiprocessing.current_process().pid
@@ -1416,32 +2196,110 @@ def generate_vgrid_dir_cache(configuration, vgrid_base_path):
 
     # Add VGrid root to directory cache
 
-    vgrid_dir_cache[vgrid_base_path] = {}
-    vgrid_dir_cache[vgrid_base_path]['mtime'] = \
-        os.path.getmtime(vgrid_path)
-
-    # logger.debug('(%s) Updating dir_cache %s: %s' % (pid,
-    #             vgrid_base_path,
-    #             vgrid_dir_cache[vgrid_base_path]['mtime']))
+    vgrid_dir_cache[vgrid_base_path] = os.path.getmtime(vgrid_path)
 
     # Add VGrid subdirs to directory cache
 
-    for (root, dir_names, _) in walk(vgrid_path, followlinks=True):
-        for dir_name in dir_names:
-            dir_path = os.path.join(root, dir_name)
-            dir_cache_path = dir_path[shared_state['base_dir_len']:]
+    top_dirs = [force_utf8(ent.path[shared_state['base_dir_len']:]) for ent
+                in scandir(vgrid_path) if ent.is_dir(follow_symlinks=True)]
+    for found in _parallel_map(lambda path: _scan_dir_tree(configuration,
+                                                            path), top_dirs):
+        for (dir_cache_path, mtime) in found.items():
             if not vgrid_dir_cache.has_key(dir_cache_path):
-                vgrid_dir_cache[dir_cache_path] = {}
-                vgrid_dir_cache[dir_cache_path]['mtime'] = \
-                    os.path.getmtime(dir_path)
-
-                # logger.debug('(%s) Updating dir_cache %s: %s' % (pid,
-                #             dir_cache_path,
-                #             vgrid_dir_cache[dir_cache_path]['mtime']))
+                vgrid_dir_cache[dir_cache_path] = mtime
 
+    logger.info('(%s) generated dir cache for %s with %d dirs' %
+                (pid, vgrid_base_path, len(vgrid_dir_cache)))
     return True
 
 
+def reconcile_dir_cache(configuration, vgrid_name):
+    """Update the loaded directory cache for *vgrid_name* in the global
+    dir_cache with any changes on disk since it was saved. The top-level
+    subtrees are checked in parallel and only dirs with changed mtime are
+    rescanned. Returns the number of changed and removed dirs.
+    """
+
+    pid = multiprocessing.current_process().pid
+    reconcile_t1 = time.time()
+    vgrid_dir_cache = dir_cache[vgrid_name]
+    subtrees = {}
+    for (path, mtime) in vgrid_dir_cache.items():
+        subtrees.setdefault(_subtree_key(path), []).append((path, mtime))
+    results = _parallel_map(lambda entries: _reconcile_dir_tree(
+        configuration, vgrid_dir_cache, entries), subtrees.values())
+    updates = 0
+    for (changed, removed) in results:
+        vgrid_dir_cache.update(changed)
+        for path in removed:
+            vgrid_dir_cache.pop(path, None)
+        updates += len(changed) + len(removed)
+    logger.info('(%s) reconciled dir cache for %s with %d dirs in %d '
+                'subtrees: %d updates in %.1fs' %
+                (pid, vgrid_name, len(vgrid_dir_cache), len(subtrees),
+                 updates, time.time() - reconcile_t1))
+    return updates
+
+
+def read_dir_cache(path):
+    """Read dir cache in the compact format from *path*. Returns dictionary
+    mapping relative dir paths to mtime or None if the file is not in that
+    format. The mtime array and paths are sliced directly out of a read-only
+    memory map of the file.
+    """
+
+    cache_fd = open(path, 'rb')
+    try:
+        if os.fstat(cache_fd.fileno()).st_size <= len(_dir_cache_magic):
+            return None
+        cache_map = mmap.mmap(cache_fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if cache_map[:len(_dir_cache_magic)] != _dir_cache_magic:
+                return None
+            header_end = cache_map.find('\n')
+            (_, count, byteorder) = cache_map[:header_end].split(' ')
+            count = int(count)
+            mtimes = array('d')
+            start = header_end + 1
+            end = start + count * mtimes.itemsize
+            mtimes.fromstring(cache_map[start:end])
+            if count:
+                paths = cache_map[end:].split('\0')
+            else:
+                paths = []
+        finally:
+            cache_map.close()
+    finally:
+        cache_fd.close()
+    if byteorder != sys.byteorder:
+        mtimes.byteswap()
+    if len(paths) != count:
+        raise ValueError('truncated dir cache with %d of %d paths' %
+                         (len(paths), count))
+    return dict(izip(paths, mtimes))
+
+
+def write_dir_cache(vgrid_dir_cache, path):
+    """Write *vgrid_dir_cache* to *path* in the compact format. Paths are
+    sorted component-wise so that each subtree is a contiguous range.
+    """
+
+    entries = dict([(force_utf8(i), j) for (i, j) in
+                    vgrid_dir_cache.items()])
+    paths = sorted(entries, key=lambda i: i.replace(os.sep, '\0'))
+    mtimes = array('d', [entries[i] for i in paths])
+    tmp_path = '%s.%d' % (path, os.getpid())
+    cache_fd = open(tmp_path, 'wb')
+    try:
+        cache_fd.write('%s %d %s\n' % (_dir_cache_magic, len(paths),
+                                        sys.byteorder))
+        cache_fd.write(mtimes.tostring())
+        cache_fd.write('\0'.join(paths))
+    finally:
+        cache_fd.close()
+    os.rename(tmp_path, path)
+
+
 def load_dir_cache(configuration, vgrid_name):
     """Load directory cache for *vgrid_name*, into the global dir_cache"""
 
@@ -1458,38 +2316,44 @@ def load_dir_cache(configuration, vgrid_name):
     # logger.debug('(%s) loading dir cache for: %s from: %s' % (pid,
     #             vgrid_name, vgrid_dir_cache_filename))
 
-    # Load dir cache or generate new cache
+    # Load and reconcile dir cache or generate new cache
 
+    generate_cache = True
+    legacy_format = False
     if os.path.exists(vgrid_dir_cache_filepath):
+        try:
+            loaded_dir_cache = read_dir_cache(vgrid_dir_cache_filepath)
+        except Exception, exc:
+            loaded_dir_cache = False
+            logger.error('(%s) Failed to read vgrid_dir_cache for: %s from '
+                         'file: %s (%s)' % (pid, vgrid_name,
+                                            vgrid_dir_cache_filepath, exc))
+        if loaded_dir_cache is None:
+
+            # Migrate legacy pickled cache with a dictionary for each dir
+            # Make sure we only have utf8 everywhere to avoid encoding issues
 
-        # cache_t1 = time.time()
-
-        loaded_dir_cache = unpickle(vgrid_dir_cache_filepath, logger,
-                                    allow_missing=False)
-
-        # cache_t2 = time.time()
-        # logger.debug('(%s) Loaded vgrid_dir_cache for: %s in %s secs'
-        #             % (pid, vgrid_name, str(cache_t2 - cache_t1)))
+            legacy_dir_cache = unpickle(vgrid_dir_cache_filepath, logger,
+                                        allow_missing=False)
+            if legacy_dir_cache is False:
+                loaded_dir_cache = False
+            else:
+                logger.info('(%s) converting legacy vgrid_dir_cache for: %s'
+                            % (pid, vgrid_name))
+                legacy_format = True
+                loaded_dir_cache = dict(
+                    [(force_utf8(path), entry.get('mtime', 0)) for
+                     (path, entry) in legacy_dir_cache.items()])
 
         if loaded_dir_cache is False:
-            generate_cache = True
             logger.error('(%s) Failed to load vgrid_dir_cache for: %s from file: %s'
                          % (pid, vgrid_name, vgrid_dir_cache_filepath))
         else:
             generate_cache = False
-            # TODO: once all caches are migrated we can remove this loop again
-            # Make sure we only have utf8 everywhere to avoid encoding issues
-            for old_path in [i for i in loaded_dir_cache.keys() if
-                             isinstance(i, unicode)]:
-                print "NOTE: forcing old cache entry %s to utf8" % [old_path]
-                new_path = force_utf8(old_path)
-                entry = loaded_dir_cache[old_path]
-                del loaded_dir_cache[old_path]
-                loaded_dir_cache[new_path] = entry
-
             dir_cache[vgrid_name] = loaded_dir_cache
-    else:
-        generate_cache = True
+            if reconcile_dir_cache(configuration, vgrid_name) or \
+                    legacy_format:
+                result = save_dir_cache(vgrid_name)
 
     if generate_cache:
         logger.info('(%s) Force generation of vgrid_dir_cache for: %s' %
@@ -1534,7 +2398,12 @@ def save_dir_cache(vgrid_name):
         else:
             logger.info('(%s) saving cache for: %s to file: %s' %
                         (pid, vgrid_name, dir_cache_filepath))
-            pickle(vgrid_dir_cache, dir_cache_filepath, logger)
+            try:
+                write_dir_cache(vgrid_dir_cache, dir_cache_filepath)
+            except Exception, exc:
+                logger.error('(%s) could not save cache for: %s: %s' %
+                             (pid, vgrid_name, exc))
+                result = False
 
     return result
 
@@ -1575,6 +2444,27 @@ def monitor(configuration, vgrid_name):
     # Allow e.g. logrotate to force log re-open after rotates
     register_hangup_handler(configuration)
 
+    monitor_state = gauge('event_monitor', 'Loaded trigger targets and '
+                          'cached dirs', ('item', ))
+    monitor_state.set_function(lambda: len(all_rules), item='targets')
+    monitor_state.set_function(lambda: len(dir_cache.get(vgrid_name, {})),
+                               item='dirs')
+    monitor_state.set_function(
+        lambda: shared_state['file_handler'].trigger_pool.pending(),
+        item='pending_triggers')
+    monitor_state.set_function(
+        lambda: shared_state['file_handler'].coalescer.pending(),
+        item='pending_events')
+    monitor_state.set_function(
+        lambda: len(shared_state['file_inotify']._wd_for_path),
+        item='watched_dirs')
+    monitor_state.set_function(lambda: shared_state['cold_poller'].polled(),
+                               item='polled_dirs')
+    if vgrid_name == '.':
+        serve_metrics(configuration, 'events')
+    else:
+        serve_metrics(configuration, 'events-%s' % vgrid_name)
+
     # Monitor rule configurations
 
     if vgrid_name == '.':
@@ -1697,8 +2587,12 @@ def monitor(configuration, vgrid_name):
                 # Start paths in vgrid_dir_cache to monitor
                 print '(%s) init trigger handling for: %s' % (pid, vgrid_name)
                 add_monitor_t1 = time.time()
+                start_warmup()
                 add_vgrid_file_monitors(configuration, vgrid_name)
+                buffered = stop_warmup(shared_state['file_handler'])
                 add_monitor_t2 = time.time()
+                logger.info('(%s) handled %d events buffered during warm-up '
+                            'of %s' % (pid, buffered, vgrid_name))
                 print '(%s) ready to handle triggers for: %s in %s secs' \
                       % (pid, vgrid_name, add_monitor_t2 - add_monitor_t1)
                 logger.info('(%s) ready to handle triggers for: %s in %s secs'
@@ -96,9 +96,11 @@ from shared.griddaemons.ftps import default_max_user_hits, \
     default_max_secret_hits, default_username_validator, \
     get_fs_path, acceptable_chmod, refresh_user_creds, refresh_share_creds, \
     update_login_map, login_map_lookup, hit_rate_limit, expire_rate_limit, \
-    check_twofactor_session, validate_auth_attempt
+    check_twofactor_session, validate_auth_attempt, AuthCache, \
+    init_creds_watcher, init_twofactor_index
 from shared.tlsserver import hardened_openssl_context
 from shared.logger import daemon_logger, register_hangup_handler
+from shared.metrics import counter, serve_metrics
 from shared.pwhash import make_scramble
 from shared.useradm import check_password_hash
 from shared.validstring import possible_user_id, possible_sharelink_id
@@ -106,6 +108,30 @@ from shared.validstring import possible_user_id, possible_sharelink_id
 
 configuration, logger = None, None
 
+_ftps_files = counter('ftps_files_total', 'Files transferred over ftps',
+                      ('direction', ))
+_ftps_bytes = counter('ftps_bytes_total', 'Bytes in files transferred over '
+                      'ftps', ('direction', ))
+
+
+def _count_transfer(path, direction):
+    """Count completed transfer of file in path"""
+    _ftps_files.inc(direction=direction)
+    try:
+        _ftps_bytes.inc(os.path.getsize(path), direction=direction)
+    except OSError:
+        pass
+
+
+def _on_file_sent(handler, path):
+    """Count downloads"""
+    _count_transfer(path, 'sent')
+
+
+def _on_file_received(handler, path):
+    """Count uploads"""
+    _count_transfer(path, 'received')
+
 
 class MiGTLSFTPHandler(TLS_FTPHandler):
     """Hardened version of TLS_FTPHandler to fix
@@ -230,6 +256,9 @@ class MiGUserAuthorizer(DummyAuthorizer):
             self.last_expire = time.time()
             expire_rate_limit(configuration, "ftps", 
                 expire_delay=self.min_expire_delay)
+            daemon_conf['hash_cache'].expire()
+            logger.debug("hash cache stats: %s" %
+                         daemon_conf['hash_cache'].stats())
         if hit_rate_limit(configuration, 'ftps', client_ip, username,
                           max_user_hits=max_user_hits):
             exceeded_rate_limit = True
@@ -444,6 +473,9 @@ def start_service(conf):
     #    handler.masquerade_address = socket.gethostbyname(
     #        configuration.user_ftps_show_address)
     handler.passive_ports = conf.user_ftps_pasv_ports
+    handler.on_file_sent = _on_file_sent
+    handler.on_file_received = _on_file_received
+    serve_metrics(configuration, 'ftps')
     server = ThreadedFTPServer((conf.user_ftps_address,
                                 conf.user_ftps_ctrl_port),
                                handler)
@@ -508,10 +540,12 @@ unless it is available in mig/server/MiGserver.conf
         'user_alias': configuration.user_ftps_alias,
         # No creds locking needed here due to central auth
         'creds_lock': None,
-        'users': [],
-        'shares': [],
+        'users': {},
+        'shares': {},
         'login_map': {},
-        'hash_cache': {},
+        'hash_cache': AuthCache(),
+        'creds_watcher': init_creds_watcher(configuration),
+        'twofactor_index': init_twofactor_index(configuration),
         'time_stamp': 0,
         'logger': logger,
         'nossl': nossl,
@@ -86,9 +86,10 @@ from shared.griddaemons.openid import default_max_user_hits, \
     default_user_abuse_hits, default_proto_abuse_hits, \
     default_username_validator, refresh_user_creds, update_login_map, \
     login_map_lookup, hit_rate_limit, expire_rate_limit, \
-    validate_auth_attempt
+    validate_auth_attempt, init_creds_watcher
 from shared.html import openid_page_template
 from shared.logger import daemon_logger, register_hangup_handler
+from shared.metrics import histogram, timed, serve_metrics
 from shared.pwhash import make_scramble
 from shared.safeinput import valid_distinguished_name, valid_password, \
     valid_path, valid_ascii, valid_job_id, valid_base_url, valid_url, \
@@ -100,6 +101,9 @@ from shared.validstring import possible_user_id
 
 configuration, logger = None, None
 
+_request_seconds = histogram('openid_request_seconds', 'Run time of openid '
+                             'requests', ('method', ))
+
 # Update with extra fields
 cert_field_map.update({'role': 'ROLE', 'timezone': 'TZ', 'nickname': 'NICK',
                        'fullname': 'CN', 'o': 'O', 'ou': 'OU'})
@@ -323,6 +327,7 @@ class ServerHandler(BaseHTTPRequestHandler):
         self.password = None
         self.login_expire = None
 
+    @timed(_request_seconds, label='method')
     def do_GET(self):
         """Handle all HTTP GET requests"""
         # Make sure key is always available for exception handler
@@ -398,6 +403,7 @@ if this persistently happens.
 </p>"""
             self.showErrorPage(err_msg, error_code=500)
 
+    @timed(_request_seconds, label='method')
     def do_POST(self):
         """Handle all HTTP POST requests"""
         try:
@@ -1448,6 +1454,7 @@ def start_service(configuration):
         httpserver.socket.accept = types.MethodType(
             limited_accept, httpserver.socket)
 
+    serve_metrics(configuration, 'openid')
     serve_msg = 'Server running at: %s' % httpserver.base_url
     logger.info(serve_msg)
     print serve_msg
@@ -1553,8 +1560,9 @@ i4HdbgS6M21GvqIfhN2NncJ00aJukr5L29JrKFgSCPP9BDRb9Jgy0gu1duhTv0C0
         'allow_publickey': 'publickey' in configuration.user_openid_auth,
         'user_alias': configuration.user_openid_alias,
         'host_rsa_key': host_rsa_key,
-        'users': [],
+        'users': {},
         'login_map': {},
+        'creds_watcher': init_creds_watcher(configuration),
         'time_stamp': 0,
         'logger': logger,
         'nossl': nossl,
@@ -35,9 +35,11 @@ import threading
 import os
 import signal
 import copy
+import Queue
+from collections import deque
 
 import jobscriptgenerator
-from jobqueue import JobQueue
+from jobqueue import IndexedJobQueue, indexed_queue
 from shared.base import client_id_dir, generate_https_urls
 from shared.conf import get_configuration_object, get_resource_exe
 from shared.defaults import default_vgrid, maxfill_fields
@@ -46,7 +48,9 @@ from shared.fileio import pickle, unpickle, unpickle_and_change_status, \
 from shared.gridscript import clean_grid_stdin, \
     remove_jobrequest_pending_files, check_mrsl_files, requeue_job, \
     server_cleanup, load_queue, save_queue, load_schedule_cache, \
-    save_schedule_cache, arc_job_status, clean_arc_job
+    save_schedule_cache, arc_job_status, clean_arc_job, open_grid_stdin, \
+    read_grid_stdin, open_queue_journal
+from shared.metrics import gauge, histogram, serve_metrics
 from shared.notification import notify_user_thread
 from shared.resadm import atomic_resource_exe_restart, put_exe_pgid
 from shared.vgrid import job_fits_res_vgrid, validated_vgrid_list
@@ -61,6 +65,26 @@ except ImportError, ime:
 (job_queue, executing_queue, scheduler) = (None, None, None)
 (job_time_out_thread, job_time_out_stop) = (None, None)
 
+# Messages are handled concurrently by a pool of dispatch workers so all
+# access to shared state must hold the matching lock:
+# scheduler_lock protects the scheduler including the attached job and done
+# queues, whereas executing_lock protects the executing queue. Always take
+# scheduler_lock before executing_lock when both are needed to avoid
+# deadlocks.
+# Messages with the same job or resource exe key are handled strictly in
+# arrival order: each key has a FIFO of tickets in pending_tickets and only
+# items at the head of all their key FIFOs go on the ready queue for the
+# workers, so workers never wait for other items. Both pending_tickets and
+# pending_items are guarded by pending_cond.
+# Jobs taken from the job queue by a resource request stay in scheduled_jobs
+# guarded by scheduler_lock until they are in the executing queue, so that
+# a concurrent cancel can mark them instead of getting lost.
+
+(scheduler_lock, executing_lock) = (threading.RLock(), threading.RLock())
+(pending_tickets, pending_items, pending_cond) = ({}, {},
+                                                  threading.Condition())
+scheduled_jobs = {}
+
 def hangup_handler(signal, frame):
     """A simple signal handler to force configuration reload and log reopening
     on SIGHUP.
@@ -98,22 +122,20 @@ def time_out_jobs(stop_event):
                 time.sleep(1)
                 continue
 
-            qlen = executing_queue.queue_length()
+            # Work on a snapshot of the executing jobs to avoid racing with
+            # the dispatch workers, which may modify executing_queue at any
+            # time. Jobs removed in the meantime are just skipped.
+
+            with executing_lock:
+                qlen = executing_queue.queue_length()
+                exec_jobs = [executing_queue.get_job(i) for i in
+                             range(qlen)]
             if qlen == 0:
                 logger.info('No jobs in executing_queue')
             else:
                 logger.info('time_out_jobs(): %d job(s) in queue' % qlen)
 
-                # TODO: this is a race - 'Main' may modify executing_queue at
-                # any time!
-                # Especially since we ask it to remove the job we just looked
-                # at and then look at the next index, so we may skip jobs
-                # if it removes the job before we dequeue next index.
-                # We should use locking or at least remove from back to
-                # make it slightly better.
-
-                for i in range(0, qlen):
-                    job = executing_queue.get_job(i)
+                for (i, job) in enumerate(exec_jobs):
                     if not job:
                         logger.warning(
                             'time-out RC? found empty job in slot %d!' % i)
@@ -178,8 +200,9 @@ def time_out_jobs(stop_event):
                                 msg = '(failed inside ARC)'
                             else:
                                 msg = None
-                            exec_job = executing_queue.dequeue_job_by_id(
-                                job['JOB_ID'])
+                            with executing_lock:
+                                exec_job = executing_queue.dequeue_job_by_id(
+                                    job['JOB_ID'])
                             if exec_job:
                                 # job was still there, clean up here
                                 # (otherwise, someone else picked it up in
@@ -222,6 +245,8 @@ def graceful_shutdown():
 
         job_time_out_thread.join(5)
         print 'graceful_shutdown: saving state'
+        scheduler_lock.acquire()
+        executing_lock.acquire()
         if job_queue and not save_queue(job_queue, job_queue_path,
                 logger):
             logger.warning('failed to save job queue')
@@ -231,6 +256,8 @@ def graceful_shutdown():
         if scheduler and not save_schedule_cache(scheduler.get_cache(),
                 schedule_cache_path, logger):
             logger.warning('failed to save scheduler cache')
+        executing_lock.release()
+        scheduler_lock.release()
         print 'graceful_shutdown: saved state; now blocking for timeout thread'
 
         # Now make sure timeout thread finishes
@@ -242,173 +269,146 @@ def graceful_shutdown():
     sys.exit(0)
 
 
-# ## Main ###
-# register ctrl+c signal handler to shutdown system cleanly
-
-signal.signal(signal.SIGINT, clean_shutdown)
-
-# Allow e.g. logrotate to force log re-open after rotates
-signal.signal(signal.SIGHUP, hangup_handler)
-
-configuration = get_configuration_object()
-logger = configuration.logger
-
-if not configuration.site_enable_jobs:
-    err_msg = "Job support is disabled in configuration!"
-    logger.error(err_msg)
-    print err_msg
-    sys.exit(1)
-    
-print """
-Running main grid 'daemon'.
-
-Set the MIG_CONF environment to the server configuration path
-unless it is available in the default path
-mig/server/MiGserver.conf
-"""
-logger.info('Starting MiG server')
-
-# Load queues from file dump if available
-
-job_queue_path = os.path.join(configuration.mig_system_files,
-                              'job_queue.pickle')
-executing_queue_path = os.path.join(configuration.mig_system_files,
-                                    'executing_queue.pickle')
-schedule_cache_path = os.path.join(configuration.mig_system_files,
-                                   'schedule_cache.pickle')
-only_new_jobs = True
-job_queue = load_queue(job_queue_path, logger)
-executing_queue = load_queue(executing_queue_path, logger)
-if not job_queue or not executing_queue:
-    logger.warning('Could not load queues from previous run')
-    only_new_jobs = False
-    job_queue = JobQueue(logger)
-    executing_queue = JobQueue(logger)
-else:
-    logger.info('Loaded queues from previous run')
-
-# Always use an empty done queue after restart
-
-done_queue = JobQueue(logger)
-
-schedule_cache = load_schedule_cache(schedule_cache_path, logger)
-if not schedule_cache:
-    logger.warning('Could not load schedule cache from previous run')
-else:
-    logger.info('Loaded schedule cache from previous run')
-
-logger.info('starting scheduler ' + configuration.sched_alg)
-if configuration.sched_alg == 'FirstFit':
-    from firstfitscheduler import FirstFitScheduler
-    scheduler = FirstFitScheduler(logger, configuration)
-elif configuration.sched_alg == 'BestFit':
-    from bestfitscheduler import BestFitScheduler
-    scheduler = BestFitScheduler(logger, configuration)
-elif configuration.sched_alg == 'FairFit':
-    from fairfitscheduler import FairFitScheduler
-    scheduler = FairFitScheduler(logger, configuration)
-elif configuration.sched_alg == 'MaxThroughput':
-    from maxthroughputscheduler import MaxThroughputScheduler
-    scheduler = MaxThroughputScheduler(logger, configuration)
-elif configuration.sched_alg == 'Random':
-    from randomscheduler import RandomScheduler
-    scheduler = RandomScheduler(logger, configuration)
-elif configuration.sched_alg == 'FIFO':
-    from fifoscheduler import FIFOScheduler
-    scheduler = FIFOScheduler(logger, configuration)
-else:
-    from firstfitscheduler import FirstFitScheduler
-    print 'Unknown sched_alg %s - using FirstFit scheduler'\
-         % configuration.sched_alg
-    scheduler = FirstFitScheduler(logger, configuration)
-
-scheduler.attach_job_queue(job_queue)
-scheduler.attach_done_queue(done_queue)
-if schedule_cache:
-    scheduler.set_cache(schedule_cache)
-
-# redirect grid_stdin to sys.stdin
+def load_user_job(strip_line):
+    """Load the job from a USERJOBFILE message and prepare it for the job
+    queue. ARC jobs are submitted directly and put in the executing queue
+    here. Returns the job if it should go into the job queue and None
+    otherwise.
+    """
 
-try:
-    if not os.path.exists(configuration.grid_stdin):
-        logger.info('creating grid_script input pipe %s'
-                     % configuration.grid_stdin)
-        try:
-            os.mkfifo(configuration.grid_stdin)
-        except StandardError, err:
-            logger.error('Could not create missing grid_stdin fifo: '
-                          + '%s exception: %s '
-                          % (configuration.grid_stdin, err))
-    grid_stdin = open(configuration.grid_stdin, 'r')
-except StandardError:
-    logger.error('failed to open grid_stdin! %s' % sys.exc_info()[0])
-    sys.exit(1)
-
-logger.info('cleaning pipe')
-clean_grid_stdin(grid_stdin)
-
-# Make sure empty job home exists
-
-empty_home = os.path.join(configuration.user_home,
-                          configuration.empty_job_name)
-if not os.path.exists(empty_home):
-    logger.info('creating empty job home dir %s' % empty_home)
-    try:
-        os.mkdir(empty_home)
-    except Exception, exc:
-        logger.error('failed to create empty job home dir %s: %s'
-                      % (empty_home, exc))
+    file_userjob = configuration.mrsl_files_dir\
+         + strip_line.replace('USERJOBFILE ', '') + '.mRSL'
+    dict_userjob = unpickle_and_change_status(file_userjob, 'QUEUED'
+            , logger)
+
+    if not dict_userjob:
+        logger.error('Could not unpickle and change status. '
+                      + 'Job not enqueued!')
+        return None
+
+    # Set owner to be able to do per-user job statistics
+
+    user_str = strip_line.replace('USERJOBFILE ', '')
+    (user_id, filename) = user_str.split(os.sep)
+
+    dict_userjob['OWNER'] = user_id
+    dict_userjob['MIGRATE_COUNT'] = str(0)
+
+    # ARC jobs: directly submit, and put in executing_queue
+    if dict_userjob['JOBTYPE'] == 'arc':
+        if not configuration.arc_clusters:
+            logger.error('ARC backend disabled - ignore %s' % \
+                         dict_userjob)
+            return None
+        logger.debug('ARC Job' )
+        (arc_job, msg) = jobscriptgenerator.create_arc_job(\
+                                dict_userjob, configuration, logger)
+        if not arc_job:
+            # something has gone wrong
+            logger.error('Job NOT submitted (%s)' % msg) 
+            # discard this job (as FAILED, including message)
+            # see gridscript::requeue_job for how to do this...
+
+            dict_userjob['STATUS'] = 'FAILED'
+            dict_userjob['FAILED_TIMESTAMP'] = time.gmtime()
+            # and create an execution history (basically empty)
+            hist = (
+                {'QUEUED_TIMESTAMP': dict_userjob['QUEUED_TIMESTAMP'],
+                 'EXECUTING_TIMESTAMP': dict_userjob['FAILED_TIMESTAMP'],
+                 'FAILED_TIMESTAMP': dict_userjob['FAILED_TIMESTAMP'],
+                 'FAILED_MESSAGE': ('ARC Submission failed: %s' % msg),
+                 'UNIQUE_RESOURCE_NAME': 'ARC',})
+            dict_userjob['EXECUTION_HISTORY'] = [hist]
+
+            # should also notify the user (if requested)
+            # not implented for this branch.
 
-msg = 'Checking for mRSL files with status parse or queued'
-print msg
-logger.info(msg)
-check_mrsl_files(configuration, job_queue, executing_queue,
-                 only_new_jobs, logger)
+        else:
+            # all fine, job is now in some ARC queue
+            logger.debug('Job submitted (%s,%s)' % (arc_job['SESSIONID'], arc_job['ARCID']))
+            # set some job fields for job status retrieval, and
+            # put in exec.queue for job status queries and timeout
+            dict_userjob['SESSIONID'] = arc_job['SESSIONID']
+            # abuse these two fields, 
+            # expected by timeout thread to be there anyway
+            dict_userjob['UNIQUE_RESOURCE_NAME'] = 'ARC'
+            dict_userjob['EXE'] = arc_job['ARCID']
+
+            # this one is used by the timeout thread as well
+            # We put in a wild guess, 10 minutes. Perhaps not enough
+            dict_userjob['EXECUTION_DELAY'] = 600
+
+            # set to executing even though it is kind-of wrong...
+            dict_userjob['STATUS'] = 'EXECUTING'
+            dict_userjob['EXECUTING_TIMESTAMP'] = time.gmtime()
+            with executing_lock:
+                executing_queue.enqueue_job(dict_userjob, \
+                                            executing_queue.queue_length())
 
-msg = 'Cleaning up after pending job requests'
-print msg
-remove_jobrequest_pending_files(configuration)
+        # Either way, save the job mrsl. 
+        # Status is EXECUTING or FAILED
+        pickle(dict_userjob, file_userjob, logger)
 
-# start the timer function to check if cputime is exceeded
+        # go on with scheduling loop (do not use scheduler magic below)
+        return None
 
-logger.info('starting time_out_jobs()')
-job_time_out_stop = threading.Event()
-job_time_out_thread = threading.Thread(target=time_out_jobs,
-        args=(job_time_out_stop, ))
-job_time_out_thread.start()
+    return dict_userjob
 
-msg = 'Starting main loop'
-print msg
-logger.info(msg)
 
-# main loop
+def queue_user_jobs(user_jobs):
+    """Put the loaded user_jobs in the job queue and update the scheduler
+    user stats once per owner, all in a single scheduler_lock session.
+    """
 
-loop_counter = 0
-last_read_from_grid_stdin_empty = False
+    with scheduler_lock:
+        for dict_userjob in user_jobs:
+            job_queue.enqueue_job(dict_userjob, job_queue.queue_length())
+
+        # Update list of users - create user if new
 
-# print str(executing_queue.queue_length())
-# print str(job_queue.queue_length())
-# print str(done_queue.queue_length())
+        owners = {}
+        for dict_userjob in user_jobs:
+            user_id = dict_userjob['OWNER']
+            if not owners.has_key(user_id):
+                user_dict = {}
+                user_dict['USER_ID'] = user_id
+                scheduler.update_users(user_dict)
+                owners[user_id] = scheduler.find_user(user_dict)
+            user_dict = owners[user_id]
+            user_dict['QUEUE_HIST'].pop(0)
+            user_dict['QUEUE_HIST'].append(dict_userjob)
+        for user_dict in owners.values():
+            scheduler.update_seen(user_dict)
+
+
+def handle_user_jobs(lines):
+    """Handle a batch of USERJOBFILE messages in one go"""
+
+    user_jobs = []
+    for strip_line in lines:
+        print strip_line.upper()
+        logger.info(strip_line.upper())
+        dict_userjob = load_user_job(strip_line)
+        if dict_userjob:
+            user_jobs.append(dict_userjob)
+    if user_jobs:
+        queue_user_jobs(user_jobs)
+    logger.info('USERJOBFILE: queued %d of %d job(s) in batch'
+                % (len(user_jobs), len(lines)))
+
+
+def handle_message(line):
+    """Handle a single message line from the grid_stdin pipe. Called from
+    the dispatch worker threads so all access to the job, executing and done
+    queues and to the scheduler must hold scheduler_lock or executing_lock
+    as described above.
+    """
 
-# TODO: perhaps we should run the pipe reader as main thread
-#   and then spawn threads for actual handling. It should of
-#   course still be thread safe.
+    global job_time_out_thread
 
-while True:
-    line = grid_stdin.readline()
     strip_line = line.strip()
     cap_line = strip_line.upper()
     linelist = strip_line.split(' ')
-    if strip_line == '':
-        if last_read_from_grid_stdin_empty:
-            time.sleep(1)
-        last_read_from_grid_stdin_empty = True
-
-        # no reason to investigate content of line
-
-        continue
-    else:
-        last_read_from_grid_stdin_empty = False
 
     if cap_line.find('USERJOBFILE ') == 0:
 
@@ -416,102 +416,7 @@ while True:
         # *********     USER JOB   *********
         # *********                *********
 
-        print cap_line
-        logger.info(cap_line)
-
-        # add to queue
-
-        file_userjob = configuration.mrsl_files_dir\
-             + strip_line.replace('USERJOBFILE ', '') + '.mRSL'
-        dict_userjob = unpickle_and_change_status(file_userjob, 'QUEUED'
-                , logger)
-
-        if not dict_userjob:
-            logger.error('Could not unpickle and change status. '
-                          + 'Job not enqueued!')
-            continue
-
-        # Set owner to be able to do per-user job statistics
-
-        user_str = strip_line.replace('USERJOBFILE ', '')
-        (user_id, filename) = user_str.split(os.sep)
-
-        dict_userjob['OWNER'] = user_id
-        dict_userjob['MIGRATE_COUNT'] = str(0)
-
-        # ARC jobs: directly submit, and put in executing_queue
-        if dict_userjob['JOBTYPE'] == 'arc':
-            if not configuration.arc_clusters:
-                logger.error('ARC backend disabled - ignore %s' % \
-                             dict_userjob)
-                continue
-            logger.debug('ARC Job' )
-            (arc_job, msg) = jobscriptgenerator.create_arc_job(\
-                                    dict_userjob, configuration, logger)
-            if not arc_job:
-                # something has gone wrong
-                logger.error('Job NOT submitted (%s)' % msg) 
-                # discard this job (as FAILED, including message)
-                # see gridscript::requeue_job for how to do this...
-                
-                dict_userjob['STATUS'] = 'FAILED'
-                dict_userjob['FAILED_TIMESTAMP'] = time.gmtime()
-                # and create an execution history (basically empty)
-                hist = (
-                    {'QUEUED_TIMESTAMP': dict_userjob['QUEUED_TIMESTAMP'],
-                     'EXECUTING_TIMESTAMP': dict_userjob['FAILED_TIMESTAMP'],
-                     'FAILED_TIMESTAMP': dict_userjob['FAILED_TIMESTAMP'],
-                     'FAILED_MESSAGE': ('ARC Submission failed: %s' % msg),
-                     'UNIQUE_RESOURCE_NAME': 'ARC',})
-                dict_userjob['EXECUTION_HISTORY'] = [hist]
-
-                # should also notify the user (if requested)
-                # not implented for this branch.
-
-            else:
-                # all fine, job is now in some ARC queue
-                logger.debug('Job submitted (%s,%s)' % (arc_job['SESSIONID'], arc_job['ARCID']))
-                # set some job fields for job status retrieval, and
-                # put in exec.queue for job status queries and timeout
-                dict_userjob['SESSIONID'] = arc_job['SESSIONID']
-                # abuse these two fields, 
-                # expected by timeout thread to be there anyway
-                dict_userjob['UNIQUE_RESOURCE_NAME'] = 'ARC'
-                dict_userjob['EXE'] = arc_job['ARCID']
-
-                # this one is used by the timeout thread as well
-                # We put in a wild guess, 10 minutes. Perhaps not enough
-                dict_userjob['EXECUTION_DELAY'] = 600
-
-                # set to executing even though it is kind-of wrong...
-                dict_userjob['STATUS'] = 'EXECUTING'
-                dict_userjob['EXECUTING_TIMESTAMP'] = time.gmtime()
-                executing_queue.enqueue_job(dict_userjob, \
-                                            executing_queue.queue_length())
-
-            # Either way, save the job mrsl. 
-            # Status is EXECUTING or FAILED
-            pickle(dict_userjob, file_userjob, logger)
-
-            # go on with scheduling loop (do not use scheduler magic below)
-            continue
-
-        # following: non-ARC code
-        
-        # put job in queue
-
-        job_queue.enqueue_job(dict_userjob, job_queue.queue_length())
-
-        user_dict = {}
-        user_dict['USER_ID'] = user_id
-
-        # Update list of users - create user if new
-
-        scheduler.update_users(user_dict)
-        user_dict = scheduler.find_user(user_dict)
-        user_dict['QUEUE_HIST'].pop(0)
-        user_dict['QUEUE_HIST'].append(dict_userjob)
-        scheduler.update_seen(user_dict)
+        handle_user_jobs([strip_line])
     elif cap_line.find('SERVERJOBFILE ') == 0:
 
         # *********                  *********
@@ -529,11 +434,12 @@ while True:
         if dict_serverjob == False:
             logger.error(
                 'Could not unpickle migrated job - not put into queue!')
-            continue
+            return
 
         # put job in queue
 
-        job_queue.enqueue_job(dict_serverjob, job_queue.queue_length())
+        with scheduler_lock:
+            job_queue.enqueue_job(dict_serverjob, job_queue.queue_length())
     elif cap_line.find('JOBSCHEDULE ') == 0:
 
         # *********                     *********
@@ -545,7 +451,7 @@ while True:
 
         if len(linelist) != 2:
             logger.error('Invalid job schedule request %s' % linelist)
-            continue
+            return
 
         # read values
 
@@ -553,10 +459,11 @@ while True:
 
         # find job in queue and dump schedule values to mRSL for job status
 
-        job_dict = job_queue.get_job_by_id(job_id)
+        with scheduler_lock:
+            job_dict = job_queue.get_job_by_id(job_id)
         if not job_dict:
             logger.info('Job is not in waiting queue - no schedule to update')
-            continue
+            return
 
         client_dir = client_id_dir(job_dict['USER_CERT'])
         file_serverjob = configuration.mrsl_files_dir + client_dir\
@@ -564,11 +471,12 @@ while True:
         dict_serverjob = unpickle(file_serverjob, logger)
         if dict_serverjob == False:
             logger.error('Could not unpickle job - not updating schedule!')
-            continue
+            return
 
         # update and save schedule
 
-        scheduler.copy_schedule(job_dict, dict_serverjob)
+        with scheduler_lock:
+            scheduler.copy_schedule(job_dict, dict_serverjob)
         pickle(dict_serverjob, file_serverjob, logger)
     elif cap_line.find('RESOURCEREQUEST ') == 0:
 
@@ -578,12 +486,13 @@ while True:
 
         print cap_line
         logger.info(cap_line)
-        logger.info('RESOURCEREQUEST: %d job(s) in the queue.' % \
-                    job_queue.queue_length())
+        with scheduler_lock:
+            queued_jobs = job_queue.queue_length()
+        logger.info('RESOURCEREQUEST: %d job(s) in the queue.' % queued_jobs)
 
         if len(linelist) != 8:
             logger.error('Invalid resource request %s' % linelist)
-            continue
+            return
 
         # read values
 
@@ -604,7 +513,7 @@ while True:
         if resource_config == False:
             logger.error('error unpickling resource config for %s'
                           % unique_resource_name)
-            continue
+            return
 
         sandboxed = resource_config.get('SANDBOX', False)
 
@@ -627,7 +536,7 @@ while True:
 
             # we cannot create and dispatch job without pgid written to file!
 
-            continue
+            return
 
         job_dict = None
 
@@ -652,9 +561,10 @@ while True:
             # This is done to avoid them stacking up in the executing_queue
             # in case of a faulty resource who keeps requesting jobs
             
-            job_dict = \
-                     executing_queue.dequeue_job_by_id(last_req.get(
-                'JOB_ID', ''), log_errors=False)
+            with executing_lock:
+                job_dict = \
+                         executing_queue.dequeue_job_by_id(last_req.get(
+                    'JOB_ID', ''), log_errors=False)
             if job_dict:
                 logger.info('last job was an empty job which did not finish')
                 if not server_cleanup(
@@ -682,9 +592,10 @@ while True:
             if job_dict:
                 if job_dict['STATUS'] not in last_job_ok_status_list:
                     last_job_failed = True
-                    exe_job = \
-                        executing_queue.get_job_by_id(job_dict['JOB_ID'
-                            ])
+                    with executing_lock:
+                        exe_job = \
+                            executing_queue.get_job_by_id(job_dict['JOB_ID'
+                                ])
                     if exe_job:
 
                         # Ignore missing fields
@@ -704,15 +615,17 @@ while True:
 
                         # Clear any scheduling data for exe_job before requeue
 
-                        scheduler.clear_schedule(exe_job)
-                        requeue_job(
-                            exe_job,
-                            'RESOURCE DIED',
-                            job_queue,
-                            executing_queue,
-                            configuration,
-                            logger,
-                            )
+                        with scheduler_lock:
+                            with executing_lock:
+                                scheduler.clear_schedule(exe_job)
+                                requeue_job(
+                                    exe_job,
+                                    'RESOURCE DIED',
+                                    job_queue,
+                                    executing_queue,
+                                    configuration,
+                                    logger,
+                                    )
                     else:
                         logger.info(
                             '%s:%s requested job but last %s was rescheduled'
@@ -745,7 +658,7 @@ while True:
                 logger)
         if not status:
             logger.error('could not get exe configuration for resource!')
-            continue
+            return
 
         last_request_dict = {'RESOURCE_CONFIG': resource_config,
                              'CREATED_TIME': datetime.datetime.now(),
@@ -813,10 +726,12 @@ while True:
 
         # Update list of resources
 
-        scheduler.update_resources(resource_config)
-        scheduler.update_seen(resource_config)
+        with scheduler_lock:
+            scheduler.update_resources(resource_config)
+            scheduler.update_seen(resource_config)
+            queued_jobs = job_queue.queue_length()
 
-        if job_queue.queue_length() == 0 or last_job_failed or nodecount < 1:
+        if queued_jobs == 0 or last_job_failed or nodecount < 1:
 
             # No jobs: Create 'empty' job script and double sleep time if
             # repeated empty job
@@ -867,14 +782,15 @@ while True:
                 last_request_dict['CPUTIME'] = empty_job['CPUTIME']
                 last_request_dict['EMPTY_JOB'] = True
 
-                executing_queue.enqueue_job(last_request_dict,
-                        executing_queue.queue_length())
+                with executing_lock:
+                    executing_queue.enqueue_job(last_request_dict,
+                            executing_queue.queue_length())
                 logger.info('empty job script created')
             else:
                 msg = 'Failed to create job script: %s' % msg
                 print msg
                 logger.error(msg)
-                continue
+                return
         else:
 
             # there are jobs in the queue
@@ -882,7 +798,8 @@ while True:
             # Expire outdated jobs - expire_jobs removes them from queue
             # and returns them in a list: handle the file update here.
 
-            expired_jobs = scheduler.expire_jobs()
+            with scheduler_lock:
+                expired_jobs = scheduler.expire_jobs()
             for expired in expired_jobs:
 
                 # tell the user about the expired job - we do not wait for
@@ -923,34 +840,42 @@ while True:
             # race condition if a job has not been dequeued after the
             # status in the mRSL file has been changed to FROZEN or CANCELED)
 
-            while True:
-                job_dict = scheduler.schedule(resource_config)
-                if not job_dict:
-                    break
+            with scheduler_lock:
+                while True:
+                    with _schedule_seconds.time():
+                        job_dict = scheduler.schedule(resource_config)
+                    if not job_dict:
+                        break
 
-                client_dir = client_id_dir(job_dict['USER_CERT'])
-                mrsl_filename = configuration.mrsl_files_dir\
-                     + client_dir + '/' + job_dict['JOB_ID'] + '.mRSL'
-                dummy_dict = unpickle(mrsl_filename, logger)
+                    client_dir = client_id_dir(job_dict['USER_CERT'])
+                    mrsl_filename = configuration.mrsl_files_dir\
+                         + client_dir + '/' + job_dict['JOB_ID'] + '.mRSL'
+                    dummy_dict = unpickle(mrsl_filename, logger)
 
-                # The job status should be "QUEUED" at this point
+                    # The job status should be "QUEUED" at this point
 
-                if dummy_dict == False:
-                    logger.error('error unpickling mrsl in %s'
-                                  % mrsl_filename)
-                    continue
+                    if dummy_dict == False:
+                        logger.error('error unpickling mrsl in %s'
+                                      % mrsl_filename)
+                        continue
 
-                if dummy_dict['STATUS'] == 'QUEUED':
-                    break
+                    if dummy_dict['STATUS'] == 'QUEUED':
+                        scheduled_jobs[job_dict['JOB_ID']] = None
+                        break
+
+                # Record any in-place changes to jobs left in the queue
+
+                scheduler.journal_job_changes()
 
             if not job_dict:
 
                 # no jobs in the queue fits the resource!
 
                 print 'X'
+                with scheduler_lock:
+                    queued_jobs = job_queue.queue_length()
                 logger.info('No jobs in the queue can be executed by '
-                             + 'resource, queue length: %s'
-                             % job_queue.queue_length())
+                             + 'resource, queue length: %s' % queued_jobs)
 
                 # Create 'empty' job script and double sleep time if
                 # repeated empty job
@@ -1000,8 +925,9 @@ while True:
                     last_request_dict['CPUTIME'] = empty_job['CPUTIME']
                     last_request_dict['EMPTY_JOB'] = True
 
-                    executing_queue.enqueue_job(last_request_dict,
-                            executing_queue.queue_length())
+                    with executing_lock:
+                        executing_queue.enqueue_job(last_request_dict,
+                                executing_queue.queue_length())
                     logger.info('empty job script created')
             else:
 
@@ -1098,21 +1024,53 @@ while True:
                         for name in maxfill_fields:
                             active_job[name] = new_job[name]
 
-                        executing_queue.enqueue_job(active_job,
-                                executing_queue.queue_length())
-
-                        print 'executing_queue length %d'\
-                             % executing_queue.queue_length()
+                        with scheduler_lock:
+                            canceled = scheduled_jobs.pop(
+                                job_dict['JOB_ID'], None) == 'CANCELED'
+                            if not canceled:
+                                with executing_lock:
+                                    executing_queue.enqueue_job(active_job,
+                                            executing_queue.queue_length())
+                                    executing_jobs = \
+                                        executing_queue.queue_length()
+
+                        if canceled:
+
+                            # job was canceled while we created job script
+
+                            logger.info('Job %s canceled during dispatch'
+                                        % new_job['JOB_ID'])
+                            mrsl_dict['STATUS'] = 'CANCELED'
+                            pickle(mrsl_dict, mrsl_filename, logger)
+                            last_request_dict['STATUS'] = 'Job canceled'
+                            if not server_cleanup(
+                                new_job['SESSIONID'],
+                                new_job['IOSESSIONID'],
+                                localjobname,
+                                new_job['JOB_ID'],
+                                configuration,
+                                logger,
+                                ):
+                                logger.error('could not clean up MiG server')
+                        else:
+                            print 'executing_queue length %d' % \
+                                executing_jobs
                     else:
 
-                        # put original job in back in job queue
+                        # put original job in back in job queue unless it
+                        # was canceled meanwhile
 
-                        job_queue.enqueue_job(job_dict,
-                                job_queue.queue_length())
+                        with scheduler_lock:
+                            if scheduled_jobs.pop(job_dict['JOB_ID'],
+                                                  None) != 'CANCELED':
+                                job_queue.enqueue_job(job_dict,
+                                        job_queue.queue_length())
                         msg = 'error creating new job script, job requeued'
                         print msg
                         logger.error(msg)
                 else:
+                    with scheduler_lock:
+                        scheduled_jobs.pop(job_dict['JOB_ID'], None)
                     logger.error('error unpickling mRSL: %s'
                                   % mrsl_filename)
 
@@ -1228,7 +1186,8 @@ while True:
         # TODO: update price *after* publishing status so that price fits delay?
 
         if configuration.enable_server_dist:
-            scheduler.update_price(resource_config)
+            with scheduler_lock:
+                scheduler.update_price(resource_config)
     elif cap_line.find('RESOURCEFINISHEDJOB ') == 0:
 
         # *********                       *********
@@ -1238,12 +1197,14 @@ while True:
 
         print cap_line
         logger.info(cap_line)
+        with scheduler_lock:
+            queued_jobs = job_queue.queue_length()
         logger.info('RESOURCEFINISHEDJOB: %d job(s) in the queue.' % \
-                    job_queue.queue_length())
+                    queued_jobs)
 
         if len(linelist) != 5:
             logger.error('Invalid resourcefinishedjob request')
-            continue
+            return
 
         # read values
 
@@ -1254,7 +1215,8 @@ while True:
 
         msg = 'RESOURCEFINISHEDJOB: %s:%s finished job %s id %s'\
              % (res_name, exe_name, sessionid, job_id)
-        job_dict = executing_queue.get_job_by_id(job_id)
+        with executing_lock:
+            job_dict = executing_queue.get_job_by_id(job_id)
 
         if not job_dict:
             msg += \
@@ -1268,11 +1230,12 @@ while True:
             if not configuration.arc_clusters:
                 logger.error('ARC backend disabled - ignore %s' % \
                              job_dict)
-                continue
+                return
             msg += (', which is an ARC job (ID %s).' % job_dict['EXE'])
 
             # remove from the executing queue
-            executing_queue.dequeue_job_by_id(job_id)
+            with executing_lock:
+                executing_queue.dequeue_job_by_id(job_id)
 
             # job status has been checked by put script already
             # we need to clean up the job remainder (links, queue, and ARC
@@ -1302,9 +1265,11 @@ while True:
                 # handing back job as first contact with new server
                 # Still not sure if we need finished handling at all, though...
 
-                scheduler.finished_job(res_name, job_dict)
+                with scheduler_lock:
+                    scheduler.finished_job(res_name, job_dict)
 
-            executing_queue.dequeue_job_by_id(job_id)
+            with executing_lock:
+                executing_queue.dequeue_job_by_id(job_id)
             msg += '%s removed from executing queue.' % job_id
 
         # print msg
@@ -1318,13 +1283,15 @@ while True:
 
         print cap_line
         logger.info(cap_line)
+        with executing_lock:
+            executing_jobs = executing_queue.queue_length()
         logger.info(
             'Before restart exe failed: %d job(s) in the executing queue.' % \
-            executing_queue.queue_length())
+            executing_jobs)
 
         if len(linelist) != 4:
             logger.error('Invalid restart exe failed request')
-            continue
+            return
 
         # read values
 
@@ -1344,11 +1311,13 @@ while True:
             configuration,
             logger,
             )
-        executing_queue.enqueue_job(retry_job,
-                                    executing_queue.queue_length())
+        with executing_lock:
+            executing_queue.enqueue_job(retry_job,
+                                        executing_queue.queue_length())
+            executing_jobs = executing_queue.queue_length()
         logger.info(
             'After restart exe failed: %d job(s) in the executing queue.' % \
-            executing_queue.queue_length())
+            executing_jobs)
     elif cap_line.find('JOBACTION') == 0:
 
         # *********                       *********
@@ -1357,12 +1326,13 @@ while True:
 
         print cap_line
         logger.info(cap_line)
-        logger.info('Job action: %d job(s) in the queue.' % \
-                    job_queue.queue_length())
+        with scheduler_lock:
+            queued_jobs = job_queue.queue_length()
+        logger.info('Job action: %d job(s) in the queue.' % queued_jobs)
 
         if len(linelist) != 6:
             logger.error('Invalid job action request')
-            continue
+            return
 
         # read values
 
@@ -1392,22 +1362,32 @@ while True:
         if original_status in other_status_list:
             pass
         elif original_status in queued_status_list:
-            if new_status == 'CANCELED':
-                job_dict = job_queue.dequeue_job_by_id(job_id)
-            else:
-                job_dict = job_queue.get_job_by_id(job_id)
-                if not job_dict:
-                    logger.warning("Couldn't find job in queue: %s" % job_id)
-                    continue
-                scheduler.clear_schedule(job_dict)
-                job_dict['STATUS'] = new_status
+            with scheduler_lock:
+                if new_status == 'CANCELED' and job_id in scheduled_jobs:
+
+                    # Resource request is dispatching job - let it cancel
+
+                    logger.info('cancel job %s during dispatch' % job_id)
+                    scheduled_jobs[job_id] = new_status
+                    return
+                elif new_status == 'CANCELED':
+                    job_dict = job_queue.dequeue_job_by_id(job_id)
+                else:
+                    job_dict = job_queue.get_job_by_id(job_id)
+                    if not job_dict:
+                        logger.warning("Couldn't find job in queue: %s" % job_id)
+                        return
+                    scheduler.clear_schedule(job_dict)
+                    job_dict['STATUS'] = new_status
+                    job_queue.log_update(job_dict)
         elif original_status in executing_status_list:
 
             # Retrieve job_dict
 
-            num_executing_jobs_before = executing_queue.queue_length()
-            job_dict = executing_queue.dequeue_job_by_id(job_id)
-            num_executing_jobs_after = executing_queue.queue_length()
+            with executing_lock:
+                num_executing_jobs_before = executing_queue.queue_length()
+                job_dict = executing_queue.dequeue_job_by_id(job_id)
+                num_executing_jobs_after = executing_queue.queue_length()
             logger.info('Number of jobs in executing queue. '
                          + 'Before cancel: %s. After cancel: %s'
                          % (num_executing_jobs_before,
@@ -1421,7 +1401,7 @@ while True:
 
                 logger.info(
                     'Cancel job: Could not get job_dict for executing job')
-                continue
+                return
 
             # special treatment of ARC jobs: delete two links and cancel job
             # in ARC
@@ -1429,10 +1409,11 @@ while True:
                 if not configuration.arc_clusters:
                     logger.error('ARC backend disabled - ignore %s' % \
                                  job_dict)
-                    continue
+                    return
 
                 # remove from the executing queue
-                executing_queue.dequeue_job_by_id(job_id)
+                with executing_lock:
+                    executing_queue.dequeue_job_by_id(job_id)
 
                 # job status has been set by the cancel request already, but 
                 # we need to kill the ARC job, or clean it (if already
@@ -1441,7 +1422,7 @@ while True:
                               configuration, logger, True)
 
                 logger.debug('ARC job completed')
-                continue
+                return
 
             if not server_cleanup(
                 job_dict['SESSIONID'],
@@ -1480,12 +1461,14 @@ while True:
 
         print cap_line
         logger.info(cap_line)
+        with executing_lock:
+            executing_jobs = executing_queue.queue_length()
         logger.info('job timeout: %d job(s) in the executing queue.' % \
-                    executing_queue.queue_length())
+                    executing_jobs)
 
         if len(linelist) != 4:
             logger.error('Invalid timeout job request')
-            continue
+            return
         
         # read values
 
@@ -1505,7 +1488,8 @@ while True:
 
         # Retrieve job_dict
 
-        job_dict = executing_queue.get_job_by_id(jobid)
+        with executing_lock:
+            job_dict = executing_queue.get_job_by_id(jobid)
 
         # special treatment of ARC jobs: delete two links and 
         # clean job in ARC system, do not retry.
@@ -1513,10 +1497,11 @@ while True:
             if not configuration.arc_clusters:
                 logger.error('ARC backend disabled - ignore %s' % \
                              job_dict)
-                continue
+                return
 
             # remove from the executing queue
-            executing_queue.dequeue_job_by_id(jobid)
+            with executing_lock:
+                executing_queue.dequeue_job_by_id(jobid)
 
             # job status has been set by the cancel request already, but 
             # we need to kill the ARC job, or clean it (if already finished),
@@ -1525,7 +1510,7 @@ while True:
                           configuration, logger, True)
 
             logger.debug('ARC job timed out, removed')
-            continue
+            return
 
 
         # Execution information is removed from job_dict in
@@ -1563,22 +1548,25 @@ while True:
                     ):
                     logger.error('could not clean up MiG server')
 
-                executing_queue.dequeue_job_by_id(job_dict['JOB_ID'])
+                with executing_lock:
+                    executing_queue.dequeue_job_by_id(job_dict['JOB_ID'])
             else:
 
                 # Real job, requeue job
 
                 # Clear any scheduling data for exe_job before requeue
 
-                scheduler.clear_schedule(job_dict)
-                requeue_job(
-                    job_dict,
-                    'JOB TIMEOUT',
-                    job_queue,
-                    executing_queue,
-                    configuration,
-                    logger,
-                    )
+                with scheduler_lock:
+                    with executing_lock:
+                        scheduler.clear_schedule(job_dict)
+                        requeue_job(
+                            job_dict,
+                            'JOB TIMEOUT',
+                            job_queue,
+                            executing_queue,
+                            configuration,
+                            logger,
+                            )
 
             # Restart non-sandbox resources for all timed out jobs
 
@@ -1613,9 +1601,10 @@ while True:
         details = linelist[1:]
         if not details:
             details.append('JOB_ID')
-        logger.info('--- DISPLAYING JOB QUEUE INFORMATION ---\n%s' % \
-                    '\n'.join(job_queue.format_queue(details)))
-        job_queue.show_queue(details)
+        with scheduler_lock:
+            logger.info('--- DISPLAYING JOB QUEUE INFORMATION ---\n%s' % \
+                        '\n'.join(job_queue.format_queue(details)))
+            job_queue.show_queue(details)
     elif cap_line.find('DROPQUEUED') == 0:
         logger.info('--- REMOVING JOBS FROM JOB QUEUE ---')
         job_list = linelist[1:]
@@ -1623,7 +1612,8 @@ while True:
             logger.info('No jobs specified for removal')
         for job_id in job_list:
             try:
-                job_queue.dequeue_job_by_id(job_id)
+                with scheduler_lock:
+                    job_queue.dequeue_job_by_id(job_id)
                 logger.info("Removed job %s from job queue" % job_id)
             except Exception, exc:
                 logger.error("Failed to remove job %s from job queue: %s" \
@@ -1632,9 +1622,10 @@ while True:
         details = linelist[1:]
         if not details:
             details.append('JOB_ID')
-        logger.info('--- DISPLAYING EXECUTING QUEUE INFORMATION ---\n%s' % \
-                    '\n'.join(executing_queue.format_queue(details)))
-        executing_queue.show_queue(details)
+        with executing_lock:
+            logger.info('--- DISPLAYING EXECUTING QUEUE INFORMATION ---\n%s' % \
+                        '\n'.join(executing_queue.format_queue(details)))
+            executing_queue.show_queue(details)
     elif cap_line.find('DROPEXECUTING') == 0:
         logger.info('--- REMOVING JOBS FROM EXECUTING QUEUE ---')
         job_list = linelist[1:]
@@ -1642,7 +1633,8 @@ while True:
             logger.info('No jobs specified for removal')
         for job_id in job_list:
             try:
-                executing_queue.dequeue_job_by_id(job_id)
+                with executing_lock:
+                    executing_queue.dequeue_job_by_id(job_id)
                 logger.info("Removed job %s from executing queue" % job_id)
             except Exception, exc:
                 logger.error("Failed to remove job %s from exe queue: %s" \
@@ -1651,9 +1643,10 @@ while True:
         details = linelist[1:]
         if not details:
             details.append('JOB_ID')
-        logger.info('--- DISPLAYING DONE QUEUE INFORMATION ---\n%s' % \
-                    '\n'.join(done_queue.format_queue(details)))
-        done_queue.show_queue(details)
+        with scheduler_lock:
+            logger.info('--- DISPLAYING DONE QUEUE INFORMATION ---\n%s' % \
+                        '\n'.join(done_queue.format_queue(details)))
+            done_queue.show_queue(details)
     elif cap_line.find('DROPDONE') == 0:
         logger.info('--- REMOVING JOBS FROM DONE QUEUE ---')
         job_list = linelist[1:]
@@ -1661,7 +1654,8 @@ while True:
             logger.info('No jobs specified for removal')
         for job_id in job_list:
             try:
-                done_queue.dequeue_job_by_id(job_id)
+                with scheduler_lock:
+                    done_queue.dequeue_job_by_id(job_id)
                 logger.info("Removed job %s from done queue" % job_id)
             except Exception, exc:
                 logger.error("Failed to remove job %s from exe queue: %s" \
@@ -1679,20 +1673,234 @@ while True:
     elif cap_line.find('RELOADCONFIG') == 0:
         logger.info('--- RELOADING CONFIGURATION ---')
         configuration.reload_config(True)
-    elif cap_line.find('SHUTDOWN') == 0:
-        logger.info('--- SAFE SHUTDOWN INITIATED ---')
-        print '--- SAFE SHUTDOWN INITIATED ---'
-        graceful_shutdown()
     else:
         print 'not understood: %s' % cap_line
         logger.error('not understood: %s' % cap_line)
         time.sleep(1)
 
-    # Experimental distributed server code
 
-    if configuration.enable_server_dist:
-        servercomm.exchange_status(configuration, scheduler,
-                                   loop_counter)
+def message_key(strip_line):
+    """Extract the key used to serialize handling of related messages.
+    Messages about the same job or the same resource exe are handled in the
+    order they arrived, whereas unrelated messages are handled in parallel.
+    """
+
+    linelist = strip_line.split(' ')
+    cap_cmd = linelist[0].upper()
+    if cap_cmd in ('USERJOBFILE', 'SERVERJOBFILE') and len(linelist) > 1:
+        return 'job:%s' % os.path.basename(linelist[1])
+    elif cap_cmd in ('JOBSCHEDULE', 'JOBACTION') and len(linelist) > 1:
+        return 'job:%s' % linelist[1]
+    elif cap_cmd == 'RESOURCEREQUEST' and len(linelist) > 2:
+        return 'exe:%s_%s' % (linelist[2], linelist[1])
+    elif cap_cmd in ('RESOURCEFINISHEDJOB', 'RESTARTEXEFAILED',
+                     'JOBTIMEOUT') and len(linelist) > 2:
+        return 'exe:%s_%s' % (linelist[1], linelist[2])
+    return 'admin'
+
+
+def ticket_ready(ticket):
+    """Check if the pending item with ticket is first in line for all its
+    message keys. The caller must hold pending_cond.
+    """
+
+    (keys, _) = pending_items[ticket]
+    for key in keys:
+        if pending_tickets[key][0] != ticket:
+            return False
+    return True
+
+
+def dispatch_messages(ready_queue, lines, ticket):
+    """Register lines for handling by the dispatch workers as a single work
+    item. The ticket is queued for all the message keys and the item goes
+    on ready_queue right away if no earlier items share a key with it.
+    Blocks while dispatch_queue_size items are pending to apply backpressure
+    on the pipe reader.
+    """
+
+    keys = set([message_key(line) for line in lines])
+    pending_cond.acquire()
+    try:
+        while len(pending_items) >= configuration.dispatch_queue_size:
+            pending_cond.wait()
+        pending_items[ticket] = (keys, lines)
+        for key in keys:
+            pending_tickets.setdefault(key, deque()).append(ticket)
+        if ticket_ready(ticket):
+            ready_queue.put((ticket, keys, lines))
+    finally:
+        pending_cond.release()
+
+
+_schedule_seconds = histogram('schedule_seconds', 'Run time of scheduler '
+                              'passes for resource requests')
+_message_seconds = histogram('message_seconds', 'Run time of grid_script '
+                             'message handling', ('command', ))
+
+
+def dispatch_worker(ready_queue):
+    """Handle messages from ready_queue until a None item arrives. When an
+    item is done any later items first in line for all their keys as a
+    result are put on ready_queue. Items with multiple lines are USERJOBFILE
+    batches.
+    """
+
+    while True:
+        item = ready_queue.get()
+        if item is None:
+            break
+        (ticket, keys, lines) = item
+        command = lines[0].split(' ', 1)[0].upper()
+        try:
+            with _message_seconds.time(command=command):
+                if len(lines) > 1:
+                    handle_user_jobs(lines)
+                else:
+                    handle_message(lines[0])
+
+            # Experimental distributed server code
+
+            if configuration.enable_server_dist:
+                with scheduler_lock:
+                    servercomm.exchange_status(configuration, scheduler,
+                                               ticket)
+        except Exception, exc:
+            logger.error('dispatch worker failed to handle %s: %s'
+                         % (lines, exc))
+        pending_cond.acquire()
+        try:
+            del pending_items[ticket]
+            next_tickets = set()
+            for key in keys:
+                pending_tickets[key].popleft()
+                if pending_tickets[key]:
+                    next_tickets.add(pending_tickets[key][0])
+                else:
+                    del pending_tickets[key]
+            for next_ticket in sorted(next_tickets):
+                if ticket_ready(next_ticket):
+                    ready_queue.put((next_ticket, ) +
+                                    pending_items[next_ticket])
+            pending_cond.notify_all()
+        finally:
+            pending_cond.release()
+        sys.stdout.flush()
+        logger.debug('handled %d message(s) in item %d' % (len(lines),
+                                                           ticket))
+
+
+def stop_dispatch_workers(ready_queue, workers):
+    """Let workers finish all pending messages and wait for them to end"""
+
+    pending_cond.acquire()
+    try:
+        while pending_items:
+            pending_cond.wait()
+    finally:
+        pending_cond.release()
+    for _ in workers:
+        ready_queue.put(None)
+    for worker in workers:
+        worker.join()
+
+logger.info('starting time_out_jobs()')
+job_time_out_stop = threading.Event()
+job_time_out_thread = threading.Thread(target=time_out_jobs,
+        args=(job_time_out_stop, ))
+job_time_out_thread.start()
+
+msg = 'Starting %d dispatch workers' % configuration.dispatch_workers
+print msg
+logger.info(msg)
+
+work_queue = Queue.Queue()
+dispatch_threads = []
+for _ in range(configuration.dispatch_workers):
+    worker = threading.Thread(target=dispatch_worker, args=(work_queue, ))
+    worker.start()
+    dispatch_threads.append(worker)
+
+queue_usage = gauge('queue_length', 'Jobs and messages in grid_script '
+                    'queues', ('queue', ))
+queue_usage.set_function(lambda: job_queue.queue_length(), queue='job')
+queue_usage.set_function(lambda: executing_queue.queue_length(),
+                         queue='executing')
+queue_usage.set_function(lambda: len(pending_items), queue='dispatch')
+serve_metrics(configuration, 'script')
+
+msg = 'Starting main loop'
+print msg
+logger.info(msg)
+
+# main loop: the pipe reader runs as main thread and hands messages to the
+# dispatch workers through the bounded work queue. It blocks until input
+# arrives and then picks up all available messages in one go so that bursts
+# of USERJOBFILE messages are queued and scheduled in batches. Reads time out
+# after main_loop_tick seconds so that the housekeeping below runs even when
+# the server is idle.
+
+loop_counter = 0
+partial_line = ''
+
+main_loop_tick = 60
+
+while True:
+    (lines, partial_line) = read_grid_stdin(grid_stdin, partial_line,
+                                            main_loop_tick)
+    user_jobs = []
+    for line in lines:
+        strip_line = line.strip()
+        cap_line = strip_line.upper()
+        if strip_line == '':
+
+            # no reason to investigate content of line
+
+            continue
+
+        if cap_line.find('USERJOBFILE ') == 0:
+            user_jobs.append(strip_line)
+            if len(user_jobs) >= configuration.dispatch_batch_size:
+                dispatch_messages(work_queue, user_jobs, loop_counter)
+                loop_counter += 1
+                user_jobs = []
+            continue
+
+        # Keep message order by dispatching any collected jobs first
+
+        if user_jobs:
+            dispatch_messages(work_queue, user_jobs, loop_counter)
+            loop_counter += 1
+            user_jobs = []
+
+        if cap_line.find('SHUTDOWN') == 0:
+            logger.info('--- SAFE SHUTDOWN INITIATED ---')
+            print '--- SAFE SHUTDOWN INITIATED ---'
+            stop_dispatch_workers(work_queue, dispatch_threads)
+            graceful_shutdown()
+
+        dispatch_messages(work_queue, [strip_line], loop_counter)
+        loop_counter += 1
+
+    if user_jobs:
+        dispatch_messages(work_queue, user_jobs, loop_counter)
+        loop_counter += 1
+
+    # Compact queue journals into fresh queue snapshots once they grow big
+    # or whenever the server is idle
+
+    journal_records = job_queue.journal_records + \
+        executing_queue.journal_records
+    if journal_records > configuration.queue_journal_limit or \
+           journal_records and not lines:
+        logger.info('saving queue snapshots to compact journals')
+        with scheduler_lock:
+            with executing_lock:
+                if not save_queue(job_queue, job_queue_path, logger):
+                    logger.warning('failed to save job queue')
+                if not save_queue(executing_queue, executing_queue_path,
+                                  logger):
+                    logger.warning('failed to save executing queue')
 
     # TMP: Auto restart time out thread until we find the death cause
 
@@ -1702,12 +1910,12 @@ while True:
                        job_time_out_thread.isAlive(),
                        job_time_out_stop.isSet()))
         logger.info('ressurect time out thread with executing queue:')
-        logger.info('%s' % executing_queue.show_queue(['ALL']))
+        with executing_lock:
+            logger.info('%s' % executing_queue.show_queue(['ALL']))
         job_time_out_stop.clear()
         job_time_out_thread = threading.Thread(target=time_out_jobs,
                 args=(job_time_out_stop, ))
         job_time_out_thread.start()
 
     sys.stdout.flush()
-    loop_counter += 1
-    logger.debug('loop ended')
+    logger.debug('read loop ended after %d message(s)' % len(lines))
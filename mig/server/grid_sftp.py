@@ -62,7 +62,10 @@
 Requires Paramiko module (http://pypi.python.org/pypi/paramiko).
 """
 
+import errno
+import mmap
 import os
+import Queue
 import shutil
 import socket
 import sys
@@ -78,6 +81,11 @@ try:
 except ImportError:
     print "ERROR: the python paramiko module is required for this daemon"
     sys.exit(1)
+# NOTE: Use faster scandir if available
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
 
 from shared.base import invisible_path, force_utf8
 from shared.conf import get_configuration_object
@@ -94,9 +102,11 @@ from shared.griddaemons.sftp import default_username_validator, \
     refresh_jupyter_creds, update_login_map, login_map_lookup, \
     hit_rate_limit, expire_rate_limit, clear_sessions, \
     track_open_session, track_close_session, active_sessions, \
-    check_twofactor_session, validate_auth_attempt
+    check_twofactor_session, validate_auth_attempt, AuthCache, \
+    init_creds_watcher, init_twofactor_index
 from shared.logger import daemon_logger, daemon_gdp_logger, \
     register_hangup_handler
+from shared.metrics import counter, gauge, histogram, timed, serve_metrics
 from shared.notification import send_system_notification
 from shared.pwhash import make_scramble
 from shared.useradm import check_password_hash
@@ -105,6 +115,11 @@ from shared.validstring import possible_user_id, possible_job_id,\
 
 configuration, logger = None, None
 
+_sftp_bytes = counter('sftp_bytes_total', 'Bytes in sftp file reads and '
+                      'writes', ('direction', ))
+_sftp_op_seconds = histogram('sftp_op_seconds', 'Run time of sftp '
+                             'operations', ('op', ))
+
 
 class SFTPHandle(paramiko.SFTPHandle):
     """Override default SFTPHandle"""
@@ -115,11 +130,22 @@ class SFTPHandle(paramiko.SFTPHandle):
     sftpserver = None
     ftrace = None
     valid_ftrace_types = None
+    # Buffer sizes for read-ahead on read-only files and write-behind on
+    # write-only files. Large enough to serve many packets per syscall.
+    read_buffer_size = 2**20
+    write_buffer_size = 2**20
+    # Serve reads from a memory map for read-only files of at least this
+    # size. Disabled (0) by default because truncation of a mapped file by
+    # another process makes reads past the new end crash with SIGBUS.
+    mmap_min_size = 0
 
     def __init__(self, flags=0, sftpserver=None):
         paramiko.SFTPHandle.__init__(self, flags)
         if sftpserver is not None:
             self.sftpserver = sftpserver
+        self.readmap = None
+        self.write_behind = False
+        self.write_pos = None
         if self.logger is None:
             self.logger = logger
         if configuration.site_enable_gdp:
@@ -296,6 +322,8 @@ class SFTPHandle(paramiko.SFTPHandle):
         #                                                    "unknown"))
         active = getattr(self, 'active')
         file_obj = getattr(self, active)
+        if self.write_behind:
+            file_obj.flush()
         return paramiko.SFTPAttributes.from_stat(os.fstat(file_obj.fileno()),
                                                  getattr(self, "path",
                                                          "unknown"))
@@ -307,19 +335,68 @@ class SFTPHandle(paramiko.SFTPHandle):
         #                  (repr(attr), path))
         return self.sftpserver._chattr(path, attr, self)
 
+    def map_readfile(self):
+        """Map readfile into memory if it is large enough for mmap reads.
+        Skipped with GDP where logging tracks the readfile position.
+        """
+        if not self.mmap_min_size or configuration.site_enable_gdp:
+            return False
+        try:
+            fileno = self.readfile.fileno()
+            if os.fstat(fileno).st_size < self.mmap_min_size:
+                return False
+            self.readmap = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+            return True
+        except Exception, err:
+            self.logger.warning("mmap of %s failed: %s" %
+                                (getattr(self, "path", "unknown"), err))
+            return False
+
     @__gdp_log
     def read(self, offset, length):
         """Handle operations of same name"""
-        return super(SFTPHandle, self).read(offset, length)
+        if self.readmap is not None:
+            data = self.readmap[offset:offset + length]
+        else:
+            data = super(SFTPHandle, self).read(offset, length)
+        if isinstance(data, basestring):
+            _sftp_bytes.inc(len(data), direction='read')
+        return data
 
     @__gdp_log
     def write(self, offset, data):
         """Handle operations of same name"""
-        return super(SFTPHandle, self).write(offset, data)
+        self.sftpserver._expire_attr(getattr(self, "real_path", None))
+        _sftp_bytes.inc(len(data), direction='write')
+        if not self.write_behind:
+            return super(SFTPHandle, self).write(offset, data)
+        # Leave buffered data for the file object to write in large chunks
+        # rather than flushing after every packet like the default write
+        try:
+            if offset != self.write_pos:
+                self.writefile.seek(offset)
+            self.writefile.write(data)
+            self.write_pos = offset + len(data)
+        except IOError, err:
+            self.write_pos = None
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        return paramiko.SFTP_OK
 
     @__gdp_log
     def close(self):
         """Handle operations of same name"""
+        if self.readmap is not None:
+            self.readmap.close()
+            self.readmap = None
+        if self.write_behind:
+            # Report any delayed write errors on close
+            try:
+                self.writefile.flush()
+            except IOError, err:
+                self.logger.error("flush on close of %s failed: %s" %
+                                  (getattr(self, "path", "unknown"), err))
+                super(SFTPHandle, self).close()
+                return paramiko.SFTPServer.convert_errno(err.errno)
         return super(SFTPHandle, self).close()
 
 
@@ -343,10 +420,15 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
     logger = None
     transport = None
     root = None
+    # Seconds to trust stat results cached by list_folder and stat
+    attr_cache_ttl = 2
+    attr_cache_size = 10000
 
     def __init__(self, server, *largs, **kwargs):
         """Init"""
         paramiko.SFTPServerInterface.__init__(self, server)
+        # Per-session cache of recent stat results on real paths
+        self.attr_cache = {}
         # From openssh subsys global configuration and logger may be missing
         global configuration, logger
         if self.configuration:
@@ -532,6 +614,35 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
         #                                                     reply))
         return reply
 
+    def _cache_attr(self, real_path, stat_res):
+        """Save stat_res for real_path in the session attribute cache"""
+        if len(self.attr_cache) >= self.attr_cache_size:
+            self.attr_cache.clear()
+        self.attr_cache[real_path] = (time.time(), stat_res)
+
+    def _expire_attr(self, *real_paths):
+        """Remove cached attributes for real_paths and their parent dirs,
+        which change too when entries are created or removed.
+        """
+        for real_path in real_paths:
+            if real_path is None:
+                continue
+            self.attr_cache.pop(real_path, None)
+            self.attr_cache.pop(os.path.dirname(real_path), None)
+
+    def _stat(self, real_path):
+        """Returns the os.stat result for real_path using the session cache
+        if it was recently looked up. Raises OSError like os.stat on error.
+        """
+        cached = self.attr_cache.get(real_path, None)
+        if cached is not None:
+            (stamp, stat_res) = cached
+            if stamp + self.attr_cache_ttl >= time.time():
+                return stat_res
+        stat_res = os.stat(real_path)
+        self._cache_attr(real_path, stat_res)
+        return stat_res
+
     def _acceptable_chmod(self, sftp_path, mode):
         """Wrap helper"""
         # self.logger.debug("acceptable_chmod: %s" % sftp_path)
@@ -573,6 +684,7 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
         # not be a problem anymore. If it ain't broken...
         self.logger.info("chattr %s for path %s :: %s" %
                          (repr(attr), path, real_path))
+        self._expire_attr(real_path)
         ignored = True
         if getattr(attr, 'st_mode', None) is not None and attr.st_mode > 0:
             # self.logger.debug('_chattr st_mode: %s' % attr.st_mode)
@@ -637,6 +749,7 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
 
         # Only allow change of mode on files and only outside chmod_exceptions
         if self._acceptable_chmod(real_path, mode):
+            self._expire_attr(real_path)
             # Only allow permission changes that won't give excessive access
             # or remove own access.
             if os.path.isdir(path):
@@ -662,6 +775,7 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
 
     # Public interface functions
 
+    @timed(_sftp_op_seconds)
     def open(self, path, flags, attr):
         """Handle operations of same name"""
         path = force_utf8(path)
@@ -688,6 +802,8 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
             return paramiko.SFTP_PERMISSION_DENIED
         if not self.__gdp_log("open", path, flags=flags):
             return paramiko.SFTP_FAILURE
+        if flags != os.O_RDONLY:
+            self._expire_attr(real_path)
         handle = SFTPHandle(flags, sftpserver=self)
         setattr(handle, 'real_path', real_path)
         setattr(handle, 'path', path)
@@ -706,15 +822,16 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
             # self.logger.debug("chattr done on %s :: %s (%s %s)" % \
             #                  (path, real_path, repr(flags), repr(attr)))
             mode = flags_to_mode(flags)
+            access = flags & (os.O_RDONLY | os.O_WRONLY | os.O_RDWR)
             if flags == os.O_RDONLY:
-                # Read-only mode
-                readfile = open(real_path, mode)
+                # Read-only mode with read-ahead
+                readfile = open(real_path, mode, handle.read_buffer_size)
                 writefile = None
                 active = 'readfile'
-            elif flags == os.O_WRONLY:
-                # Write-only mode
+            elif access == os.O_WRONLY and not flags & os.O_APPEND:
+                # Write-only mode with write-behind
                 readfile = None
-                writefile = open(real_path, mode)
+                writefile = open(real_path, mode, handle.write_buffer_size)
                 active = 'writefile'
             else:
                 # All other modes are handled as read+write
@@ -723,6 +840,10 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
             setattr(handle, 'readfile', readfile)
             setattr(handle, 'writefile', writefile)
             setattr(handle, 'active', active)
+            if readfile is None:
+                handle.write_behind = True
+            elif writefile is None:
+                handle.map_readfile()
             # self.logger.debug("open done %s :: %s (%s %s)" % \
             #                  (path, real_path, str(handle), mode))
             return handle
@@ -732,6 +853,7 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
                               (path, real_path, mode, err))
             return paramiko.SFTP_FAILURE
 
+    @timed(_sftp_op_seconds)
     def list_folder(self, path):
         """Handle operations of same name"""
         path = force_utf8(path)
@@ -743,32 +865,47 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
             return paramiko.SFTP_PERMISSION_DENIED
         # self.logger.debug("list_folder %s :: %s" % (path, real_path))
         reply = []
-        if not os.path.exists(real_path):
-            self.logger.warning("list_folder on missing path %s :: %s" %
-                                (path, real_path))
-            return paramiko.SFTP_NO_SUCH_FILE
         try:
-            files = os.listdir(real_path)
+            # Combined listing and stat through scandir entries if available
+            if scandir is not None:
+                files = [(entry.name, entry.stat) for entry in
+                         scandir(real_path)]
+            else:
+                files = [(name, None) for name in os.listdir(real_path)]
+        except OSError, err:
+            if err.errno == errno.ENOENT:
+                self.logger.warning("list_folder on missing path %s :: %s" %
+                                    (path, real_path))
+                return paramiko.SFTP_NO_SUCH_FILE
+            self.logger.error("list_folder on %s :: %s failed: %s" %
+                              (path, real_path, err))
+            return paramiko.SFTP_FAILURE
         except Exception, err:
             self.logger.error("list_folder on %s :: %s failed: %s" %
                               (path, real_path, err))
             return paramiko.SFTP_FAILURE
         if not self.__gdp_log("list_folder", path):
             return paramiko.SFTP_FAILURE
-        for filename in files:
+        for (filename, entry_stat) in files:
             if invisible_path(filename):
                 continue
             full_name = ("%s/%s" % (real_path, filename)).replace("//", "/")
             # stat may fail e.g. if filename is a stale storage mount point
             try:
+                if entry_stat is not None:
+                    stat_res = entry_stat()
+                else:
+                    stat_res = os.stat(full_name)
+                self._cache_attr(full_name, stat_res)
                 reply.append(paramiko.SFTPAttributes.from_stat(
-                    os.stat(full_name), self._strip_root(filename)))
+                    stat_res, self._strip_root(filename)))
             except Exception, err:
                 self.logger.warning("list_folder %s: stat on %s failed: %s" %
                                     (path, full_name, err))
         # self.logger.debug("list_folder %s reply %s" % (path, reply))
         return reply
 
+    @timed(_sftp_op_seconds)
     def stat(self, path):
         """Handle operations of same name"""
         path = force_utf8(path)
@@ -779,19 +916,24 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
             self.logger.warning('stat %s: %s' % (path, err))
             return paramiko.SFTP_PERMISSION_DENIED
         # self.logger.debug("stat %s :: %s" % (path, real_path))
-        # for consistency with lstat
-        if not os.path.exists(real_path):
-            # It's common to check file existence with stat so don't warn
-            # self.logger.debug("stat on missing path %s :: %s" %
-            #                  (path, real_path))
-            return paramiko.SFTP_NO_SUCH_FILE
         try:
-            return paramiko.SFTPAttributes.from_stat(os.stat(real_path), path)
+            return paramiko.SFTPAttributes.from_stat(self._stat(real_path),
+                                                     path)
+        except OSError, err:
+            if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                # It's common to check file existence with stat so don't warn
+                # self.logger.debug("stat on missing path %s :: %s" %
+                #                  (path, real_path))
+                return paramiko.SFTP_NO_SUCH_FILE
+            self.logger.error("stat on %s :: %s failed: %s" %
+                              (path, real_path, err))
+            return paramiko.SFTP_FAILURE
         except Exception, err:
             self.logger.error("stat on %s :: %s failed: %s" %
                               (path, real_path, err))
             return paramiko.SFTP_FAILURE
 
+    @timed(_sftp_op_seconds)
     def lstat(self, path):
         """Handle operations of same name"""
         path = force_utf8(path)
@@ -802,19 +944,26 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
             self.logger.warning('lstat %s: %s' % (path, err))
             return paramiko.SFTP_PERMISSION_DENIED
         # self.logger.debug("lstat %s :: %s" % (path, real_path))
-        if not os.path.lexists(real_path):
-            # It's common to check file existence with stat so no warning here
-            # self.logger.debug("lstat on missing path %s :: %s" %
-            #                  (path, real_path))
-            return paramiko.SFTP_NO_SUCH_FILE
-        # self.logger.debug('return lstat %s' % path)
         try:
-            return paramiko.SFTPAttributes.from_stat(os.stat(real_path), path)
+            return paramiko.SFTPAttributes.from_stat(self._stat(real_path),
+                                                     path)
+        except OSError, err:
+            # Only dangling links exist without target stat
+            if err.errno in (errno.ENOENT, errno.ENOTDIR) and \
+                    not os.path.lexists(real_path):
+                # It's common to check file existence with stat so no warning
+                # self.logger.debug("lstat on missing path %s :: %s" %
+                #                  (path, real_path))
+                return paramiko.SFTP_NO_SUCH_FILE
+            self.logger.error("lstat on %s :: %s failed: %s" %
+                              (path, real_path, err))
+            return paramiko.SFTP_FAILURE
         except Exception, err:
             self.logger.error("lstat on %s :: %s failed: %s" %
                               (path, real_path, err))
             return paramiko.SFTP_FAILURE
 
+    @timed(_sftp_op_seconds)
     def remove(self, path):
         """Handle operations of same name"""
         path = force_utf8(path)
@@ -841,6 +990,7 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
         if not self.__gdp_log("remove", path):
             return paramiko.SFTP_FAILURE
         try:
+            self._expire_attr(real_path)
             os.remove(real_path)
             self.logger.info("removed %s :: %s" % (path, real_path))
             return paramiko.SFTP_OK
@@ -850,6 +1000,7 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
                               (path, real_path, err))
             return paramiko.SFTP_FAILURE
 
+    @timed(_sftp_op_seconds)
     def rename(self, oldpath, newpath):
         """Handle operations of same name"""
         oldpath = force_utf8(oldpath)
@@ -883,6 +1034,8 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
         try:
             # Use shutil move to allow move to other file system like external
             # storage mounted file systems
+            # Any cached attributes of moved dir contents are stale now, too
+            self.attr_cache.clear()
             shutil.move(real_oldpath, real_newpath)
             self.logger.info("renamed %s to %s :: %s to %s"
                              % (oldpath, newpath, real_oldpath, real_newpath))
@@ -894,6 +1047,7 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
                               (real_oldpath, real_newpath, err))
             return paramiko.SFTP_FAILURE
 
+    @timed(_sftp_op_seconds)
     def mkdir(self, path, mode):
         """Handle operations of same name"""
         path = force_utf8(path)
@@ -915,6 +1069,7 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
             return paramiko.SFTP_FAILURE
         try:
             # Force MiG default mode
+            self._expire_attr(real_path)
             os.mkdir(real_path, 0755)
             self.logger.info("made dir %s :: %s" % (path, real_path))
             return paramiko.SFTP_OK
@@ -924,6 +1079,7 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
                               (path, real_path, err))
             return paramiko.SFTP_FAILURE
 
+    @timed(_sftp_op_seconds)
     def rmdir(self, path):
         """Handle operations of same name"""
         path = force_utf8(path)
@@ -950,6 +1106,7 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
             return paramiko.SFTP_FAILURE
         # self.logger.debug("rmdir on path %s :: %s" % (path, real_path))
         try:
+            self._expire_attr(real_path)
             os.rmdir(real_path)
             self.logger.info("removed dir %s :: %s" % (path, real_path))
             return paramiko.SFTP_OK
@@ -959,14 +1116,17 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
                               (path, real_path, err))
             return paramiko.SFTP_FAILURE
 
+    @timed(_sftp_op_seconds)
     def chattr(self, path, attr):
         """Handle operations of same name"""
         return self._chattr(path, attr)
 
+    @timed(_sftp_op_seconds)
     def chmod(self, path, mode):
         """Handle operations of same name"""
         return self._chmod(path, mode)
 
+    @timed(_sftp_op_seconds)
     def readlink(self, path):
         """Handle operations of same name"""
         path = force_utf8(path)
@@ -987,6 +1147,7 @@ class SimpleSftpServer(paramiko.SFTPServerInterface):
                                 (path, real_path, err))
             return paramiko.SFTP_FAILURE
 
+    @timed(_sftp_op_seconds)
     def symlink(self, target_path, path):
         """Handle operations of same name"""
         target_path = force_utf8(target_path)
@@ -1249,14 +1410,216 @@ def update_sftp_login_map(daemon_conf, username, password=False, key=False):
     return daemon_conf
 
 
-def accept_client(client, addr, root_dir, host_rsa_key, conf={}):
-    """Handle a single client session"""
+class SessionWorkerPool(object):
+    """Bounded pool of worker threads handling the login phase of client
+    sessions. Accepted connections are queued for the workers and new
+    workers are only started when no idle ones are left and the pool is
+    below max_workers. Admission control rejects connections right away when
+    the queue of waiting connections is full or max_sessions connections are
+    already open and closes any that waited longer than max_wait seconds for
+    a worker. Workers exit after idle_timeout seconds without connections to
+    hand back resources after load peaks.
+    The handler must return a tuple with the transport and a logout function
+    once the session is established or None if it already ended. The worker
+    is then released and a single monitor thread calls logout when the
+    transport is no longer active.
+    """
+
+    def __init__(self, handler, max_workers, max_queued, max_wait,
+                 stop_running, idle_timeout=300, max_sessions=-1):
+        """Init pool calling handler(client, addr) for each connection"""
+        self.handler = handler
+        self.max_workers = max_workers
+        self.max_wait = max_wait
+        self.stop_running = stop_running
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.__queue = Queue.Queue(max_queued)
+        self.__lock = threading.Lock()
+        self.__workers = 0
+        self.__idle = 0
+        self.__connections = {}
+        self.__sessions = {}
+        self.__monitor_thread = None
+        self.__stats = {'accepted': 0, 'rejected': 0, 'expired': 0,
+                        'finished': 0, 'failed': 0}
+
+    def __account(self, addr, **kwargs):
+        """Update or remove the accounting entry for connection from addr.
+        The caller must hold the pool lock.
+        """
+        if kwargs:
+            self.__connections.setdefault(addr, {}).update(kwargs)
+        else:
+            return self.__connections.pop(addr, {})
+
+    def __worker(self):
+        """Handle queued connections until idle for too long or stopped"""
+        idle_since = time.time()
+        while not self.stop_running.is_set():
+            self.__lock.acquire()
+            self.__idle += 1
+            self.__lock.release()
+            try:
+                (client, addr, queued) = self.__queue.get(timeout=1)
+            except Queue.Empty:
+                client = None
+            self.__lock.acquire()
+            self.__idle -= 1
+            if client is None:
+                if idle_since + self.idle_timeout < time.time():
+                    self.__workers -= 1
+                    self.__lock.release()
+                    return
+                self.__lock.release()
+                continue
+            now = time.time()
+            if queued + self.max_wait < now:
+                self.__stats['expired'] += 1
+                self.__account(addr)
+                self.__lock.release()
+                logger.warning("closing connection from %s after waiting "
+                               "%.1fs for a session worker" %
+                               (addr, now - queued))
+                client.close()
+                continue
+            self.__account(addr, started=now, waited=now - queued)
+            self.__lock.release()
+            try:
+                session = self.handler(client, addr)
+                outcome = 'finished'
+            except Exception, exc:
+                logger.error("session handler failed for %s: %s" %
+                             (addr, exc))
+                session = None
+                outcome = 'failed'
+                client.close()
+            if session is None:
+                self.__done(addr, outcome)
+            else:
+                self.__lock.acquire()
+                self.__sessions[addr] = session
+                if self.__monitor_thread is None:
+                    self.__monitor_thread = threading.Thread(
+                        target=self.__monitor)
+                    self.__monitor_thread.daemon = True
+                    self.__monitor_thread.start()
+                self.__lock.release()
+            idle_since = time.time()
+        self.__lock.acquire()
+        self.__workers -= 1
+        self.__lock.release()
+
+    def __done(self, addr, outcome):
+        """Account for ended connection from addr with outcome"""
+        self.__lock.acquire()
+        self.__stats[outcome] += 1
+        entry = self.__account(addr)
+        self.__lock.release()
+        now = time.time()
+        logger.info("session from %s for %s done after %.1fs (waited "
+                    "%.3fs)" % (addr, entry.get('username', None),
+                                now - entry.get('started', now),
+                                entry.get('waited', 0)))
+
+    def __monitor(self):
+        """Call logout for established sessions once their transport is no
+        longer active and close all transports when stopped. Exits when no
+        sessions are left.
+        """
+        while True:
+            time.sleep(1)
+            self.__lock.acquire()
+            if not self.__sessions:
+                self.__monitor_thread = None
+                self.__lock.release()
+                return
+            sessions = self.__sessions.items()
+            self.__lock.release()
+            stopping = self.stop_running.is_set()
+            for (addr, (transport, logout)) in sessions:
+                if stopping:
+                    transport.close()
+                if transport.is_active():
+                    continue
+                self.__lock.acquire()
+                del self.__sessions[addr]
+                self.__lock.release()
+                try:
+                    logout()
+                    outcome = 'finished'
+                except Exception, exc:
+                    logger.error("session logout failed for %s: %s" %
+                                 (addr, exc))
+                    outcome = 'failed'
+                self.__done(addr, outcome)
+
+    def submit(self, client, addr):
+        """Queue client connection from addr for a session worker. Returns
+        False if the connection was rejected due to a full queue or too many
+        open sessions and True otherwise.
+        """
+        self.__lock.acquire()
+        try:
+            if self.max_sessions >= 0 and \
+                    len(self.__connections) >= self.max_sessions:
+                self.__stats['rejected'] += 1
+                return False
+            try:
+                self.__queue.put_nowait((client, addr, time.time()))
+            except Queue.Full:
+                self.__stats['rejected'] += 1
+                return False
+            self.__stats['accepted'] += 1
+            self.__account(addr, queued=time.time())
+            if self.__idle < self.__queue.qsize() and \
+                    self.__workers < self.max_workers:
+                self.__workers += 1
+                worker = threading.Thread(target=self.__worker)
+                worker.daemon = True
+                worker.start()
+            return True
+        finally:
+            self.__lock.release()
+
+    def account(self, addr, **kwargs):
+        """Save kwargs in the accounting entry for connection from addr"""
+        self.__lock.acquire()
+        try:
+            if self.__connections.has_key(addr):
+                self.__account(addr, **kwargs)
+        finally:
+            self.__lock.release()
+
+    def stats(self):
+        """Returns a dictionary with pool usage and connection counters"""
+        self.__lock.acquire()
+        try:
+            stats = dict(self.__stats)
+            stats['workers'] = self.__workers
+            stats['idle'] = self.__idle
+            stats['queued'] = self.__queue.qsize()
+            stats['active'] = len([i for i in self.__connections.values()
+                                   if i.has_key('started')])
+            stats['sessions'] = len(self.__sessions)
+            return stats
+        finally:
+            self.__lock.release()
+
+
+def accept_client(client, addr, root_dir, host_key, conf={}):
+    """Handle login of a single client session. The host_key is the parsed
+    paramiko key shared by all sessions but a raw RSA key string is still
+    accepted.
+    Returns a tuple with the session transport and a logout function to call
+    once the transport is no longer active.
+    """
     # logger.debug("In session handler thread from %s %s" % (client, addr))
 
     window_size = conf.get('window_size', DEFAULT_WINDOW_SIZE)
     max_packet_size = conf.get('max_packet_size', DEFAULT_MAX_PACKET_SIZE)
-    host_key_file = StringIO(host_rsa_key)
-    host_key = paramiko.RSAKey(file_obj=host_key_file)
+    if isinstance(host_key, basestring):
+        host_key = paramiko.RSAKey(file_obj=StringIO(host_key))
     transport = paramiko.Transport(client, default_window_size=window_size,
                                    default_max_packet_size=max_packet_size)
     # Restrict transport to strong ciphers+kex+digests used in OpenSSH
@@ -1377,6 +1740,8 @@ def accept_client(client, addr, root_dir, host_rsa_key, conf={}):
     gdp_project = False
     if username is not None:
         success = True
+        if conf.get('session_pool', None):
+            conf['session_pool'].account(addr, username=username)
         active_count = active_sessions(configuration, 'sftp', username)
         logger.info("Proceed with login for %s with %d active sessions"
                     % (username, active_count))
@@ -1413,18 +1778,17 @@ def accept_client(client, addr, root_dir, host_rsa_key, conf={}):
         transport.close()
 
     # Ignore user connection here as we only care about sftp.
-    # Keep the connection alive until user disconnects or server is halted.
+    # The session pool keeps the connection alive until user disconnects or
+    # server is halted and then calls logout.
 
     # NOTE: is_active check does not seem to always catch broken connections
     # http://stackoverflow.com/questions/20147902/how-to-know-if-a-paramiko-ssh-channel-is-disconnected
     #       We try to keep connections alive and force failure with timeout.
 
-    while transport.is_active():
-        if conf['stop_running'].is_set():
-            transport.close()
-        time.sleep(1)
-
-    if username is not None:
+    def logout():
+        """Log out and clean up after session ended"""
+        if username is None:
+            return
         if success:
             msg = "Logout for %s from %s" % (username, addr, )
             print msg
@@ -1439,6 +1803,8 @@ def accept_client(client, addr, root_dir, host_rsa_key, conf={}):
             if active_count == 0:
                 project_close(configuration, 'sftp', addr[0], username)
 
+    return (transport, logout)
+
 
 def start_service(configuration):
     """Service daemon"""
@@ -1452,7 +1818,7 @@ def start_service(configuration):
         # Allow reuse of socket to avoid TCP time outs
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_socket.bind((daemon_conf['address'], daemon_conf['port']))
-        server_socket.listen(10)
+        server_socket.listen(configuration.user_sftp_backlog)
     except Exception, err:
         err_msg = 'Could not open socket: %s' % err
         logger.error(err_msg)
@@ -1464,6 +1830,30 @@ def start_service(configuration):
     logger.info("accept connections: window_size %d / max_packet_size %d" %
                 (window_size, max_packet_size))
 
+    def handle_session(client, addr):
+        """Session login handler for the worker pool"""
+        return accept_client(client, addr, daemon_conf['root_dir'],
+                             daemon_conf['host_key'], daemon_conf)
+
+    session_pool = SessionWorkerPool(
+        handle_session, configuration.user_sftp_max_workers,
+        configuration.user_sftp_backlog, daemon_conf['auth_timeout'],
+        daemon_conf['stop_running'],
+        max_sessions=configuration.user_sftp_session_limit)
+    daemon_conf['session_pool'] = session_pool
+
+    pool_usage = gauge('sftp_session_pool', 'sftp session worker pool usage',
+                       ('state', ))
+    for name in ('workers', 'idle', 'queued', 'active', 'sessions'):
+        pool_usage.set_function(lambda name=name: session_pool.stats()[name],
+                                state=name)
+    pool_sessions = counter('sftp_pool_sessions_total', 'sftp connections '
+                            'handled by the session pool', ('outcome', ))
+    for name in ('accepted', 'rejected', 'expired', 'finished', 'failed'):
+        pool_sessions.set_function(
+            lambda name=name: session_pool.stats()[name], outcome=name)
+    serve_metrics(configuration, 'sftp')
+
     min_expire_delay = 300
     last_expire = time.time()
     while True:
@@ -1484,17 +1874,21 @@ def start_service(configuration):
             logger.warning('ignoring failed client connection for %s: %s' %
                            (client_tuple, err))
             continue
-        logger.info("Handling new session from %s %s (%d active sessions)" %
-                    (client, addr, threading.active_count()))
-        worker = threading.Thread(target=accept_client,
-                                  args=[client, addr, daemon_conf['root_dir'],
-                                        daemon_conf['host_rsa_key'],
-                                        daemon_conf])
-        worker.start()
+        if not session_pool.submit(client, addr):
+            logger.warning("Rejecting session from %s with backlog or "
+                           "session limit full: %s" % (addr,
+                                                       session_pool.stats()))
+            client.close()
+            continue
+        logger.info("Queued new session from %s %s" % (client, addr))
         if last_expire + min_expire_delay < time.time():
             last_expire = time.time()
             expire_rate_limit(configuration, "sftp", 
                 expire_delay=min_expire_delay)
+            daemon_conf['hash_cache'].expire()
+            logger.debug("hash cache stats: %s" %
+                         daemon_conf['hash_cache'].stats())
+            logger.info("session pool stats: %s" % session_pool.stats())
 
 
 if __name__ == "__main__":
@@ -1575,6 +1969,8 @@ i4HdbgS6M21GvqIfhN2NncJ00aJukr5L29JrKFgSCPP9BDRb9Jgy0gu1duhTv0C0
     except IOError:
         logger.info("No valid host key provided - using default")
         host_rsa_key = default_host_key
+    # Parse host key once and share it between all sessions
+    host_key = paramiko.RSAKey(file_obj=StringIO(host_rsa_key))
 
     # Lookup chroot exceptions once and for all
     chroot_exceptions = user_chroot_exceptions(configuration)
@@ -1592,14 +1988,17 @@ i4HdbgS6M21GvqIfhN2NncJ00aJukr5L29JrKFgSCPP9BDRb9Jgy0gu1duhTv0C0
         'allow_publickey': 'publickey' in configuration.user_sftp_auth,
         'user_alias': configuration.user_sftp_alias,
         'host_rsa_key': host_rsa_key,
+        'host_key': host_key,
         # Lock needed here due to threaded creds updates
         'creds_lock': threading.Lock(),
-        'users': [],
-        'jobs': [],
-        'shares': [],
-        'jupyter_mounts': [],
+        'users': {},
+        'jobs': {},
+        'shares': {},
+        'jupyter_mounts': {},
         'login_map': {},
-        'hash_cache': {},
+        'hash_cache': AuthCache(),
+        'creds_watcher': init_creds_watcher(configuration),
+        'twofactor_index': init_twofactor_index(configuration),
         'time_stamp': 0,
         'logger': logger,
         'auth_timeout': 60,
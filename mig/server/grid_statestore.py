@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# --- BEGIN_HEADER ---
+#
+# grid_statestore - shared rate limit and session state store daemon
+# Copyright (C) 2003-2020  The MiG Project lead by Brian Vinter
+#
+# This file is part of MiG.
+#
+# MiG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# MiG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# -- END_HEADER ---
+#
+
+"""Serve the rate limit and session state store shared by the io daemons
+on the local unix socket set in user_state_store.
+"""
+
+import os
+import signal
+import sys
+
+from shared.conf import get_configuration_object
+from shared.griddaemons.statestore import serve_state_store
+from shared.logger import daemon_logger, register_hangup_handler
+
+configuration, logger = None, None
+
+
+def handle_stop(signum, stack):
+    print "Got signal %s - fake ctrl-c" % signum
+    raise KeyboardInterrupt
+
+
+if __name__ == '__main__':
+    # Force no log init since we use separate logger
+    configuration = get_configuration_object(skip_log=True)
+
+    log_level = configuration.loglevel
+    if sys.argv[1:] and sys.argv[1] in ['debug', 'info', 'warning', 'error']:
+        log_level = sys.argv[1]
+
+    # Use separate logger
+    logger = daemon_logger("statestore", configuration.user_statestore_log,
+                           log_level)
+    configuration.logger = logger
+
+    # Allow e.g. logrotate to force log re-open after rotates
+    register_hangup_handler(configuration)
+
+    # Allow clean exit
+    signal.signal(signal.SIGTERM, handle_stop)
+
+    address = configuration.user_state_store
+    if not address:
+        err_msg = "No user_state_store socket set in configuration!"
+        logger.error(err_msg)
+        print err_msg
+        sys.exit(1)
+
+    print """
+Running grid state store for rate limits and sessions shared by io daemons.
+
+Set the MIG_CONF environment to the server configuration path
+unless it is available in mig/server/MiGserver.conf
+"""
+
+    print 'Starting state store daemon on %s - Ctrl-C to quit' % address
+    logger.info("Starting state store daemon on %s" % address)
+    try:
+        serve_state_store(configuration, address)
+    except KeyboardInterrupt:
+        pass
+    except Exception, exc:
+        msg = 'Caught unexpected exception: %s' % exc
+        logger.error(msg)
+        print msg
+
+    if os.path.exists(address):
+        os.remove(address)
+    print 'State store daemon shutting down'
+    sys.exit(0)
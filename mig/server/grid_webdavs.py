@@ -36,6 +36,7 @@ per-user subdir chrooting inside root_dir.
 """
 
 import os
+import stat
 import sys
 import threading
 import time
@@ -54,10 +55,11 @@ try:
     from wsgidav.error_printer import ErrorPrinter
     from wsgidav.fs_dav_provider import FileResource, FolderResource, \
         FilesystemProvider
+    from wsgidav.dav_provider import DAVCollection, DAVNonCollection
     from wsgidav.domain_controller import WsgiDAVDomainController
     from wsgidav.http_authenticator import HTTPAuthenticator
     from wsgidav.dav_error import DAVError, HTTP_FORBIDDEN
-    from wsgidav.util import getRfc1123Time
+    from wsgidav.util import getRfc1123Time, joinUri
 except ImportError, ierr:
     print "ERROR: the python wsgidav module is required for this daemon"
     print "You may need to install cherrypy if your wsgidav does not bundle it"
@@ -75,12 +77,14 @@ from shared.griddaemons.davs import get_fs_path, acceptable_chmod, \
     update_login_map, login_map_lookup, hit_rate_limit, expire_rate_limit, \
     add_user_object, track_open_session, clear_sessions, \
     track_close_session, track_close_expired_sessions, \
-    get_active_session, check_twofactor_session, validate_auth_attempt
+    get_active_session, check_twofactor_session, validate_auth_attempt, \
+    AuthCache, init_creds_watcher, init_twofactor_index
 from shared.pwhash import make_scramble
 from shared.sslsession import ssl_session_token
 from shared.tlsserver import hardened_ssl_context
 from shared.logger import daemon_logger, daemon_gdp_logger, \
     register_hangup_handler
+from shared.metrics import gauge, histogram, serve_metrics
 from shared.notification import send_system_notification
 from shared.pwhash import unscramble_digest, assure_password_strength
 from shared.useradm import check_password_hash, generate_password_hash, \
@@ -89,6 +93,8 @@ from shared.validstring import possible_user_id, possible_sharelink_id
 
 configuration, logger = None, None
 
+_request_seconds = histogram('davs_request_seconds', 'Run time of davs '
+                             'requests including response', ('method', ))
 
 def _handle_allowed(request, abs_path):
     """Helper to make sure ordinary handle of a COPY, MOVE or DELETE
@@ -127,6 +133,21 @@ def _get_addr(environ):
     return addr
 
 
+def _cached_stat(environ, path):
+    """Stat helper with a cache of results for the rest of the request in
+    environ. Only used for PROPFIND where no files change during the request
+    and we would otherwise stat each entry several times when listing.
+    Raises OSError like os.stat if path is missing.
+    """
+    if environ.get('REQUEST_METHOD', None) != 'PROPFIND':
+        return os.stat(path)
+    stat_cache = environ.setdefault('mig.stat_cache', {})
+    path_stat = stat_cache.get(path, None)
+    if path_stat is None:
+        path_stat = stat_cache[path] = os.stat(path)
+    return path_stat
+
+
 def _get_port(environ):
     """Extract client port from environ dict"""
     port = environ.get('HTTP_X_FORWARDED_FOR_PORT', '')
@@ -680,14 +701,15 @@ class MiGWsgiDAVDomainController(WsgiDAVDomainController):
         self.user_map = self.userMap = userMap
         self.last_expire = time.time()
         self.min_expire_delay = 300
-        self.hash_cache = {}
-        self.digest_cache = {}
+        self.hash_cache = AuthCache()
+        self.digest_cache = AuthCache()
 
     def _expire_caches(self):
         """Expire old entries in the hash and digest caches"""
-        self.hash_cache.clear()
-        self.digest_cache.clear()
-        # logger.debug("Expired hash and digest caches")
+        self.hash_cache.expire()
+        self.digest_cache.expire()
+        logger.debug("hash cache stats: %s ; digest cache stats: %s" %
+                     (self.hash_cache.stats(), self.digest_cache.stats()))
 
     def _expire_volatile(self):
         """Expire old entries in the volatile helper dictionaries"""
@@ -838,11 +860,15 @@ class MiGFileResource(FileResource):
     """
 
     def __init__(self, path, environ, filePath):
+        """Mimic FileResource constructor but with cached stat"""
         self.username = _username_from_env(environ)
         self.ip_addr = _get_addr(environ)
-        FileResource.__init__(self, path, environ, filePath)
         if invisible_path(path):
             raise DAVError(HTTP_FORBIDDEN)
+        DAVNonCollection.__init__(self, path, environ)
+        self._filePath = filePath
+        self.filestat = _cached_stat(environ, filePath)
+        self.name = os.path.basename(filePath).encode('utf8')
 
     def __allow_handle(method):
         """Decorator wrapper for _handle_allowed"""
@@ -965,11 +991,15 @@ class MiGFolderResource(FolderResource):
     """
 
     def __init__(self, path, environ, filePath):
+        """Mimic FolderResource constructor but with cached stat"""
         self.username = _username_from_env(environ)
         self.ip_addr = _get_addr(environ)
-        FolderResource.__init__(self, path, environ, filePath)
         if invisible_path(path):
             raise DAVError(HTTP_FORBIDDEN)
+        DAVCollection.__init__(self, path, environ)
+        self._filePath = filePath
+        self.filestat = _cached_stat(environ, filePath)
+        self.name = os.path.basename(filePath).encode('utf8')
 
     def __allow_handle(method):
         """Decorator wrapper for _handle_allowed"""
@@ -1096,11 +1126,26 @@ class MiGFolderResource(FolderResource):
 
         See DAVCollection.getMemberNames()
 
-        Use parent version and filter out any invisible file names.
+        Like parent version but filter out any invisible file names and stat
+        each entry just once with the result cached for getMember.
         """
         # logger.debug("in getMemberNames: %s" % self.path)
-        return [i for i in super(MiGFolderResource, self).getMemberNames() if
-                not invisible_path(i)]
+        nameList = []
+        for name in os.listdir(self._filePath):
+            if not isinstance(name, unicode):
+                name = name.decode(sys.getfilesystemencoding())
+            if invisible_path(name):
+                continue
+            # Skip non files (broken links and special files)
+            try:
+                mode = _cached_stat(self.environ,
+                                    os.path.join(self._filePath, name))[0]
+            except OSError:
+                continue
+            if not stat.S_ISDIR(mode) and not stat.S_ISREG(mode):
+                continue
+            nameList.append(name.encode('utf8'))
+        return nameList
 
     def getMember(self, name):
         """Return direct collection member (DAVResource or derived).
@@ -1111,23 +1156,55 @@ class MiGFolderResource(FolderResource):
         self.getMember on all folder names, so we need to override here to
         avoid the FolderResource and FileResource objects being returned.
 
-        Call parent version, filter invisible and mangle to our own
-        MiGFileResource and MiGFolderResource objects.
+        Directly create our own MiGFileResource and MiGFolderResource objects
+        without going through the parent version to avoid creating and
+        stat'ing each resource twice. Invisible names are filtered.
         """
         # logger.debug("in getMember: %s" % name)
-        res = FolderResource.getMember(self, name)
-        if invisible_path(res.name):
+        if invisible_path(name):
+            return None
+        filePath = os.path.join(self._filePath, name.decode('utf8'))
+        path = joinUri(self.path, name)
+        try:
+            mode = _cached_stat(self.environ, filePath)[0]
+        except OSError:
+            return None
+        if stat.S_ISDIR(mode):
+            res = MiGFolderResource(path, self.environ, filePath)
+        elif stat.S_ISREG(mode):
+            res = MiGFileResource(path, self.environ, filePath)
+        else:
+            # logger.debug("Skipping non-file %s" % path)
             res = None
-        # logger.debug("getMember found %s" % res)
-        if res and not res.isCollection and \
-                not isinstance(res, MiGFileResource):
-            res = MiGFileResource(res.path, self.environ, res._filePath)
-        elif res and res.isCollection and \
-                not isinstance(res, MiGFolderResource):
-            res = MiGFolderResource(res.path, self.environ, res._filePath)
         # logger.debug("getMember returning %s" % res)
         return res
 
+    def _iterDescendants(self, collections, resources, depthFirst, depth,
+                         addSelf):
+        """Generator version of the getDescendants walk. Yields resources
+        one at a time so that only the current branch is kept in memory.
+        """
+        if addSelf and not depthFirst:
+            yield self
+        if depth != "0":
+            for name in self.getMemberNames():
+                child = self.getMember(name)
+                if child is None:
+                    continue
+                want = (collections and child.isCollection) or \
+                    (resources and not child.isCollection)
+                if want and not depthFirst:
+                    yield child
+                if child.isCollection and depth == "infinity":
+                    for res in child._iterDescendants(collections, resources,
+                                                      depthFirst, depth,
+                                                      False):
+                        yield res
+                if want and depthFirst:
+                    yield child
+        if addSelf and depthFirst:
+            yield self
+
     def getDescendants(self, collections=True, resources=True,
                        depthFirst=False, depth="infinity", addSelf=False):
         """Return a list _DAVResource objects of a collection (children,
@@ -1146,12 +1223,19 @@ class MiGFolderResource(FolderResource):
         depth : string
         '0' | '1' | 'infinity'
 
-        Call parent version just with debug logging added.
+        Same walk as parent version but for PROPFIND we return a generator
+        instead of a list, so that the multistatus response is built while
+        walking rather than after collecting all resources of a possibly huge
+        tree. Other methods like COPY and DELETE iterate the result more than
+        once and still get a list.
         """
-        # logger.debug("in getDescendantsWrap for %s" % self)
-        res = FolderResource.getDescendants(self, collections, resources,
-                                            depthFirst, depth, addSelf)
-        # logger.debug("getDescendants wrap returning %s" % res)
+        # logger.debug("in getDescendants for %s" % self)
+        assert depth in ("0", "1", "infinity")
+        res = self._iterDescendants(collections, resources, depthFirst, depth,
+                                    addSelf)
+        if self.environ.get('REQUEST_METHOD', None) != 'PROPFIND':
+            res = list(res)
+        # logger.debug("getDescendants returning %s" % res)
         return res
 
 
@@ -1361,6 +1445,47 @@ class SessionExpire(threading.Thread):
         # logger.debug("SessionExpire Thread: #%s" % self.ident)
 
 
+class _TimedResponse(object):
+    """Response iterable wrapper observing request time on close"""
+
+    def __init__(self, result, method, start):
+        """Init wrapper"""
+        self.result = result
+        self.method = method
+        self.start = start
+
+    def __iter__(self):
+        """Iterate wrapped response"""
+        return iter(self.result)
+
+    def close(self):
+        """Close wrapped response and observe total request time"""
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            _request_seconds.observe(time.time() - self.start,
+                                     method=self.method)
+
+
+class MetricsTimer(object):
+    """WSGI wrapper timing requests per method. Keeps the wrapped application
+    in _application like the wsgidav middleware so that the stack can still
+    be traversed e.g. in _find_authenticator.
+    """
+
+    def __init__(self, application):
+        """Init wrapper"""
+        self._application = application
+
+    def __call__(self, environ, start_response):
+        """Time request"""
+        start = time.time()
+        method = environ.get('REQUEST_METHOD', 'UNKNOWN')
+        result = self._application(environ, start_response)
+        return _TimedResponse(result, method, start)
+
+
 class LogStats(threading.Thread):
     """Log server and auth statistics """
 
@@ -1385,6 +1510,19 @@ class LogStats(threading.Thread):
         except Exception:
             self.stats['auth'] = None
             logger.warning("Failed to retreive auth stats")
+        server_usage = gauge('davs_server', 'davs server thread pool and '
+                             'request stats', ('stat', ))
+        for name in ('Queue', 'Threads', 'Threads Idle', 'Requests',
+                     'Bytes Read', 'Bytes Written', 'Socket Errors'):
+            server_usage.set_function(lambda name=name: self._server_stat(
+                name), stat=name.lower().replace(' ', '_'))
+
+    def _server_stat(self, name):
+        """Returns the current value of server stat with name"""
+        value = self.stats['server'][name]
+        if callable(value):
+            value = value(self.stats['server'])
+        return value
 
     def _log_stats(self, force=False):
         """Perform actual logging"""
@@ -1567,7 +1705,8 @@ def run(configuration):
     # Use bundled CherryPy WSGI Server to support SSL
     version = "%s WebDAV" % configuration.short_title
     server = wsgiserver.CherryPyWSGIServer((config["host"], config["port"]),
-                                           app, server_name=version)
+                                           MetricsTimer(app),
+                                           server_name=version)
     server.stats['Enabled'] = config['enable_stats']
 
     logger.info('Listening on %(host)s (%(port)s)' % config)
@@ -1575,6 +1714,7 @@ def run(configuration):
     sessionexpiretracker = SessionExpire()
     logstats = LogStats(config, server, interval=60,
                         idle_only=False, change_only=True)
+    serve_metrics(configuration, 'davs')
 
     try:
         sessionexpiretracker.start()
@@ -1670,8 +1810,8 @@ unless it is available in mig/server/MiGserver.conf
         'user_alias': configuration.user_davs_alias,
         # Lock needed here due to threaded creds updates
         'creds_lock': threading.Lock(),
-        'users': [],
-        'shares': [],
+        'users': {},
+        'shares': {},
         'login_map': {},
         # NOTE: enable for litmus test (http://www.webdav.org/neon/litmus/)
         #
@@ -1683,6 +1823,8 @@ unless it is available in mig/server/MiGserver.conf
         # ./configure --with-ssl
         # make URL=$HTTPS_URL CREDS="%(litmus_id)s %(litmus_password)s" check
         'litmus_password': litmus_password,
+        'creds_watcher': init_creds_watcher(configuration),
+        'twofactor_index': init_twofactor_index(configuration),
         'time_stamp': 0,
         'logger': logger,
         # TODO: Add the following to configuration:
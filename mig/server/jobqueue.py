@@ -27,6 +27,8 @@
 
 """MiG server job queue"""
 
+import cPickle
+
 
 def format_job(job_dict, detail=['JOB_ID']):
 
@@ -183,4 +185,352 @@ class JobQueue:
                                % jobid)
         return job
 
+    def log_update(self, job):
+        """Plain queues have no journal to record in-place job changes in"""
+
+        pass
+
+
+
+
+class IndexedJobQueue(JobQueue):
+
+    """Job queue with a JOB_ID index and an order-maintaining Fenwick tree.
+
+    Jobs live in an append-only slot list where removed jobs leave a None
+    tombstone behind. A binary indexed tree over the slots counts the live
+    jobs so that positional lookups map to slots in O(log n), while the
+    JOB_ID index gives O(1) lookup and O(log n) removal by job ID.
+    Appending at the end of the queue is O(log n) and tombstones are
+    compacted away once they outnumber the live jobs, so removal stays
+    amortized O(log n). Inserting at any other index falls back to an O(n)
+    rebuild, just like list insertion in the plain JobQueue.
+
+    Changes can optionally be appended to a journal file as they happen so
+    that the queue can be recovered from the last pickled snapshot plus the
+    journal records written since then. Records carry a sequence number,
+    which is saved with the snapshot to tell which records it includes.
+    """
+
+    slots = None
+    tree = None
+    live = 0
+    slot_map = None
+    journal = None
+    journal_seq = 0
+    journal_records = 0
+
+    # Don't bother compacting tiny queues
+
+    min_compact = 1024
+
+    def __init__(self, logger):
+        """Init"""
+
+        self.logger = logger
+        self.__rebuild([])
+        self.logger.info('initialised indexed queue')
+
+    def __getstate__(self):
+        """Leave out logger and journal file when pickling"""
+
+        state = self.__dict__.copy()
+        state['logger'] = None
+        state['journal'] = None
+        return state
+
+    def __log_change(self, *record):
+        """Append record of a queue change to the journal if enabled"""
+
+        if self.journal is None:
+            return
+        self.journal_seq += 1
+        self.journal_records += 1
+        try:
+            cPickle.dump((self.journal_seq, ) + record, self.journal,
+                         cPickle.HIGHEST_PROTOCOL)
+            self.journal.flush()
+        except Exception, exc:
+            self.logger.error('failed to write queue journal record: %s'
+                              % exc)
+
+    def open_journal(self, path):
+        """Append all further queue changes to the journal in path"""
+
+        self.journal = open(path, 'ab')
+        self.journal_records = 0
+
+    def close_journal(self):
+        """Stop journaling queue changes"""
+
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = None
+
+    def reset_journal(self):
+        """Truncate journal after all changes went into a saved snapshot"""
+
+        if self.journal is not None:
+            self.journal.seek(0)
+            self.journal.truncate()
+        self.journal_records = 0
+
+    def replay_journal(self, path):
+        """Apply any journal records from path which are newer than the
+        queue state. Returns the number of records applied.
+        A broken last record from a crash is ignored and cut off to keep
+        the journal usable for appending.
+        """
+
+        (journal, self.journal) = (self.journal, None)
+        applied = 0
+        try:
+            handle = open(path, 'r+b')
+        except IOError:
+            self.journal = journal
+            return applied
+        try:
+            while True:
+                offset = handle.tell()
+                try:
+                    record = cPickle.load(handle)
+                except Exception, exc:
+
+                    # Plain end of journal or a partially written record
+
+                    handle.seek(0, 2)
+                    if handle.tell() > offset:
+                        self.logger.warning('cutting broken tail of %s: %s'
+                                            % (path, exc))
+                        handle.seek(offset)
+                        handle.truncate()
+                    break
+                (seq, action, args) = (record[0], record[1], record[2:])
+                if seq <= self.journal_seq:
+                    continue
+                if action == 'enqueue':
+                    self.enqueue_job(args[0], min(args[1],
+                                                  self.queue_length()))
+                elif action == 'dequeue':
+                    self.dequeue_job_by_id(args[0], log_errors=False)
+                elif action == 'update':
+                    job = self.get_job_by_id(args[0], log_errors=False)
+                    if job:
+                        job.clear()
+                        job.update(args[1])
+                self.journal_seq = seq
+                applied += 1
+        finally:
+            handle.close()
+            self.journal = journal
+        return applied
+
+    def log_update(self, job):
+        """Record the current contents of job after in-place changes if it
+        is in the queue.
+        """
+
+        job_id = job.get('JOB_ID', None)
+        if self.slot_map.get(job_id, None) is None:
+            return
+        self.__log_change('update', job_id, job)
+
+    def __rebuild(self, jobs):
+        """Rebuild slots, tree and index from the ordered jobs list"""
+
+        self.slots = list(jobs)
+        self.live = len(self.slots)
+        self.slot_map = {}
+        self.tree = [0] * (self.live + 1)
+        for (slot, job) in enumerate(self.slots):
+            job_id = job.get('JOB_ID', None)
+            if job_id is not None:
+                self.slot_map[job_id] = slot
+
+        # Linear time tree construction: push each count to its parent
+
+        for pos in xrange(1, self.live + 1):
+            self.tree[pos] += 1
+            parent = pos + (pos & -pos)
+            if parent <= self.live:
+                self.tree[parent] += self.tree[pos]
+
+    def __live_jobs(self):
+        """Return list of jobs currently in queue in queue order"""
+
+        return [job for job in self.slots if job is not None]
+
+    def __prefix_count(self, pos):
+        """Number of live jobs in the first pos slots"""
+
+        total = 0
+        while pos > 0:
+            total += self.tree[pos]
+            pos -= pos & -pos
+        return total
+
+    def __find_slot(self, index):
+        """Find slot holding the job at index in queue order"""
+
+        pos = 0
+        remain = index + 1
+        step = 1
+        while step * 2 <= len(self.slots):
+            step *= 2
+        while step > 0:
+            next_pos = pos + step
+            if next_pos <= len(self.slots) and self.tree[next_pos] < remain:
+                pos = next_pos
+                remain -= self.tree[next_pos]
+            step //= 2
+        return pos
+
+    def __append_slot(self, job):
+        """Append job in a new slot at the end of the queue"""
+
+        self.slots.append(job)
+        pos = len(self.slots)
+
+        # New tree node covers the slots (pos - lowbit(pos), pos]
+
+        low = pos - (pos & -pos)
+        self.tree.append(self.__prefix_count(pos - 1)
+                         - self.__prefix_count(low) + 1)
+        self.live += 1
+        job_id = job.get('JOB_ID', None)
+        if job_id is not None:
+            self.slot_map[job_id] = pos - 1
+
+    def __remove_slot(self, slot):
+        """Remove and return job in slot"""
+
+        job = self.slots[slot]
+        self.slots[slot] = None
+        self.slot_map.pop(job.get('JOB_ID', None), None)
+        pos = slot + 1
+        while pos <= len(self.slots):
+            self.tree[pos] -= 1
+            pos += pos & -pos
+        self.live -= 1
+        tombstones = len(self.slots) - self.live
+        if tombstones > self.min_compact and tombstones > self.live:
+            self.__rebuild(self.__live_jobs())
+        return job
+
+    def format_queue(self, detail=['JOB_ID']):
+        """Format queue contents for printing"""
+
+        out = []
+        if self.queue_length() > 0:
+            for j in self.__live_jobs():
+                out.append('\n'.join(format_job(j, detail)))
+        else:
+            out.append('\t-Empty-')
+        return out
+
+    def queue_length(self):
+        """Count number of jobs in queue"""
+
+        return self.live
+
+    def enqueue_job(self, job, index):
+        """Insert job at index in queue"""
+
+        if self.queue_length() >= index:
+
+            # check if a job with that job_id is in the queue to avoid
+            # multiple occurences
+
+            try:
+                if self.slot_map.has_key(job['JOB_ID']):
+                    self.logger.error('enqueue_job called with a job already in the queue! Skipping enqueue_job for job_id %s!'
+                             % job['JOB_ID'])
+                    return False
+            except Exception, exc:
+                self.logger.error('enqueue_job exception when checking if specified job already is in the queue: %s'
+                                   % exc)
+
+            if index == self.queue_length():
+                self.__append_slot(job)
+            else:
+                jobs = self.__live_jobs()
+                jobs[index:index] = [job]
+                self.__rebuild(jobs)
+            self.__log_change('enqueue', job, index)
+            return True
+        else:
+            self.logger.error("NEW JOB! failed to enqueue job - index %d \
+            out of range! (qlen %d)"
+                              , index, self.queue_length())
+        return False
+
+    def get_job(self, index):
+        """Find and return job found at index in queue"""
+
+        job = None
+        if self.queue_length() > index:
+            job = self.slots[self.__find_slot(index)]
+        else:
+            self.logger.error("get_job: Failed to get job - index %d \
+            out of range! (qlen %d)"
+                              , index, self.queue_length())
+        return job
+
+    def get_job_by_id(self, jobid, log_errors=True):
+        """Find and return job with jobid"""
+
+        job = None
+        if self.queue_length() > 0:
+            slot = self.slot_map.get(jobid, None)
+            if slot is not None:
+                job = self.slots[slot]
+        elif log_errors:
+            self.logger.error('get_job_by_id: Queue empty.')
+
+        if not job and log_errors:
+            self.logger.error('get_job_by_id: Failed to get job - jobid: %s '
+                               % jobid)
+        return job
+
+    def dequeue_job(self, index):
+        """Dequeue and return job found at index in queue"""
+
+        job = None
+        if self.queue_length() > index:
+            job = self.__remove_slot(self.__find_slot(index))
+            self.__log_change('dequeue', job.get('JOB_ID', None))
+        else:
+            self.logger.error("dequeue_job: Failed to dequeue job - index %d \
+            out of range! (qlen %d)"
+                              , index, self.queue_length())
+        return job
+
+    def dequeue_job_by_id(self, jobid, log_errors=True):
+        """Dequeue and return job with id: 'jobid'"""
+
+        job = None
+        if self.queue_length() > 0:
+            slot = self.slot_map.get(jobid, None)
+            if slot is not None:
+                job = self.__remove_slot(slot)
+                self.__log_change('dequeue', jobid)
+        elif log_errors:
+            self.logger.error('dequeue_job_by_id: Queue empty.')
+
+        if not job and log_errors:
+            self.logger.error('dequeue_job_by_id: Failed to dequeue job - jobid: %s '
+                               % jobid)
+        return job
+
+
+def indexed_queue(queue, logger):
+    """Return an IndexedJobQueue with the jobs of queue in the same order.
+    Used to convert queues pickled by the plain list based JobQueue.
+    """
 
+    if isinstance(queue, IndexedJobQueue):
+        return queue
+    indexed = IndexedJobQueue(logger)
+    for index in xrange(queue.queue_length()):
+        indexed.enqueue_job(queue.get_job(index), indexed.queue_length())
+    return indexed
@@ -27,6 +27,7 @@
 
 """General Scheduler framework"""
 
+import bisect
 import calendar
 import fnmatch
 import re
@@ -131,8 +132,56 @@ class Scheduler:
     simple_expr = '^[0-9.()+*/-]+$'
     simple_re = re.compile(simple_expr)
 
+    # Resource capability index used to narrow down the resources that
+    # best_resource needs to run the full job_fits_resource check on
+
+    res_index = None
+
+    # Numeric job requirements that must not exceed the resource value
+
+    index_numeric = ['NODECOUNT', 'CPUCOUNT', 'CPUTIME', 'DISK', 'MEMORY']
+
+    # Wildcard characters in fnmatch patterns of job RESOURCE lists
+
+    wildcard_re = re.compile('[*?[]')
+
+    # Incremental scheduling state: resources get a new version stamp from
+    # the sched_version counter whenever anything affecting job fitness or
+    # price changes, and the change log lets fit_cache entries for jobs
+    # re-evaluate only the resources that changed since they were cached.
+
+    sched_version = 0
+    changed_jobs = None
+    res_signatures = None
+    res_change_log = None
+    change_log_start = 0
+    fit_cache = None
+
+    # Job fields that influence fitness and price on a resource
+
+    job_sched_fields = [
+        'RESOURCE',
+        'ARCHITECTURE',
+        'JOBTYPE',
+        'RUNTIMEENVIRONMENT',
+        'SANDBOX',
+        'PLATFORM',
+        'VGRID',
+        'USER_CERT',
+        'MAXPRICE',
+        'MAXFILL',
+        ] + maxfill_fields
+
     illegal_price = -42.0
     reschedule_interval = 1800
+
+    # Validated and compiled price expressions and evaluated resource min
+    # prices are cached to keep safe evaluation out of the scheduling loop.
+    # Both caches are simply cleared when they grow beyond price_cache_size.
+
+    price_code_cache = None
+    min_price_cache = None
+    price_cache_size = 4096
     __schedule_fields = {
         'SCHEDULE_TIMESTAMP': None,
         'SCHEDULE_HINT': None,
@@ -156,6 +205,10 @@ class Scheduler:
         self.resources = {}
         self.servers = {}
         self.peers = config.peers
+        self.price_code_cache = {}
+        self.min_price_cache = {}
+        self.changed_jobs = {}
+        self.rebuild_resource_index()
         self.update_local_server()
 
     def _clone_dict(self, dictionary):
@@ -178,6 +231,23 @@ class Scheduler:
         self.job_queue = job_queue
         self.update_local_server()
 
+    def mark_job_changed(self, job):
+        """Remember that job was changed in place so that the change can be
+        recorded in the job queue journal with journal_job_changes.
+        """
+
+        self.changed_jobs[job['JOB_ID']] = job
+
+    def journal_job_changes(self):
+        """Record all job changes since last call in the job queue journal.
+        Jobs no longer in the queue are ignored by the queue.
+        """
+
+        if self.job_queue is not None:
+            for job in self.changed_jobs.values():
+                self.job_queue.log_update(job)
+        self.changed_jobs.clear()
+
     def attach_done_queue(self, done_queue):
 
         # Bind supplied done_queue to this scheduler
@@ -192,6 +262,7 @@ class Scheduler:
         (self.servers, self.resources, self.users) = cache
         for entities in (self.servers, self.resources, self.users):
             self.expire_entitites(entities)
+        self.rebuild_resource_index()
         self.update_local_server()
 
     def get_cache(self):
@@ -368,6 +439,8 @@ class Scheduler:
                 self.logger.info('Dropping stale cache data for %s'
                                   % entity_id)
                 del entities[entity_id]
+                if entities is self.resources:
+                    self.forget_resource(entity_id)
             else:
                 self.logger.info('Keeping cache data for %s'
                                   % entity_id)
@@ -581,8 +654,325 @@ class Scheduler:
 
         res_id = res['RESOURCE_ID']
         self.resources[res_id] = res
+        self.index_resource(res)
+        self.touch_resource(res)
         return res
 
+    def resource_index_entry(self, res):
+        """Extract the resource values used in the capability index. Numeric
+        values that can't be parsed are kept as None and never rule out the
+        resource, so that job_fits_resource gets to log the problem.
+        """
+
+        public_id = res['RESOURCE_ID']
+        if res.get('ANONYMOUS', True):
+            public_id = anon_resource_id(public_id)
+        re_names = frozenset([rre[0] for rre in
+                              res.get('RUNTIMEENVIRONMENT', [])])
+        numeric = []
+        for attr in self.index_numeric:
+            try:
+                numeric.append(int(res[attr]))
+            except (KeyError, TypeError, ValueError):
+                numeric.append(None)
+        return (public_id, res.get('ARCHITECTURE', ''),
+                res.get('JOBTYPE', 'batch'), re_names, tuple(numeric))
+
+    def rebuild_resource_index(self):
+        """Build the capability index from scratch for all resources. Any
+        cached job fitness is thrown away as well.
+        """
+
+        self.sched_version += 1
+        self.res_signatures = {}
+        self.res_change_log = []
+        self.change_log_start = self.sched_version
+        self.fit_cache = {}
+        self.res_index = {
+            'ENTRIES': {},
+            'PUBLIC_ID': {},
+            'ARCHITECTURE': {},
+            'JOBTYPE': {},
+            'RUNTIMEENVIRONMENT': {},
+            'NUMERIC': dict([(attr, []) for attr in self.index_numeric]),
+            'UNSORTED': dict([(attr, set()) for attr in
+                              self.index_numeric]),
+            }
+        for res in self.resources.values():
+            self.index_resource(res)
+            self.res_signatures[res['RESOURCE_ID']] = \
+                self.resource_signature(res)
+
+    def index_resource(self, res):
+        """Add or refresh the capability index entry for res"""
+
+        res_id = res['RESOURCE_ID']
+        entry = self.resource_index_entry(res)
+        old_entry = self.res_index['ENTRIES'].get(res_id, None)
+        if old_entry == entry:
+            return
+        elif old_entry is not None:
+            self.unindex_resource(res_id)
+        (public_id, arch, jobtype, re_names, numeric) = entry
+        self.res_index['ENTRIES'][res_id] = entry
+        for (name, val) in [('PUBLIC_ID', public_id),
+                            ('ARCHITECTURE', arch), ('JOBTYPE', jobtype)]:
+            self.res_index[name].setdefault(val, set()).add(res_id)
+        for re_name in re_names:
+            self.res_index['RUNTIMEENVIRONMENT'].setdefault(
+                re_name, set()).add(res_id)
+        for (attr, val) in zip(self.index_numeric, numeric):
+            if val is None:
+                self.res_index['UNSORTED'][attr].add(res_id)
+            else:
+                bisect.insort(self.res_index['NUMERIC'][attr],
+                              (val, res_id))
+
+    def unindex_resource(self, res_id):
+        """Remove any capability index entry for res_id"""
+
+        entry = self.res_index['ENTRIES'].pop(res_id, None)
+        if entry is None:
+            return
+        (public_id, arch, jobtype, re_names, numeric) = entry
+        buckets = [('PUBLIC_ID', public_id), ('ARCHITECTURE', arch),
+                   ('JOBTYPE', jobtype)]
+        buckets += [('RUNTIMEENVIRONMENT', name) for name in re_names]
+        for (name, val) in buckets:
+            bucket = self.res_index[name].get(val, set())
+            bucket.discard(res_id)
+            if not bucket:
+                self.res_index[name].pop(val, None)
+        for (attr, val) in zip(self.index_numeric, numeric):
+            if val is None:
+                self.res_index['UNSORTED'][attr].discard(res_id)
+                continue
+            sorted_vals = self.res_index['NUMERIC'][attr]
+            pos = bisect.bisect_left(sorted_vals, (val, res_id))
+            if pos < len(sorted_vals) and sorted_vals[pos] == (val, res_id):
+                del sorted_vals[pos]
+
+    def resource_signature(self, res):
+        """Extract the resource values that influence job fitness and price"""
+
+        return (self.resource_index_entry(res), res.get('MINPRICE', None),
+                res.get('LOAD_MULTIPLY', None), res.get('SANDBOX', False),
+                res.get('PLATFORM', ''), res.get('VGRID', None),
+                res.get('RUNTIMEENVIRONMENT', []))
+
+    def log_resource_change(self, res_id):
+        """Give res_id a new version stamp in the change log. The log is
+        trimmed when it grows long and cached job fitness older than the
+        log start is then simply re-evaluated in full.
+        """
+
+        self.sched_version += 1
+        self.res_change_log.append((self.sched_version, res_id))
+        if len(self.res_change_log) > max(1024, 4 * len(self.resources)):
+            half = len(self.res_change_log) / 2
+            self.change_log_start = self.res_change_log[half - 1][0]
+            self.res_change_log = self.res_change_log[half:]
+
+    def changed_resources(self, version):
+        """Return set of resource IDs changed after version"""
+
+        pos = bisect.bisect_left(self.res_change_log, (version + 1, ))
+        return set([res_id for (_, res_id) in self.res_change_log[pos:]])
+
+    def touch_resource(self, res):
+        """Log a change for res if anything relevant for scheduling changed.
+        Called from update_resources and update_price.
+        """
+
+        res_id = res['RESOURCE_ID']
+        signature = self.resource_signature(res)
+        if self.res_signatures.get(res_id, None) != signature:
+            self.res_signatures[res_id] = signature
+            self.log_resource_change(res_id)
+
+    def forget_resource(self, res_id):
+        """Remove all index and change tracking state for res_id"""
+
+        self.unindex_resource(res_id)
+        if self.res_signatures.pop(res_id, None) is not None:
+            self.log_resource_change(res_id)
+
+    def job_signature(self, job):
+        """Extract the job values that influence fitness and price"""
+
+        return [job.get(name, None) for name in self.job_sched_fields]
+
+    def fitting_resources(self, job):
+        """Return list of (res, job_price, res_price) tuples for the
+        resources that job fits. The spec fitness and prices are cached per
+        job and later calls only re-evaluate the resources changed since
+        then. Vgrid access is checked on every call since vgrid membership
+        changes are not tracked here. The cache entry is
+        thrown away if the job changed, if the price period (UTC hour)
+        changed, if the entry is older than reschedule_interval or if job
+        MAXPRICE depends on the current execution delay.
+        """
+
+        job_id = job['JOB_ID']
+        now = time.time()
+        period = time.gmtime(now)[:4]
+        cached = self.fit_cache.get(job_id, None)
+        if cached and (cached['SIGNATURE'] != self.job_signature(job)
+                       or cached['PERIOD'] != period
+                       or cached['VERSION'] < self.change_log_start
+                       or now - cached['CREATED'] > self.reschedule_interval
+                       or 'exec_delay' in str(job.get('MAXPRICE', ''))):
+            cached = None
+
+        if cached is None:
+            cached = {'CREATED': now, 'PERIOD': period, 'FITS': {}}
+            self.fit_cache[job_id] = cached
+            candidates = self.candidate_resources(job)
+        else:
+            candidates = []
+            requirements = self.job_index_requirements(job)
+            for res_id in self.changed_resources(cached['VERSION']):
+                cached['FITS'].pop(res_id, None)
+                entry = self.res_index['ENTRIES'].get(res_id, None)
+                res = self.resources.get(res_id, None)
+                if entry is None or res is None:
+                    continue
+                if self.index_entry_fits(entry, requirements):
+                    candidates.append(res)
+
+        # Evaluate job price once for the whole batch of resources
+
+        job_price = None
+        for res in candidates:
+            if self.job_fits_resource_spec(job, res):
+                if job_price is None:
+                    job_price = self.get_max_price(job)
+                cached['FITS'][res['RESOURCE_ID']] = \
+                    self.current_prices(job, res, job_price)
+
+        fits = []
+        for (res_id, (job_price, res_price)) in cached['FITS'].items():
+            res = self.resources.get(res_id, None)
+            if res is not None and self.job_fits_resource_vgrid(job, res):
+                fits.append((res, job_price, res_price))
+
+        # job_fits_resource may normalize job fields so sign afterwards
+
+        cached['VERSION'] = self.sched_version
+        cached['SIGNATURE'] = self.job_signature(job)
+        return fits
+
+    def job_index_requirements(self, job):
+        """Extract the job requirements that can be checked against the
+        capability index entries.
+        """
+
+        job_dests = job.get('RESOURCE', [])
+        if [dest for dest in job_dests if self.wildcard_re.search(dest)]:
+            job_dests = []
+        job_types = None
+        if job.has_key('JOBTYPE'):
+
+            # Same rules as job_fits_resource: all matches everything and
+            # batch is a subset of bulk
+
+            job_types = [job['JOBTYPE'], 'all']
+            if job['JOBTYPE'] == 'batch':
+                job_types.append('bulk')
+        job_numeric = []
+        for attr in self.index_numeric:
+            try:
+                job_numeric.append(int(job[attr]))
+            except (KeyError, TypeError, ValueError):
+                job_numeric.append(None)
+        return {'RESOURCE': job_dests,
+                'ARCHITECTURE': job.get('ARCHITECTURE', ''),
+                'JOBTYPE': job_types,
+                'RUNTIMEENVIRONMENT': frozenset(job.get('RUNTIMEENVIRONMENT',
+                                                        [])),
+                'NUMERIC': job_numeric}
+
+    def index_entry_fits(self, entry, requirements):
+        """Check if capability index entry may fit job requirements"""
+
+        (public_id, arch, jobtype, re_names, numeric) = entry
+        if requirements['RESOURCE'] and \
+                not public_id in requirements['RESOURCE']:
+            return False
+        if requirements['ARCHITECTURE'] and \
+                requirements['ARCHITECTURE'] != arch:
+            return False
+        if requirements['JOBTYPE'] is not None and \
+                not jobtype in requirements['JOBTYPE']:
+            return False
+        if not requirements['RUNTIMEENVIRONMENT'].issubset(re_names):
+            return False
+        for (job_val, res_val) in zip(requirements['NUMERIC'], numeric):
+            if job_val is not None and res_val is not None and \
+                    job_val > res_val:
+                return False
+        return True
+
+    def candidate_resources(self, job):
+        """Use the capability index to find the resources that may fit job.
+        The result is a superset of the resources where job_fits_resource
+        succeeds, but usually a lot smaller than all resources. We walk the
+        index bucket or numeric range with the fewest entries and check the
+        rest of the requirements against the index entries. Numeric ranges
+        are only expanded into resource IDs if they are the chosen driver.
+        """
+
+        index = self.res_index
+        requirements = self.job_index_requirements(job)
+        drivers = []
+        if requirements['RESOURCE']:
+            dest_ids = [index['PUBLIC_ID'].get(dest, set()) for dest in
+                        requirements['RESOURCE']]
+            drivers.append((sum([len(ids) for ids in dest_ids]), dest_ids))
+        if requirements['ARCHITECTURE']:
+            arch_ids = [index['ARCHITECTURE'].get(
+                requirements['ARCHITECTURE'], set())]
+            drivers.append((len(arch_ids[0]), arch_ids))
+        if requirements['JOBTYPE'] is not None:
+            type_ids = [index['JOBTYPE'].get(name, set()) for name in
+                        requirements['JOBTYPE']]
+            drivers.append((sum([len(ids) for ids in type_ids]), type_ids))
+        for re_name in requirements['RUNTIMEENVIRONMENT']:
+            re_ids = [index['RUNTIMEENVIRONMENT'].get(re_name, set())]
+            drivers.append((len(re_ids[0]), re_ids))
+        for (attr, job_val) in zip(self.index_numeric,
+                                   requirements['NUMERIC']):
+            if job_val is None:
+                continue
+            sorted_vals = index['NUMERIC'][attr]
+            pos = bisect.bisect_left(sorted_vals, (job_val, ))
+            unsorted = index['UNSORTED'][attr]
+            drivers.append((len(sorted_vals) - pos + len(unsorted),
+                            (sorted_vals, pos, unsorted)))
+
+        if drivers:
+            drivers.sort(key=lambda driver: driver[0])
+            driver_ids = set()
+            ids_list = drivers[0][1]
+            if isinstance(ids_list, tuple):
+                (sorted_vals, pos, unsorted) = ids_list
+                ids_list = [[res_id for (_, res_id) in
+                             sorted_vals[pos:]], unsorted]
+            for ids in ids_list:
+                driver_ids.update(ids)
+        else:
+            driver_ids = index['ENTRIES'].keys()
+
+        candidates = []
+        for res_id in driver_ids:
+            entry = index['ENTRIES'].get(res_id, None)
+            res = self.resources.get(res_id, None)
+            if entry is None or res is None:
+                continue
+            if self.index_entry_fits(entry, requirements):
+                candidates.append(res)
+        return candidates
+
     # TODO: handle disappearing server-links somewhere
     # TODO: handle moved entities (detection: newer timestamp and different "SERVER")
     # TODO: make sure we follow vector clock update strategies...
@@ -670,6 +1060,7 @@ class Scheduler:
                 self.logger.info('prune_peer_resources: remove %s'
                                   % cur_id)
                 del self.resources[cur_id]
+                self.forget_resource(cur_id)
 
     def prune_peer_users(self, server_id, users):
 
@@ -756,6 +1147,8 @@ class Scheduler:
             # self.logger.info("remove_peer_resources: remove %s from %s" % (res_id, server_id))
 
             del resources[res_id]
+            if resources is self.resources:
+                self.forget_resource(res_id)
 
     def remove_peer_users(self, server_id, users):
         for (user_id, user) in users.items():
@@ -880,6 +1273,7 @@ class Scheduler:
         # Updated multiplier automatically gets included from unitprice
 
         res_dict['CUR_PRICE'] = self.get_min_price(resource_conf, [])
+        self.touch_resource(res_dict)
 
         # self.logger.debug("update_price: %s, %s %f %f" % \
         #                 (res_id, min_price, load, load_multiply))
@@ -898,13 +1292,26 @@ class Scheduler:
         res_re = resource_conf['RUNTIMEENVIRONMENT']
 
         utc_time = time.gmtime()
+
+        # The price only changes with the MINPRICE expression, the load
+        # multiplier, the UTC hour and the set of charged REs. So all jobs
+        # sharing those within the hour reuse a single evaluation.
+
+        res = self.find_resource(resource_conf)
+        charged = tuple([(rre[0], rre[0] in job_re) for rre in res_re])
+        price_key = (resource_conf['RESOURCE_ID'],
+                     resource_conf.get('MINPRICE', None),
+                     res.get('LOAD_MULTIPLY', None), utc_time[:4], charged)
+        if self.min_price_cache.has_key(price_key):
+            return self.min_price_cache[price_key]
+
         res_replace_map = {
-            'hour': repr(utc_time.tm_hour),
-            'wday': repr(utc_time.tm_wday),
-            'yday': repr(utc_time.tm_yday),
-            'date': repr(utc_time.tm_mday),
-            'month': repr(utc_time.tm_mon),
-            'year': repr(utc_time.tm_year),
+            'hour': utc_time.tm_hour,
+            'wday': utc_time.tm_wday,
+            'yday': utc_time.tm_yday,
+            'date': utc_time.tm_mday,
+            'month': utc_time.tm_mon,
+            'year': utc_time.tm_year,
             }
 
         # Replace required REs with 1 and rest with 0
@@ -915,14 +1322,18 @@ class Scheduler:
 
                 # self.logger.debug("get_min_price: charging for RE: %s" % re_name)
 
-                res_replace_map[re_name] = repr(1)
+                res_replace_map[re_name] = 1
             else:
 
                 # self.logger.debug("get_min_price: not charging for RE: %s" % re_name)
 
-                res_replace_map[re_name] = repr(0)
+                res_replace_map[re_name] = 0
 
-        return self.unit_price(resource_conf, res_replace_map)
+        if len(self.min_price_cache) >= self.price_cache_size:
+            self.min_price_cache.clear()
+        min_price = self.unit_price(resource_conf, res_replace_map)
+        self.min_price_cache[price_key] = min_price
+        return min_price
 
     def get_max_price(self, job):
 
@@ -930,19 +1341,46 @@ class Scheduler:
 
         exec_delay = time.mktime(time.gmtime())\
              - time.mktime(job['RECEIVED_TIMESTAMP'])
-        job_replace_map = {'exec_delay': repr(exec_delay)}
+        job_replace_map = {'exec_delay': exec_delay}
         return self.eval_price(job['MAXPRICE'], job_replace_map)
 
+    def compiled_price(self, expr, compile_func, variables=()):
+        """Return cached (codeobj, error) tuple for expr where the expression
+        was validated and compiled with compile_func on first use. Any names
+        in variables are allowed in expr. Illegal expressions are cached with
+        the error to avoid repeated parsing.
+        """
+
+        cache_key = (expr, compile_func, variables)
+        if self.price_code_cache.has_key(cache_key):
+            return self.price_code_cache[cache_key]
+        try:
+            if variables:
+                compiled = (compile_func(expr, variables), None)
+            else:
+                compiled = (compile_func(expr), None)
+        except ValueError, err:
+            compiled = (None, err)
+        if len(self.price_code_cache) >= self.price_cache_size:
+            self.price_code_cache.clear()
+        self.price_code_cache[cache_key] = compiled
+        return compiled
+
     def eval_price(self, price_string, replace_map):
 
-        # Parse the price_string with replacements specified in replace_map
-        # dictionary
+        # Parse the price_string with the variable values specified in
+        # replace_map dictionary
 
         # The substitution and safe evaluation can be a real CPU hog.
         # Try to make the common case (simple price) fast by avoiding
         # substitution and safe evaluation if possible.
+        # Expressions are only validated and compiled once and then the
+        # cached code object is evaluated directly. Variables are replaced
+        # by placeholder names rather than their values, so that the same
+        # compiled expression is used with the values passed as locals.
 
         expr = price_string
+        variables = {}
 
         # self.logger.debug("eval_price: %s %s" % (price_string, replace_map))
 
@@ -950,42 +1388,41 @@ class Scheduler:
 
             # No need to evaluate expression at all before float()
 
-            eval_func = None
+            compile_func = None
             eval_price = expr
         elif self.simple_re.match(expr):
 
             # Need to do simple evaluation
 
-            eval_func = safeeval.expr_eval
+            compile_func = safeeval.expr_compile
         else:
             for key in replace_map.keys():
+                if not key in expr:
+                    continue
 
                 # self.logger.debug("%s : %s %s" % (price_string, key,
                 #                 replace_map[key]))
 
-                expr = expr.replace(key, replace_map[key])
+                name = '_var%d_' % len(variables)
+                expr = expr.replace(key, name)
+                variables[name] = replace_map[key]
 
                 # self.logger.debug("%s" % expr)
 
-            if self.simple_re.match(expr):
-
-                # No more unknown parts - simple evaluation
+            # Math evaluation with any variables
 
-                eval_func = safeeval.expr_eval
-            else:
-
-                # Still unknown contents - math evaluation
+            compile_func = safeeval.math_expr_compile
 
-                eval_func = safeeval.math_expr_eval
-
-        if eval_func:
-            try:
-                eval_price = eval_func(expr)
-            except ValueError, err:
+        if compile_func:
+            (codeobj, err) = self.compiled_price(expr, compile_func,
+                                                 tuple(sorted(variables)))
+            if err:
                 self.logger.error('eval_price: illegal price expression: %s!'
                                    % price_string)
                 self.logger.error('%s' % err)
                 return self.illegal_price
+            try:
+                eval_price = safeeval.compiled_eval(codeobj, variables)
             except Exception, err:
                 self.logger.error('eval_price: evaluation of %s caused exception!'
                                    % price_string)
@@ -1093,9 +1530,11 @@ class Scheduler:
         unit_price = min_price * load_multiply
         return unit_price
 
-    def current_prices(self, job, res):
+    def current_prices(self, job, res, job_price=None):
         """Returns a tuple with current job maxprice and resource price for
-        executing the job now.
+        executing the job now. The job maxprice does not depend on res, so
+        callers pricing a job on a batch of resources may pass it in
+        job_price to only evaluate it once.
         If price is broken we just ignore it and leave job to expire.
         """
         
@@ -1135,7 +1574,8 @@ class Scheduler:
 
         unit_price = self.get_min_price(res, maxed['RUNTIMEENVIRONMENT'])
         res_price = units * unit_price
-        job_price = self.get_max_price(maxed)
+        if job_price is None:
+            job_price = self.get_max_price(maxed)
 
         # self.logger.debug("current_prices: job %s, price %d, units %d" % \
         #                                (job["JOB_ID"], job_price, units))
@@ -1157,6 +1597,18 @@ class Scheduler:
         return (job_price, res_price)
 
     def job_fits_resource(self, job, res):
+        """Check if job fits res in both specs and vgrid access. Sets
+        RESOURCE_VGRID of job to the matching vgrid of res.
+        """
+
+        if not self.job_fits_resource_spec(job, res):
+            return False
+        return self.job_fits_resource_vgrid(job, res)
+
+    def job_fits_resource_spec(self, job, res):
+        """Check if job fits the resource specs of res. The result only
+        depends on job and res so it can be cached until one of them changes.
+        """
 
         # self.logger.info("scheduler examines job_id %s" % job["JOB_ID"])
 
@@ -1286,6 +1738,17 @@ class Scheduler:
 
                 return False
 
+        return True
+
+    def job_fits_resource_vgrid(self, job, res):
+        """Check if job owner and res share a vgrid and set RESOURCE_VGRID of
+        job accordingly. The result depends on vgrid membership so it must
+        not be cached.
+        """
+
+        res_id = res['RESOURCE_ID']
+        old_vgrids = (job.get('VGRID', None), job.get('RESOURCE_VGRID', None))
+
         # Check VGRID
         # Force old jobs with VGRID string value to list form
 
@@ -1313,6 +1776,9 @@ class Scheduler:
             # self.logger.info("Incompatible VGRID lists: %s (%s) vs %s (%s)" % \
             #                 (res["VGRID"], res_name, job["VGRID"], job_name))
 
+        if old_vgrids != (job['VGRID'], job['RESOURCE_VGRID']):
+            self.mark_job_changed(job)
+        if not match:
             return False
 
         # self.logger.info("end job_fits_resource")
@@ -1377,6 +1843,7 @@ class Scheduler:
 
         if not job.has_key('MIGRATE_COUNT'):
             job['MIGRATE_COUNT'] = str(0)
+            self.mark_job_changed(job)
 
         migrate_count = int(job['MIGRATE_COUNT'])
         dist = self.resource_distance(res)
@@ -1445,8 +1912,10 @@ class Scheduler:
         job_id = job['JOB_ID']
 
         # self.logger.debug("best_resource: inspecting job %s" % job_id)
+        # Fitness and prices are only evaluated for resources that may fit
+        # according to the capability index and changed since last time
 
-        for (res_id, res) in self.resources.items():
+        for (res, job_price, res_price) in self.fitting_resources(job):
 
             # self.logger.info("test job %s against %s" % (job_id, res_id))
 
@@ -1456,18 +1925,8 @@ class Scheduler:
 
             # Note: We don't know future CPUTIME of other resources, but just
             # keep last requested time as a qualified guess
-
-            if not self.job_fits_resource(job, res):
-
-                # self.logger.info("best_resource: job %s does not fit %s" % (job_id, res_id))
-
-                continue
-
-            # self.logger.info("job %s fits %s" % (job_id, res_id))
-
             # Check if price is acceptable
 
-            (job_price, res_price) = self.current_prices(job, res)
             raw_diff = job_price - res_price
 
             if res_dist > 0:
@@ -1691,14 +2150,18 @@ class Scheduler:
 
         now = time.time()
         first_request = request_res.get('FIRST_SEEN', now)
+        queued_ids = set()
 
         for i in range(local_jobs):
             best = None
             job = self.job_queue.get_job(i)
             job_id = job['JOB_ID']
+            queued_ids.add(job_id)
 
             # Fill any missing fields for e.g. new jobs
 
+            if not job.has_key('SCHEDULE_HINT'):
+                self.mark_job_changed(job)
             self.fill_schedule(job)
 
             # backwards compatible timestamp extraction (was float before)
@@ -1723,6 +2186,7 @@ class Scheduler:
 
             # Reset schedule
 
+            self.mark_job_changed(job)
             self.clear_schedule(job)
             self.fill_schedule(job)
 
@@ -1770,6 +2234,14 @@ class Scheduler:
             job['EXEC_DIFF'] = best['diff']
             job['EXEC_RAWDIFF'] = best['raw']
 
+        # Drop cached fitness for jobs no longer in queue
+
+        for job_id in self.fit_cache.keys():
+            if not job_id in queued_ids:
+                del self.fit_cache[job_id]
+
+        self.journal_job_changes()
+
         return True
 
     def returned_job(self, job):
@@ -139,10 +139,10 @@ if __name__ == '__main__':
         'user_alias': configuration.user_sftp_alias,
         # Lock needed here due to threaded creds updates
         'creds_lock': threading.Lock(),
-        'users': [],
-        'jobs': [],
-        'shares': [],
-        'jupyter_mounts': [],
+        'users': {},
+        'jobs': {},
+        'shares': {},
+        'jupyter_mounts': {},
         'login_map': {},
         'hash_cache': {},
         'time_stamp': 0,
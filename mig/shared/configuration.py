@@ -146,6 +146,9 @@ def fix_missing(config_file, verbose=True):
         'user_sftp_auth': ['publickey', 'password'],
         'user_sftp_alias': '',
         'user_sftp_log': 'sftp.log',
+        'user_sftp_max_workers': 256,
+        'user_sftp_backlog': 128,
+        'user_sftp_session_limit': -1,
         'user_sftp_subsys_address': fqdn,
         'user_sftp_subsys_port': 22,
         'user_sftp_subsys_log': 'sftp-subsys.log',
@@ -199,6 +202,11 @@ def fix_missing(config_file, verbose=True):
         'user_sshmux_log': 'sshmux.log',
         'user_vmproxy_key': '~/certs/combined.pem',
         'user_vmproxy_log': 'vmproxy.log',
+        'user_state_store': '',
+        'user_state_snapshot': 60,
+        'user_statestore_log': 'statestore.log',
+        'user_creds_rescan': 0,
+        'metrics_dir': '',
         'user_events_log': 'events.log',
         'user_cron_log': 'cron.log',
         'user_transfers_log': 'transfers.log',
@@ -336,6 +344,9 @@ class Configuration:
     workflows_vgrid_patterns_home = ''
     workflows_vgrid_recipes_home = ''
     workflows_vgrid_history_home = ''
+    workflows_trigger_workers = 32
+    workflows_trigger_queue_size = 10000
+    workflows_event_coalesce_window = 1.0
     site_landing_page = ''
     site_skin = ''
     site_collaboration_links = ''
@@ -380,6 +391,9 @@ class Configuration:
     user_sftp_window_size = 0
     user_sftp_max_packet_size = 0
     user_sftp_max_sessions = -1
+    user_sftp_max_workers = 256
+    user_sftp_backlog = 128
+    user_sftp_session_limit = -1
     user_sftp_subsys_address = ''
     user_sftp_subsys_port = 22
     user_sftp_subsys_log = 'sftp-subsys.log'
@@ -432,6 +446,11 @@ class Configuration:
     user_sshmux_log = 'sshmux.log'
     user_vmproxy_key = ''
     user_vmproxy_log = 'vmproxy.log'
+    user_state_store = ''
+    user_state_snapshot = 60
+    user_statestore_log = 'statestore.log'
+    user_creds_rescan = 0
+    metrics_dir = ''
     user_events_log = 'events.log'
     user_cron_log = 'cron.log'
     user_transfers_log = 'transfers.log'
@@ -490,6 +509,10 @@ class Configuration:
     sched_alg = 'FirstFit'
     expire_after = 86400
     job_retries = 4
+    dispatch_workers = 4
+    dispatch_queue_size = 1024
+    dispatch_batch_size = 1000
+    queue_journal_limit = 10000
     logfile = ''
     loglevel = ''
     logger_obj = None
@@ -882,6 +905,15 @@ location.""" % self.config_file
         if config.has_option('GLOBAL', 'user_sftp_max_sessions'):
             self.user_sftp_max_sessions = config.getint(
                 'GLOBAL', 'user_sftp_max_sessions')
+        if config.has_option('GLOBAL', 'user_sftp_max_workers'):
+            self.user_sftp_max_workers = config.getint(
+                'GLOBAL', 'user_sftp_max_workers')
+        if config.has_option('GLOBAL', 'user_sftp_backlog'):
+            self.user_sftp_backlog = config.getint(
+                'GLOBAL', 'user_sftp_backlog')
+        if config.has_option('GLOBAL', 'user_sftp_session_limit'):
+            self.user_sftp_session_limit = config.getint(
+                'GLOBAL', 'user_sftp_session_limit')
         if config.has_option('GLOBAL', 'user_sftp_subsys_address'):
             self.user_sftp_subsys_address = config.get(
                 'GLOBAL', 'user_sftp_subsys_address')
@@ -1163,6 +1195,19 @@ location.""" % self.config_file
                                                'user_vmproxy_key')
         if config.has_option('GLOBAL', 'user_vmproxy_log'):
             self.user_vmproxy_log = config.get('GLOBAL', 'user_vmproxy_log')
+        if config.has_option('GLOBAL', 'user_state_store'):
+            self.user_state_store = config.get('GLOBAL', 'user_state_store')
+        if config.has_option('GLOBAL', 'user_state_snapshot'):
+            self.user_state_snapshot = config.getint('GLOBAL',
+                                                     'user_state_snapshot')
+        if config.has_option('GLOBAL', 'user_statestore_log'):
+            self.user_statestore_log = config.get('GLOBAL',
+                                                  'user_statestore_log')
+        if config.has_option('GLOBAL', 'user_creds_rescan'):
+            self.user_creds_rescan = config.getint('GLOBAL',
+                                                   'user_creds_rescan')
+        if config.has_option('GLOBAL', 'metrics_dir'):
+            self.metrics_dir = config.get('GLOBAL', 'metrics_dir')
         if config.has_option('GLOBAL', 'vm_proxy_host'):
             self.vm_proxy_host = config.get('GLOBAL', 'vm_proxy_host')
         else:
@@ -1309,6 +1354,18 @@ location.""" % self.config_file
 
         if config.has_option('SCHEDULER', 'job_retries'):
             self.job_retries = config.getint('SCHEDULER', 'job_retries')
+        if config.has_option('SCHEDULER', 'dispatch_workers'):
+            self.dispatch_workers = config.getint('SCHEDULER',
+                                                  'dispatch_workers')
+        if config.has_option('SCHEDULER', 'dispatch_queue_size'):
+            self.dispatch_queue_size = config.getint('SCHEDULER',
+                                                     'dispatch_queue_size')
+        if config.has_option('SCHEDULER', 'dispatch_batch_size'):
+            self.dispatch_batch_size = config.getint('SCHEDULER',
+                                                     'dispatch_batch_size')
+        if config.has_option('SCHEDULER', 'queue_journal_limit'):
+            self.queue_journal_limit = config.getint('SCHEDULER',
+                                                     'queue_journal_limit')
 
         if config.has_option('FEASIBILITY', 'resource_seen_within_hours'):
             self.resource_seen_within_hours = config.getint(
@@ -1433,6 +1490,15 @@ location.""" % self.config_file
         if config.has_option('WORKFLOWS', 'vgrid_history_home'):
             self.workflows_vgrid_history_home = config.get(
                 'WORKFLOWS', 'vgrid_history_home')
+        if config.has_option('WORKFLOWS', 'trigger_workers'):
+            self.workflows_trigger_workers = config.getint(
+                'WORKFLOWS', 'trigger_workers')
+        if config.has_option('WORKFLOWS', 'trigger_queue_size'):
+            self.workflows_trigger_queue_size = config.getint(
+                'WORKFLOWS', 'trigger_queue_size')
+        if config.has_option('WORKFLOWS', 'event_coalesce_window'):
+            self.workflows_event_coalesce_window = config.getfloat(
+                'WORKFLOWS', 'event_coalesce_window')
 
         if config.has_option('SITE', 'images'):
             self.site_images = config.get('SITE', 'images')
@@ -1912,6 +1978,7 @@ location.""" % self.config_file
                          'user_davs_log', 'user_ftps_log',
                          'user_openid_log', 'user_monitor_log',
                          'user_sshmux_log', 'user_vmproxy_log',
+                         'user_statestore_log',
                          'user_events_log', 'user_cron_log',
                          'user_transfers_log', 'user_notify_log',
                          'user_imnotify_log', 'user_auth_log',
@@ -319,6 +319,15 @@ def send_message_to_grid_script(message, logger, configuration):
         return False
 
 
+def send_messages_to_grid_script(messages, logger, configuration):
+    """Write a list of instructions to the grid_script named pipe input in a
+    single locked write, so that grid_script can pick them all up in one read
+    and handle them as a batch.
+    """
+    return send_message_to_grid_script(''.join(messages), logger,
+                                       configuration)
+
+
 def send_message_to_grid_notify(message, logger, configuration):
     """Write message to notify home"""
     try:
@@ -27,8 +27,10 @@
 
 """ MiG daemon auth functions"""
 
+import threading
 import time
 import re
+from collections import OrderedDict
 
 from shared.auth import active_twofactor_session
 from shared.defaults import CRACK_USERNAME_REGEX
@@ -36,11 +38,109 @@ from shared.gdp import get_client_id_from_project_client_id
 from shared.griddaemons.ratelimits import default_user_abuse_hits, \
     default_proto_abuse_hits, default_max_secret_hits, update_rate_limit
 from shared.griddaemons.sessions import active_sessions
+from shared.metrics import counter
 from shared.notification import send_system_notification
 from shared.settings import load_twofactor
 from shared.twofactorkeywords import get_keywords_dict as twofactor_defaults
 from shared.useradm import expand_openid_alias
 
+default_auth_cache_size = 4096
+default_auth_cache_ttl = 300
+
+_auth_attempts = counter('auth_attempts_total', 'IO daemon auth attempts',
+                         ('protocol', 'authtype', 'result'))
+
+
+class AuthCache(dict):
+    """Size bounded cache of recently verified password hashes and digests
+    shared by all the auth threads of a daemon. It plugs in as the
+    hash_cache or digest_cache dictionary of the password check helpers.
+    Entries expire ttl seconds after they were stored and the least recently
+    used entries are evicted when more than max_size entries are cached.
+    Keeps hit and miss counters to help tune the size and ttl.
+    """
+
+    def __init__(self, max_size=default_auth_cache_size,
+                 ttl=default_auth_cache_ttl):
+        """Init empty cache"""
+        dict.__init__(self)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        self.__stamps = OrderedDict()
+        self.__stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0}
+
+    def get(self, key, default=None):
+        """Returns cached value of key or default if missing or expired"""
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            stamp = self.__stamps.pop(key, None)
+            if stamp is None:
+                self.__stats['misses'] += 1
+                return default
+            if stamp + self.ttl < now:
+                dict.pop(self, key, None)
+                self.__stats['expired'] += 1
+                self.__stats['misses'] += 1
+                return default
+            # Move to most recently used end
+            self.__stamps[key] = stamp
+            self.__stats['hits'] += 1
+            return dict.get(self, key, default)
+        finally:
+            self.__lock.release()
+
+    def __setitem__(self, key, value):
+        """Cache value for key and evict least recently used overflow"""
+        self.__lock.acquire()
+        try:
+            self.__stamps.pop(key, None)
+            self.__stamps[key] = time.time()
+            dict.__setitem__(self, key, value)
+            while len(self.__stamps) > self.max_size:
+                (old_key, _) = self.__stamps.popitem(last=False)
+                dict.pop(self, old_key, None)
+                self.__stats['evicted'] += 1
+        finally:
+            self.__lock.release()
+
+    def clear(self):
+        """Remove all cached entries"""
+        self.__lock.acquire()
+        try:
+            self.__stamps.clear()
+            dict.clear(self)
+        finally:
+            self.__lock.release()
+
+    def expire(self):
+        """Remove all expired entries and return the number removed"""
+        expired = 0
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            for (key, stamp) in self.__stamps.items():
+                if stamp + self.ttl >= now:
+                    continue
+                del self.__stamps[key]
+                dict.pop(self, key, None)
+                expired += 1
+            self.__stats['expired'] += expired
+            return expired
+        finally:
+            self.__lock.release()
+
+    def stats(self):
+        """Returns a dictionary with cache size and hit/miss counters"""
+        self.__lock.acquire()
+        try:
+            stats = dict(self.__stats)
+            stats['size'] = len(self.__stamps)
+            return stats
+        finally:
+            self.__lock.release()
+
 
 def valid_twofactor_session(configuration, client_id, addr=None):
     """Check if *client_id* has a valid 2FA session.
@@ -53,6 +153,17 @@ def valid_twofactor_session(configuration, client_id, addr=None):
        and merge this function with the existing 'refresh_X_creds' framework
     """
     logger = configuration.logger
+    daemon_conf = getattr(configuration, 'daemon_conf', {})
+    twofactor_index = daemon_conf.get('twofactor_index', None)
+    if twofactor_index:
+        session_end = twofactor_index.session_end(client_id, addr)
+        if session_end is None:
+            logger.warning("no 2FA session found for %s (%s)" %
+                           (client_id, addr))
+            return False
+        logger.debug("valid 2FA session found for %s (%s) until %s" %
+                     (client_id, addr, session_end))
+        return True
     session_data = active_twofactor_session(configuration, client_id, addr)
     if session_data is None:
         logger.warning("no 2FA session found for %s (%s)" % (client_id, addr))
@@ -69,6 +180,8 @@ def check_twofactor_session(configuration, username, addr, proto):
     First check if site enables twofactor at all and in that case if the user
     actually requires it for given proto. Finally check the validity of the
     corresponding 2FA session file if so.
+    Any twofactor_index in daemon_conf is used to look up settings and
+    sessions in memory instead of on disk.
     """
     logger = configuration.logger
     if not configuration.site_enable_twofactor:
@@ -78,8 +191,13 @@ def check_twofactor_session(configuration, username, addr, proto):
     if configuration.site_enable_gdp:
         client_id = get_client_id_from_project_client_id(
             configuration, client_id)
-    twofactor_dict = load_twofactor(client_id, configuration,
-                                    allow_missing=True)
+    daemon_conf = getattr(configuration, 'daemon_conf', {})
+    twofactor_index = daemon_conf.get('twofactor_index', None)
+    if twofactor_index:
+        twofactor_dict = twofactor_index.load_twofactor(client_id)
+    else:
+        twofactor_dict = load_twofactor(client_id, configuration,
+                                        allow_missing=True)
     # logger.debug("found twofactor_dict for %s : %s" %
     #              (client_id, twofactor_dict))
     if not twofactor_dict:
@@ -264,6 +382,7 @@ def validate_auth_attempt(configuration,
     # Log auth attempt and set (authorized, disconnect) return values
 
     if exceeded_rate_limit:
+        result = "rate_limit"
         disconnect = True
         auth_msg = "Exceeded rate limit"
         log_msg = auth_msg + " for %s from %s" % (username, ip_addr)
@@ -273,6 +392,7 @@ def validate_auth_attempt(configuration,
         authlog(configuration, 'WARNING', protocol, authtype,
                 username, ip_addr, auth_msg, notify=notify)
     elif exceeded_max_sessions:
+        result = "max_sessions"
         disconnect = True
         active_count = active_sessions(configuration, protocol, username)
         auth_msg = "Too many open sessions"
@@ -282,6 +402,7 @@ def validate_auth_attempt(configuration,
         authlog(configuration, 'WARNING', protocol, authtype,
                 username, ip_addr, auth_msg, notify=notify)
     elif invalid_username:
+        result = "invalid_username"
         disconnect = True
         if re.match(CRACK_USERNAME_REGEX, username) is not None:
             auth_msg = "Crack username detected"
@@ -298,6 +419,7 @@ def validate_auth_attempt(configuration,
         authlog(configuration, authlog_lvl, protocol, authtype,
                 username, ip_addr, auth_msg, notify=False)
     elif invalid_user:
+        result = "invalid_user"
         disconnect = True
         auth_msg = "Invalid user"
         log_msg = auth_msg + " %s from %s" % (username, ip_addr)
@@ -308,6 +430,7 @@ def validate_auth_attempt(configuration,
                 username, ip_addr,
                 auth_msg, notify=False)
     elif not authtype_enabled:
+        result = "disabled"
         disconnect = True
         auth_msg = "%s auth disabled or %s not set" % (authtype, authtype)
         log_msg = auth_msg + " for %s from %s" % (username, ip_addr)
@@ -317,6 +440,7 @@ def validate_auth_attempt(configuration,
         authlog(configuration, 'ERROR', protocol, authtype,
                 username, ip_addr, auth_msg, notify=notify)
     elif valid_auth and not twofa_passed:
+        result = "twofactor"
         disconnect = True
         auth_msg = "No valid two factor session"
         log_msg = auth_msg + " for %s from %s" % (username, ip_addr)
@@ -326,6 +450,7 @@ def validate_auth_attempt(configuration,
         authlog(configuration, 'ERROR', protocol, authtype,
                 username, ip_addr, auth_msg, notify=notify)
     elif authtype_enabled and not valid_auth:
+        result = "failed"
         auth_msg = "Failed %s" % authtype
         log_msg = auth_msg + " login for %s from %s" % (username, ip_addr)
         if tcp_port > 0:
@@ -334,6 +459,7 @@ def validate_auth_attempt(configuration,
         authlog(configuration, 'ERROR', protocol, authtype,
                 username, ip_addr, auth_msg, notify=notify)
     elif valid_auth and twofa_passed:
+        result = "accepted"
         authorized = True
         if notify and not configuration.site_enable_gdp:
             notify = False
@@ -345,6 +471,7 @@ def validate_auth_attempt(configuration,
         authlog(configuration, 'INFO', protocol, authtype,
                 username, ip_addr, auth_msg, notify=notify)
     else:
+        result = "error"
         disconnect = True
         auth_msg = "Unknown auth error"
         log_msg = auth_msg + " for %s from %s" % (username, ip_addr)
@@ -354,6 +481,8 @@ def validate_auth_attempt(configuration,
         authlog(configuration, 'ERROR', protocol, authtype,
                 username, ip_addr, auth_msg, notify=notify)
 
+    _auth_attempts.inc(protocol=protocol, authtype=authtype, result=result)
+
     # Update and check rate limits
 
     (_, proto_hits, user_hits, secret_hits) = \
@@ -0,0 +1,391 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# --- BEGIN_HEADER ---
+#
+# credswatch - grid daemon credential change watcher
+# Copyright (C) 2010-2020  The MiG Project lead by Brian Vinter
+#
+# This file is part of MiG.
+#
+# MiG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# MiG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# -- END_HEADER ---
+#
+
+"""MiG daemon credential change watcher.
+
+The refresh_X_creds helpers check the auth files, job links or share links
+of a username for changes on every login. With a watcher enabled they
+instead skip those checks for usernames without any file system events
+since their last check. Watches are registered lazily on the directories
+holding the credential files of the usernames actually logging in and all
+of them share a single inotify instance. Watches not used for
+user_creds_rescan seconds are removed again. Any username is still checked
+in full at least every user_creds_rescan seconds as a safety net for missed
+events.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+import time
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                        use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                   ctypes.c_uint32]
+    _inotify_rm_watch = _libc.inotify_rm_watch
+    _inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    inotify_available = True
+except (OSError, AttributeError):
+    inotify_available = False
+
+# Selected inotify constants from sys/inotify.h
+(IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO,
+ IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_MOVE_SELF) = \
+    (0x2, 0x4, 0x8, 0x40, 0x80, 0x100, 0x200, 0x400, 0x800)
+(IN_Q_OVERFLOW, IN_IGNORED, IN_ONLYDIR, IN_CLOEXEC) = \
+    (0x4000, 0x8000, 0x1000000, 0x80000)
+_watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | \
+    IN_ONLYDIR
+_event_header = struct.Struct('iIII')
+
+# Watch modes telling how to find changed usernames for events in a dir
+WATCH_NAMES, WATCH_BASENAME, WATCH_ALL = 'names', 'basename', 'all'
+
+
+class DirWatcher(object):
+    """Non-recursive watches on any number of dirs using a single inotify
+    instance and reader thread. The handler is called with the path of each
+    changed entry in a watched dir or of the dir itself. It is called with
+    None if the kernel queue overflowed, so that events may have been lost.
+    """
+
+    def __init__(self, handler):
+        """Init inotify instance and start reader thread"""
+        self.handler = handler
+        self.__fd = _inotify_init1(IN_CLOEXEC)
+        if self.__fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.__lock = threading.Lock()
+        self.__wd_paths = {}
+        self.__path_wds = {}
+        self.__stop = threading.Event()
+        self.__reader = threading.Thread(target=self.__read_events)
+        self.__reader.daemon = True
+        self.__reader.start()
+
+    def __read_events(self):
+        """Read and dispatch events until stopped"""
+        while not self.__stop.is_set():
+            try:
+                (readable, _, _) = select.select([self.__fd], [], [], 1)
+                if not readable:
+                    continue
+                data = os.read(self.__fd, 65536)
+            except (OSError, select.error), err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                break
+            changed = []
+            offset = 0
+            self.__lock.acquire()
+            try:
+                while offset < len(data):
+                    (wd, mask, _, length) = _event_header.unpack_from(data,
+                                                                      offset)
+                    offset += _event_header.size
+                    name = data[offset:offset + length].rstrip('\0')
+                    offset += length
+                    if mask & IN_Q_OVERFLOW:
+                        changed.append(None)
+                        continue
+                    paths = self.__wd_paths.get(wd, [])
+                    if mask & IN_IGNORED:
+                        # Watch is gone after dir removal or remove
+                        for path in self.__wd_paths.pop(wd, []):
+                            del self.__path_wds[path]
+                    for path in paths:
+                        if name:
+                            changed.append(os.path.join(path, name))
+                        else:
+                            changed.append(path)
+            finally:
+                self.__lock.release()
+            for path in changed:
+                self.handler(path)
+        os.close(self.__fd)
+
+    def add(self, path):
+        """Watch dir at path unless already watched. Raises OSError if that
+        fails e.g. due to a missing dir or the inotify watch limit.
+        """
+        self.__lock.acquire()
+        try:
+            if self.__path_wds.has_key(path):
+                return
+            wd = _inotify_add_watch(self.__fd, path, _watch_mask)
+            if wd < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err), path)
+            # NOTE: the same dir may be watched through several paths
+            paths = self.__wd_paths.setdefault(wd, [])
+            paths.append(path)
+            self.__path_wds[path] = wd
+        finally:
+            self.__lock.release()
+
+    def remove(self, path):
+        """Remove any watch on dir at path"""
+        self.__lock.acquire()
+        try:
+            wd = self.__path_wds.pop(path, None)
+            if wd is None:
+                return
+            paths = self.__wd_paths[wd]
+            paths.remove(path)
+            if not paths:
+                del self.__wd_paths[wd]
+                _inotify_rm_watch(self.__fd, wd)
+        finally:
+            self.__lock.release()
+
+    def watched(self):
+        """Returns the number of watched paths"""
+        return len(self.__path_wds)
+
+    def stop(self):
+        """Stop reader thread and close inotify instance"""
+        self.__stop.set()
+
+
+class CredsWatcher(object):
+    """Track which usernames may have changed credentials on disk.
+    Usernames are tracked separately for each kind of credentials like
+    users, jobs or shares. A username is clean after a successful check with
+    watches in place and until an event in one of its watched directories
+    or the rescan interval makes it dirty again. Watches are removed when
+    not used for a full rescan interval, since no clean marks can depend on
+    them by then.
+    """
+
+    def __init__(self, configuration, rescan):
+        """Init watcher and start inotify reader thread"""
+        self.logger = configuration.logger
+        self.rescan = rescan
+        self.__lock = threading.Lock()
+        self.__watched = {}
+        self.__used = {}
+        self.__clean = {}
+        self.__dirty = {}
+        self.__last_evict = time.time()
+        self.__backoff = 0
+        self.__dir_watcher = DirWatcher(self.mark_dirty)
+
+    def __unclean(self, mode, value):
+        """Drop clean marks depending on a watch with mode and value.
+        The caller must hold the watcher lock.
+        """
+        if mode == WATCH_NAMES:
+            for key in value:
+                self.__clean.pop(key, None)
+        else:
+            if mode == WATCH_BASENAME:
+                (value, _) = value
+            for key in [i for i in self.__clean if i[0] == value]:
+                del self.__clean[key]
+
+    def __evict(self, now):
+        """Remove watches not used within the last rescan interval.
+        The caller must hold the watcher lock.
+        """
+        self.__last_evict = now
+        for (path, stamp) in self.__used.items():
+            if stamp + self.rescan >= now:
+                continue
+            (mode, value) = self.__watched.pop(path)
+            del self.__used[path]
+            self.__unclean(mode, value)
+            self.__dir_watcher.remove(path)
+        self.__backoff = 0
+
+    def __watch(self, path, mode, value):
+        """Add a non-recursive watch on path unless already watched.
+        Returns True if path is watched and False otherwise.
+        The caller must hold the watcher lock.
+        """
+        now = time.time()
+        if self.__last_evict + self.rescan < now:
+            self.__evict(now)
+        if self.__watched.has_key(path):
+            if mode == WATCH_NAMES:
+                self.__watched[path][1].add(value)
+            self.__used[path] = now
+            return True
+        if self.__backoff > now:
+            return False
+        try:
+            self.__dir_watcher.add(path)
+        except OSError, err:
+            if not os.path.isdir(path):
+                return False
+            # Typically out of inotify watches so pause adding until evicted
+            self.logger.warning("pause new creds watches for %ds after watch "
+                                "on %s failed with %d watches: %s" %
+                                (self.rescan, path,
+                                 self.__dir_watcher.watched(), err))
+            self.__backoff = now + self.rescan
+            return False
+        if mode == WATCH_NAMES:
+            value = set([value])
+        self.__watched[path] = (mode, value)
+        self.__used[path] = now
+        return True
+
+    def watch_names(self, kind, username, dirs):
+        """Watch dirs for changes to the kind credentials of username. Missing
+        dirs are skipped if their parent dir is in dirs too, since creation
+        then shows up as an event there.
+        Returns True if all existing dirs are watched and False otherwise.
+        """
+        self.__lock.acquire()
+        try:
+            for path in dirs:
+                if self.__watch(path, WATCH_NAMES, (kind, username)):
+                    continue
+                if os.path.isdir(path) or not os.path.dirname(path) in dirs:
+                    return False
+            return True
+        finally:
+            self.__lock.release()
+
+    def watch_basenames(self, kind, path, suffix=''):
+        """Watch path where the name of each entry is a username with kind
+        credentials followed by suffix.
+        Returns True if path is watched and False otherwise.
+        """
+        self.__lock.acquire()
+        try:
+            return self.__watch(path, WATCH_BASENAME, (kind, suffix))
+        finally:
+            self.__lock.release()
+
+    def watch_all(self, kind, path):
+        """Watch path where any change may affect the kind credentials of all
+        usernames. Returns True if path is watched and False otherwise.
+        """
+        self.__lock.acquire()
+        try:
+            return self.__watch(path, WATCH_ALL, kind)
+        finally:
+            self.__lock.release()
+
+    def mark_dirty(self, path):
+        """Mark usernames affected by a change to path as dirty. A path of
+        None means that events were lost and marks all usernames dirty.
+        """
+        now = time.time()
+        changed = []
+        self.__lock.acquire()
+        try:
+            if path is None:
+                self.__clean.clear()
+                self.__dirty[None] = now
+                return
+            parent = os.path.dirname(path)
+            for watch_path in (path, parent):
+                (mode, value) = self.__watched.get(watch_path, (None, None))
+                if mode == WATCH_NAMES:
+                    changed += value
+                elif mode == WATCH_BASENAME and watch_path == parent:
+                    (kind, suffix) = value
+                    name = os.path.basename(path)
+                    if suffix and name.endswith(suffix):
+                        name = name[:-len(suffix)]
+                    changed.append((kind, name))
+                elif mode == WATCH_ALL:
+                    # Also catch any checks of kind still in progress
+                    changed.append((value, None))
+                    changed += [i for i in self.__clean if i[0] == value]
+            for key in changed:
+                self.__clean.pop(key, None)
+                self.__dirty[key] = now
+        finally:
+            self.__lock.release()
+
+    def is_clean(self, kind, username):
+        """Check if kind credentials of username are unchanged since last
+        check.
+        """
+        self.__lock.acquire()
+        try:
+            stamp = self.__clean.get((kind, username), None)
+            return stamp is not None and stamp + self.rescan > time.time()
+        finally:
+            self.__lock.release()
+
+    def mark_clean(self, kind, username, check_stamp):
+        """Mark kind credentials of username clean after a check started at
+        check_stamp unless an event arrived during the check.
+        """
+        key = (kind, username)
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            # Watches may have been evicted during a very long check
+            if check_stamp + self.rescan < now:
+                return
+            for dirty_key in (key, (kind, None), None):
+                if self.__dirty.get(dirty_key, 0) >= check_stamp:
+                    return
+            self.__dirty.pop(key, None)
+            self.__clean[key] = now
+            # Old dirty marks can't affect any running checks
+            if len(self.__dirty) > 10000:
+                for (name, stamp) in self.__dirty.items():
+                    if stamp + self.rescan < now:
+                        del self.__dirty[name]
+        finally:
+            self.__lock.release()
+
+    def stop(self):
+        """Stop inotify reader thread"""
+        self.__dir_watcher.stop()
+
+
+def init_creds_watcher(configuration):
+    """Returns a started CredsWatcher if enabled with a positive
+    user_creds_rescan value in configuration and None otherwise.
+    """
+    logger = configuration.logger
+    rescan = configuration.user_creds_rescan
+    if rescan <= 0:
+        return None
+    if not inotify_available:
+        logger.warning("creds watcher requires inotify support")
+        return None
+    logger.info("watching creds changes with full rescan every %ds" %
+                rescan)
+    return CredsWatcher(configuration, rescan)
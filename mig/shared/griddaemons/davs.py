@@ -40,4 +40,6 @@ from shared.griddaemons.sessions import clear_sessions, \
     track_open_session, track_close_session, \
     track_close_expired_sessions, get_active_session
 from shared.griddaemons.auth import check_twofactor_session, \
-    validate_auth_attempt
+    validate_auth_attempt, AuthCache
+from shared.griddaemons.credswatch import init_creds_watcher
+from shared.griddaemons.twofactorindex import init_twofactor_index
@@ -35,4 +35,6 @@ from shared.griddaemons.ratelimits import default_max_user_hits, \
     default_user_abuse_hits, default_proto_abuse_hits, \
     default_max_secret_hits, hit_rate_limit, expire_rate_limit
 from shared.griddaemons.auth import check_twofactor_session, \
-    validate_auth_attempt
+    validate_auth_attempt, AuthCache
+from shared.griddaemons.credswatch import init_creds_watcher
+from shared.griddaemons.twofactorindex import init_twofactor_index
@@ -109,6 +109,27 @@ last_update: %s''' % self.last_update
         return out
 
 
+def purge_logins(logins, usernames, keep=None):
+    """Remove the Login objects for usernames from the logins dictionary,
+    which maps each username to a list of its Login objects like the
+    'users', 'jobs', 'shares' and 'jupyter_mounts' entries in daemon_conf.
+    The optional keep function can be used to only remove the Login objects
+    for which it returns False.
+    The caller must hold any creds_lock.
+    """
+    for username in usernames:
+        if not logins.has_key(username):
+            continue
+        if keep is None:
+            kept = []
+        else:
+            kept = [i for i in logins[username] if keep(i)]
+        if kept:
+            logins[username] = kept
+        else:
+            del logins[username]
+
+
 def get_creds_changes(conf, username, authkeys_path, authpasswords_path,
                       authdigests_path):
     """Check if creds changed for username using the provided auth files and
@@ -119,7 +140,7 @@ def get_creds_changes(conf, username, authkeys_path, authpasswords_path,
     creds_lock = conf.get('creds_lock', None)
     if creds_lock:
         creds_lock.acquire()
-    old_users = [i for i in conf['users'] if i.username == username]
+    old_users = list(conf['users'].get(username, []))
     if creds_lock:
         creds_lock.release()
     old_key_users = [i for i in old_users if i.public_key]
@@ -188,7 +209,7 @@ def get_job_changes(conf, username, mrsl_path):
     creds_lock = conf.get('creds_lock', None)
     if creds_lock:
         creds_lock.acquire()
-    old_users = [i for i in conf['jobs'] if i.username == username]
+    old_users = list(conf['jobs'].get(username, []))
     if creds_lock:
         creds_lock.release()
     changed_paths = []
@@ -215,7 +236,7 @@ def get_share_changes(conf, username, sharelink_path):
     creds_lock = conf.get('creds_lock', None)
     if creds_lock:
         creds_lock.acquire()
-    old_users = [i for i in conf['shares'] if i.username == username]
+    old_users = list(conf['shares'].get(username, []))
     if creds_lock:
         creds_lock.release()
     changed_paths = []
@@ -240,7 +261,7 @@ def add_user_object(configuration,
                     pubkey=None,
                     chroot=True,
                     user_dict=None):
-    """Add a single Login object to active user list"""
+    """Add a single Login object to active user map"""
     conf = configuration.daemon_conf
     logger = conf.get("logger", logging.getLogger())
     creds_lock = conf.get('creds_lock', None)
@@ -255,7 +276,7 @@ def add_user_object(configuration,
     # logger.debug("Adding user login:\n%s" % user)
     if creds_lock:
         creds_lock.acquire()
-    conf['users'].append(user)
+    conf['users'].setdefault(login, []).append(user)
     if creds_lock:
         creds_lock.release()
 
@@ -268,7 +289,7 @@ def add_job_object(configuration,
                    pubkey=None,
                    chroot=True,
                    ip_addr=None):
-    """Add a single Login object to active jobs list"""
+    """Add a single Login object to active jobs map"""
     conf = configuration.daemon_conf
     logger = conf.get("logger", logging.getLogger())
     creds_lock = conf.get('creds_lock', None)
@@ -283,14 +304,14 @@ def add_job_object(configuration,
     # logger.debug("Adding job login:\n%s" % job)
     if creds_lock:
         creds_lock.acquire()
-    conf['jobs'].append(job)
+    conf['jobs'].setdefault(login, []).append(job)
     if creds_lock:
         creds_lock.release()
 
 
 def add_share_object(configuration, login, home, password=None, digest=None,
                      pubkey=None, chroot=True, ip_addr=None):
-    """Add a single Login object to active shares list"""
+    """Add a single Login object to active shares map"""
     conf = configuration.daemon_conf
     logger = conf.get("logger", logging.getLogger())
     creds_lock = conf.get('creds_lock', None)
@@ -305,14 +326,14 @@ def add_share_object(configuration, login, home, password=None, digest=None,
     # logger.debug("Adding share login:\n%s" % share)
     if creds_lock:
         creds_lock.acquire()
-    conf['shares'].append(share)
+    conf['shares'].setdefault(login, []).append(share)
     if creds_lock:
         creds_lock.release()
 
 
 def add_jupyter_object(configuration, login, home, password=None, digest=None,
                        pubkey=None, chroot=True, ip_addr=None):
-    """Add a single Login object to active jupyter mount list"""
+    """Add a single Login object to active jupyter mount map"""
     conf = configuration.daemon_conf
     logger = conf.get('logger', logging.getLogger())
     creds_lock = conf.get('creds_lock', None)
@@ -327,7 +348,7 @@ def add_jupyter_object(configuration, login, home, password=None, digest=None,
     # logger.debug("Adding jupyter login:\n%s" % jupyter_mount)
     if creds_lock:
         creds_lock.acquire()
-    conf['jupyter_mounts'].append(jupyter_mount)
+    conf['jupyter_mounts'].setdefault(login, []).append(jupyter_mount)
     if creds_lock:
         creds_lock.release()
 
@@ -363,9 +384,8 @@ def update_user_objects(configuration, auth_file, path, user_vars, auth_protos,
         all_passwords = []
         all_digests = []
         # Clean up all old key entries for this user
-        conf['users'] = [i for i in conf['users']
-                         if not i.username in user_logins or
-                         i.public_key is None]
+        purge_logins(conf['users'], user_logins,
+                     lambda i: i.public_key is None)
     elif auth_file == proto_authpasswords:
         all_keys = []
         if private_auth_file:
@@ -379,9 +399,8 @@ def update_user_objects(configuration, auth_file, path, user_vars, auth_protos,
             all_passwords = []
         all_digests = []
         # Clean up all old password entries for this user
-        conf['users'] = [i for i in conf['users']
-                         if not i.username in user_logins or
-                         i.password is None]
+        purge_logins(conf['users'], user_logins,
+                     lambda i: i.password is None)
     else:
         all_keys = []
         all_passwords = []
@@ -392,11 +411,11 @@ def update_user_objects(configuration, auth_file, path, user_vars, auth_protos,
         else:
             all_digests = []
         # Clean up all old digest entries for this user
-        conf['users'] = [i for i in conf['users']
-                         if not i.username in user_logins or
-                         i.digest is None]
+        purge_logins(conf['users'], user_logins,
+                     lambda i: i.digest is None)
     # logger.debug("after clean up old users list is:\n%s" % \
-    #             '\n'.join(["%s" % i for i in conf['users']]))
+    #             '\n'.join(["%s" % i for i in conf['users'].get(user_alias,
+    #                                                             [])]))
     if creds_lock:
         creds_lock.release()
     for user_key in all_keys:
@@ -463,7 +482,8 @@ def update_user_objects(configuration, auth_file, path, user_vars, auth_protos,
                             digest=user_digest,
                             user_dict=user_dict)
     # logger.debug("after update users list is:\n%s" % \
-    #             '\n'.join(["%s" % i for i in conf['users']]))
+    #             '\n'.join(["%s" % i for i in conf['users'].get(user_alias,
+    #                                                             [])]))
 
 
 def refresh_user_creds(configuration, protocol, username):
@@ -507,6 +527,12 @@ def refresh_user_creds(configuration, protocol, username):
 
     auth_protos = (proto_authkeys, proto_authpasswords, proto_authdigests)
 
+    # Skip all disk checks if creds watcher saw no changes since last check
+    creds_watcher = conf.get('creds_watcher', None)
+    if creds_watcher and creds_watcher.is_clean('users', username):
+        return (conf, changed_users)
+    check_stamp = time.time()
+
     # We support direct and symlinked usernames for now
     # NOTE: entries are gracefully removed if user no longer exists
     if private_auth_file:
@@ -521,12 +547,29 @@ def refresh_user_creds(configuration, protocol, username):
     else:
         authkeys_path = authpasswords_path = authdigests_path = conf['db_path']
 
+    # NOTE: watch before checking to catch any changes during the check
+    watched = False
+    if creds_watcher and private_auth_file:
+        watch_dirs = [os.path.dirname(i) for i in (authkeys_path,
+                                                   authpasswords_path,
+                                                   authdigests_path)]
+        # Watch home for creation of any missing auth dirs
+        if [i for i in watch_dirs if not os.path.isdir(i)]:
+            watch_dirs.append(os.path.realpath(os.path.join(conf['root_dir'],
+                                                            username)))
+        watched = creds_watcher.watch_names('users', username, watch_dirs)
+    elif creds_watcher:
+        watched = creds_watcher.watch_all('users',
+                                          os.path.dirname(conf['db_path']))
+
     # logger.debug("Updating user creds for %s" % username)
 
     changed_paths = get_creds_changes(conf, username, authkeys_path,
                                       authpasswords_path, authdigests_path)
     if not changed_paths:
         # logger.debug("No user creds changes for %s" % username)
+        if watched:
+            creds_watcher.mark_clean('users', username, check_stamp)
         return (conf, changed_users)
 
     short_id, short_alias = None, None
@@ -587,6 +630,8 @@ def refresh_user_creds(configuration, protocol, username):
         logger.info("Refreshed user %s from configuration: %s" %
                     (username, changed_paths))
         changed_users.append(username)
+    if watched:
+        creds_watcher.mark_clean('users', username, check_stamp)
     return (conf, changed_users)
 
 
@@ -609,7 +654,7 @@ def refresh_users(configuration, protocol):
     last_update = conf['time_stamp']
     if creds_lock:
         creds_lock.acquire()
-    old_usernames = [i.username for i in conf['users']]
+    old_usernames = conf['users'].keys()
     if creds_lock:
         creds_lock.release()
     cur_usernames = []
@@ -688,12 +733,13 @@ def refresh_users(configuration, protocol):
         changed_users += [user_id, user_alias]
         if short_id is not None:
             changed_users += [short_id, short_alias]
-    removed = [i for i in old_usernames if not i in cur_usernames]
+    cur_set = set(cur_usernames)
+    removed = [i for i in old_usernames if not i in cur_set]
     if removed:
         logger.info("Removing login for %d deleted users" % len(removed))
         if creds_lock:
             creds_lock.acquire()
-        conf['users'] = [i for i in conf['users'] if not i.username in removed]
+        purge_logins(conf['users'], removed)
         if creds_lock:
             creds_lock.release()
         changed_users += removed
@@ -724,12 +770,23 @@ def refresh_job_creds(configuration, protocol, username):
         # logger.debug("ruled out %s as a possible job ID" % username)
         return (conf, changed_jobs)
 
+    creds_watcher = conf.get('creds_watcher', None)
+    if creds_watcher and creds_watcher.is_clean('jobs', username):
+        return (conf, changed_jobs)
+    check_stamp = time.time()
+    watched = False
+    if creds_watcher:
+        watched = creds_watcher.watch_basenames(
+            'jobs', configuration.sessid_to_mrsl_link_home, '.mRSL')
+
     link_path = os.path.join(configuration.sessid_to_mrsl_link_home,
                              "%s.mRSL" % username)
     # logger.debug("Updating job creds for %s" % username)
     changed_paths = get_job_changes(conf, username, link_path)
     if not changed_paths:
         # logger.debug("No job creds changes for %s" % username)
+        if watched:
+            creds_watcher.mark_clean('jobs', username, check_stamp)
         return (conf, changed_jobs)
 
     job_dict = None
@@ -786,11 +843,13 @@ def refresh_job_creds(configuration, protocol, username):
         logger.info("Removing login(s) for inactive job %s" % username)
         if creds_lock:
             creds_lock.acquire()
-        conf['jobs'] = [i for i in conf['jobs'] if i.username != username]
+        purge_logins(conf['jobs'], [username])
         if creds_lock:
             creds_lock.release()
         changed_jobs.append(username)
     logger.info("Refreshed jobs from configuration")
+    if watched:
+        creds_watcher.mark_clean('jobs', username, check_stamp)
     return (conf, changed_jobs)
 
 
@@ -807,7 +866,7 @@ def refresh_jobs(configuration, protocol):
     creds_lock = conf.get('creds_lock', None)
     if creds_lock:
         creds_lock.acquire()
-    old_usernames = [i.username for i in conf['jobs']]
+    old_usernames = conf['jobs'].keys()
     if creds_lock:
         creds_lock.release()
     cur_usernames = []
@@ -871,12 +930,13 @@ def refresh_jobs(configuration, protocol):
                 cur_usernames.append(user_alias)
                 changed_jobs.append(user_alias)
 
-    removed = [i for i in old_usernames if not i in cur_usernames]
+    cur_set = set(cur_usernames)
+    removed = [i for i in old_usernames if not i in cur_set]
     if removed:
         logger.info("Removing login for %d finished jobs" % len(removed))
         if creds_lock:
             creds_lock.acquire()
-        conf['jobs'] = [i for i in conf['jobs'] if not i.username in removed]
+        purge_logins(conf['jobs'], removed)
         if creds_lock:
             creds_lock.release()
         changed_jobs += removed
@@ -925,11 +985,22 @@ def refresh_share_creds(configuration, protocol, username,
         logger.error("invalid share mode %s for %s" % (mode, username))
         return (conf, changed_shares)
 
+    creds_watcher = conf.get('creds_watcher', None)
+    if creds_watcher and creds_watcher.is_clean('shares', username):
+        return (conf, changed_shares)
+    check_stamp = time.time()
+    watched = False
+    if creds_watcher:
+        watched = creds_watcher.watch_basenames(
+            'shares', os.path.join(configuration.sharelink_home, mode))
+
     # logger.debug("Updating share creds for %s" % username)
     link_path = os.path.join(configuration.sharelink_home, mode, username)
     changed_paths = get_share_changes(conf, username, link_path)
     if not changed_paths:
         # logger.debug("No share creds changes for %s" % username)
+        if watched:
+            creds_watcher.mark_clean('shares', username, check_stamp)
         return (conf, changed_shares)
 
     try:
@@ -984,11 +1055,13 @@ def refresh_share_creds(configuration, protocol, username,
         logger.info("Removing login(s) for inactive share %s" % username)
         if creds_lock:
             creds_lock.acquire()
-        conf['shares'] = [i for i in conf['shares'] if i.username != username]
+        purge_logins(conf['shares'], [username])
         if creds_lock:
             creds_lock.release()
         changed_shares.append(username)
     logger.info("Refreshed shares from configuration")
+    if watched:
+        creds_watcher.mark_clean('shares', username, check_stamp)
     return (conf, changed_shares)
 
 
@@ -1010,7 +1083,7 @@ def refresh_shares(configuration, protocol, share_modes=['read-write']):
     creds_lock = conf.get('creds_lock', None)
     if creds_lock:
         creds_lock.acquire()
-    old_usernames = [i.username for i in conf['shares']]
+    old_usernames = conf['shares'].keys()
     if creds_lock:
         creds_lock.release()
     cur_usernames = []
@@ -1066,13 +1139,13 @@ def refresh_shares(configuration, protocol, share_modes=['read-write']):
             cur_usernames.append(user_alias)
             changed_shares.append(user_alias)
 
-    removed = [i for i in old_usernames if not i in cur_usernames]
+    cur_set = set(cur_usernames)
+    removed = [i for i in old_usernames if not i in cur_set]
     if removed:
         logger.info("Removing login for %d inactive shares" % len(removed))
         if creds_lock:
             creds_lock.acquire()
-        conf['shares'] = [i for i in conf['shares'] if not i.username in
-                          removed]
+        purge_logins(conf['shares'], removed)
         if creds_lock:
             creds_lock.release()
         changed_shares += removed
@@ -1134,8 +1207,9 @@ def refresh_jupyter_creds(configuration, protocol, username):
             # same user_dir
             if creds_lock:
                 creds_lock.acquire()
-            conf['jupyter_mounts'] = [i for i in conf['jupyter_mounts']
-                                      if i.home != user_dir]
+            purge_logins(conf['jupyter_mounts'],
+                         conf['jupyter_mounts'].keys(),
+                         lambda i: i.home != user_dir)
             if creds_lock:
                 creds_lock.release()
 
@@ -1147,8 +1221,8 @@ def refresh_jupyter_creds(configuration, protocol, username):
     if creds_lock:
         creds_lock.acquire()
     logger.info("Active jupyter_mounts: " +
-                str([(i.username, i.home) for i in
-                     conf['jupyter_mounts']]))
+                str([(i.username, i.home) for mounts in
+                     conf['jupyter_mounts'].values() for i in mounts]))
     if creds_lock:
         creds_lock.release()
     logger.info("Refreshed active jupyter creds")
@@ -1163,23 +1237,23 @@ def update_login_map(daemon_conf, changed_users, changed_jobs=[],
     The login_map is a dictionary for fast lookup and we create a list of
     matching Login objects since each user/job/share may have multiple logins
     (e.g. public keys).
+    The 'users', 'jobs', 'shares' and 'jupyter_mounts' are already kept as
+    dictionaries mapping each username to its Login objects, so the work here
+    is proportional to the number of changed usernames.
     """
     login_map = daemon_conf['login_map']
     creds_lock = daemon_conf.get('creds_lock', None)
     if creds_lock:
         creds_lock.acquire()
     for username in changed_users:
-        login_map[username] = [i for i in daemon_conf['users'] if username ==
-                               i.username]
+        login_map[username] = list(daemon_conf['users'].get(username, []))
     for username in changed_jobs:
-        login_map[username] = [i for i in daemon_conf['jobs'] if username ==
-                               i.username]
+        login_map[username] = list(daemon_conf['jobs'].get(username, []))
     for username in changed_shares:
-        login_map[username] = [i for i in daemon_conf['shares'] if username ==
-                               i.username]
+        login_map[username] = list(daemon_conf['shares'].get(username, []))
     for username in changed_jupyter:
-        login_map[username] = [i for i in daemon_conf['jupyter_mounts']
-                               if username == i.username]
+        login_map[username] = list(daemon_conf['jupyter_mounts'].get(
+            username, []))
     if creds_lock:
         creds_lock.release()
 
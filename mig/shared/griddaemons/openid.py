@@ -34,3 +34,4 @@ from shared.griddaemons.ratelimits import default_max_user_hits, \
     default_user_abuse_hits, default_proto_abuse_hits, \
     hit_rate_limit, expire_rate_limit
 from shared.griddaemons.auth import validate_auth_attempt
+from shared.griddaemons.credswatch import init_creds_watcher
@@ -30,8 +30,8 @@
 import os
 import time
 import traceback
-from shared.fileio import pickle, unpickle, acquire_file_lock, \
-    release_file_lock, touch
+from shared.fileio import touch
+from shared.griddaemons.statestore import open_state, snapshot_state
 
 default_max_user_hits, default_fail_cache = 5, 120
 default_user_abuse_hits = 25
@@ -42,67 +42,11 @@ _rate_limits_filename = "rate_limits.pck"
 _last_expired_filename = "last_expired"
 
 
-def _acquire_rate_limits_lock(configuration, proto, exclusive=True):
-    """Acquire rate limits lock for protocol proto"""
-
-    flock_filepath = \
-        os.path.join(configuration.mig_system_run,
-                     "%s.%s.lock"
-                     % (proto, _rate_limits_filename))
-
-    flock = acquire_file_lock(flock_filepath, exclusive=exclusive)
-
-    return flock
-
-
-def _release_rate_limits_lock(lock):
-    """Release rate limits lock"""
-    return release_file_lock(lock)
-
-
-def _load_rate_limits(configuration,
-                      proto,
-                      do_lock=True):
-    """Load rate limits dict"""
-    logger = configuration.logger
-    rate_limits_filepath = os.path.join(configuration.mig_system_run,
-                                        "%s.%s"
-                                        % (proto, _rate_limits_filename))
-    if do_lock:
-        rate_limits_lock = _acquire_rate_limits_lock(
-            configuration, proto, exclusive=False)
-    result = unpickle(rate_limits_filepath, logger)
-    if do_lock:
-        _release_rate_limits_lock(rate_limits_lock)
-
-    if not isinstance(result, dict):
-        logger.warning("failed to retrieve active %s rate limits from %s" % (
-            proto, rate_limits_filepath))
-        result = {}
-
-    return result
-
-
-def _save_rate_limits(configuration,
-                      proto,
-                      rate_limits,
-                      do_lock=True):
-    """Save rate limits dict"""
-    logger = configuration.logger
-    rate_limits_filepath = os.path.join(configuration.mig_system_run,
-                                        "%s.%s"
-                                        % (proto, _rate_limits_filename))
-    if do_lock:
-        rate_limits_lock = _acquire_rate_limits_lock(configuration, proto)
-    result = pickle(rate_limits, rate_limits_filepath, logger)
-    if do_lock:
-        _release_rate_limits_lock(rate_limits_lock)
-
-    if not result:
-        logger.error("failed to save %s rate limits to %s" %
-                     (proto, rate_limits_filepath))
-
-    return result
+def _rate_limits_namespace(proto):
+    """Name of state store namespace and snapshot file for proto rate limits.
+    The namespace holds an entry for each client address.
+    """
+    return "%s.%s" % (proto, _rate_limits_filename)
 
 
 def _get_last_expire(configuration, proto):
@@ -125,6 +69,139 @@ def _set_last_expire(configuration, proto):
     return touch(last_expired_filepath, configuration)
 
 
+def _update_address_limits(_address_limits, proto, client_id, login_success,
+                           secret, timestamp):
+    """State store update helper for update_rate_limit on the rate limit
+    entry for a single client address. Returns the updated entry and a tuple
+    with all the old and new counters. Entries without any failures left are
+    removed.
+    """
+    if _address_limits is None:
+        _address_limits = {}
+    _proto_limits = _address_limits.get(proto, {})
+    if not _proto_limits:
+        _address_limits[proto] = _proto_limits
+    _user_limits = _proto_limits.get(client_id, {})
+
+    address_fails = old_address_fails = _address_limits.get('fails', 0)
+    address_hits = old_address_hits = _address_limits.get('hits', 0)
+    proto_fails = old_proto_fails = _proto_limits.get('fails', 0)
+    proto_hits = old_proto_hits = _proto_limits.get('hits', 0)
+    user_fails = old_user_fails = _user_limits.get('fails', 0)
+    user_hits = old_user_hits = _user_limits.get('hits', 0)
+    secret_hits = old_secret_hits = 0
+    if login_success:
+        if _user_limits:
+            address_fails -= user_fails
+            address_hits -= user_hits
+            proto_fails -= user_fails
+            proto_hits -= user_hits
+            user_fails = user_hits = 0
+            del _proto_limits[client_id]
+    else:
+        if not _user_limits:
+            _proto_limits[client_id] = _user_limits
+        _secret_limits = _user_limits.get(secret, {})
+        if not _secret_limits:
+            _user_limits[secret] = _secret_limits
+        secret_hits = old_secret_hits = _secret_limits.get('hits', 0)
+        if secret_hits == 0:
+            address_hits += 1
+            proto_hits += 1
+            user_hits += 1
+        address_fails += 1
+        proto_fails += 1
+        user_fails += 1
+        secret_hits += 1
+        _secret_limits['timestamp'] = timestamp
+        _secret_limits['hits'] = secret_hits
+        _user_limits['fails'] = user_fails
+        _user_limits['hits'] = user_hits
+    _address_limits['fails'] = address_fails
+    _address_limits['hits'] = address_hits
+    _proto_limits['fails'] = proto_fails
+    _proto_limits['hits'] = proto_hits
+    if address_fails <= 0 and proto_fails <= 0:
+        _address_limits = None
+    return (_address_limits,
+            (address_fails, old_address_fails, address_hits, old_address_hits,
+             proto_fails, old_proto_fails, proto_hits, old_proto_hits,
+             user_fails, old_user_fails, user_hits, old_user_hits,
+             secret_hits, old_secret_hits))
+
+
+def _expire_address_limits(_address_limits, proto, fail_cache, now):
+    """State store update helper for expire_rate_limit on the rate limit
+    entry for a single client address. Returns the updated entry and a tuple
+    with the number of expired secrets and all the old and new counters.
+    Entries without any failures left are removed.
+    """
+    expired = 0
+    # debug_msg = "expire addr: %s" % _client_address
+    address_fails = old_address_fails = _address_limits.get('fails', 0)
+    address_hits = old_address_hits = _address_limits.get('hits', 0)
+    _proto_limits = _address_limits.setdefault(proto, {})
+    # debug_msg += ", proto: %s" % _proto
+    proto_fails = old_proto_fails = _proto_limits.get('fails', 0)
+    proto_hits = old_proto_hits = _proto_limits.get('hits', 0)
+    user_fails = old_user_fails = 0
+    user_hits = old_user_hits = 0
+    for _user in _proto_limits.keys():
+        if _user in ['hits', 'fails']:
+            continue
+        # debug_msg += ", user: %s" % _user
+        _user_limits = _proto_limits[_user]
+        user_fails = old_user_fails = _user_limits['fails']
+        user_hits = old_user_hits = _user_limits['hits']
+        for _secret in _user_limits.keys():
+            if _secret in ['hits', 'fails']:
+                continue
+            _secret_limits = _user_limits[_secret]
+            if _secret_limits['timestamp'] + fail_cache < now:
+                secret_hits = _secret_limits['hits']
+                # debug_msg += \
+                #"\ntimestamp: %s, secret_hits: %d" \
+                #    % (_secret_limits['timestamp'], secret_hits) \
+                #    + ", secret: %s" % _secret
+                address_fails -= secret_hits
+                address_hits -= 1
+                proto_fails -= secret_hits
+                proto_hits -= 1
+                user_fails -= secret_hits
+                user_hits -= 1
+                del _user_limits[_secret]
+                expired += 1
+        _user_limits['fails'] = user_fails
+        _user_limits['hits'] = user_hits
+        # debug_msg += "\nold_user_fails: %d -> %d" \
+        # % (old_user_fails, user_fails) \
+        #    + "\nold_user_hits: %d -> %d" \
+        #    % (old_user_hits, user_hits)
+        if user_fails == 0:
+            # debug_msg += "\nRemoving expired user: %s" % _user
+            del _proto_limits[_user]
+    _proto_limits['fails'] = proto_fails
+    _proto_limits['hits'] = proto_hits
+    # debug_msg += "\nold_proto_fails: %d -> %d" \
+    # % (old_proto_fails, proto_fails) \
+    #    + "\nold_proto_hits: %d -> %d" \
+    #    % (old_proto_hits, proto_hits)
+    _address_limits['fails'] = address_fails
+    _address_limits['hits'] = address_hits
+    # debug_msg += "\nold_address_fails: %d -> %d" \
+    # % (old_address_fails, address_fails) \
+    #    + "\nold_address_hits: %d -> %d" \
+    #    % (old_address_hits, address_hits)
+    # logger.debug(debug_msg)
+    if address_fails <= 0 and proto_fails <= 0:
+        _address_limits = None
+    return (_address_limits,
+            (expired, (address_fails, old_address_fails, address_hits,
+                       old_address_hits, proto_fails, old_proto_fails,
+                       proto_hits, old_proto_hits, user_fails, old_user_fails,
+                       user_hits, old_user_hits)))
+
+
 def hit_rate_limit(configuration, proto, client_address, client_id,
                    max_user_hits=default_max_user_hits):
     """Check if proto login from client_address with client_id should be
@@ -146,8 +223,9 @@ def hit_rate_limit(configuration, proto, client_address, client_id,
     logger = configuration.logger
     refuse = False
 
-    _rate_limits = _load_rate_limits(configuration, proto)
-    _address_limits = _rate_limits.get(client_address, {})
+    store = open_state(configuration, _rate_limits_namespace(proto))
+    _address_limits = store.get(_rate_limits_namespace(proto), client_address,
+                                {})
     _proto_limits = _address_limits.get(proto, {})
     _user_limits = _proto_limits.get(client_id, {})
     proto_hits = _proto_limits.get('hits', 0)
@@ -213,66 +291,27 @@ def update_rate_limit(configuration, proto, client_address, client_id,
     if not secret:
         secret = timestamp
 
-    rate_limits_lock = _acquire_rate_limits_lock(
-        configuration, proto, exclusive=True)
-    _rate_limits = _load_rate_limits(configuration, proto, do_lock=False)
+    namespace = _rate_limits_namespace(proto)
     try:
-        # logger.debug("update rate limit db: %s" % _rate_limits)
-        _address_limits = _rate_limits.get(client_address, {})
-        if not _address_limits:
-            _rate_limits[client_address] = _address_limits
-        _proto_limits = _address_limits.get(proto, {})
-        if not _proto_limits:
-            _address_limits[proto] = _proto_limits
-        _user_limits = _proto_limits.get(client_id, {})
-
-        address_fails = old_address_fails = _address_limits.get('fails', 0)
-        address_hits = old_address_hits = _address_limits.get('hits', 0)
-        proto_fails = old_proto_fails = _proto_limits.get('fails', 0)
-        proto_hits = old_proto_hits = _proto_limits.get('hits', 0)
-        user_fails = old_user_fails = _user_limits.get('fails', 0)
-        user_hits = old_user_hits = _user_limits.get('hits', 0)
+        store = open_state(configuration, namespace)
         if login_success:
-            if _user_limits:
-                address_fails -= user_fails
-                address_hits -= user_hits
-                proto_fails -= user_fails
-                proto_hits -= user_hits
-                user_fails = user_hits = 0
-                del _proto_limits[client_id]
+            ttl = None
         else:
-            if not _user_limits:
-                _proto_limits[client_id] = _user_limits
-            _secret_limits = _user_limits.get(secret, {})
-            if not _secret_limits:
-                _user_limits[secret] = _secret_limits
-            secret_hits = old_secret_hits = _secret_limits.get('hits', 0)
-            if secret_hits == 0:
-                address_hits += 1
-                proto_hits += 1
-                user_hits += 1
-            address_fails += 1
-            proto_fails += 1
-            user_fails += 1
-            secret_hits += 1
-            _secret_limits['timestamp'] = timestamp
-            _secret_limits['hits'] = secret_hits
-            _user_limits['fails'] = user_fails
-            _user_limits['hits'] = user_hits
-        _address_limits['fails'] = address_fails
-        _address_limits['hits'] = address_hits
-        _proto_limits['fails'] = proto_fails
-        _proto_limits['hits'] = proto_hits
-        if not _save_rate_limits(configuration,
-                                 proto, _rate_limits, do_lock=False):
+            ttl = default_fail_cache
+        (address_fails, old_address_fails, address_hits, old_address_hits,
+         proto_fails, old_proto_fails, proto_hits, old_proto_hits,
+         user_fails, old_user_fails, user_hits, old_user_hits,
+         secret_hits, old_secret_hits) = \
+            store.update(namespace, client_address, _update_address_limits,
+                         (proto, client_id, login_success, secret,
+                          timestamp), ttl)
+        if not snapshot_state(configuration, namespace):
             raise IOError("%s save rate limits failed for %s" %
                           (proto, client_id))
     except Exception, exc:
         logger.error("update %s Rate limit failed: %s" % (proto, exc))
         logger.info(traceback.format_exc())
 
-    _release_rate_limits_lock(rate_limits_lock)
-
     """
     logger.debug("update %s rate limit %s for %s\n"
                  % (proto, status[login_success], client_address)
@@ -328,75 +367,23 @@ def expire_rate_limit(configuration, proto,
                      % (-expired, expire_delay))
         return expired
 
-    rate_limits_lock = _acquire_rate_limits_lock(
-        configuration, proto, exclusive=True)
-    _rate_limits = _load_rate_limits(configuration, proto, do_lock=False)
+    namespace = _rate_limits_namespace(proto)
     try:
-        for _client_address in _rate_limits.keys():
-            # debug_msg = "expire addr: %s" % _client_address
-            _address_limits = _rate_limits[_client_address]
-            address_fails = old_address_fails = _address_limits['fails']
-            address_hits = old_address_hits = _address_limits['hits']
-            _proto_limits = _address_limits[proto]
-            # debug_msg += ", proto: %s" % _proto
-            proto_fails = old_proto_fails = _proto_limits['fails']
-            proto_hits = old_proto_hits = _proto_limits['hits']
-            for _user in _proto_limits.keys():
-                if _user in ['hits', 'fails']:
-                    continue
-                # debug_msg += ", user: %s" % _user
-                _user_limits = _proto_limits[_user]
-                user_fails = old_user_fails = _user_limits['fails']
-                user_hits = old_user_hits = _user_limits['hits']
-                for _secret in _user_limits.keys():
-                    if _secret in ['hits', 'fails']:
-                        continue
-                    _secret_limits = _user_limits[_secret]
-                    if _secret_limits['timestamp'] + fail_cache < now:
-                        secret_hits = _secret_limits['hits']
-                        # debug_msg += \
-                        #"\ntimestamp: %s, secret_hits: %d" \
-                        #    % (_secret_limits['timestamp'], secret_hits) \
-                        #    + ", secret: %s" % _secret
-                        address_fails -= secret_hits
-                        address_hits -= 1
-                        proto_fails -= secret_hits
-                        proto_hits -= 1
-                        user_fails -= secret_hits
-                        user_hits -= 1
-                        del _user_limits[_secret]
-                        expired += 1
-                _user_limits['fails'] = user_fails
-                _user_limits['hits'] = user_hits
-                # debug_msg += "\nold_user_fails: %d -> %d" \
-                # % (old_user_fails, user_fails) \
-                #    + "\nold_user_hits: %d -> %d" \
-                #    % (old_user_hits, user_hits)
-                if user_fails == 0:
-                    # debug_msg += "\nRemoving expired user: %s" % _user
-                    del _proto_limits[_user]
-            _proto_limits['fails'] = proto_fails
-            _proto_limits['hits'] = proto_hits
-            # debug_msg += "\nold_proto_fails: %d -> %d" \
-            # % (old_proto_fails, proto_fails) \
-            #    + "\nold_proto_hits: %d -> %d" \
-            #    % (old_proto_hits, proto_hits)
-            _address_limits['fails'] = address_fails
-            _address_limits['hits'] = address_hits
-            # debug_msg += "\nold_address_fails: %d -> %d" \
-            # % (old_address_fails, address_fails) \
-            #    + "\nold_address_hits: %d -> %d" \
-            #    % (old_address_hits, address_hits)
-            # logger.debug(debug_msg)
-        if not _save_rate_limits(configuration,
-                                 proto, _rate_limits, do_lock=False):
+        store = open_state(configuration, namespace)
+        results = store.update_all(namespace, _expire_address_limits,
+                                   (proto, fail_cache, now))
+        for (address_expired, counts) in results.values():
+            expired += address_expired
+            (address_fails, old_address_fails, address_hits,
+             old_address_hits, proto_fails, old_proto_fails, proto_hits,
+             old_proto_hits, user_fails, old_user_fails, user_hits,
+             old_user_hits) = counts
+        if not snapshot_state(configuration, namespace, force=True):
             raise IOError("%s save rate limits failed" % proto)
     except Exception, exc:
         logger.error("expire rate limit failed: %s" % exc)
         logger.info(traceback.format_exc())
 
-    _release_rate_limits_lock(rate_limits_lock)
-
     if expired:
         logger.info("expire %s rate limit expired %d items" % (proto,
                                                                expired))
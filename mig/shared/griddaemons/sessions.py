@@ -25,89 +25,90 @@
 # -- END_HEADER ---
 #
 
-"""MiG daemon session tracker functions"""
+"""MiG daemon session tracker functions.
+
+The sessions are kept in the daemon state store. The do_lock arguments are
+only kept for API compatibility since all state store updates are atomic.
+"""
 
-import os
 import time
 from shared.defaults import io_session_timeout
-from shared.fileio import pickle, unpickle, acquire_file_lock, \
-    release_file_lock
+from shared.griddaemons.statestore import open_state, snapshot_state
+from shared.metrics import gauge
 
 _sessions_filename = "sessions.pck"
+_session_keys = ['session_id', 'client_id', 'ip_addr', 'tcp_port',
+                 'authorized', 'timestamp']
+_open_sessions = gauge('sessions_open', 'Sessions opened and not yet closed '
+                       'by this daemon', ('protocol', ))
 
 
-def _acquire_sessions_lock(configuration, proto, exclusive=True):
-    """Acquire sessions lock for protocol proto"""
-    flock_filepath = \
-        os.path.join(configuration.mig_system_run,
-                     "%s.%s.lock"
-                     % (proto, _sessions_filename))
-    flock = acquire_file_lock(flock_filepath, exclusive=exclusive)
-
-    return flock
-
-
-def _release_sessions_lock(flock):
-    """Release sessions file lock"""
-    return release_file_lock(flock)
-
+def _sessions_namespace(proto):
+    """Name of state store namespace and snapshot file for proto sessions.
+    The namespace holds an entry for each client_id.
+    """
+    return "%s.%s" % (proto, _sessions_filename)
 
-def _load_sessions(configuration, proto, do_lock=True):
-    """Load sessions dict"""
-    logger = configuration.logger
-    sessions_filepath = os.path.join(configuration.mig_system_run,
-                                     "%s.%s"
-                                     % (proto, _sessions_filename))
-    sessions_lock = None
-    if do_lock:
-        sessions_lock = _acquire_sessions_lock(
-            configuration, proto, exclusive=False)
-    result = unpickle(sessions_filepath, logger)
-    if do_lock:
-        _release_sessions_lock(sessions_lock)
-
-    if not isinstance(result, dict):
-        logger.warning("failed to retrieve active %s sessions from %s" %
-                       (proto, sessions_filepath))
-        result = {}
 
+def _copy_session(session):
+    """Returns a copy of session dictionary with keys inserted in the same
+    order as when it was created to keep the same key order on output.
+    """
+    result = {}
+    for key in _session_keys:
+        if session.has_key(key):
+            result[key] = session[key]
     return result
 
 
-def _save_sessions(configuration,
-                   proto,
-                   sessions,
-                   do_lock=True):
-    """Save sessions dict"""
-    logger = configuration.logger
-    do_lock = None
-    sessions_filepath = os.path.join(configuration.mig_system_run,
-                                     "%s.%s"
-                                     % (proto, _sessions_filename))
-    if do_lock:
-        sessions_lock = _acquire_sessions_lock(
-            configuration, proto, exclusive=True)
-    result = pickle(sessions, sessions_filepath, logger)
-    if do_lock:
-        _release_sessions_lock(sessions_lock)
-
-    if not result:
-        logger.error("failed to save active %s sessions to %s" %
-                     (proto, sessions_filepath))
-
-    return result
+def _open_session(_cached, proto, session_id, client_id, client_address,
+                  client_port, authorized, timestamp):
+    """State store update helper for track_open_session on the sessions of
+    a single client_id. Returns the updated entry and a tuple with a boolean
+    telling if the session is new and a copy of the session.
+    """
+    if _cached is None:
+        _cached = {}
+    _proto = _cached.get(proto, {})
+    if not _proto:
+        _cached[proto] = _proto
+    _session = _proto.get(session_id, {})
+    new_session = not _session
+    if new_session:
+        _proto[session_id] = _session
+    _session['session_id'] = session_id
+    _session['client_id'] = client_id
+    _session['ip_addr'] = client_address
+    _session['tcp_port'] = client_port
+    _session['authorized'] = authorized
+    _session['timestamp'] = timestamp
+    return (_cached, (new_session, _copy_session(_session)))
+
+
+def _close_session(_cached, proto, session_id):
+    """State store update helper for track_close_session on the sessions of
+    a single client_id. Returns the updated entry and the closed session or
+    None if not found. Entries without any sessions left are removed.
+    """
+    if _cached is None:
+        return (None, None)
+    open_sessions = _cached.get(proto, {})
+    result = open_sessions.pop(session_id, None)
+    if not open_sessions:
+        _cached.pop(proto, None)
+    if not _cached:
+        _cached = None
+    return (_cached, result)
 
 
 def clear_sessions(configuration,
                    proto,
                    do_lock=True):
     """Clear sessions"""
-    logger = configuration.logger
-
-    return _save_sessions(configuration,
-                          proto,
-                          {},
-                          do_lock=do_lock)
+    namespace = _sessions_namespace(proto)
+    store = open_state(configuration, namespace)
+    store.clear(namespace)
+    return snapshot_state(configuration, namespace, force=True)
 
 
 def track_open_session(configuration,
@@ -132,38 +133,22 @@ def track_open_session(configuration,
     result = None
     if not session_id:
         session_id = "%s:%s" % (client_address, client_port)
-    if do_lock:
-        sessions_lock = _acquire_sessions_lock(
-            configuration, proto, exclusive=False)
-    _active_sessions = _load_sessions(configuration, proto, do_lock=False)
+    namespace = _sessions_namespace(proto)
     try:
-        _cached = _active_sessions.get(client_id, {})
-        if not _cached:
-            _active_sessions[client_id] = _cached
-        _proto = _cached.get(proto, {})
-        if not _proto:
-            _cached[proto] = _proto
-        _session = _proto.get(session_id, {})
-        if not _session:
-            _proto[session_id] = _session
-        _session['session_id'] = session_id
-        _session['client_id'] = client_id
-        _session['ip_addr'] = client_address
-        _session['tcp_port'] = client_port
-        _session['authorized'] = authorized
-        _session['timestamp'] = time.time()
-        result = _session
-        if not _save_sessions(configuration,
-                              proto, _active_sessions, do_lock=False):
+        store = open_state(configuration, namespace)
+        (new_session, result) = store.update(
+            namespace, client_id, _open_session,
+            (proto, session_id, client_id, client_address, client_port,
+             authorized, time.time()))
+        if new_session:
+            _open_sessions.inc(protocol=proto)
+        if not snapshot_state(configuration, namespace):
             raise IOError("%s save sessions failed for %s" %
                           (proto, client_id))
     except Exception, exc:
         result = None
         logger.error("track open session failed: %s" % exc)
 
-    if do_lock:
-        _release_sessions_lock(sessions_lock)
-
     return result
 
 
@@ -179,11 +164,12 @@ def get_active_session(configuration,
     #              % (proto, client_id, session_id) \
     #              + " do_lock: %s" % do_lock)
     result = None
-    _active_sessions = _load_sessions(configuration, proto, do_lock=do_lock)
-    result = _active_sessions.get(client_id, {}).get(
+    namespace = _sessions_namespace(proto)
+    store = open_state(configuration, namespace)
+    result = store.get(namespace, client_id, {}).get(
         proto, {}).get(session_id, {})
 
-    return result
+    return _copy_session(result)
 
 
 def get_open_sessions(configuration,
@@ -196,16 +182,17 @@ def get_open_sessions(configuration,
     # logger.debug("proto: '%s', client_id: %s, do_lock: %s"
     #              % (proto, client_id, do_lock))
     result = {}
-    _active_sessions = _load_sessions(configuration, proto, do_lock=do_lock)
-    # logger.debug("__active_sessions: %s" % __active_sessions)
+    namespace = _sessions_namespace(proto)
+    store = open_state(configuration, namespace)
     if client_id is not None:
-        result = _active_sessions.get(client_id, {}).get(
-            proto, {})
+        open_proto_session = store.get(namespace, client_id, {}).get(proto, {})
+        for (session_id, session) in open_proto_session.items():
+            result[session_id] = _copy_session(session)
     else:
-        for (_, open_sessions) in _active_sessions.iteritems():
+        for (_, open_sessions) in store.items(namespace):
             open_proto_session = open_sessions.get(proto, {})
-            if open_proto_session:
-                result.update(open_proto_session)
+            for (session_id, session) in open_proto_session.items():
+                result[session_id] = _copy_session(session)
 
     return result
 
@@ -228,32 +215,28 @@ def track_close_session(configuration,
     if not session_id:
         session_id = "%s:%s" % (client_address, client_port)
 
-    if do_lock:
-        sessions_lock = _acquire_sessions_lock(
-            configuration, proto, exclusive=True)
-    _active_sessions = _load_sessions(configuration, proto, do_lock=False)
-    open_sessions = _active_sessions.get(client_id, {}).get(proto, {})
-    if open_sessions and open_sessions.has_key(session_id):
-        try:
-            result = open_sessions[session_id]
-            del open_sessions[session_id]
-            if not _save_sessions(configuration,
-                                  proto, _active_sessions, do_lock=False):
+    namespace = _sessions_namespace(proto)
+    try:
+        store = open_state(configuration, namespace)
+        closed = store.update(namespace, client_id, _close_session,
+                              (proto, session_id))
+        if closed is not None:
+            result = closed
+            _open_sessions.dec(protocol=proto)
+            if not snapshot_state(configuration, namespace):
                 raise IOError("%s save sessions failed for %s" %
                               (proto, client_id))
-        except Exception, exc:
-            result = None
-            msg = "track close session failed for client: %s" % client_id \
-                + "with session id: %s" % session_id \
-                + ", error: %s" % exc
-            logger.error(msg)
-    else:
-        msg = "track close session: '%s' _NOT_ found for proto: '%s'" \
-            % (session_id, proto) \
-            + ", client: '%s'" % client_id
-        logger.warning(msg)
-    if do_lock:
-        _release_sessions_lock(sessions_lock)
+        else:
+            msg = "track close session: '%s' _NOT_ found for proto: '%s'" \
+                % (session_id, proto) \
+                + ", client: '%s'" % client_id
+            logger.warning(msg)
+    except Exception, exc:
+        result = None
+        msg = "track close session failed for client: %s" % client_id \
+            + "with session id: %s" % session_id \
+            + ", error: %s" % exc
+        logger.error(msg)
 
     return result
 
@@ -272,9 +255,6 @@ def track_close_expired_sessions(
     # logger.debug(msg)
     result = {}
     session_timeout = io_session_timeout.get(proto, 0)
-    if do_lock:
-        sessions_lock = _acquire_sessions_lock(
-            configuration, proto, exclusive=True)
     open_sessions = get_open_sessions(
         configuration, proto, client_id=client_id, do_lock=False)
     # logger.debug("open_sessions: %s" % open_sessions)
@@ -297,8 +277,6 @@ def track_close_expired_sessions(
                                     do_lock=False)
             if closed_session is not None:
                 result[cur_session_id] = closed_session
-    if do_lock:
-        _release_sessions_lock(sessions_lock)
 
     return result
 
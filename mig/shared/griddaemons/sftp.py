@@ -38,4 +38,6 @@ from shared.griddaemons.ratelimits import default_max_user_hits, \
 from shared.griddaemons.sessions import clear_sessions, \
 	track_open_session, track_close_session, active_sessions
 from shared.griddaemons.auth import check_twofactor_session, \
-    validate_auth_attempt
+    validate_auth_attempt, AuthCache
+from shared.griddaemons.credswatch import init_creds_watcher
+from shared.griddaemons.twofactorindex import init_twofactor_index
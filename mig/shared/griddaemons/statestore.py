@@ -0,0 +1,377 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# --- BEGIN_HEADER ---
+#
+# statestore - grid daemon rate limit and session state store
+# Copyright (C) 2010-2020  The MiG Project lead by Brian Vinter
+#
+# This file is part of MiG.
+#
+# MiG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# MiG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# -- END_HEADER ---
+#
+
+"""MiG daemon state store for rate limits and session tracking.
+
+The grid daemons keep rate limit and session state in named namespaces of
+a store with atomic updates and optional expiry of entries. By default the
+store lives in the daemon process memory. If user_state_store is set in the
+configuration the daemons instead connect to a shared store served on that
+local unix socket by grid_statestore.
+The pickle files in mig_system_run are only written as periodic snapshots
+and read back when a namespace is first used.
+The shared store only accepts clients presenting the random site key saved
+in a private file next to the snapshots by the serving daemon.
+"""
+
+import base64
+import copy
+import os
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+from shared.fileio import pickle, unpickle
+
+# NOTE: the manager protocol unpickles client data so the key must be secret
+_state_store_key_name = 'statestore.key'
+
+_store = None
+_store_lock = threading.Lock()
+_snapshot_lock = threading.Lock()
+_last_snapshot = {}
+
+
+class MemoryStore(object):
+    """Store of entries in named namespaces. All operations run under a
+    single lock so that the read-modify-write in update and incr is atomic.
+    Entries can be given a time to live in seconds after which they are
+    treated as missing and removed on next expire.
+    """
+
+    def __init__(self):
+        """Init empty store"""
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        self.__expire = {}
+        self.__version = {}
+
+    def __live(self, namespace, key, now):
+        """Returns the entries of namespace after dropping key if it expired.
+        The caller must hold the store lock.
+        """
+        entries = self.__entries.setdefault(namespace, {})
+        expire = self.__expire.setdefault(namespace, {})
+        if expire.get(key, now) < now:
+            del expire[key]
+            entries.pop(key, None)
+        return entries
+
+    def __store(self, namespace, key, value, ttl, now):
+        """Save value for key in namespace or remove it if value is None.
+        The caller must hold the store lock.
+        """
+        entries = self.__entries[namespace]
+        expire = self.__expire[namespace]
+        if value is None:
+            entries.pop(key, None)
+            expire.pop(key, None)
+        else:
+            entries[key] = value
+            if ttl is not None:
+                expire[key] = now + ttl
+        self.__version[namespace] = self.__version.get(namespace, 0) + 1
+
+    def is_loaded(self, namespace):
+        """Check if namespace was loaded or used in store"""
+        return self.__entries.has_key(namespace)
+
+    def load(self, namespace, entries):
+        """Load entries dictionary into namespace unless already loaded.
+        Returns True if entries were loaded and False otherwise.
+        """
+        self.__lock.acquire()
+        try:
+            if self.__entries.has_key(namespace):
+                return False
+            self.__entries[namespace] = entries
+            self.__expire[namespace] = {}
+            self.__version[namespace] = 0
+            return True
+        finally:
+            self.__lock.release()
+
+    def get(self, namespace, key, default=None):
+        """Returns value of key in namespace or default if missing"""
+        self.__lock.acquire()
+        try:
+            return self.__live(namespace, key, time.time()).get(key, default)
+        finally:
+            self.__lock.release()
+
+    def items(self, namespace):
+        """Returns list of (key, value) tuples for all entries in namespace"""
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            entries = self.__entries.get(namespace, {})
+            expire = self.__expire.get(namespace, {})
+            return [(key, value) for (key, value) in entries.items() if
+                    expire.get(key, now) >= now]
+        finally:
+            self.__lock.release()
+
+    def set(self, namespace, key, value, ttl=None):
+        """Set key in namespace to value with optional time to live"""
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            self.__live(namespace, key, now)
+            self.__store(namespace, key, value, ttl, now)
+        finally:
+            self.__lock.release()
+
+    def delete(self, namespace, key):
+        """Remove key from namespace and return the old value if any"""
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            value = self.__live(namespace, key, now).get(key, None)
+            self.__store(namespace, key, None, None, now)
+            return value
+        finally:
+            self.__lock.release()
+
+    def incr(self, namespace, key, amount=1, ttl=None):
+        """Atomically add amount to counter key in namespace and return the
+        new value. Missing counters start from zero.
+        """
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            value = self.__live(namespace, key, now).get(key, 0) + amount
+            self.__store(namespace, key, value, ttl, now)
+            return value
+        finally:
+            self.__lock.release()
+
+    def update(self, namespace, key, func, args=(), ttl=None):
+        """Atomically replace the value of key in namespace using func. It is
+        called with the current value or None if missing followed by args and
+        must return a tuple with the new value and a result to return. A new
+        value of None removes the key.
+        The func must be a module level function for use with the shared
+        store since it is passed by reference to the store process.
+        """
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            value = self.__live(namespace, key, now).get(key, None)
+            (value, result) = func(value, *args)
+            self.__store(namespace, key, value, ttl, now)
+            return result
+        finally:
+            self.__lock.release()
+
+    def update_all(self, namespace, func, args=()):
+        """Atomically call update with func for all keys in namespace.
+        Returns a dictionary mapping keys to their update result.
+        """
+        now = time.time()
+        results = {}
+        self.__lock.acquire()
+        try:
+            for (key, _) in self.__entries.get(namespace, {}).items():
+                value = self.__live(namespace, key, now).get(key, None)
+                if value is None:
+                    continue
+                (value, results[key]) = func(value, *args)
+                self.__store(namespace, key, value, None, now)
+            return results
+        finally:
+            self.__lock.release()
+
+    def clear(self, namespace):
+        """Remove all entries in namespace"""
+        self.__lock.acquire()
+        try:
+            self.__entries[namespace] = {}
+            self.__expire[namespace] = {}
+            self.__version[namespace] = self.__version.get(namespace, 0) + 1
+        finally:
+            self.__lock.release()
+
+    def expire(self):
+        """Remove all expired entries and return the number removed"""
+        now = time.time()
+        expired = 0
+        self.__lock.acquire()
+        try:
+            for (namespace, expire) in self.__expire.items():
+                for (key, stamp) in expire.items():
+                    if stamp < now:
+                        self.__live(namespace, key, now)
+                        expired += 1
+            return expired
+        finally:
+            self.__lock.release()
+
+    def snapshot(self, namespace):
+        """Returns a tuple with the change version of namespace and a copy of
+        all the live entries for saving.
+        """
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            entries = self.__entries.get(namespace, {})
+            expire = self.__expire.get(namespace, {})
+            live = dict([(key, value) for (key, value) in entries.items() if
+                         expire.get(key, now) >= now])
+            return (self.__version.get(namespace, 0), copy.deepcopy(live))
+        finally:
+            self.__lock.release()
+
+
+class StateStoreManager(BaseManager):
+    """Manager to serve or connect to a MemoryStore on a unix socket"""
+    pass
+
+
+def state_store_authkey(configuration, create=False):
+    """Returns the secret key for the shared state store from the key file
+    in mig_system_run. The create flag is used by the serving daemon to
+    generate a random key readable only by the owner if none exists yet.
+    Raises IOError if the key file is missing and create is not set.
+    """
+    key_path = os.path.join(configuration.mig_system_run,
+                            _state_store_key_name)
+    if create and not os.path.exists(key_path):
+        authkey = base64.b16encode(os.urandom(32)).lower()
+        tmp_path = "%s.%d.tmp" % (key_path, os.getpid())
+        key_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0600)
+        try:
+            os.write(key_fd, authkey)
+        finally:
+            os.close(key_fd)
+        os.rename(tmp_path, key_path)
+    if create:
+        os.chmod(key_path, 0600)
+    key_file = open(key_path, 'r')
+    try:
+        authkey = key_file.read().strip()
+    finally:
+        key_file.close()
+    if not authkey:
+        raise IOError("empty state store key in %s" % key_path)
+    return authkey
+
+
+def serve_state_store(configuration, address):
+    """Serve a shared MemoryStore on the unix socket address until killed"""
+    shared_store = MemoryStore()
+    StateStoreManager.register('get_store', callable=lambda: shared_store)
+    if os.path.exists(address):
+        os.remove(address)
+    manager = StateStoreManager(address=address,
+                                authkey=state_store_authkey(configuration,
+                                                            True))
+    # Make sure socket is never accessible to others, not even briefly
+    old_umask = os.umask(0077)
+    try:
+        server = manager.get_server()
+    finally:
+        os.umask(old_umask)
+    os.chmod(address, 0600)
+    configuration.logger.info("serving shared state store on %s" % address)
+    server.serve_forever()
+
+
+def get_state_store(configuration):
+    """Returns the state store for this process. That is, a MemoryStore in
+    process memory or a proxy for the shared store if user_state_store is
+    set in the configuration.
+    """
+    global _store
+    if _store is not None:
+        return _store
+    _store_lock.acquire()
+    try:
+        if _store is None:
+            address = configuration.user_state_store
+            if address:
+                StateStoreManager.register('get_store')
+                manager = StateStoreManager(
+                    address=address,
+                    authkey=state_store_authkey(configuration))
+                manager.connect()
+                _store = manager.get_store()
+                configuration.logger.info("using shared state store on %s" %
+                                          address)
+            else:
+                _store = MemoryStore()
+    finally:
+        _store_lock.release()
+    return _store
+
+
+def open_state(configuration, namespace):
+    """Returns the state store after making sure namespace is loaded from
+    the snapshot in mig_system_run with the same name on first use.
+    """
+    logger = configuration.logger
+    store = get_state_store(configuration)
+    if not store.is_loaded(namespace):
+        snapshot_path = os.path.join(configuration.mig_system_run, namespace)
+        entries = unpickle(snapshot_path, logger, allow_missing=True)
+        if not isinstance(entries, dict):
+            entries = {}
+        if store.load(namespace, entries):
+            logger.debug("loaded %d %s entries from snapshot" %
+                         (len(entries), namespace))
+    return store
+
+
+def snapshot_state(configuration, namespace, force=False):
+    """Save namespace entries to the snapshot in mig_system_run with the
+    same name if changed and user_state_snapshot seconds passed since the
+    last snapshot. The force flag skips the interval check.
+    Returns False if saving the snapshot failed and True otherwise.
+    """
+    logger = configuration.logger
+    now = time.time()
+    (last_stamp, last_version) = _last_snapshot.get(namespace, (0, -1))
+    if not force and last_stamp + configuration.user_state_snapshot > now:
+        return True
+    if not _snapshot_lock.acquire(force):
+        # Another thread is saving a snapshot right now
+        return True
+    try:
+        store = get_state_store(configuration)
+        (version, entries) = store.snapshot(namespace)
+        if version == last_version and not force:
+            _last_snapshot[namespace] = (now, version)
+            return True
+        snapshot_path = os.path.join(configuration.mig_system_run, namespace)
+        tmp_path = "%s.%d.tmp" % (snapshot_path, os.getpid())
+        if not pickle(entries, tmp_path, logger):
+            return False
+        os.rename(tmp_path, snapshot_path)
+        _last_snapshot[namespace] = (now, version)
+        return True
+    finally:
+        _snapshot_lock.release()
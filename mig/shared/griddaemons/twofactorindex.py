@@ -0,0 +1,266 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# --- BEGIN_HEADER ---
+#
+# twofactorindex - grid daemon in-memory index of 2FA sessions and settings
+# Copyright (C) 2010-2020  The MiG Project lead by Brian Vinter
+#
+# This file is part of MiG.
+#
+# MiG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# MiG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# -- END_HEADER ---
+#
+"""MiG daemon in-memory index of 2FA sessions and settings.
+
+The check_twofactor_session helper loads the twofactor settings of the user
+and globs and loads all the 2FA session files of the user on every login.
+With an index enabled the results are kept in memory and only reloaded
+after file system events in twofactor_home or the settings dir of the user,
+so that clients like WebDAV ones authenticating on every request don't hit
+the disk for the 2FA check. Session expiry is checked against the cached
+session end time, and any entry is still reloaded at least every
+user_creds_rescan seconds as a safety net for missed events. Watches on
+settings dirs of users without logins for that long are removed again.
+"""
+
+import os
+import threading
+import time
+
+from shared.auth import active_twofactor_session, generate_session_prefix
+from shared.base import client_id_dir
+from shared.griddaemons.credswatch import DirWatcher, inotify_available
+from shared.settings import load_twofactor
+
+
+class TwoFactorIndex(object):
+    """Cache active 2FA session end times per client_id and address and the
+    twofactor settings per client_id. The session files in twofactor_home are
+    named by a hash prefix of the client_id, optionally preceded by the
+    address and an underscore for the strict address links, so events there
+    map directly to the cached clients.
+    """
+
+    def __init__(self, configuration, rescan):
+        """Init index and start inotify reader thread with a watch on the
+        2FA session dir.
+        """
+        self.configuration = configuration
+        self.logger = configuration.logger
+        self.rescan = rescan
+        self.__lock = threading.Lock()
+        self.__sessions = {}
+        self.__settings = {}
+        self.__settings_dirs = {}
+        self.__watched = set()
+        self.__used = {}
+        self.__dirty = {}
+        self.__disabled = False
+        self.__last_evict = time.time()
+        self.__backoff = 0
+        self.__session_home = os.path.normpath(configuration.twofactor_home)
+        self.__settings_home = os.path.normpath(configuration.user_settings)
+        self.__dir_watcher = DirWatcher(self.mark_dirty)
+        # NOTE: settings dirs are created on first save of any user settings
+        #       so we also watch their parent to catch that
+        for path in (self.__session_home, self.__settings_home):
+            if not self.__watch(path):
+                self.__disabled = True
+
+    def __watch(self, path):
+        """Add a non-recursive watch on path. Returns True if path is
+        watched and False otherwise.
+        """
+        try:
+            self.__dir_watcher.add(path)
+        except OSError, err:
+            self.logger.warning("could not watch %s for 2FA index: %s" %
+                                (path, err))
+            return False
+        return True
+
+    def __evict(self, now):
+        """Forget settings dirs not used within the last rescan interval and
+        remove any watches on them. The caller must hold the index lock.
+        """
+        self.__last_evict = now
+        for (settings_dir, stamp) in self.__used.items():
+            if stamp + self.rescan >= now:
+                continue
+            del self.__used[settings_dir]
+            client_id = self.__settings_dirs.pop(settings_dir)
+            self.__settings.pop(client_id, None)
+            if settings_dir in self.__watched:
+                self.__watched.remove(settings_dir)
+                self.__dir_watcher.remove(settings_dir)
+        self.__backoff = 0
+
+    def __fresh(self, stamp, now):
+        """Check if entry stored at stamp is still within rescan interval"""
+        return stamp + self.rescan > now
+
+    def __store(self, key, dirty_key, cache, value, check_stamp):
+        """Store value for key in cache unless dirty_key was marked dirty
+        after check_stamp. The caller must hold the index lock.
+        """
+        if self.__dirty.get(dirty_key, 0) >= check_stamp or \
+                self.__dirty.get(None, 0) >= check_stamp:
+            return
+        self.__dirty.pop(dirty_key, None)
+        cache[key] = (value, time.time())
+
+    def mark_dirty(self, path):
+        """Drop cached sessions or settings affected by a change to path. A
+        path of None means that events were lost and drops everything.
+        """
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            if path is None:
+                self.__sessions.clear()
+                self.__settings.clear()
+                self.__dirty[None] = now
+                return
+            parent = os.path.dirname(path)
+            if parent == self.__session_home:
+                name = os.path.basename(path)
+                # NOTE: session keys are base64 so the last '_' splits any
+                #       address from the session key in strict address links
+                prefix = name.split('_')[-1][:64]
+                self.__sessions.pop(prefix, None)
+                self.__dirty[('session', prefix)] = now
+            for watch_path in (path, parent):
+                client_id = self.__settings_dirs.get(watch_path, None)
+                if client_id is not None:
+                    self.__settings.pop(client_id, None)
+                    self.__dirty[('settings', client_id)] = now
+            # Old dirty marks can't affect any running checks
+            if len(self.__dirty) > 10000:
+                for (key, stamp) in self.__dirty.items():
+                    if stamp + self.rescan < now:
+                        del self.__dirty[key]
+        finally:
+            self.__lock.release()
+
+    def load_twofactor(self, client_id):
+        """Returns twofactor settings dict for client_id like load_twofactor
+        from shared.settings but from the index if possible.
+        """
+        configuration = self.configuration
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            (twofactor_dict, stamp) = self.__settings.get(client_id,
+                                                          (None, 0))
+            if self.__fresh(stamp, now):
+                return twofactor_dict
+            if self.__disabled:
+                return load_twofactor(client_id, configuration,
+                                      allow_missing=True)
+            if self.__last_evict + self.rescan < now:
+                self.__evict(now)
+            settings_dir = os.path.join(self.__settings_home,
+                                        client_id_dir(client_id))
+            watched = settings_dir in self.__watched
+            if not watched and self.__backoff > now:
+                return load_twofactor(client_id, configuration,
+                                      allow_missing=True)
+            # Map events to client before loading to not miss any changes
+            self.__settings_dirs[settings_dir] = client_id
+            self.__used[settings_dir] = now
+        finally:
+            self.__lock.release()
+
+        # A missing settings dir shows up in the settings home watch
+        if not watched and os.path.isdir(settings_dir):
+            if not self.__watch(settings_dir):
+                # Typically out of inotify watches so pause until evicted
+                self.__lock.acquire()
+                try:
+                    self.__backoff = now + self.rescan
+                finally:
+                    self.__lock.release()
+                return load_twofactor(client_id, configuration,
+                                      allow_missing=True)
+            self.__lock.acquire()
+            try:
+                self.__watched.add(settings_dir)
+            finally:
+                self.__lock.release()
+        twofactor_dict = load_twofactor(client_id, configuration,
+                                        allow_missing=True)
+        self.__lock.acquire()
+        try:
+            self.__store(client_id, ('settings', client_id), self.__settings,
+                         twofactor_dict, now)
+        finally:
+            self.__lock.release()
+        return twofactor_dict
+
+    def session_end(self, client_id, addr=None):
+        """Returns the end time of the latest active 2FA session for
+        client_id and optional addr like active_twofactor_session from
+        shared.auth but from the index if possible. Returns None if no such
+        session is active.
+        """
+        configuration = self.configuration
+        prefix = generate_session_prefix(configuration, client_id)
+        key = (client_id, addr)
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            (end, stamp) = self.__sessions.get(prefix, {}).get(key, (None, 0))
+            if self.__fresh(stamp, now):
+                if end is not None and end < now:
+                    return None
+                return end
+        finally:
+            self.__lock.release()
+
+        session_data = active_twofactor_session(configuration, client_id, addr)
+        if session_data is None:
+            end = None
+        else:
+            end = session_data.get('session_end', -1)
+        if not self.__disabled:
+            self.__lock.acquire()
+            try:
+                self.__store(key, ('session', prefix),
+                             self.__sessions.setdefault(prefix, {}), end, now)
+            finally:
+                self.__lock.release()
+        return end
+
+    def stop(self):
+        """Stop inotify reader thread"""
+        self.__dir_watcher.stop()
+
+
+def init_twofactor_index(configuration):
+    """Returns a started TwoFactorIndex if twofactor is enabled on the site
+    and the creds watcher is enabled with a positive user_creds_rescan value
+    in configuration. Returns None otherwise.
+    """
+    logger = configuration.logger
+    rescan = configuration.user_creds_rescan
+    if rescan <= 0 or not configuration.site_enable_twofactor:
+        return None
+    if not inotify_available:
+        logger.warning("2FA index requires inotify support")
+        return None
+    logger.info("indexing 2FA sessions with full reload every %ds" % rescan)
+    return TwoFactorIndex(configuration, rescan)
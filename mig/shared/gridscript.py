@@ -27,13 +27,15 @@
 
 """Main MiG daemon (grid_script) helper functions"""
 
+import errno
 import os
+import select
 import time
 
 import shared.fileio as io
 from shared.base import client_id_dir
 from shared.defaults import job_output_dir
-from shared.fileio import send_message_to_grid_script
+from shared.fileio import send_messages_to_grid_script
 from shared.notification import notify_user_thread
 try:
     import shared.arcwrapper as arc
@@ -41,24 +43,91 @@ except Exception, exc:
     # Ignore errors and let it crash if ARC is enabled without the lib
     pass
 
-def clean_grid_stdin(stdin):
+def open_grid_stdin(path):
+    """Open the grid_stdin named pipe for non-blocking reads and return the
+    file descriptor. We open a write descriptor of our own, too, in order to
+    never see EOF when all senders close the pipe. That way a poll on the
+    pipe blocks until new input arrives rather than returning at once.
+    """
+
+    stdin_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+    return stdin_fd
+
+
+def read_grid_stdin(stdin_fd, partial='', timeout=None):
+    """Wait up to timeout seconds (forever if None) for input on the
+    grid_stdin pipe and then read all currently available data from it.
+    Returns a tuple with the list of complete lines read and any trailing
+    partial line, which should be passed as partial in the next call.
+    """
+
+    poller = select.poll()
+    poller.register(stdin_fd, select.POLLIN)
+    if timeout is not None:
+        timeout *= 1000
+    try:
+        if not poller.poll(timeout):
+            return ([], partial)
+    except select.error, err:
+
+        # Signals like SIGHUP interrupt poll - just let caller retry
+
+        if err.args[0] == errno.EINTR:
+            return ([], partial)
+        raise
+    chunks = [partial]
+    while True:
+        try:
+            chunk = os.read(stdin_fd, 65536)
+        except OSError, err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                break
+            raise
+        if not chunk:
+            break
+        chunks.append(chunk)
+    lines = ''.join(chunks).split('\n')
+    return (lines[:-1], lines[-1])
+
+
+def clean_grid_stdin(stdin_fd):
     """Deletes all content from the pipe (used when grid-script is
     started). First content in pipe might be lost!!
     """
 
     while True:
-        line = stdin.readline()
-        if not line:
+        try:
+            if not os.read(stdin_fd, 65536):
+                break
+        except OSError:
             break
 
 
 def save_queue(queue, path, logger):
-    """Save job queue to path for quick loading later"""
+    """Save job queue to path for quick loading later. The snapshot is
+    written to a temporary file first so that a crash never leaves a broken
+    snapshot behind. Any queue journal is reset after a successful save
+    since the snapshot then covers all the changes recorded there.
+    """
 
     # Don't try to save logger
 
+    queue_logger = queue.logger
     queue.logger = None
-    return io.pickle(queue, path, logger)
+    tmp_path = '%s.tmp' % path
+    saved = io.pickle(queue, tmp_path, logger)
+    queue.logger = queue_logger
+    if not saved:
+        return False
+    try:
+        os.rename(tmp_path, path)
+    except OSError, err:
+        logger.error('could not move queue snapshot in place: %s' % err)
+        return False
+    if getattr(queue, 'journal', None):
+        queue.reset_journal()
+    return True
 
 
 def load_queue(path, logger):
@@ -75,6 +144,23 @@ def load_queue(path, logger):
         return queue
 
 
+def open_queue_journal(queue, path, logger, replay=True):
+    """Open the append-only journal for the queue with snapshot in path and
+    replay any changes recorded there since the snapshot if replay is set.
+    Without replay the journal is reset because it can't be applied to
+    anything but the snapshot.
+    """
+
+    journal_path = '%s.journal' % path
+    if replay:
+        applied = queue.replay_journal(journal_path)
+        logger.info('replayed %d change(s) from queue journal %s'
+                    % (applied, journal_path))
+    queue.open_journal(journal_path)
+    if not replay:
+        queue.reset_journal()
+
+
 def save_schedule_cache(cache, path, logger):
     """Save schedule cache to path for quick loading later"""
 
@@ -107,6 +193,7 @@ def check_mrsl_files(
         last_start = os.path.getmtime(last_start_file)
 
     check_mrsl_files_start_time = time.time()
+    parse_messages = []
 
     # TODO: switch to listdir or glob? all files are in mrsl_files_dir/*/*.mRSL
     
@@ -149,16 +236,15 @@ def check_mrsl_files(
 
                 # parse is ok, since mRSL file exists
                 # tell 'grid_script' and let grid_script put it into the queue
+                # in batches
 
                 logger.info('Found a file with PARSE status: %s'
                              % job_dict['JOB_ID'])
                 job_id = job_dict['JOB_ID']
                 client_id = job_dict['USER_CERT']
                 client_dir = client_id_dir(client_id)
-                message = 'USERJOBFILE %s/%s\n' % (client_dir, job_id)
-                if not send_message_to_grid_script(message, logger,
-                        configuration):
-                    print 'Fatal error: Could not write to grid stdin'
+                parse_messages.append('USERJOBFILE %s/%s\n' % (client_dir,
+                                                                job_id))
             elif job_dict['STATUS'] == 'QUEUED'\
                  and not job_queue.get_job_by_id(job_dict['JOB_ID']):
 
@@ -188,6 +274,11 @@ def check_mrsl_files(
                 # logger.debug('Job in %s is already treated' % filename)
                 continue
 
+    if parse_messages and not send_messages_to_grid_script(parse_messages,
+                                                           logger,
+                                                           configuration):
+        print 'Fatal error: Could not write to grid stdin'
+
     # update last_start_file access times. Note the timestamp is not "now" but
     # when check_mrsl_files was called to avoid loosing any jobs being parsed
     # at the same time as this function is running.
@@ -0,0 +1,406 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# --- BEGIN_HEADER ---
+#
+# metrics - daemon instrumentation with counters, gauges and histograms
+# Copyright (C) 2003-2020  The MiG Project lead by Brian Vinter
+#
+# This file is part of MiG.
+#
+# MiG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# MiG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# -- END_HEADER ---
+#
+
+"""Daemon instrumentation with counters, gauges and latency histograms.
+
+Metrics live in a process wide registry and are cheap to update even if
+they are never exported. If metrics_dir is set in the configuration the
+daemons call serve_metrics to serve them in the Prometheus text exposition
+format over HTTP on a NAME.sock unix socket there, e.g. with
+curl --unix-socket ~/state/metrics/sftp.sock http://localhost/metrics
+"""
+
+import os
+import socket
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from functools import wraps
+from SocketServer import TCPServer, ThreadingMixIn
+
+# Latency buckets in seconds
+default_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+# Label values beyond this many per metric are folded into 'other'
+max_label_sets = 1000
+metrics_prefix = 'mig_'
+
+
+def _format_value(value):
+    """Format sample value for exposition"""
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(labelnames, values, extra=()):
+    """Format label set for exposition"""
+    pairs = zip(labelnames, values) + list(extra)
+    if not pairs:
+        return ''
+    escaped = []
+    for (name, value) in pairs:
+        value = ("%s" % value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')
+        escaped.append('%s="%s"' % (name, value))
+    return '{%s}' % ','.join(escaped)
+
+
+class Metric(object):
+    """Base metric with optional labels. Values are kept per label value
+    tuple and may be provided by a function called on export instead.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labelnames=()):
+        """Init metric"""
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        self._functions = {}
+
+    def _key(self, labels):
+        """Returns label values tuple for labels dictionary. Any label sets
+        beyond max_label_sets are folded into 'other' to bound memory use.
+        The caller must hold the metric lock.
+        """
+        key = tuple([labels.get(i, '') for i in self.labelnames])
+        if not self._values.has_key(key) and \
+                len(self._values) >= max_label_sets:
+            key = tuple(['other' for _ in self.labelnames])
+        return key
+
+    def set_function(self, func, **labels):
+        """Use the return value of func as the value for labels on export"""
+        self._lock.acquire()
+        try:
+            self._functions[tuple([labels.get(i, '') for i in
+                                   self.labelnames])] = func
+        finally:
+            self._lock.release()
+
+    def samples(self):
+        """Returns list of (suffix, label values, extra labels, value)"""
+        self._lock.acquire()
+        try:
+            values = self._values.items()
+            functions = self._functions.items()
+        finally:
+            self._lock.release()
+        samples = [('', key, (), value) for (key, value) in values]
+        for (key, func) in functions:
+            try:
+                samples.append(('', key, (), func()))
+            except Exception:
+                # Skip unavailable values like stats of stopped services
+                continue
+        return samples
+
+    def expose(self):
+        """Returns the exposition lines for this metric"""
+        doc = self.doc.replace('\\', '\\\\').replace('\n', '\\n')
+        lines = ['# HELP %s %s' % (self.name, doc),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        # NOTE: stable sort on label values keeps histogram bucket order
+        samples = sorted(self.samples(), key=lambda sample: sample[1])
+        for (suffix, key, extra, value) in samples:
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                                        _format_labels(self.labelnames, key,
+                                                       extra),
+                                        _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    """Monotonically increasing count like attempts or bytes"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Add amount to the count for labels"""
+        self._lock.acquire()
+        try:
+            key = self._key(labels)
+            self._values[key] = self._values.get(key, 0) + amount
+        finally:
+            self._lock.release()
+
+
+class Gauge(Metric):
+    """Value that can go up and down like queue lengths"""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """Set value for labels"""
+        self._lock.acquire()
+        try:
+            self._values[self._key(labels)] = value
+        finally:
+            self._lock.release()
+
+    def inc(self, amount=1, **labels):
+        """Add amount to value for labels"""
+        self._lock.acquire()
+        try:
+            key = self._key(labels)
+            self._values[key] = self._values.get(key, 0) + amount
+        finally:
+            self._lock.release()
+
+    def dec(self, amount=1, **labels):
+        """Subtract amount from value for labels"""
+        self.inc(-amount, **labels)
+
+
+class _Timer(object):
+    """Context manager observing elapsed time in a histogram"""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+        return False
+
+
+class Histogram(Metric):
+    """Distribution of observed values like latencies in buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=default_buckets):
+        """Init histogram with the upper bounds in buckets"""
+        Metric.__init__(self, name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'), )
+
+    def observe(self, value, **labels):
+        """Record value for labels"""
+        self._lock.acquire()
+        try:
+            key = self._key(labels)
+            entry = self._values.get(key, None)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for (index, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+        finally:
+            self._lock.release()
+
+    def time(self, **labels):
+        """Returns context manager observing time spent in it"""
+        return _Timer(self, labels)
+
+    def samples(self):
+        """Returns list of (suffix, label values, extra labels, value) with
+        cumulative bucket counts, sum and count for each label set.
+        """
+        self._lock.acquire()
+        try:
+            values = [(key, list(buckets), total, count) for
+                      (key, (buckets, total, count)) in self._values.items()]
+        finally:
+            self._lock.release()
+        samples = []
+        for (key, buckets, total, count) in values:
+            cumulative = 0
+            for (bound, hits) in zip(self.buckets, buckets):
+                cumulative += hits
+                samples.append(('_bucket', key,
+                                (('le', _format_value(float(bound))), ),
+                                cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), count))
+        return samples
+
+
+class MetricsRegistry(object):
+    """Registry of all metrics in a process"""
+
+    def __init__(self):
+        """Init empty registry"""
+        self.__lock = threading.Lock()
+        self.__metrics = {}
+
+    def __get_or_add(self, cls, name, doc, labelnames, **kwargs):
+        """Returns existing metric with name or a new cls metric"""
+        name = metrics_prefix + name
+        self.__lock.acquire()
+        try:
+            metric = self.__metrics.get(name, None)
+            if metric is None:
+                metric = self.__metrics[name] = cls(name, doc, labelnames,
+                                                    **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("metric %s is already a %s" %
+                                 (name, metric.kind))
+            return metric
+        finally:
+            self.__lock.release()
+
+    def counter(self, name, doc, labelnames=()):
+        """Returns counter with name"""
+        return self.__get_or_add(Counter, name, doc, labelnames)
+
+    def gauge(self, name, doc, labelnames=()):
+        """Returns gauge with name"""
+        return self.__get_or_add(Gauge, name, doc, labelnames)
+
+    def histogram(self, name, doc, labelnames=(), buckets=default_buckets):
+        """Returns histogram with name"""
+        return self.__get_or_add(Histogram, name, doc, labelnames,
+                                 buckets=buckets)
+
+    def render(self):
+        """Returns all metrics in text exposition format"""
+        self.__lock.acquire()
+        try:
+            metrics = sorted(self.__metrics.items())
+        finally:
+            self.__lock.release()
+        lines = []
+        for (_, metric) in metrics:
+            lines += metric.expose()
+        return '\n'.join(lines) + '\n'
+
+
+_registry = MetricsRegistry()
+
+
+def counter(name, doc, labelnames=()):
+    """Returns counter with name from the process registry"""
+    return _registry.counter(name, doc, labelnames)
+
+
+def gauge(name, doc, labelnames=()):
+    """Returns gauge with name from the process registry"""
+    return _registry.gauge(name, doc, labelnames)
+
+
+def histogram(name, doc, labelnames=(), buckets=default_buckets):
+    """Returns histogram with name from the process registry"""
+    return _registry.histogram(name, doc, labelnames, buckets)
+
+
+def render_metrics():
+    """Returns all metrics of the process in text exposition format"""
+    return _registry.render()
+
+
+def timed(hist, label='op'):
+    """Decorator observing the run time of the decorated function in hist
+    with the function name as value of label.
+    """
+    def _decorator(func):
+        """Wrap func"""
+        labels = {label: func.__name__}
+
+        @wraps(func)
+        def _impl(*args, **kwargs):
+            with hist.time(**labels):
+                return func(*args, **kwargs)
+        return _impl
+    return _decorator
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve metrics of the process on GET"""
+
+    def do_GET(self):
+        """Send metrics in text exposition format"""
+        body = render_metrics()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        """Unix socket clients have no address"""
+        return 'local'
+
+    def log_message(self, format, *args):
+        """No request logging"""
+        pass
+
+
+class UnixHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server on a unix socket"""
+
+    address_family = socket.AF_UNIX
+    daemon_threads = True
+
+    def server_bind(self):
+        """Bind without the host name lookup of HTTPServer"""
+        TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+    def get_request(self):
+        """Fake a client address for the request handler"""
+        (request, _) = self.socket.accept()
+        return (request, ('local', 0))
+
+
+def serve_metrics(configuration, name):
+    """Serve process metrics on the NAME.sock unix socket in metrics_dir in
+    a background thread. Returns the server or None if metrics_dir is unset
+    or serving failed.
+    """
+    logger = configuration.logger
+    if not configuration.metrics_dir:
+        return None
+    address = os.path.join(configuration.metrics_dir, '%s.sock' % name)
+    try:
+        if not os.path.isdir(configuration.metrics_dir):
+            os.makedirs(configuration.metrics_dir)
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixHTTPServer(address, MetricsHandler)
+        os.chmod(address, 0600)
+    except Exception, exc:
+        logger.error("could not serve metrics on %s: %s" % (address, exc))
+        return None
+    worker = threading.Thread(target=server.serve_forever)
+    worker.daemon = True
+    worker.start()
+    logger.info("serving metrics on %s" % address)
+    return server
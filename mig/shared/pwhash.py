@@ -73,6 +73,18 @@ HASH_FUNCTION = 'sha256'  # Must be in hashlib.
 COST_FACTOR = 10000
 
 
+def pbkdf2_hash(password, salt, cost_factor, key_length, hash_function):
+    """Returns the raw PBKDF2 key for password and salt. Uses the native
+    hashlib.pbkdf2_hmac from python 2.7.8+ if available as it is orders of
+    magnitude faster than the pure python pbkdf2_bin fallback.
+    """
+    if hasattr(hashlib, 'pbkdf2_hmac'):
+        return hashlib.pbkdf2_hmac(hash_function, password, salt,
+                                   cost_factor, key_length)
+    return pbkdf2_bin(password, salt, cost_factor, key_length,
+                      getattr(hashlib, hash_function))
+
+
 def make_hash(password):
     """Generate a random salt and return a new hash for the password."""
     if isinstance(password, unicode):
@@ -84,8 +96,8 @@ def make_hash(password):
         HASH_FUNCTION,
         COST_FACTOR,
         salt,
-        b64encode(pbkdf2_bin(password, salt, COST_FACTOR, KEY_LENGTH,
-                             getattr(hashlib, HASH_FUNCTION))))
+        b64encode(pbkdf2_hash(password, salt, COST_FACTOR, KEY_LENGTH,
+                              HASH_FUNCTION)))
 
 
 def check_hash(configuration, service, username, password, hashed,
@@ -120,9 +132,9 @@ def check_hash(configuration, service, username, password, hashed,
     algorithm, hash_function, cost_factor, salt, hash_a = hashed.split('$')
     assert algorithm == 'PBKDF2'
     hash_a = b64decode(hash_a)
-    hash_b = pbkdf2_bin(password, salt, int(cost_factor), len(hash_a),
-                        getattr(hashlib, hash_function))
-    assert len(hash_a) == len(hash_b)  # we requested this from pbkdf2_bin()
+    hash_b = pbkdf2_hash(password, salt, int(cost_factor), len(hash_a),
+                         hash_function)
+    assert len(hash_a) == len(hash_b)  # we requested this from pbkdf2_hash()
     # Same as "return hash_a == hash_b" but takes a constant time.
     # See http://carlos.bueno.org/2011/10/timing.html
     diff = 0
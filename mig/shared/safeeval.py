@@ -89,7 +89,7 @@ _math_expr_codes = _expr_codes + map(dis.opmap.__getitem__, ['LOAD_NAME'
         , 'LOAD_ATTR', 'CALL_FUNCTION'])
 
 # TODO: add more?
-# Keep this list in sync with import list in math_expr_eval
+# Keep this list in sync with import list in compiled_eval
 # Please note that the last functions are 'built-in' and *not* from math
 
 _math_names = [
@@ -276,11 +276,50 @@ def math_expr_eval(expr):
     ValueError: opcode LOAD_NAME not allowed
     """
 
+    return compiled_eval(math_expr_compile(expr))
+
+
+def expr_compile(expr):
+    """expr_compile(expression) -> codeobj
+
+    Validate expression like expr_eval but return the compiled code object
+    for repeated evaluation with compiled_eval instead of the value.
+    """
+
+    return test_expr(expr, _expr_codes)
+
+
+def math_expr_compile(expr, variables=[]):
+    """math_expr_compile(math_expression, variables) -> codeobj
+
+    Validate expression like math_expr_eval but return the compiled code
+    object for repeated evaluation with compiled_eval instead of the value.
+    The names in the optional variables list are allowed in the expression
+    and their values must be given to compiled_eval.
+    """
+
+    return test_expr(expr, _math_expr_codes, _math_names + list(variables))
+
+
+def compiled_eval(codeobj, variables={}):
+    """compiled_eval(codeobj, variables) -> value
+
+    Evaluate code object from expr_compile or math_expr_compile with the
+    allowed math functions and the optional variables dictionary values
+    available.
+
+    >>> compiled_eval(math_expr_compile(\"max(1, 2)+floor(2.5)\"))
+    4.0
+    >>> compiled_eval(math_expr_compile(\"2*hour\", ['hour']), {'hour': 3})
+    6
+    """
+
     from math import sin, cos, exp, ceil, floor, fabs, floor, fmod, \
         log, log10, pi, sqrt, e
 
-    c = test_expr(expr, _math_expr_codes, _math_names)
-    return eval(c)
+    names = locals().copy()
+    names.update(variables)
+    return eval(codeobj, globals(), names)
 
 
 def subprocess_check_output(command, stdin=None, stdout=None, stderr=None,
@@ -502,6 +502,15 @@ def vgrid_is_entity_in_list(
     or more parent vgrids don't have the particular entity group file.
     """
 
+    # Access checks are plain lookups in the vgrid index when it is up to date
+
+    if recursive and not dict_field:
+        from shared.vgridaccess import vgrid_index_allowed
+        allowed = vgrid_index_allowed(configuration, vgrid_name, entity_id,
+                                      group)
+        if allowed is not None:
+            return allowed
+
     # Get the list of entities of specified type (group) in vgrid (vgrid_name)
 
     (status, entries) = vgrid_list(vgrid_name, group, configuration, recursive,
@@ -1023,6 +1032,12 @@ def vgrid_list(vgrid_name, group, configuration, recursive=True,
         name = configuration.vgrid_imagesettings
     else:
         return (False, "vgrid_list: unknown group: '%s'" % group)
+    if recursive and not filter_entries and replace_missing is None:
+        # Inherited participation is precomputed in the vgrid map refresh
+        from shared.vgridaccess import vgrid_index_list
+        entries = vgrid_index_list(configuration, vgrid_name, group)
+        if entries is not None:
+            return (True, entries)
     if recursive:
         vgrid_parts = vgrid_name.split('/')
     else:
@@ -29,14 +29,18 @@
 
 import copy
 import os
+import threading
 import time
 import fcntl
+import zlib
+from collections import OrderedDict
 
 from shared.base import sandbox_resource, client_id_dir
 from shared.conf import get_all_exe_vgrids, get_all_store_vgrids, \
     get_resource_fields, get_resource_configuration
 from shared.defaults import settings_filename, profile_filename, default_vgrid
-from shared.modified import mark_resource_modified, mark_vgrid_modified, \
+from shared.modified import mark_entity_modified, mark_resource_modified, \
+    mark_vgrid_modified, \
     check_users_modified, check_resources_modified, check_vgrids_modified, \
     reset_users_modified, reset_resources_modified, reset_vgrids_modified
 from shared.resource import list_resources, real_to_anon_res_map
@@ -64,66 +68,342 @@ SETTINGS = '__settings__'
 # refresh for each env when extracting providers.
 MAP_CACHE_SECONDS = 60
 
+# Entity maps are saved as a number of shards with the entities spread by
+# name hash. Thus a refresh only needs to rewrite the shards with dirty
+# entities. The map file itself just holds the shard index and the stamp.
+# Each save also appends the changed shards to a change log, so that
+# processes with a previously loaded map can just load the changed shards.
+MAP_SHARDS = 64
+# Collapse change log when it reaches this number of entries
+MAP_CHANGES_LIMIT = 1000
+MAP_INDEX = (SHARDS, STAMP) = ('__shards__', '__stamp__')
+ALL_SHARDS = '*'
+
+# Max number of results derived from the maps to keep in process memory
+MAP_MEMO_SIZE = 4096
+
+# The vgrid map refresh also saves an index with the inherited participation
+# of all vgrids and the reverse entity to vgrid role lookup, so that access
+# checks need not walk and load the participation files up the vgrid tree.
+INDEX_FIELDS = (PARENTS, PATTERNS, MISSING) = ('__parents__', '__patterns__',
+                                                '__missing__')
+INDEX_GROUPS = {'owners': OWNERS, 'members': MEMBERS, 'resources': RESOURCES}
+
 last_refresh = {USERS: 0, RESOURCES: 0, VGRIDS: 0}
 last_load = {USERS: 0, RESOURCES: 0, VGRIDS: 0}
 last_map = {USERS: {}, RESOURCES: {}, VGRIDS: {}}
+# Map and modified file stat fingerprints and modified state at last load
+last_key = {USERS: None, RESOURCES: None, VGRIDS: None}
+last_dirty = {USERS: True, RESOURCES: True, VGRIDS: True}
+# Bumped whenever a new map is loaded to invalidate derived results
+map_version = {USERS: 0, RESOURCES: 0, VGRIDS: 0}
+map_memo = OrderedDict()
+map_memo_lock = threading.Lock()
+map_cache_stats = {'hits': 0, 'misses': 0, 'memo_hits': 0, 'memo_misses': 0}
+# Index and modified file stat fingerprint and index at last index lookup
+last_index = {'key': None, 'index': None}
+
+
+def entity_map_paths(configuration, kind):
+    """Returns tuple with map, lock, shard dir and change log path for the
+    entity map of given kind.
+    """
+    base_path = os.path.join(configuration.mig_system_files, kind)
+    return ("%s.map" % base_path, "%s.lock" % base_path,
+            "%s.shards" % base_path, "%s.changes" % base_path)
+
+
+def entity_shard(name):
+    """Returns the index of the map shard holding entity with given name"""
+    return (zlib.crc32(name) & 0xffffffff) % MAP_SHARDS
+
+
+def map_sections(kind, entity_map):
+    """Returns list of (section, entities) tuples for entity_map of given
+    kind. The vgrid map has a users, resources and vgrids section whereas
+    the other maps just have a single unnamed one.
+    """
+    if kind == 'vgrid':
+        return [(section, entity_map.setdefault(section, {})) for section in
+                MAP_SECTIONS]
+    return [(None, entity_map)]
+
+
+def load_map_shards(shard_dir, kind, entity_map, shards):
+    """Load entities from the given shards in shard_dir into entity_map.
+    Returns the list of shards that could not be loaded.
+    """
+    sections = dict(map_sections(kind, entity_map))
+    missing = []
+    for index in shards:
+        try:
+            shard = load(os.path.join(shard_dir, "%d" % index))
+        except IOError:
+            missing.append(index)
+            continue
+        for (section, entities) in shard.items():
+            sections[section].update(entities)
+    return missing
+
+
+def prune_map_shards(kind, entity_map, shards):
+    """Returns a shallow copy of entity_map without the entities belonging
+    in shards.
+    """
+    pruned_map = {}
+    pruned_sections = dict(map_sections(kind, pruned_map))
+    for (section, entities) in map_sections(kind, entity_map):
+        pruned_sections[section].update(
+            [(name, entry) for (name, entry) in entities.items() if
+             entity_shard(name) not in shards])
+    return pruned_map
+
+
+def changed_map_shards(changes_path, since):
+    """Returns the set of shards changed after since according to the change
+    log in changes_path or None if the log does not reach back that far.
+    """
+    try:
+        log_handle = open(changes_path, 'r')
+        log_lines = log_handle.readlines()
+        log_handle.close()
+    except IOError:
+        return None
+    covered = False
+    changed = set()
+    for line in log_lines:
+        parts = line.split()
+        if len(parts) != 2:
+            continue
+        if float(parts[0]) <= since:
+            covered = True
+        elif parts[1] == ALL_SHARDS:
+            return None
+        else:
+            changed.update([int(i) for i in parts[1].split(',') if i])
+    if not covered:
+        return None
+    return changed
 
 
-def load_entity_map(configuration, kind, do_lock):
-    """Load map of given entities and their configuration. Uses a pickled
-    dictionary for efficiency. The do_lock option is used to enable and
-    disable locking during load.
+def log_map_changes(changes_path, stamp, shards):
+    """Append entry with stamp and changed shards to the change log in
+    changes_path. The log is kept short by collapsing the oldest half into
+    a single entry marking all shards changed when it reaches the
+    MAP_CHANGES_LIMIT.
+    """
+    try:
+        log_handle = open(changes_path, 'r')
+        log_lines = log_handle.readlines()
+        log_handle.close()
+    except IOError:
+        log_lines = []
+    if shards == ALL_SHARDS:
+        changed = ALL_SHARDS
+    else:
+        changed = ','.join(["%d" % i for i in sorted(shards)])
+    entry = "%r %s\n" % (stamp, changed)
+    if len(log_lines) < MAP_CHANGES_LIMIT:
+        log_handle = open(changes_path, 'a')
+        log_handle.write(entry)
+    else:
+        keep = MAP_CHANGES_LIMIT / 2
+        collapsed = "%s %s\n" % (log_lines[-keep].split()[0], ALL_SHARDS)
+        log_handle = open(changes_path, 'w')
+        log_handle.writelines([collapsed] + log_lines[-keep + 1:] + [entry])
+    log_handle.close()
+
+
+def save_entity_map(configuration, kind, entity_map, dirty, stamp,
+                    full=False):
+    """Save entity_map of given kind in sharded form. Only the shards holding
+    the dirty (section, name) entities are rewritten unless full is set or
+    the saved map is in a different format. The map stamp is set to stamp.
+    The caller must hold the exclusive map lock.
+    """
+    _logger = configuration.logger
+    (map_path, _, shard_dir, changes_path) = entity_map_paths(configuration,
+                                                              kind)
+    try:
+        map_index = load(map_path)
+    except Exception:
+        map_index = {}
+    if full or not isinstance(map_index, dict) or \
+            map_index.get(SHARDS, None) != MAP_SHARDS:
+        shards = ALL_SHARDS
+        shard_maps = dict([(i, {}) for i in xrange(MAP_SHARDS)])
+    else:
+        shards = set([entity_shard(name) for (_, name) in dirty])
+        shard_maps = dict([(i, {}) for i in shards])
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+    for (section, entities) in map_sections(kind, entity_map):
+        for (name, entry) in entities.items():
+            shard_index = entity_shard(name)
+            if shard_maps.has_key(shard_index):
+                shard_maps[shard_index].setdefault(section, {})[name] = entry
+    # Write to tmp and rename so that readers never see a partial shard
+    for (shard_index, shard) in shard_maps.items():
+        shard_path = os.path.join(shard_dir, "%d" % shard_index)
+        tmp_path = "%s.tmp" % shard_path
+        dump(shard, tmp_path, protocol=2)
+        os.rename(tmp_path, shard_path)
+    _logger.debug("saved %d %s map shard(s)" % (len(shard_maps), kind))
+    log_map_changes(changes_path, stamp, shards)
+    dump({SHARDS: MAP_SHARDS, STAMP: stamp}, map_path)
+    os.utime(map_path, (stamp, stamp))
+
+
+def load_entity_map(configuration, kind, do_lock, base_map=None,
+                    base_stamp=-1):
+    """Load map of given entities and their configuration. Uses pickled
+    dictionary shards for efficiency. The do_lock option is used to enable
+    and disable locking during load. The optional base_map and base_stamp
+    are used to pass a map from a previous load, so that only the shards
+    changed since then need to be loaded on top of it.
     Entity IDs are stored in their raw (non-anonymized form).
     Returns tuple with map and time stamp of last map modification.
     Please note that time stamp is explicitly set to start of last update
     to make sure any concurrent updates get caught in next run.
+    A map with missing shards is returned empty with time stamp -1 and marked
+    modified to force a full rebuild on next refresh.
     """
     _logger = configuration.logger
-    map_path = os.path.join(configuration.mig_system_files, "%s.map" % kind)
-    lock_path = os.path.join(configuration.mig_system_files, "%s.lock" % kind)
+    (map_path, lock_path, shard_dir, changes_path) = entity_map_paths(
+        configuration, kind)
     if do_lock:
         lock_handle = open(lock_path, 'a')
         fcntl.flock(lock_handle.fileno(), fcntl.LOCK_SH)
     try:
         _logger.info("before %s map load" % kind)
-        entity_map = load(map_path)
-        _logger.info("after %s map load" % kind)
+        index = load(map_path)
         map_stamp = os.path.getmtime(map_path)
+        if not isinstance(index, dict) or not index.has_key(SHARDS):
+            # Legacy single pickle map - converted on next refresh
+            entity_map = index
+        else:
+            map_stamp = index[STAMP]
+            changed = None
+            if base_map is not None and base_stamp > 0 and \
+                    index[SHARDS] == MAP_SHARDS:
+                changed = changed_map_shards(changes_path, base_stamp)
+            missing = []
+            if changed is not None:
+                _logger.debug("load %d changed %s map shard(s)" %
+                              (len(changed), kind))
+                entity_map = prune_map_shards(kind, base_map, changed)
+                missing = load_map_shards(shard_dir, kind, entity_map,
+                                          changed)
+            if changed is None or missing:
+                entity_map = {}
+                missing = load_map_shards(shard_dir, kind, entity_map,
+                                          xrange(index[SHARDS]))
+            if missing:
+                _logger.error("%s map shard(s) %s missing - need rebuild" %
+                              (kind, missing))
+                entity_map = {}
+                map_stamp = -1
+        _logger.info("after %s map load" % kind)
     except IOError:
         _logger.warn("No %s map to load" % kind)
         entity_map = {}
         map_stamp = -1
     if do_lock:
         lock_handle.close()
+        if map_stamp < 0:
+            mark_entity_modified(configuration, kind, ALL_SHARDS)
     return (entity_map, map_stamp)
 
 
-def load_user_map(configuration, do_lock=True):
+def load_user_map(configuration, do_lock=True, base_map=None,
+                  base_stamp=-1):
     """Load map of users and their configuration. Uses a pickled
     dictionary for efficiency. Optional do_lock option is used to enable and
-    disable locking during load.
+    disable locking during load. Optional base_map and base_stamp are used
+    for incremental loads as described in load_entity_map.
     User IDs are stored in their raw (non-anonymized form).
     Returns tuple with map and time stamp of last map modification.
     """
-    return load_entity_map(configuration, 'user', do_lock)
+    return load_entity_map(configuration, 'user', do_lock, base_map,
+                           base_stamp)
 
 
-def load_resource_map(configuration, do_lock=True):
+def load_resource_map(configuration, do_lock=True, base_map=None,
+                      base_stamp=-1):
     """Load map of resources and their configuration. Uses a pickled
     dictionary for efficiency. Optional do_lock option is used to enable and
-    disable locking during load.
+    disable locking during load. Optional base_map and base_stamp are used
+    for incremental loads as described in load_entity_map.
     Resource IDs are stored in their raw (non-anonymized form).
     """
-    return load_entity_map(configuration, 'resource', do_lock)
+    return load_entity_map(configuration, 'resource', do_lock, base_map,
+                           base_stamp)
 
 
-def load_vgrid_map(configuration, do_lock=True):
+def load_vgrid_map(configuration, do_lock=True, base_map=None,
+                   base_stamp=-1):
     """Load map of vgrids and their configuration. Uses a pickled
     dictionary for efficiency. Optional do_lock option is used to enable and
-    disable locking during load.
+    disable locking during load. Optional base_map and base_stamp are used
+    for incremental loads as described in load_entity_map.
     Resource IDs are stored in their raw (non-anonymized form).
     """
-    return load_entity_map(configuration, 'vgrid', do_lock)
+    return load_entity_map(configuration, 'vgrid', do_lock, base_map,
+                           base_stamp)
+
+
+def build_vgrid_index(configuration, vgrid_map, missing_conf):
+    """Build index of vgrid participation including inheritance from the
+    direct participation in vgrid_map. The missing_conf dictionary maps vgrid
+    names to a list of fields where the participation file is missing.
+    The VGRIDS section of the index maps each vgrid to a dictionary with the
+    inherited owners, members and resources in the same root-to-leaf order as
+    the recursive vgrid_list, along with the parent vgrids, the wild card
+    patterns among the entities and the vgrids with any missing files.
+    The USERS and RESOURCES sections map each explicitly listed entity to a
+    dictionary of vgrids and the fields it is inherited in.
+    """
+    index = {USERS: {}, RESOURCES: {}, VGRIDS: {}}
+    field_sections = [(OWNERS, USERS), (MEMBERS, USERS),
+                      (RESOURCES, RESOURCES)]
+    for vgrid_name in vgrid_map[VGRIDS].keys():
+        parents = vgrid_list_parents(vgrid_name, configuration)
+        chain = parents + [vgrid_name]
+        if [i for i in parents if not vgrid_map[VGRIDS].has_key(i)]:
+            configuration.logger.warning("skip index of orphan vgrid %s" %
+                                         vgrid_name)
+            continue
+        entry = {PARENTS: parents, PATTERNS: {}, MISSING: {}}
+        for (field, section) in field_sections:
+            inherited = []
+            for name in chain:
+                inherited += vgrid_map[VGRIDS][name].get(field, [])
+            entry[field] = inherited
+            entry[MISSING][field] = [i for i in chain if field in
+                                     missing_conf.get(i, [])]
+            # Wild card entries can only be matched with fnmatch on lookup
+            entry[PATTERNS][field] = []
+            for entity_id in inherited:
+                if [i for i in '*?[' if i in entity_id]:
+                    if not entity_id in entry[PATTERNS][field]:
+                        entry[PATTERNS][field].append(entity_id)
+                    continue
+                entity_vgrids = index[section].setdefault(entity_id, {})
+                roles = entity_vgrids.setdefault(vgrid_name, [])
+                if not field in roles:
+                    roles.append(field)
+        index[VGRIDS][vgrid_name] = entry
+    return index
+
+
+def save_vgrid_index(configuration, index):
+    """Save vgrid index from build_vgrid_index. The caller must hold the
+    exclusive vgrid map lock.
+    """
+    index_path = os.path.join(configuration.mig_system_files, "vgrid.index")
+    tmp_path = "%s.tmp" % index_path
+    dump(index, tmp_path, protocol=2)
+    os.rename(tmp_path, index_path)
 
 
 def refresh_user_map(configuration, clean=False):
@@ -134,14 +414,16 @@ def refresh_user_map(configuration, clean=False):
     NOTE: Save start time so that any concurrent updates get caught next time.
     """
     _logger = configuration.logger
-    start_time = time.time()
     dirty = []
-    map_path = os.path.join(configuration.mig_system_files, "user.map")
-    lock_path = os.path.join(configuration.mig_system_files, "user.lock")
+    (_, lock_path, _, _) = entity_map_paths(configuration, 'user')
     lock_handle = open(lock_path, 'a')
     fcntl.flock(lock_handle.fileno(), fcntl.LOCK_EX)
+    # Stamp under lock to keep change log entries ordered
+    start_time = time.time()
     if not clean:
         user_map, map_stamp = load_user_map(configuration, do_lock=False)
+        # Rewrite all shards if map is missing or incomplete
+        clean = map_stamp < 0
     else:
         _logger.info("Creating clean user map")
         user_map = {}
@@ -188,8 +470,9 @@ def refresh_user_map(configuration, clean=False):
 
     if dirty:
         try:
-            dump(user_map, map_path)
-            os.utime(map_path, (start_time, start_time))
+            save_entity_map(configuration, 'user', user_map,
+                            [(None, user) for user in dirty], start_time,
+                            clean)
         except Exception, exc:
             _logger.error("Could not save user map: %s" % exc)
 
@@ -207,15 +490,17 @@ def refresh_resource_map(configuration, clean=False):
     NOTE: Save start time so that any concurrent updates get caught next time.
     """
     _logger = configuration.logger
-    start_time = time.time()
     dirty = []
-    map_path = os.path.join(configuration.mig_system_files, "resource.map")
-    lock_path = os.path.join(configuration.mig_system_files, "resource.lock")
+    (_, lock_path, _, _) = entity_map_paths(configuration, 'resource')
     lock_handle = open(lock_path, 'a')
     fcntl.flock(lock_handle.fileno(), fcntl.LOCK_EX)
+    # Stamp under lock to keep change log entries ordered
+    start_time = time.time()
     if not clean:
         resource_map, map_stamp = load_resource_map(
             configuration, do_lock=False)
+        # Rewrite all shards if map is missing or incomplete
+        clean = map_stamp < 0
     else:
         _logger.info("Creating clean resource map")
         resource_map = {}
@@ -268,8 +553,9 @@ def refresh_resource_map(configuration, clean=False):
 
     if dirty:
         try:
-            dump(resource_map, map_path)
-            os.utime(map_path, (start_time, start_time))
+            save_entity_map(configuration, 'resource', resource_map,
+                            [(None, res) for res in dirty], start_time,
+                            clean)
         except Exception, exc:
             _logger.error("Could not save resource map: %s" % exc)
 
@@ -289,15 +575,18 @@ def refresh_vgrid_map(configuration, clean=False):
     NOTE: Save start time so that any concurrent updates get caught next time.
     """
     _logger = configuration.logger
-    start_time = time.time()
     dirty = {}
     vgrid_changes = {}
-    map_path = os.path.join(configuration.mig_system_files, "vgrid.map")
-    lock_path = os.path.join(configuration.mig_system_files, "vgrid.lock")
+    missing_conf = {}
+    (_, lock_path, _, _) = entity_map_paths(configuration, 'vgrid')
     lock_handle = open(lock_path, 'a')
     fcntl.flock(lock_handle.fileno(), fcntl.LOCK_EX)
+    # Stamp under lock to keep change log entries ordered
+    start_time = time.time()
     if not clean:
         vgrid_map, map_stamp = load_vgrid_map(configuration, do_lock=False)
+        # Rewrite all shards if map is missing or incomplete
+        clean = map_stamp < 0
     else:
         _logger.info("Creating clean vgrid map")
         vgrid_map = {}
@@ -335,6 +624,7 @@ def refresh_vgrid_map(configuration, clean=False):
                 # Make sure vgrid dict exists before filling it
                 vgrid_map[VGRIDS][vgrid] = vgrid_map[VGRIDS].get(vgrid, {})
                 vgrid_map[VGRIDS][vgrid][field] = []
+                missing_conf[vgrid] = missing_conf.get(vgrid, []) + [field]
                 if vgrid != default_vgrid and field not in optional_conf:
                     _logger.warning('missing file: %s' %
                                     conf_path)
@@ -346,6 +636,8 @@ def refresh_vgrid_map(configuration, clean=False):
                                               recursive=False)
                 if not status:
                     entries = []
+                    missing_conf[vgrid] = missing_conf.get(vgrid, []) + \
+                        [field]
                 vgrid_changes[vgrid] = vgrid_changes.get(vgrid, {})
                 map_entry = vgrid_map[VGRIDS].get(vgrid, {})
                 vgrid_changes[vgrid][field] = (map_entry.get(field, []),
@@ -535,25 +827,139 @@ def refresh_vgrid_map(configuration, clean=False):
 
     if dirty:
         _logger.info("Saving vgrid map changes: %s" % dirty)
+        # Participation updates also change resource and user entries
+        dirty_entities = [(RESOURCES, res) for res in update_res] + \
+            [(USERS, user) for user in update_user]
+        for (section, names) in dirty.items():
+            dirty_entities += [(section, name) for name in names]
         try:
-            dump(vgrid_map, map_path)
-            os.utime(map_path, (start_time, start_time))
+            save_entity_map(configuration, 'vgrid', vgrid_map,
+                            dirty_entities, start_time, clean)
         except Exception, exc:
             _logger.error("Could not save vgrid map: %s" % exc)
 
+    index_path = os.path.join(configuration.mig_system_files, "vgrid.index")
+    if dirty or not os.path.isfile(index_path):
+        try:
+            save_vgrid_index(configuration, build_vgrid_index(
+                configuration, vgrid_map, missing_conf))
+        except Exception, exc:
+            _logger.error("Could not save vgrid index: %s" % exc)
+
     last_refresh[VGRIDS] = start_time
     lock_handle.close()
 
     return vgrid_map
 
 
+def map_cache_key(configuration, kind):
+    """Returns a fingerprint of the map and modified mark files of given kind
+    based on their mtime and inode. The modified marks are rewritten in place
+    so their size and ctime are included, too. Any map refresh or change in
+    modified marks results in a new fingerprint. Returns None if the map is
+    missing.
+    """
+    map_path = entity_map_paths(configuration, kind)[0]
+    modified_path = os.path.join(configuration.mig_system_files,
+                                 "%s.modified" % kind)
+    try:
+        map_stat = os.stat(map_path)
+    except OSError:
+        return None
+    try:
+        modified_stat = os.stat(modified_path)
+        # NOTE: include size and ctime to detect marks within mtime resolution
+        modified_key = (modified_stat.st_mtime, modified_stat.st_ino,
+                        modified_stat.st_size, modified_stat.st_ctime)
+    except OSError:
+        modified_key = (None, None, None, None)
+    return (map_stat.st_mtime, map_stat.st_ino) + modified_key
+
+
+def cached_entity_map(configuration, kind, section, caching):
+    """Returns the map of given kind and section from process memory if the
+    map and modified mark files did not change since it was loaded and None
+    otherwise. A map loaded while entities were marked modified is only used
+    if caching is set, as it would otherwise need a refresh first.
+    """
+    cache_key = map_cache_key(configuration, kind)
+    if cache_key is None or cache_key != last_key[section] or \
+            (last_dirty[section] and not caching):
+        map_cache_stats['misses'] += 1
+        return None
+    map_cache_stats['hits'] += 1
+    last_load[section] = time.time()
+    return last_map[section]
+
+
+def update_map_cache(configuration, kind, section, entity_map, map_stamp,
+                     load_stamp, dirty, cache_key=None):
+    """Save entity_map of given kind and section in process memory for use in
+    following calls. The dirty argument tells if any entities were marked
+    modified when the map was loaded. The optional cache_key should be the
+    map_cache_key from right before a map load so that any changes racing
+    the load force a reload next time. It is looked up here if left out.
+    """
+    if cache_key is None:
+        cache_key = map_cache_key(configuration, kind)
+    last_map[section] = entity_map
+    last_refresh[section] = map_stamp
+    last_load[section] = load_stamp
+    last_key[section] = cache_key
+    last_dirty[section] = dirty
+    map_version[section] += 1
+
+
+def memo_lookup(name, args, sections):
+    """Lookup the result of a previous name(*args) call in the bounded memo
+    of results derived from the maps in sections. Returns a tuple with the
+    map versions the lookup was based on, a boolean telling if a valid
+    result was found and a copy of the result itself. The versions should be
+    passed to memo_store along with any new result.
+    """
+    versions = tuple([map_version[section] for section in sections])
+    memo_key = (name, args)
+    map_memo_lock.acquire()
+    try:
+        entry = map_memo.pop(memo_key, None)
+        if entry is not None and entry[0] == versions:
+            # Reinsert to maintain least recently used order
+            map_memo[memo_key] = entry
+            map_cache_stats['memo_hits'] += 1
+            return (versions, True, copy.copy(entry[1]))
+        map_cache_stats['memo_misses'] += 1
+        return (versions, False, None)
+    finally:
+        map_memo_lock.release()
+
+
+def memo_store(name, args, versions, result):
+    """Save a copy of the result of name(*args) derived from maps with
+    versions in the memo. Evicts least recently used results to stay within
+    MAP_MEMO_SIZE entries.
+    """
+    map_memo_lock.acquire()
+    try:
+        map_memo[(name, args)] = (versions, copy.copy(result))
+        while len(map_memo) > MAP_MEMO_SIZE:
+            map_memo.popitem(last=False)
+    finally:
+        map_memo_lock.release()
+
+
+def get_map_cache_stats():
+    """Returns a copy of the map cache hit and miss counters"""
+    stats = map_cache_stats.copy()
+    stats['memo_size'] = len(map_memo)
+    return stats
+
+
 def force_update_user_map(configuration, clean=False):
     """Refresh user map and update map cache"""
     map_stamp = load_stamp = time.time()
     user_map = refresh_user_map(configuration, clean=clean)
-    last_map[USERS] = user_map
-    last_refresh[USERS] = map_stamp
-    last_load[USERS] = load_stamp
+    update_map_cache(configuration, 'user', USERS, user_map, map_stamp,
+                     load_stamp, False)
 
     return user_map
 
@@ -562,9 +968,8 @@ def force_update_resource_map(configuration, clean=False):
     """Refresh resources map and update map cache"""
     map_stamp = load_stamp = time.time()
     resource_map = refresh_resource_map(configuration, clean=clean)
-    last_map[RESOURCES] = resource_map
-    last_refresh[RESOURCES] = map_stamp
-    last_load[RESOURCES] = load_stamp
+    update_map_cache(configuration, 'resource', RESOURCES, resource_map,
+                     map_stamp, load_stamp, False)
 
     return resource_map
 
@@ -573,9 +978,8 @@ def force_update_vgrid_map(configuration, clean=False):
     """Refresh vgrid map and update map cache"""
     map_stamp = load_stamp = time.time()
     vgrid_map = refresh_vgrid_map(configuration, clean=clean)
-    last_map[VGRIDS] = vgrid_map
-    last_refresh[VGRIDS] = map_stamp
-    last_load[VGRIDS] = load_stamp
+    update_map_cache(configuration, 'vgrid', VGRIDS, vgrid_map, map_stamp,
+                     load_stamp, False)
 
     return vgrid_map
 
@@ -588,19 +992,32 @@ def get_user_map(configuration, caching=False):
     if last_load[USERS] + MAP_CACHE_SECONDS > time.time():
         _logger.debug("using cached user map")
         return last_map[USERS]
+    user_map = cached_entity_map(configuration, 'user', USERS, caching)
+    if user_map is not None:
+        _logger.debug("using unchanged cached user map")
+        return user_map
     modified_users, _ = check_users_modified(configuration)
     if modified_users and not caching:
         _logger.info("refreshing user map (%s)" % modified_users)
         map_stamp = load_stamp = time.time()
+        cache_key = None
         user_map = refresh_user_map(configuration)
         reset_users_modified(configuration)
     else:
         _logger.debug("No changes or forced caching - not refreshing")
         load_stamp = time.time()
-        user_map, map_stamp = load_user_map(configuration)
-    last_map[USERS] = user_map
-    last_refresh[USERS] = map_stamp
-    last_load[USERS] = load_stamp
+        cache_key = map_cache_key(configuration, 'user')
+        user_map, map_stamp = load_user_map(configuration,
+                                            base_map=last_map[USERS],
+                                            base_stamp=last_refresh[USERS])
+        if map_stamp < 0 and not caching:
+            _logger.info("rebuilding missing or incomplete user map")
+            map_stamp = load_stamp = time.time()
+            cache_key = None
+            user_map = refresh_user_map(configuration)
+            reset_users_modified(configuration)
+    update_map_cache(configuration, 'user', USERS, user_map, map_stamp,
+                     load_stamp, bool(modified_users) and caching, cache_key)
     return user_map
 
 
@@ -613,20 +1030,35 @@ def get_resource_map(configuration, caching=False):
     if last_load[RESOURCES] + MAP_CACHE_SECONDS > time.time():
         _logger.debug("using cached resource map")
         return last_map[RESOURCES]
+    resource_map = cached_entity_map(configuration, 'resource', RESOURCES,
+                                     caching)
+    if resource_map is not None:
+        _logger.debug("using unchanged cached resource map")
+        return resource_map
     modified_resources, _ = check_resources_modified(configuration)
     if modified_resources and not caching:
         _logger.info(
             "refreshing resource map (%s)" % modified_resources)
         map_stamp = load_stamp = time.time()
+        cache_key = None
         resource_map = refresh_resource_map(configuration)
         reset_resources_modified(configuration)
     else:
         _logger.debug("No changes or forced caching- not refreshing")
         load_stamp = time.time()
-        resource_map, map_stamp = load_resource_map(configuration)
-    last_map[RESOURCES] = resource_map
-    last_refresh[RESOURCES] = map_stamp
-    last_load[RESOURCES] = load_stamp
+        cache_key = map_cache_key(configuration, 'resource')
+        resource_map, map_stamp = load_resource_map(
+            configuration, base_map=last_map[RESOURCES],
+            base_stamp=last_refresh[RESOURCES])
+        if map_stamp < 0 and not caching:
+            _logger.info("rebuilding missing or incomplete resource map")
+            map_stamp = load_stamp = time.time()
+            cache_key = None
+            resource_map = refresh_resource_map(configuration)
+            reset_resources_modified(configuration)
+    update_map_cache(configuration, 'resource', RESOURCES, resource_map,
+                     map_stamp, load_stamp,
+                     bool(modified_resources) and caching, cache_key)
     return resource_map
 
 
@@ -661,6 +1093,76 @@ def vgrid_inherit_map(configuration, vgrid_map):
     return inherit_map
 
 
+def get_vgrid_index(configuration):
+    """Returns the vgrid index saved in the latest vgrid map refresh if no
+    vgrids were marked modified since then and None otherwise. Kept in
+    process memory until the index or the modified marks change.
+    """
+    _logger = configuration.logger
+    index_path = os.path.join(configuration.mig_system_files, "vgrid.index")
+    modified_path = os.path.join(configuration.mig_system_files,
+                                 "vgrid.modified")
+    try:
+        index_stat = os.stat(index_path)
+        modified_stat = os.stat(modified_path)
+    except OSError:
+        return None
+    # NOTE: include size and ctime to detect marks within mtime resolution
+    index_key = (index_stat.st_mtime, index_stat.st_ino,
+                 modified_stat.st_mtime, modified_stat.st_ino,
+                 modified_stat.st_size, modified_stat.st_ctime)
+    if index_key == last_index['key']:
+        return last_index['index']
+    index = None
+    modified_vgrids, _ = check_vgrids_modified(configuration)
+    if not modified_vgrids:
+        try:
+            index = load(index_path)
+        except Exception, exc:
+            _logger.warning("could not load vgrid index: %s" % exc)
+    last_index['index'] = index
+    last_index['key'] = index_key
+    return index
+
+
+def vgrid_index_list(configuration, vgrid_name, group):
+    """Returns a list of the owners, members or resources (group) of
+    vgrid_name including the entities inherited from parent vgrids from the
+    vgrid index. Returns None if the index is not up to date or cannot
+    provide the list, so that the caller needs to read it from the vgrid
+    files.
+    """
+    index = get_vgrid_index(configuration)
+    if index is None or not INDEX_GROUPS.has_key(group):
+        return None
+    field = INDEX_GROUPS[group]
+    entry = index[VGRIDS].get(vgrid_name, None)
+    if entry is None or entry[MISSING][field]:
+        return None
+    return entry[field][:]
+
+
+def vgrid_index_allowed(configuration, vgrid_name, entity_id, group):
+    """Returns True if entity_id is one of the owners, members or resources
+    (group) of vgrid_name including inheritance, False if not and None if
+    the vgrid index is not up to date or cannot tell.
+    """
+    index = get_vgrid_index(configuration)
+    if index is None or not INDEX_GROUPS.has_key(group):
+        return None
+    field = INDEX_GROUPS[group]
+    entry = index[VGRIDS].get(vgrid_name, None)
+    if entry is None or entry[MISSING][field]:
+        return None
+    if field == RESOURCES:
+        section = RESOURCES
+    else:
+        section = USERS
+    if field in index[section].get(entity_id, {}).get(vgrid_name, []):
+        return True
+    return vgrid_allowed(entity_id, entry[PATTERNS][field])
+
+
 def get_vgrid_map(configuration, recursive=True, caching=False):
     """Returns the current map of vgrids and their configurations. Caches the
     map for load prevention with repeated calls within short time span.
@@ -673,11 +1175,14 @@ def get_vgrid_map(configuration, recursive=True, caching=False):
         _logger.debug("using cached vgrid map")
         vgrid_map = last_map[VGRIDS]
     else:
+        vgrid_map = cached_entity_map(configuration, 'vgrid', VGRIDS, caching)
+    if vgrid_map is None:
         modified_vgrids, _ = check_vgrids_modified(configuration)
         if modified_vgrids and not caching:
             _logger.info("refreshing vgrid map (%s)" %
                          modified_vgrids)
             map_stamp = load_stamp = time.time()
+            cache_key = None
             vgrid_map = refresh_vgrid_map(configuration)
             reset_vgrids_modified(configuration)
             _logger.info("refreshed vgrid map (%s)" %
@@ -685,12 +1190,27 @@ def get_vgrid_map(configuration, recursive=True, caching=False):
         else:
             _logger.debug("No changes or forced caching - not refreshing")
             load_stamp = time.time()
-            vgrid_map, map_stamp = load_vgrid_map(configuration)
-        last_map[VGRIDS] = vgrid_map
-        last_refresh[VGRIDS] = map_stamp
-        last_load[VGRIDS] = load_stamp
+            cache_key = map_cache_key(configuration, 'vgrid')
+            vgrid_map, map_stamp = load_vgrid_map(
+                configuration, base_map=last_map[VGRIDS],
+                base_stamp=last_refresh[VGRIDS])
+            if map_stamp < 0 and not caching:
+                _logger.info("rebuilding missing or incomplete vgrid map")
+                map_stamp = load_stamp = time.time()
+                cache_key = None
+                vgrid_map = refresh_vgrid_map(configuration)
+                reset_vgrids_modified(configuration)
+        update_map_cache(configuration, 'vgrid', VGRIDS, vgrid_map,
+                         map_stamp, load_stamp,
+                         bool(modified_vgrids) and caching, cache_key)
     if recursive:
-        return vgrid_inherit_map(configuration, vgrid_map)
+        # The inherited map is expensive to build so keep it until next load
+        (versions, found, inherit_map) = memo_lookup('vgrid_inherit_map', (),
+                                                     [VGRIDS])
+        if not found:
+            inherit_map = vgrid_inherit_map(configuration, vgrid_map)
+            memo_store('vgrid_inherit_map', (), versions, inherit_map)
+        return inherit_map
     else:
         return vgrid_map
 
@@ -720,15 +1240,22 @@ def user_vgrid_access(configuration, client_id, inherited=False,
     Thus this is basically the fast equivalent of the user_allowed_vgrids from
     the vgrid module and should replace that one everywhere that only vgrid map
     (cached) lookups are needed.
+    Results are kept in memory until the vgrid map changes.
     """
-    vgrid_access = [default_vgrid]
     vgrid_map = get_vgrid_map(configuration, recursive, caching)
+    memo_args = (client_id, inherited, recursive)
+    (versions, found, vgrid_access) = memo_lookup('user_vgrid_access',
+                                                  memo_args, [VGRIDS])
+    if found:
+        return vgrid_access
+    vgrid_access = [default_vgrid]
     for vgrid in vgrid_map[VGRIDS].keys():
         if vgrid_allowed(client_id, vgrid_map[VGRIDS][vgrid][OWNERS]) or \
                 vgrid_allowed(client_id, vgrid_map[VGRIDS][vgrid][MEMBERS]):
             if inherited:
                 vgrid_access += vgrid_list_parents(vgrid, configuration)
             vgrid_access.append(vgrid)
+    memo_store('user_vgrid_access', memo_args, versions, vgrid_access)
     return vgrid_access
 
 
@@ -741,12 +1268,19 @@ def check_vgrid_access(configuration, client_id, vgrid_name, recursive=True,
     Thus this is basically the fast equivalent of vgrid_is_owner_or_member from
     the vgrid module and should replace that one everywhere that only vgrid map
     (cached) lookups are needed.
+    Results are kept in memory until the vgrid map changes.
     """
-    vgrid_access = [default_vgrid]
     vgrid_map = get_vgrid_map(configuration, recursive, caching)
+    memo_args = (client_id, vgrid_name, recursive)
+    (versions, found, allowed) = memo_lookup('check_vgrid_access', memo_args,
+                                             [VGRIDS])
+    if found:
+        return allowed
     vgrid_entry = vgrid_map[VGRIDS].get(vgrid_name, {OWNERS: [], MEMBERS: []})
-    return vgrid_allowed(client_id, vgrid_entry[OWNERS]) or \
+    allowed = vgrid_allowed(client_id, vgrid_entry[OWNERS]) or \
         vgrid_allowed(client_id, vgrid_entry[MEMBERS])
+    memo_store('check_vgrid_access', memo_args, versions, allowed)
+    return allowed
 
 
 def res_vgrid_access(configuration, client_id, recursive=True, caching=False):
@@ -802,6 +1336,7 @@ def user_allowed_res_confs(configuration, client_id, caching=False):
     Please note that vgrid participation is a mutual agreement between vgrid
     owners and resource owners, so that a resource only truly participates
     in a vgrid if the vgrid *and* resource owners configured it so.
+    Results are kept in memory until the vgrid or resource map changes.
     """
     allowed = {}
 
@@ -816,6 +1351,12 @@ def user_allowed_res_confs(configuration, client_id, caching=False):
     vgrid_map_res = vgrid_map[RESOURCES]
     resource_map = get_resource_map(configuration)
 
+    (versions, found, cached) = memo_lookup('user_allowed_res_confs',
+                                            (client_id, ),
+                                            [VGRIDS, RESOURCES])
+    if found:
+        return cached
+
     # Map only contains the raw resource names - anonymize as requested
 
     anon_map = {}
@@ -836,6 +1377,7 @@ def user_allowed_res_confs(configuration, client_id, caching=False):
         if not shared:
             continue
         allowed[anon_map[res]] = resource_map.get(res, {CONF: {}})[CONF]
+    memo_store('user_allowed_res_confs', (client_id, ), versions, allowed)
     return allowed
 
 
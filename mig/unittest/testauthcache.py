@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# --- BEGIN_HEADER ---
+#
+# testauthcache - Set of unit tests for the grid daemon auth cache
+# Copyright (C) 2010-2020  The MiG Project lead by Brian Vinter
+#
+# This file is part of MiG.
+#
+# MiG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# MiG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# -- END_HEADER ---
+#
+
+
+"""Unit tests for the grid daemon auth cache"""
+
+import time
+import unittest
+
+from shared.griddaemons.auth import AuthCache
+
+
+class AuthCacheTest(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        cache = AuthCache(max_size=10, ttl=60)
+        self.assertEqual(cache.get('hash'), None)
+        cache['hash'] = True
+        self.assertEqual(cache.get('hash'), True)
+        self.assertEqual(cache.get('other', False), False)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']),
+                         (1, 2, 1))
+
+    def test_ttl_expiry(self):
+        cache = AuthCache(max_size=10, ttl=0.2)
+        cache['old'] = True
+        time.sleep(0.3)
+        cache['new'] = True
+        self.assertEqual(cache.get('old'), None)
+        self.assertEqual(cache.get('new'), True)
+        self.assertEqual(cache.stats()['expired'], 1)
+        time.sleep(0.3)
+        self.assertEqual(cache.expire(), 1)
+        self.assertEqual(cache.stats()['size'], 0)
+        self.assertFalse('new' in cache)
+
+    def test_update_restarts_ttl(self):
+        cache = AuthCache(max_size=10, ttl=0.3)
+        cache['hash'] = True
+        time.sleep(0.2)
+        cache['hash'] = True
+        time.sleep(0.2)
+        self.assertEqual(cache.get('hash'), True)
+
+    def test_lru_eviction(self):
+        cache = AuthCache(max_size=3, ttl=60)
+        for key in ('a', 'b', 'c'):
+            cache[key] = key
+        # Use a to make b the least recently used one
+        self.assertEqual(cache.get('a'), 'a')
+        cache['d'] = 'd'
+        self.assertEqual(cache.get('b'), None)
+        for key in ('a', 'c', 'd'):
+            self.assertEqual(cache.get(key), key)
+        self.assertEqual(cache.stats()['evicted'], 1)
+        self.assertEqual(len(cache), 3)
+
+    def test_clear(self):
+        cache = AuthCache(max_size=3, ttl=60)
+        cache['a'] = 'a'
+        cache.clear()
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats()['size'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# --- BEGIN_HEADER ---
+#
+# testgridevents - Set of unit tests for grid events helpers
+# Copyright (C) 2010-2020  The MiG Project lead by Brian Vinter
+#
+# This file is part of MiG.
+#
+# MiG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# MiG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# -- END_HEADER ---
+#
+
+
+"""Unit tests for the grid events rule index, event coalescing and dir
+cache helpers.
+"""
+
+import fnmatch
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+this_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(this_path, '..', 'server'))
+
+import grid_events
+from grid_events import EventCoalescer, RuleIndex, read_dir_cache, \
+    write_dir_cache
+
+
+class DummyEvent(object):
+    """Minimal file event"""
+
+    def __init__(self, src_path, event_type, dest_path=None):
+        self.src_path = src_path
+        self.event_type = event_type
+        self.time_stamp = time.time()
+        if dest_path is not None:
+            self.dest_path = dest_path
+
+
+def fnmatch_targets(rules, src_path):
+    """Returns sorted (target_path, direct_hit) pairs for the targets in
+    rules matching src_path using plain fnmatch regexps like before the
+    rule index.
+    """
+    matches = []
+    for target_path in rules:
+        recursive_regexp = fnmatch.translate(target_path)
+        direct_regexp = recursive_regexp.replace('.*', '[^/]*')
+        if re.match(recursive_regexp, src_path):
+            matches.append((target_path,
+                            re.match(direct_regexp, src_path) is not None))
+    return sorted(matches)
+
+
+class RuleIndexTest(unittest.TestCase):
+
+    def test_matches_fnmatch(self):
+        patterns = ['*', '*.txt', 'a/*', 'a/b/*.txt', '?', 'a/[bc]', 'a/b',
+                    'sub/*/x.dat', 'd*', 'c.txt', '*/*.dat']
+        rules = {}
+        for vgrid_name in ['vg1', 'vg2', 'vg1/sub']:
+            for pattern in patterns:
+                rules['/base/%s/%s' % (vgrid_name, pattern)] = [
+                    {'rule_id': pattern}]
+        index = RuleIndex(rules, 0)
+        parts = ['a', 'b', 'c.txt', 'd', 'x.dat', 'sub']
+        rand = random.Random(42)
+        for _ in range(2000):
+            src_path = '/base/%s/%s' % (
+                rand.choice(['vg1', 'vg2', 'vg3', 'vg1/sub']),
+                '/'.join([rand.choice(parts) for _ in
+                          range(rand.randint(1, 5))]))
+            matches = sorted([(i, k) for (i, _, k) in
+                              index.match(src_path)])
+            self.assertEqual(matches, fnmatch_targets(rules, src_path))
+
+    def test_reuse_compiled(self):
+        rules = {'/base/vg/*.txt': [{'rule_id': 'txt'}],
+                 '/base/vg/a.dat': [{'rule_id': 'dat'}]}
+        index = RuleIndex(rules, 0)
+        self.assertEqual(len(index.match('/base/vg/a.txt')), 1)
+        self.assertEqual(len(index.match('/base/vg/a.dat')), 1)
+        rules['/base/vg/*.dat'] = [{'rule_id': 'dat'}]
+        new_index = RuleIndex(rules, 1, index)
+        self.assertTrue(new_index.compiled['/base/vg/*.txt'] is
+                        index.compiled['/base/vg/*.txt'])
+        self.assertEqual(len(new_index.match('/base/vg/a.dat')), 2)
+
+
+class EventCoalescerTest(unittest.TestCase):
+
+    def setUp(self):
+        grid_events.logger = logging.getLogger('testgridevents')
+        grid_events.logger.addHandler(logging.NullHandler())
+        self.stop_running = threading.Event()
+        self.handled = []
+        self.coalescer = EventCoalescer(self.handled.append, 0.1,
+                                        self.stop_running)
+
+    def tearDown(self):
+        self.stop_running.set()
+
+    def wait_handled(self):
+        """Wait for all pending events to be passed on"""
+        deadline = time.time() + 5
+        while self.coalescer.pending() and time.time() < deadline:
+            time.sleep(0.05)
+
+    def test_merge_same_path_and_change(self):
+        first = DummyEvent('/base/vg/a.txt', 'modified')
+        last = DummyEvent('/base/vg/a.txt', 'modified')
+        self.coalescer.add(first)
+        self.coalescer.add(last)
+        self.wait_handled()
+        self.assertEqual(self.handled, [last])
+
+    def test_keep_different_changes(self):
+        created = DummyEvent('/base/vg/a.txt', 'created')
+        modified = DummyEvent('/base/vg/a.txt', 'modified')
+        other = DummyEvent('/base/vg/b.txt', 'modified')
+        for event in (created, modified, other):
+            self.coalescer.add(event)
+        self.wait_handled()
+        self.assertEqual(len(self.handled), 3)
+
+    def test_moves_keyed_on_target(self):
+        first = DummyEvent('/base/vg/a.txt', 'moved', '/base/vg/b.txt')
+        second = DummyEvent('/base/vg/a.txt', 'moved', '/base/vg/c.txt')
+        again = DummyEvent('/base/vg/a.txt', 'moved', '/base/vg/c.txt')
+        for event in (first, second, again):
+            self.coalescer.add(event)
+        self.wait_handled()
+        self.assertEqual(sorted([i.dest_path for i in self.handled]),
+                         ['/base/vg/b.txt', '/base/vg/c.txt'])
+        self.assertTrue(again in self.handled)
+
+
+class DirCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='testgridevents-')
+        self.cache_path = os.path.join(self.tmp_dir, 'dir_cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        dir_cache = {'': 1.5, 'a': 2.25, 'a/b': 3.0, 'a.b': 4.0,
+                     'a/b/c d': 5.0, u'\xe6\xf8\xe5': 6.0}
+        write_dir_cache(dir_cache, self.cache_path)
+        loaded = read_dir_cache(self.cache_path)
+        self.assertEqual(len(loaded), len(dir_cache))
+        self.assertEqual(loaded['a/b/c d'], 5.0)
+        self.assertEqual(loaded['\xc3\xa6\xc3\xb8\xc3\xa5'], 6.0)
+        write_dir_cache({}, self.cache_path)
+        self.assertEqual(read_dir_cache(self.cache_path), {})
+
+    def test_other_format(self):
+        cache_fd = open(self.cache_path, 'wb')
+        cache_fd.write('legacy pickle data')
+        cache_fd.close()
+        self.assertEqual(read_dir_cache(self.cache_path), None)
+
+    def test_truncated(self):
+        write_dir_cache({'a': 1.0, 'b': 2.0, 'c': 3.0}, self.cache_path)
+        data = open(self.cache_path, 'rb').read()
+        cache_fd = open(self.cache_path, 'wb')
+        cache_fd.write(data[:-4])
+        cache_fd.close()
+        self.assertRaises(ValueError, read_dir_cache, self.cache_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# --- BEGIN_HEADER ---
+#
+# testgridsftp - Set of unit tests for the grid sftp session pool
+# Copyright (C) 2010-2020  The MiG Project lead by Brian Vinter
+#
+# This file is part of MiG.
+#
+# MiG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# MiG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# -- END_HEADER ---
+#
+
+
+"""Unit tests for the grid sftp session worker pool"""
+
+import logging
+import os
+import sys
+import threading
+import time
+import unittest
+
+this_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(this_path, '..', 'server'))
+
+import grid_sftp
+from grid_sftp import SessionWorkerPool
+
+
+class DummyClient(object):
+    """Client socket stand-in"""
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class DummyTransport(object):
+    """Session transport stand-in active until closed"""
+
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def close(self):
+        self.active = False
+
+
+class SessionWorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        grid_sftp.logger = logging.getLogger('testgridsftp')
+        grid_sftp.logger.addHandler(logging.NullHandler())
+        self.stop_running = threading.Event()
+        self.transports = {}
+        self.logouts = []
+        self.login_delay = 0.0
+
+    def tearDown(self):
+        self.stop_running.set()
+
+    def login(self, client, addr):
+        """Emulate session login returning transport and logout function"""
+        time.sleep(self.login_delay)
+        self.pool.account(addr, username='user%d' % addr[1])
+        if addr[1] < 0:
+            return None
+        transport = self.transports[addr] = DummyTransport()
+        return (transport, lambda: self.logouts.append(addr))
+
+    def wait_for(self, check, timeout=5):
+        """Wait until check returns True or timeout"""
+        deadline = time.time() + timeout
+        while not check() and time.time() < deadline:
+            time.sleep(0.05)
+        return check()
+
+    def test_sessions_outlive_workers(self):
+        self.pool = SessionWorkerPool(self.login, 2, 10, 10,
+                                      self.stop_running)
+        for port in range(6):
+            self.assertTrue(self.pool.submit(DummyClient(), ('host', port)))
+        self.assertTrue(self.wait_for(
+            lambda: self.pool.stats()['sessions'] == 6))
+        self.assertTrue(self.pool.stats()['workers'] <= 2)
+        self.transports[('host', 3)].close()
+        self.assertTrue(self.wait_for(lambda: self.logouts))
+        self.assertEqual(self.logouts, [('host', 3)])
+        stats = self.pool.stats()
+        self.assertEqual((stats['sessions'], stats['finished']), (5, 1))
+
+    def test_backlog_limit(self):
+        self.login_delay = 0.5
+        self.pool = SessionWorkerPool(self.login, 1, 2, 10,
+                                      self.stop_running)
+        self.assertTrue(self.pool.submit(DummyClient(), ('host', 0)))
+        self.assertTrue(self.wait_for(
+            lambda: self.pool.stats()['active'] == 1))
+        results = [self.pool.submit(DummyClient(), ('host', port)) for port
+                   in range(1, 5)]
+        self.assertEqual(results.count(False), 2)
+        self.assertEqual(self.pool.stats()['rejected'], 2)
+
+    def test_session_limit(self):
+        self.pool = SessionWorkerPool(self.login, 4, 10, 10,
+                                      self.stop_running, max_sessions=3)
+        for port in range(3):
+            self.assertTrue(self.pool.submit(DummyClient(), ('host', port)))
+        self.assertTrue(self.wait_for(
+            lambda: self.pool.stats()['sessions'] == 3))
+        self.assertFalse(self.pool.submit(DummyClient(), ('host', 3)))
+        self.transports[('host', 0)].close()
+        self.assertTrue(self.wait_for(lambda: self.logouts))
+        self.assertTrue(self.pool.submit(DummyClient(), ('host', 4)))
+
+    def test_expired_wait(self):
+        self.login_delay = 0.3
+        self.pool = SessionWorkerPool(self.login, 1, 10, 0.1,
+                                      self.stop_running)
+        clients = [DummyClient() for _ in range(3)]
+        for (port, client) in enumerate(clients):
+            self.pool.submit(client, ('host', port))
+        self.assertTrue(self.wait_for(
+            lambda: self.pool.stats()['expired'] == 2))
+        self.assertEqual([i.closed for i in clients], [False, True, True])
+
+    def test_failed_login_and_stop(self):
+        self.pool = SessionWorkerPool(self.login, 2, 10, 10,
+                                      self.stop_running)
+        self.pool.submit(DummyClient(), ('host', -1))
+        self.pool.submit(DummyClient(), ('host', 1))
+        self.assertTrue(self.wait_for(
+            lambda: self.pool.stats()['sessions'] == 1))
+        self.assertEqual(self.pool.stats()['finished'], 1)
+        self.stop_running.set()
+        self.assertTrue(self.wait_for(lambda: self.logouts))
+        self.assertFalse(self.transports[('host', 1)].is_active())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# --- BEGIN_HEADER ---
+#
+# testjobqueue - Set of unit tests for the indexed job queue
+# Copyright (C) 2010-2020  The MiG Project lead by Brian Vinter
+#
+# This file is part of MiG.
+#
+# MiG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# MiG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# -- END_HEADER ---
+#
+
+
+"""Unit tests for the indexed job queue and its journal"""
+
+import cPickle
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+this_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(this_path, '..', 'server'))
+
+from jobqueue import JobQueue, IndexedJobQueue, indexed_queue
+
+
+def make_job(job_no):
+    """Returns a minimal job dictionary"""
+    return {'JOB_ID': 'job_%d' % job_no, 'STATUS': 'QUEUED'}
+
+
+def queue_ids(queue):
+    """Returns list of job IDs in queue order"""
+    return [queue.get_job(i)['JOB_ID'] for i in range(queue.queue_length())]
+
+
+class IndexedJobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('testjobqueue')
+        self.logger.addHandler(logging.NullHandler())
+        self.tmp_dir = tempfile.mkdtemp(prefix='testjobqueue-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_order_matches_plain_queue(self):
+        plain = JobQueue(self.logger)
+        indexed = IndexedJobQueue(self.logger)
+        indexed.min_compact = 8
+        rand = random.Random(42)
+        job_no = 0
+        for _ in range(2000):
+            action = rand.random()
+            length = plain.queue_length()
+            if action < 0.5 or length == 0:
+                index = length
+                if rand.random() < 0.2:
+                    index = rand.randint(0, length)
+                job_no += 1
+                self.assertTrue(plain.enqueue_job(make_job(job_no), index))
+                self.assertTrue(indexed.enqueue_job(make_job(job_no), index))
+            elif action < 0.75:
+                index = rand.randint(0, length - 1)
+                self.assertEqual(plain.dequeue_job(index),
+                                 indexed.dequeue_job(index))
+            else:
+                job_id = plain.get_job(rand.randint(0, length - 1))['JOB_ID']
+                self.assertEqual(plain.dequeue_job_by_id(job_id),
+                                 indexed.dequeue_job_by_id(job_id))
+            self.assertEqual(plain.queue_length(), indexed.queue_length())
+        self.assertEqual(queue_ids(plain), queue_ids(indexed))
+
+    def test_lookup_and_removal_by_id(self):
+        queue = IndexedJobQueue(self.logger)
+        for job_no in range(10):
+            queue.enqueue_job(make_job(job_no), queue.queue_length())
+        self.assertFalse(queue.enqueue_job(make_job(3), 0))
+        self.assertEqual(queue.get_job_by_id('job_7')['JOB_ID'], 'job_7')
+        self.assertEqual(queue.dequeue_job_by_id('job_7')['JOB_ID'], 'job_7')
+        self.assertIsNone(queue.get_job_by_id('job_7', log_errors=False))
+        self.assertIsNone(queue.dequeue_job_by_id('job_7', log_errors=False))
+        self.assertEqual(queue.get_job(7)['JOB_ID'], 'job_8')
+        self.assertEqual(queue.queue_length(), 9)
+
+    def test_compaction_keeps_order(self):
+        queue = IndexedJobQueue(self.logger)
+        queue.min_compact = 4
+        for job_no in range(100):
+            queue.enqueue_job(make_job(job_no), queue.queue_length())
+        for job_no in range(0, 100, 3) + range(1, 100, 3):
+            queue.dequeue_job_by_id('job_%d' % job_no)
+        self.assertTrue(len(queue.slots) < 100)
+        self.assertEqual(queue_ids(queue), ['job_%d' % i for i in
+                                            range(2, 100, 3)])
+        self.assertEqual(queue.get_job_by_id('job_50')['JOB_ID'], 'job_50')
+
+    def test_convert_plain_queue(self):
+        plain = JobQueue(self.logger)
+        for job_no in range(5):
+            plain.enqueue_job(make_job(job_no), 0)
+        indexed = indexed_queue(plain, self.logger)
+        self.assertEqual(queue_ids(plain), queue_ids(indexed))
+        self.assertTrue(indexed_queue(indexed, self.logger) is indexed)
+
+    def test_journal_replay(self):
+        journal_path = os.path.join(self.tmp_dir, 'journal')
+        queue = IndexedJobQueue(self.logger)
+        queue.open_journal(journal_path)
+        for job_no in range(5):
+            queue.enqueue_job(make_job(job_no), queue.queue_length())
+        snapshot = cPickle.dumps(queue, 2)
+        queue.enqueue_job(make_job(5), 0)
+        queue.dequeue_job_by_id('job_2')
+        job = queue.get_job_by_id('job_3')
+        job['STATUS'] = 'EXECUTING'
+        queue.log_update(job)
+        queue.close_journal()
+
+        restored = cPickle.loads(snapshot)
+        restored.logger = self.logger
+        self.assertEqual(restored.replay_journal(journal_path), 3)
+        self.assertEqual(queue_ids(restored), queue_ids(queue))
+        self.assertEqual(restored.get_job_by_id('job_3')['STATUS'],
+                         'EXECUTING')
+        # Records already in the queue state are skipped on replay
+        self.assertEqual(restored.replay_journal(journal_path), 0)
+
+    def test_journal_broken_tail(self):
+        journal_path = os.path.join(self.tmp_dir, 'journal')
+        queue = IndexedJobQueue(self.logger)
+        queue.open_journal(journal_path)
+        for job_no in range(3):
+            queue.enqueue_job(make_job(job_no), queue.queue_length())
+        queue.close_journal()
+        journal = open(journal_path, 'ab')
+        journal.write(cPickle.dumps((4, 'enqueue', make_job(9), 3), 2)[:-5])
+        journal.close()
+
+        restored = IndexedJobQueue(self.logger)
+        self.assertEqual(restored.replay_journal(journal_path), 3)
+        self.assertEqual(queue_ids(restored), queue_ids(queue))
+        restored.open_journal(journal_path)
+        restored.enqueue_job(make_job(3), restored.queue_length())
+        restored.close_journal()
+        replayed = IndexedJobQueue(self.logger)
+        self.assertEqual(replayed.replay_journal(journal_path), 4)
+
+    def test_journal_reset_after_snapshot(self):
+        journal_path = os.path.join(self.tmp_dir, 'journal')
+        queue = IndexedJobQueue(self.logger)
+        queue.open_journal(journal_path)
+        for job_no in range(3):
+            queue.enqueue_job(make_job(job_no), queue.queue_length())
+        self.assertEqual(queue.journal_records, 3)
+        snapshot = cPickle.dumps(queue, 2)
+        queue.reset_journal()
+        self.assertEqual(queue.journal_records, 0)
+        self.assertEqual(os.path.getsize(journal_path), 0)
+        queue.dequeue_job_by_id('job_1')
+        queue.close_journal()
+
+        restored = cPickle.loads(snapshot)
+        restored.logger = self.logger
+        self.assertEqual(restored.replay_journal(journal_path), 1)
+        self.assertEqual(queue_ids(restored), ['job_0', 'job_2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,370 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# --- BEGIN_HEADER ---
+#
+# testscheduler - Set of unit tests for the scheduler resource index and cache
+# Copyright (C) 2010-2020  The MiG Project lead by Brian Vinter
+#
+# This file is part of MiG.
+#
+# MiG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# MiG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# -- END_HEADER ---
+#
+
+
+"""Unit tests for the scheduler resource capability index and fit cache"""
+
+import logging
+import os
+import random
+import sys
+import time
+import unittest
+
+this_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(this_path, '..', 'server'))
+
+import scheduler
+from scheduler import Scheduler
+
+architectures = ['X86', 'AMD64', 'ARM']
+job_types = ['batch', 'bulk', 'all', 'interactive']
+runtime_envs = ['PYTHON', 'POVRAY', 'R', 'LOCALDISK']
+numeric_ranges = {'NODECOUNT': (1, 4), 'CPUCOUNT': (1, 16),
+                  'CPUTIME': (60, 7200), 'DISK': (1, 100),
+                  'MEMORY': (128, 8192)}
+
+
+class DummyConfiguration(object):
+    """Minimal configuration with just the values used by the scheduler"""
+
+    mig_server_id = 'test.server'
+    server_fqdn = 'localhost'
+    expire_after = 86400
+    peers = {}
+
+    def __init__(self):
+        self.logger = logging.getLogger('testscheduler')
+        self.logger.addHandler(logging.NullHandler())
+
+
+def dummy_vgrid_access_match(configuration, job_owner, job, res_id, res):
+    """Simple vgrid_access_match replacement using vgrid_members"""
+    for vgrid_name in job['VGRID']:
+        if vgrid_name in res['VGRID'] and \
+                job_owner in vgrid_members.get(vgrid_name, []):
+            return (True, vgrid_name, vgrid_name)
+    return (False, None, None)
+
+
+def dummy_validated_vgrid_list(configuration, job):
+    """Simple validated_vgrid_list replacement"""
+    return job['VGRID']
+
+
+vgrid_members = {}
+
+
+def make_resource(res_no, **specs):
+    """Returns a resource conf with the given specs and defaults for the
+    rest.
+    """
+    res = {'RESOURCE_ID': 'res%d.0_node' % res_no, 'ANONYMOUS': False,
+           'ARCHITECTURE': 'X86', 'RUNTIMEENVIRONMENT': [], 'MINPRICE': '1',
+           'SANDBOX': False, 'PLATFORM': '', 'VGRID': ['Generic']}
+    for attr in numeric_ranges:
+        res[attr] = numeric_ranges[attr][1]
+    res.update(specs)
+    return res
+
+
+def make_job(job_no, **specs):
+    """Returns a job with the given specs and defaults for the rest"""
+    job = {'JOB_ID': 'job_%d' % job_no, 'USER_CERT': 'user0',
+           'VGRID': ['Generic'], 'RUNTIMEENVIRONMENT': [], 'MAXPRICE': '100',
+           'RECEIVED_TIMESTAMP': time.gmtime(), 'PLATFORM': ''}
+    for attr in numeric_ranges:
+        job[attr] = numeric_ranges[attr][0]
+    job.update(specs)
+    return job
+
+
+def random_resource(rand, res_no):
+    """Returns a resource conf with random specs. A few numeric values are
+    left unparsable like in broken resource confs.
+    """
+    specs = {'ARCHITECTURE': rand.choice(architectures),
+             'RUNTIMEENVIRONMENT': [(name, []) for name in
+                                    rand.sample(runtime_envs,
+                                                rand.randint(0, 3))]}
+    if rand.random() < 0.8:
+        specs['JOBTYPE'] = rand.choice(job_types)
+    if rand.random() < 0.5:
+        specs['VGRID'] = [rand.choice(['Generic', 'vgA', 'vgB'])]
+    for (attr, (low, high)) in numeric_ranges.items():
+        if rand.random() < 0.05:
+            specs[attr] = 'broken'
+        else:
+            specs[attr] = rand.randint(low, high)
+    return make_resource(res_no, **specs)
+
+
+def random_job(rand, job_no, res_ids):
+    """Returns a job with random requirements"""
+    specs = {'RUNTIMEENVIRONMENT': rand.sample(runtime_envs,
+                                               rand.randint(0, 2))}
+    if rand.random() < 0.5:
+        specs['ARCHITECTURE'] = rand.choice(architectures)
+    if rand.random() < 0.7:
+        specs['JOBTYPE'] = rand.choice(['batch', 'bulk', 'interactive'])
+    specs['USER_CERT'] = rand.choice(['user0', 'user1'])
+    specs['VGRID'] = rand.choice([['Generic'], ['vgA'], ['vgA', 'vgB']])
+    choice = rand.random()
+    if choice < 0.1:
+        specs['RESOURCE'] = [rand.choice(res_ids)]
+    elif choice < 0.2:
+        specs['RESOURCE'] = ['res1*']
+    for (attr, (low, high)) in numeric_ranges.items():
+        specs[attr] = rand.randint(low, high)
+    job = make_job(job_no, **specs)
+    if rand.random() < 0.1:
+        del job[rand.choice(numeric_ranges.keys())]
+    return job
+
+
+class CandidateResourcesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.configuration = DummyConfiguration()
+        self.scheduler = Scheduler(self.configuration.logger,
+                                   self.configuration)
+
+    def add_resources(self, res_list):
+        """Add all resource confs in res_list to the scheduler"""
+        for res_conf in res_list:
+            self.scheduler.update_resources(res_conf)
+
+    def candidate_ids(self, job):
+        """Returns set of resource IDs from the index candidates for job"""
+        return set([res['RESOURCE_ID'] for res in
+                    self.scheduler.candidate_resources(job)])
+
+    def entry_scan_ids(self, job):
+        """Returns set of resource IDs where the index entry fits job in a
+        plain scan over all resources.
+        """
+        requirements = self.scheduler.job_index_requirements(job)
+        return set([res_id for (res_id, entry) in
+                    self.scheduler.res_index['ENTRIES'].items()
+                    if self.scheduler.index_entry_fits(entry,
+                                                       requirements)])
+
+    def spec_scan_ids(self, job):
+        """Returns set of resource IDs where job fits the resource specs in
+        a plain scan over all resources.
+        """
+        return set([res_id for (res_id, res) in
+                    self.scheduler.resources.items()
+                    if self.scheduler.job_fits_resource_spec(job, res)])
+
+    def check_job(self, job):
+        """Check that index candidates for job match the plain scans"""
+        candidates = self.candidate_ids(job)
+        self.assertEqual(candidates, self.entry_scan_ids(job))
+        self.assertTrue(self.spec_scan_ids(job).issubset(candidates))
+
+    def test_random_jobs_match_scan(self):
+        rand = random.Random(42)
+        self.add_resources([random_resource(rand, i) for i in range(80)])
+        res_ids = self.scheduler.resources.keys()
+        for job_no in range(500):
+            self.check_job(random_job(rand, job_no, res_ids))
+
+    def test_jobtype(self):
+        self.add_resources([make_resource(i, JOBTYPE=name) for (i, name) in
+                            enumerate(job_types)] + [make_resource(9)])
+        for (job_type, expected) in [
+                ('batch', ['res0.0_node', 'res1.0_node', 'res2.0_node',
+                           'res9.0_node']),
+                ('bulk', ['res1.0_node', 'res2.0_node']),
+                ('interactive', ['res2.0_node', 'res3.0_node'])]:
+            job = make_job(0, JOBTYPE=job_type)
+            self.assertEqual(self.candidate_ids(job), set(expected))
+            self.assertEqual(self.spec_scan_ids(job), set(expected))
+        self.assertEqual(len(self.candidate_ids(make_job(0))), 5)
+
+    def test_architecture_and_runtime_env(self):
+        self.add_resources([
+            make_resource(0, ARCHITECTURE='X86'),
+            make_resource(1, ARCHITECTURE='ARM',
+                          RUNTIMEENVIRONMENT=[('PYTHON', [])]),
+            make_resource(2, ARCHITECTURE='ARM',
+                          RUNTIMEENVIRONMENT=[('PYTHON', []), ('R', [])])])
+        job = make_job(0, ARCHITECTURE='ARM')
+        self.assertEqual(self.candidate_ids(job),
+                         set(['res1.0_node', 'res2.0_node']))
+        job = make_job(0, RUNTIMEENVIRONMENT=['PYTHON', 'R'])
+        self.assertEqual(self.candidate_ids(job), set(['res2.0_node']))
+        job = make_job(0, ARCHITECTURE='X86', RUNTIMEENVIRONMENT=['R'])
+        self.assertEqual(self.candidate_ids(job), set())
+        self.check_job(job)
+
+    def test_numeric_ranges(self):
+        self.add_resources([make_resource(i, MEMORY=val) for (i, val) in
+                            enumerate([512, 1024, 2048, 'broken'])])
+        job = make_job(0, MEMORY=1024)
+        self.assertEqual(self.candidate_ids(job),
+                         set(['res1.0_node', 'res2.0_node', 'res3.0_node']))
+        self.assertEqual(self.spec_scan_ids(job),
+                         set(['res1.0_node', 'res2.0_node']))
+        job = make_job(0, MEMORY=4096)
+        self.assertEqual(self.candidate_ids(job), set(['res3.0_node']))
+        self.assertEqual(self.spec_scan_ids(job), set())
+        # The numeric range must not drive when another bucket is smaller
+        job = make_job(0, MEMORY=128, ARCHITECTURE='ARM')
+        self.assertEqual(self.candidate_ids(job), set())
+
+    def test_update_and_forget(self):
+        rand = random.Random(7)
+        res_list = [random_resource(rand, i) for i in range(40)]
+        self.add_resources(res_list)
+        res_ids = self.scheduler.resources.keys()
+        jobs = [random_job(rand, i, res_ids) for i in range(100)]
+        for res_no in range(0, 40, 3):
+            self.scheduler.update_resources(random_resource(rand, res_no))
+        for res_no in range(1, 40, 7):
+            res_id = 'res%d.0_node' % res_no
+            del self.scheduler.resources[res_id]
+            self.scheduler.forget_resource(res_id)
+        for job in jobs:
+            self.check_job(job)
+
+
+class FitCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_funcs = (scheduler.vgrid_access_match,
+                           scheduler.validated_vgrid_list)
+        scheduler.vgrid_access_match = dummy_vgrid_access_match
+        scheduler.validated_vgrid_list = dummy_validated_vgrid_list
+        vgrid_members.clear()
+        vgrid_members.update({'Generic': ['user0', 'user1'],
+                              'vgA': ['user0'], 'vgB': ['user1']})
+        self.configuration = DummyConfiguration()
+        self.scheduler = Scheduler(self.configuration.logger,
+                                   self.configuration)
+        self.spec_checks = []
+        orig_spec = self.scheduler.job_fits_resource_spec
+
+        def counted_spec(job, res):
+            self.spec_checks.append(res['RESOURCE_ID'])
+            return orig_spec(job, res)
+        self.scheduler.job_fits_resource_spec = counted_spec
+
+    def tearDown(self):
+        (scheduler.vgrid_access_match,
+         scheduler.validated_vgrid_list) = self.orig_funcs
+
+    def fit_prices(self, job):
+        """Returns dict mapping fitting resource IDs to resource price"""
+        return dict([(res['RESOURCE_ID'], res_price) for (res, _, res_price)
+                     in self.scheduler.fitting_resources(job)])
+
+    def scan_prices(self, job):
+        """Returns dict mapping resource IDs to resource price for all
+        resources where job fits in a plain scan over all resources.
+        """
+        prices = {}
+        for (res_id, res) in self.scheduler.resources.items():
+            if self.scheduler.job_fits_resource(job, res):
+                prices[res_id] = self.scheduler.current_prices(job, res)[1]
+        return prices
+
+    def check_jobs(self, jobs):
+        """Check that cached fits of jobs match a plain scan"""
+        for job in jobs:
+            self.assertEqual(self.fit_prices(job), self.scan_prices(job))
+
+    def test_random_changes_match_scan(self):
+        rand = random.Random(42)
+        for res_no in range(60):
+            self.scheduler.update_resources(random_resource(rand, res_no))
+        res_ids = self.scheduler.resources.keys()
+        jobs = [random_job(rand, i, res_ids) for i in range(100)]
+        self.check_jobs(jobs)
+        for _ in range(5):
+            for res_no in rand.sample(range(60), 10):
+                self.scheduler.update_resources(random_resource(rand,
+                                                                res_no))
+            for res_id in rand.sample(res_ids, 5):
+                res = self.scheduler.resources[res_id]
+                res['MINPRICE'] = str(rand.randint(1, 5))
+                self.scheduler.touch_resource(res)
+            vgrid_members['vgA'] = rand.sample(['user0', 'user1'],
+                                               rand.randint(0, 2))
+            self.check_jobs(jobs)
+
+    def test_only_changed_resources_checked(self):
+        for res_no in range(3):
+            self.scheduler.update_resources(make_resource(res_no))
+        job = make_job(0)
+        self.assertEqual(len(self.fit_prices(job)), 3)
+        del self.spec_checks[:]
+        self.assertEqual(len(self.fit_prices(job)), 3)
+        self.assertEqual(self.spec_checks, [])
+        self.scheduler.update_resources(make_resource(1, MEMORY=64))
+        self.assertEqual(sorted(self.fit_prices(job).keys()),
+                         ['res0.0_node', 'res2.0_node'])
+        self.assertEqual(self.spec_checks, [])
+        self.scheduler.update_resources(make_resource(1))
+        self.assertEqual(len(self.fit_prices(job)), 3)
+        self.assertEqual(self.spec_checks, ['res1.0_node'])
+
+    def test_touch_resource_updates_price(self):
+        for res_no in range(2):
+            self.scheduler.update_resources(make_resource(res_no))
+        job = make_job(0)
+        old_prices = self.fit_prices(job)
+        res = self.scheduler.resources['res0.0_node']
+        res['MINPRICE'] = '3'
+        self.scheduler.touch_resource(res)
+        del self.spec_checks[:]
+        new_prices = self.fit_prices(job)
+        self.assertEqual(self.spec_checks, ['res0.0_node'])
+        self.assertEqual(new_prices['res0.0_node'],
+                         3 * old_prices['res0.0_node'])
+        self.assertEqual(new_prices['res1.0_node'],
+                         old_prices['res1.0_node'])
+        self.assertEqual(new_prices, self.scan_prices(job))
+
+    def test_vgrid_membership_change(self):
+        self.scheduler.update_resources(make_resource(0, VGRID=['vgA']))
+        self.scheduler.update_resources(make_resource(1))
+        job = make_job(0, VGRID=['vgA', 'Generic'])
+        self.assertEqual(sorted(self.fit_prices(job).keys()),
+                         ['res0.0_node', 'res1.0_node'])
+        vgrid_members['vgA'] = []
+        self.assertEqual(self.fit_prices(job).keys(), ['res1.0_node'])
+        self.assertEqual(self.fit_prices(job), self.scan_prices(job))
+        vgrid_members['vgA'] = ['user0']
+        vgrid_members['Generic'] = []
+        self.assertEqual(self.fit_prices(job).keys(), ['res0.0_node'])
+        self.assertEqual(self.fit_prices(job), self.scan_prices(job))
+
+
+if __name__ == '__main__':
+    unittest.main()
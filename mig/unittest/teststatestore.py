@@ -0,0 +1,157 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# --- BEGIN_HEADER ---
+#
+# teststatestore - Set of unit tests for the grid daemon state store
+# Copyright (C) 2010-2020  The MiG Project lead by Brian Vinter
+#
+# This file is part of MiG.
+#
+# MiG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# MiG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# -- END_HEADER ---
+#
+
+
+"""Unit tests for the grid daemon state store"""
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import shared.griddaemons.statestore as statestore
+from shared.griddaemons.statestore import MemoryStore, open_state, \
+    snapshot_state, state_store_authkey
+
+
+def add_hit(value, amount):
+    """Update function adding amount to a list of hits"""
+    hits = (value or []) + [amount]
+    return (hits, len(hits))
+
+
+def drop_hit(value, amount):
+    """Update function removing amount from a list of hits"""
+    hits = [i for i in value if i != amount]
+    return (hits or None, len(hits))
+
+
+class DummyConfiguration(object):
+    """Minimal configuration with just the values used by the state store"""
+
+    def __init__(self, run_dir):
+        self.mig_system_run = run_dir
+        self.user_state_snapshot = 0
+        self.user_state_store = ''
+        self.logger = logging.getLogger('teststatestore')
+        self.logger.addHandler(logging.NullHandler())
+
+
+class MemoryStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemoryStore()
+
+    def test_set_get_delete(self):
+        self.assertFalse(self.store.is_loaded('ns'))
+        self.assertEqual(self.store.get('ns', 'key', 'default'), 'default')
+        self.store.set('ns', 'key', 'value')
+        self.assertTrue(self.store.is_loaded('ns'))
+        self.assertEqual(self.store.get('ns', 'key'), 'value')
+        self.assertEqual(self.store.items('ns'), [('key', 'value')])
+        self.assertEqual(self.store.delete('ns', 'key'), 'value')
+        self.assertEqual(self.store.get('ns', 'key'), None)
+        self.assertEqual(self.store.get('other', 'key'), None)
+
+    def test_load_only_once(self):
+        self.assertTrue(self.store.load('ns', {'key': 1}))
+        self.assertFalse(self.store.load('ns', {'key': 2}))
+        self.assertEqual(self.store.get('ns', 'key'), 1)
+
+    def test_incr_and_update(self):
+        self.assertEqual(self.store.incr('ns', 'count'), 1)
+        self.assertEqual(self.store.incr('ns', 'count', 5), 6)
+        self.assertEqual(self.store.update('hits', 'a', add_hit, (1, )), 1)
+        self.assertEqual(self.store.update('hits', 'a', add_hit, (2, )), 2)
+        self.assertEqual(self.store.update('hits', 'b', add_hit, (1, )), 1)
+        self.assertEqual(self.store.get('hits', 'a'), [1, 2])
+        self.assertEqual(self.store.update_all('hits', drop_hit, (1, )),
+                         {'a': 1, 'b': 0})
+        # A new value of None removes the entry
+        self.assertEqual(self.store.items('hits'), [('a', [2])])
+
+    def test_ttl_expiry(self):
+        self.store.set('ns', 'short', 1, ttl=-1)
+        self.store.set('ns', 'long', 2, ttl=60)
+        self.store.incr('ns', 'count', ttl=-1)
+        self.assertEqual(self.store.get('ns', 'short'), None)
+        self.assertEqual(self.store.items('ns'), [('long', 2)])
+        self.assertEqual(self.store.expire(), 1)
+        self.assertEqual(self.store.expire(), 0)
+        self.assertEqual(self.store.snapshot('ns')[1], {'long': 2})
+
+    def test_snapshot_version(self):
+        (version, entries) = self.store.snapshot('ns')
+        self.assertEqual(entries, {})
+        self.store.set('ns', 'key', [1])
+        (new_version, entries) = self.store.snapshot('ns')
+        self.assertTrue(new_version > version)
+        entries['key'].append(2)
+        self.assertEqual(self.store.get('ns', 'key'), [1])
+        self.store.clear('ns')
+        self.assertEqual(self.store.items('ns'), [])
+        self.assertTrue(self.store.snapshot('ns')[0] > new_version)
+
+
+class StateSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='teststatestore-')
+        self.configuration = DummyConfiguration(self.tmp_dir)
+        statestore._store = None
+        statestore._last_snapshot.clear()
+
+    def tearDown(self):
+        statestore._store = None
+        statestore._last_snapshot.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_snapshot_round_trip(self):
+        store = open_state(self.configuration, 'sessions')
+        store.set('sessions', 'user', {'count': 2})
+        self.assertTrue(snapshot_state(self.configuration, 'sessions'))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir,
+                                                    'sessions')))
+        statestore._store = None
+        store = open_state(self.configuration, 'sessions')
+        self.assertEqual(store.get('sessions', 'user'), {'count': 2})
+
+    def test_authkey_file(self):
+        self.assertRaises(IOError, state_store_authkey, self.configuration)
+        authkey = state_store_authkey(self.configuration, True)
+        self.assertTrue(len(authkey) >= 32)
+        key_path = os.path.join(self.tmp_dir, 'statestore.key')
+        self.assertEqual(os.stat(key_path).st_mode & 0777, 0600)
+        self.assertEqual(state_store_authkey(self.configuration), authkey)
+        self.assertEqual(state_store_authkey(self.configuration, True),
+                         authkey)
+
+
+if __name__ == '__main__':
+    unittest.main()
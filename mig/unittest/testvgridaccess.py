@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# --- BEGIN_HEADER ---
+#
+# testvgridaccess - Set of unit tests for the sharded entity maps
+# Copyright (C) 2010-2020  The MiG Project lead by Brian Vinter
+#
+# This file is part of MiG.
+#
+# MiG is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# MiG is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# -- END_HEADER ---
+#
+
+
+"""Unit tests for the sharded entity maps and their change log"""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from shared.modified import check_users_modified, mark_user_modified
+from shared.serial import dump
+import shared.vgridaccess as vgridaccess
+from shared.vgridaccess import ALL_SHARDS, MAP_SHARDS, RESOURCES, USERS, \
+    VGRIDS, changed_map_shards, entity_map_paths, entity_shard, \
+    load_entity_map, log_map_changes, map_cache_key, save_entity_map
+
+
+class DummyConfiguration(object):
+    """Minimal configuration with just the values used by the map helpers"""
+
+    def __init__(self, system_files):
+        self.mig_system_files = system_files
+        self.logger = logging.getLogger('testvgridaccess')
+        self.logger.addHandler(logging.NullHandler())
+
+
+class ShardedEntityMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='testvgridaccess-')
+        self.configuration = DummyConfiguration(self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_full_save_and_load(self):
+        user_map = dict([('user%d' % i, {'value': i}) for i in range(200)])
+        save_entity_map(self.configuration, 'user', user_map,
+                        [(None, i) for i in user_map], 1000.0, True)
+        (shard_dir, changes_path) = entity_map_paths(self.configuration,
+                                                     'user')[2:]
+        self.assertEqual(len(os.listdir(shard_dir)), MAP_SHARDS)
+        (loaded, stamp) = load_entity_map(self.configuration, 'user', True)
+        self.assertEqual(loaded, user_map)
+        self.assertEqual(stamp, 1000.0)
+        self.assertEqual(changed_map_shards(changes_path, 999.0), None)
+
+    def test_incremental_load(self):
+        vgrid_map = {USERS: dict([('user%d' % i, {'value': i}) for i in
+                                  range(100)]),
+                     RESOURCES: {'res': {'value': 0}},
+                     VGRIDS: {'Generic': {'value': 0}}}
+        save_entity_map(self.configuration, 'vgrid', vgrid_map, [], 1000.0,
+                        True)
+        (base_map, base_stamp) = load_entity_map(self.configuration,
+                                                 'vgrid', True)
+        vgrid_map[USERS]['user7'] = {'value': 42}
+        del vgrid_map[USERS]['user8']
+        dirty = [(USERS, 'user7'), (USERS, 'user8')]
+        save_entity_map(self.configuration, 'vgrid', vgrid_map, dirty,
+                        1001.0)
+        changes_path = entity_map_paths(self.configuration, 'vgrid')[3]
+        self.assertEqual(changed_map_shards(changes_path, base_stamp),
+                         set([entity_shard('user7'), entity_shard('user8')]))
+        (loaded, stamp) = load_entity_map(self.configuration, 'vgrid', True,
+                                          base_map, base_stamp)
+        self.assertEqual(loaded, vgrid_map)
+        self.assertEqual(stamp, 1001.0)
+        # Entries in untouched shards are reused from the base map
+        changed = (entity_shard('user7'), entity_shard('user8'))
+        for name in [i for i in vgrid_map[USERS] if not entity_shard(i) in
+                     changed]:
+            self.assertTrue(loaded[USERS][name] is base_map[USERS][name])
+
+    def test_change_log_collapse(self):
+        changes_path = entity_map_paths(self.configuration, 'user')[3]
+        limit = vgridaccess.MAP_CHANGES_LIMIT
+        for i in range(limit + 1):
+            log_map_changes(changes_path, 1000.0 + i, set([i % MAP_SHARDS]))
+        log_lines = open(changes_path).readlines()
+        self.assertTrue(len(log_lines) <= limit)
+        self.assertTrue(log_lines[0].split()[1] == ALL_SHARDS)
+        # Stamps before the collapsed entry are no longer covered
+        self.assertEqual(changed_map_shards(changes_path, 1000.0), None)
+        last_stamp = 1000.0 + limit
+        self.assertEqual(changed_map_shards(changes_path, last_stamp - 1),
+                         set([limit % MAP_SHARDS]))
+        self.assertEqual(changed_map_shards(changes_path, last_stamp), set())
+
+    def test_missing_shard_forces_rebuild(self):
+        user_map = dict([('user%d' % i, {'value': i}) for i in range(50)])
+        save_entity_map(self.configuration, 'user', user_map, [], 1000.0,
+                        True)
+        shard_dir = entity_map_paths(self.configuration, 'user')[2]
+        os.remove(os.path.join(shard_dir, "%d" % entity_shard('user3')))
+        (loaded, stamp) = load_entity_map(self.configuration, 'user', True)
+        self.assertEqual(loaded, {})
+        self.assertEqual(stamp, -1)
+        self.assertTrue(check_users_modified(self.configuration)[0])
+        save_entity_map(self.configuration, 'user', user_map, [], 1001.0,
+                        True)
+        (loaded, stamp) = load_entity_map(self.configuration, 'user', True)
+        self.assertEqual(loaded, user_map)
+
+    def test_cache_key_within_mtime_tick(self):
+        save_entity_map(self.configuration, 'user', {}, [], 1000.0, True)
+        modified_path = os.path.join(self.tmp_dir, 'user.modified')
+        mark_user_modified(self.configuration, 'user0')
+        os.utime(modified_path, (1000, 1000))
+        modified_ino = os.stat(modified_path).st_ino
+        cache_key = map_cache_key(self.configuration, 'user')
+        # A mark rewrites the file in place and may keep the same mtime
+        mark_user_modified(self.configuration, 'user1')
+        os.utime(modified_path, (1000, 1000))
+        self.assertEqual(os.stat(modified_path).st_ino, modified_ino)
+        self.assertNotEqual(map_cache_key(self.configuration, 'user'),
+                            cache_key)
+
+    def test_legacy_map_load(self):
+        user_map = {'user0': {'value': 0}}
+        map_path = entity_map_paths(self.configuration, 'user')[0]
+        dump(user_map, map_path)
+        (loaded, _) = load_entity_map(self.configuration, 'user', True)
+        self.assertEqual(loaded, user_map)
+        # Saving converts it to shards with a full write
+        save_entity_map(self.configuration, 'user', user_map,
+                        [(None, 'user0')], 1000.0)
+        shard_dir = entity_map_paths(self.configuration, 'user')[2]
+        self.assertEqual(len(os.listdir(shard_dir)), MAP_SHARDS)
+        (loaded, _) = load_entity_map(self.configuration, 'user', True)
+        self.assertEqual(loaded, user_map)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -39,6 +39,7 @@ from shared.objecttypes import get_object_type_info
 from shared.output import validate, format_output, dummy_main, reject_main
 from shared.safeinput import valid_backend_name, html_escape
 from shared.scriptinput import fieldstorage_to_dict
+from shared.vgridaccess import get_map_cache_stats
 
 
 def object_type_info(object_type):
@@ -116,6 +117,9 @@ def stub(configuration, client_id, import_path, backend, user_arguments_dict,
             {'object_type': 'error_text', 'text':
              'Output validation error! %s' % val_msg})
     after_time = time.time()
+    # NOTE: entity maps and access results stay in memory between requests
+    _logger.debug("%s map cache stats after %s: %s" % (_addr, backend,
+                                                        get_map_cache_stats()))
     output_objects.append({'object_type': 'timing_info', 'text':
                            "done in %.3fs" % (after_time - before_time)})
     return (output_objects, (ret_code, ret_msg))